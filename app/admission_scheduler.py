@@ -0,0 +1,197 @@
+"""
+Admission control for agent runs, shared by the HTTP, SSE and websocket entry points.
+
+- Runs on the same thread_id never overlap: they're admitted one at a time, in arrival order.
+- At most LLAMABOT_MAX_CONCURRENT_RUNS runs execute in the whole process, and at most
+  LLAMABOT_MAX_CONCURRENT_RUNS_PER_TENANT per tenant, so a burst doesn't pile onto the LLM provider.
+- When a slot frees up, threads with waiting runs take turns (round robin), so one busy thread can't starve others.
+- A thread may have LLAMABOT_MAX_QUEUED_PER_THREAD runs waiting; more are rejected straight away, and a run that
+  waits longer than LLAMABOT_ADMISSION_TIMEOUT seconds gives up.
+- Optionally, the admitted run also takes a cross-worker lock on its thread (thread_lock.py), so a thread stays
+  ordered when several processes serve it.
+- A thread's entry is dropped as soon as it has nothing running or waiting, so memory follows the live threads
+  rather than every thread ever seen.
+
+Queue depth, running runs and wait times are reported to the metrics registry (GET /metrics).
+
+Usage:
+
+async with admission_scheduler.admit(thread_id, tenant=tenant):
+    ... run the agent ...
+"""
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional
+import asyncio
+import logging
+import os
+import time
+
+from app.metrics import metrics
+from app.thread_lock import create_thread_lock
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_RUNS = int(os.getenv("LLAMABOT_MAX_CONCURRENT_RUNS", "32"))
+MAX_CONCURRENT_RUNS_PER_TENANT = int(os.getenv("LLAMABOT_MAX_CONCURRENT_RUNS_PER_TENANT", "8")) # 0 means no per-tenant cap
+MAX_QUEUED_PER_THREAD = int(os.getenv("LLAMABOT_MAX_QUEUED_PER_THREAD", "10"))
+ADMISSION_TIMEOUT_SECONDS = float(os.getenv("LLAMABOT_ADMISSION_TIMEOUT", "120"))
+
+
+class AdmissionRejected(Exception):
+    """The run was not admitted: its thread's queue is full, or it waited too long."""
+
+
+@dataclass
+class _Waiter:
+    future: asyncio.Future
+    tenant: Optional[str]
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class _ThreadEntry:
+    running: bool = False
+    waiters: Deque[_Waiter] = field(default_factory=deque)
+
+
+class AdmissionScheduler:
+    def __init__(self, max_concurrent: Optional[int] = None, max_per_tenant: Optional[int] = None,
+                 max_queued_per_thread: Optional[int] = None, timeout: Optional[float] = None, thread_lock=None):
+        self.max_concurrent = max_concurrent if max_concurrent is not None else MAX_CONCURRENT_RUNS
+        self.max_per_tenant = max_per_tenant if max_per_tenant is not None else MAX_CONCURRENT_RUNS_PER_TENANT
+        self.max_queued_per_thread = max_queued_per_thread if max_queued_per_thread is not None else MAX_QUEUED_PER_THREAD
+        self.timeout = timeout if timeout is not None else ADMISSION_TIMEOUT_SECONDS
+        self.thread_lock = thread_lock # picked on first use (see thread_lock.py), once .env has been loaded
+        self.threads: Dict[str, _ThreadEntry] = {}
+        self.running_by_tenant: Dict[Optional[str], int] = {}
+        self.running = 0
+        self._ready: Deque[str] = deque() # threads with waiters and nothing running, in turn order
+
+    @property
+    def queued(self) -> int:
+        return sum(len(entry.waiters) for entry in self.threads.values())
+
+    def is_thread_queue_full(self, thread_id: str) -> bool:
+        entry = self.threads.get(thread_id)
+        return entry is not None and len(entry.waiters) >= self.max_queued_per_thread
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "threads": len(self.threads),
+            "running_by_tenant": {str(tenant): count for tenant, count in self.running_by_tenant.items()},
+        }
+
+    @asynccontextmanager
+    async def admit(self, thread_id: str, tenant: Optional[str] = None, timeout: Optional[float] = None):
+        """Wait for this thread's turn and a free slot, then hold it for the duration of the block."""
+        if self.thread_lock is None:
+            # every admitted run holds one lock connection
+            self.thread_lock = create_thread_lock(pool_size=self.max_concurrent)
+        await self.acquire(thread_id, tenant, timeout)
+        try:
+            # Only one run per thread gets here in this process; this orders it against other workers.
+            async with self.thread_lock.hold(f"{thread_id}"):
+                yield
+        finally:
+            self.release(thread_id, tenant)
+
+    async def acquire(self, thread_id: str, tenant: Optional[str] = None, timeout: Optional[float] = None):
+        thread_id = f"{thread_id}"
+        entry = self.threads.setdefault(thread_id, _ThreadEntry())
+        if len(entry.waiters) >= self.max_queued_per_thread:
+            metrics.increment("admission.rejected")
+            self._forget_if_idle(thread_id)
+            raise AdmissionRejected(f"Too many pending messages on thread {thread_id}")
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), tenant)
+        entry.waiters.append(waiter)
+        if not entry.running and len(entry.waiters) == 1:
+            self._ready.append(thread_id)
+        self._dispatch()
+        self._report()
+
+        timeout = timeout if timeout is not None else self.timeout
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout if timeout > 0 else None)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted just as we gave up: hand the slot straight back.
+                self.release(thread_id, tenant)
+            else:
+                waiter.future.cancel()
+                self._remove_waiter(thread_id, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.increment("admission.timeouts")
+                logger.warning(f"⏳ Run on thread {thread_id} waited {timeout}s for admission, giving up")
+                raise AdmissionRejected(f"Timed out after {timeout}s waiting for thread {thread_id}") from None
+            raise
+        metrics.observe("admission.wait_seconds", time.monotonic() - waiter.enqueued_at)
+
+    def release(self, thread_id: str, tenant: Optional[str] = None):
+        thread_id = f"{thread_id}"
+        entry = self.threads.get(thread_id)
+        if entry is None or not entry.running:
+            return
+        entry.running = False
+        self.running -= 1
+        self.running_by_tenant[tenant] = self.running_by_tenant.get(tenant, 1) - 1
+        if self.running_by_tenant[tenant] <= 0:
+            del self.running_by_tenant[tenant]
+        if entry.waiters:
+            self._ready.append(thread_id) # back of the line, behind the other threads that are waiting
+        else:
+            self._forget_if_idle(thread_id)
+        self._dispatch()
+        self._report()
+
+    def _has_tenant_slot(self, tenant: Optional[str]) -> bool:
+        return self.max_per_tenant <= 0 or tenant is None or self.running_by_tenant.get(tenant, 0) < self.max_per_tenant
+
+    def _dispatch(self):
+        """Admit waiting runs while there are free slots, giving each waiting thread a turn."""
+        for _ in range(len(self._ready)):
+            if self.running >= self.max_concurrent:
+                return
+            thread_id = self._ready.popleft()
+            entry = self.threads.get(thread_id)
+            if entry is None or entry.running or not entry.waiters:
+                continue
+            if not self._has_tenant_slot(entry.waiters[0].tenant):
+                self._ready.append(thread_id) # its tenant is at its cap, let the next thread go
+                continue
+            waiter = entry.waiters.popleft()
+            entry.running = True
+            self.running += 1
+            self.running_by_tenant[waiter.tenant] = self.running_by_tenant.get(waiter.tenant, 0) + 1
+            waiter.future.set_result(None)
+
+    def _remove_waiter(self, thread_id: str, waiter: _Waiter):
+        entry = self.threads.get(thread_id)
+        if entry is None:
+            return
+        try:
+            entry.waiters.remove(waiter)
+        except ValueError:
+            pass
+        if not entry.waiters and thread_id in self._ready:
+            self._ready.remove(thread_id)
+        self._forget_if_idle(thread_id)
+        self._dispatch() # the waiter may have been holding up its thread's turn for a tenant slot
+        self._report()
+
+    def _forget_if_idle(self, thread_id: str):
+        entry = self.threads.get(thread_id)
+        if entry is not None and not entry.running and not entry.waiters:
+            del self.threads[thread_id]
+
+    def _report(self):
+        metrics.set_gauge("admission.running", self.running)
+        metrics.set_gauge("admission.queue_depth", self.queued)
+
+
+# Process-wide: the caps are about what this process sends to the LLM provider, whatever the transport.
+admission_scheduler = AdmissionScheduler()
@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 
-from langchain_openai import ChatOpenAI
+from app.llm_client import get_chat_model
 from langchain.schema import HumanMessage
 from dotenv import load_dotenv
 
@@ -10,7 +10,7 @@ class BaseAgent(ABC):
         self.description = description
 
         load_dotenv()
-        self.llm = ChatOpenAI(model="o4-mini")
+        self.llm = get_chat_model("o4-mini")
 
     @abstractmethod
     def run(self, input: str) -> str:
@@ -18,3 +18,7 @@ class BaseAgent(ABC):
 
     def invoke(self, input: str) -> str:
         return self.llm.invoke(input)
+
+    async def ainvoke(self, input: str) -> str:
+        # Prefer this from async code: cancelling the caller aborts the request to the provider.
+        return await self.llm.ainvoke(input)
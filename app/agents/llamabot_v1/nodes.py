@@ -1,4 +1,5 @@
 from langchain_openai import ChatOpenAI
+from app.llm_client import get_routed_chat_model
 from langchain_ollama import ChatOllama
 
 from langchain_core.tools import tool
@@ -14,20 +15,24 @@ from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 
 from langgraph.graph import START, StateGraph
 from langgraph.prebuilt import tools_condition
-from langgraph.prebuilt import ToolNode, InjectedState
+from langgraph.prebuilt import InjectedState
+from app.tool_execution import BoundedToolNode
 
-import requests
+import httpx
 import json
 from typing import Annotated
 from datetime import datetime
 
+from app.serialization import dumps
+from app.prompt_assembly import assemble_prompt
+
 # Warning: Brittle - None type will break this when it's injected into the state for the tool call, and it silently fails. So if it doesn't map state types properly from the frontend, it will break. (must be exactly what's defined here).
 class LlamaBotState(MessagesState):
     api_token: str
     agent_prompt: str
 
 @tool
-def rails_https_request(route: Optional[str], method: Optional[str], params: Optional[dict], state: Annotated[dict, InjectedState]) -> str:
+async def rails_https_request(route: Optional[str], method: Optional[str], params: Optional[dict], state: Annotated[dict, InjectedState]) -> str:
     """
     Make an HTTP request to the Rails server with robust error handling.
     Returns a JSON string with structured information about the request and response.
@@ -37,11 +42,11 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
     
     RAILS_SERVER_URL = os.getenv("LLAMAPRESS_API_URL")
     if not RAILS_SERVER_URL:
-        return json.dumps({
+        return dumps({
             "success": False,
             "error": "LLAMAPRESS_API_URL environment variable not set",
             "error_type": "configuration_error"
-        }, indent=2)
+        })
     
     # Build the API endpoint
     if route:
@@ -58,20 +63,20 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
     }
     
     try:
-        # Make the HTTP request
-        response = requests.request(
-            method=method or "GET",
-            url=API_ENDPOINT,
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': f'LlamaBot {state.get("api_token")}',
-                'Accept': 'application/json, text/html, text/plain, */*'
-            },
-            json=params if params and method and method.upper() in ['POST', 'PUT', 'PATCH'] else None,
-            params=params if params and method and method.upper() == 'GET' else None,
-            timeout=30,
-            allow_redirects=True
-        )
+        # Make the HTTP request (async, so cancelling the run aborts it instead of leaving it running in a thread)
+        async with httpx.AsyncClient(follow_redirects=True) as client:
+            response = await client.request(
+                method=method or "GET",
+                url=API_ENDPOINT,
+                headers={
+                    'Content-Type': 'application/json',
+                    'Authorization': f'LlamaBot {state.get("api_token")}',
+                    'Accept': 'application/json, text/html, text/plain, */*'
+                },
+                json=params if params and method and method.upper() in ['POST', 'PUT', 'PATCH'] else None,
+                params=params if params and method and method.upper() == 'GET' else None,
+                timeout=30
+            )
         
         # Get response metadata
         content_type = response.headers.get('content-type', '').lower()
@@ -83,13 +88,13 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
             try:
                 # Try to parse as JSON first
                 json_data = response.json()
-                return json.dumps({
+                return dumps({
                     "success": True,
                     "status_code": response.status_code,
                     "content_type": content_type,
                     "data": json_data,
                     "request_info": request_info
-                }, indent=2, default=str)
+                })
                 
             except json.JSONDecodeError:
                 # Not valid JSON, handle based on content type
@@ -104,7 +109,7 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                     else:
                         title = "No title found"
                     
-                    return json.dumps({
+                    return dumps({
                         "success": True,
                         "status_code": response.status_code,
                         "content_type": content_type,
@@ -113,22 +118,22 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                         "html_content": response_text[:1000] + "..." if len(response_text) > 1000 else response_text,
                         "full_html_length": len(response_text),
                         "request_info": request_info
-                    }, indent=2)
+                    })
                     
                 elif 'text' in content_type or 'plain' in content_type:
                     # Plain text response
-                    return json.dumps({
+                    return dumps({
                         "success": True,
                         "status_code": response.status_code,
                         "content_type": content_type,
                         "data_type": "text",
                         "text_content": response_text,
                         "request_info": request_info
-                    }, indent=2)
+                    })
                     
                 else:
                     # Unknown content type
-                    return json.dumps({
+                    return dumps({
                         "success": True,
                         "status_code": response.status_code,
                         "content_type": content_type,
@@ -136,12 +141,12 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                         "raw_content": response_text[:500] + "..." if len(response_text) > 500 else response_text,
                         "content_length": len(response_text),
                         "request_info": request_info
-                    }, indent=2)
+                    })
         
         elif response.status_code >= 300 and response.status_code < 400:
             # Redirection responses
             location = response.headers.get('location', 'Not specified')
-            return json.dumps({
+            return dumps({
                 "success": False,
                 "status_code": response.status_code,
                 "error": f"Redirection to: {location}",
@@ -150,22 +155,22 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                 "content_type": content_type,
                 "response_text": response.text[:500] + "..." if len(response.text) > 500 else response.text,
                 "request_info": request_info
-            }, indent=2)
+            })
             
         elif response.status_code >= 400 and response.status_code < 500:
             # Client error responses
             try:
                 error_data = response.json()
-                return json.dumps({
+                return dumps({
                     "success": False,
                     "status_code": response.status_code,
                     "error": error_data.get('error', f'Client error {response.status_code}'),
                     "error_type": "client_error",
                     "error_data": error_data,
                     "request_info": request_info
-                }, indent=2)
+                })
             except json.JSONDecodeError:
-                return json.dumps({
+                return dumps({
                     "success": False,
                     "status_code": response.status_code,
                     "error": f"Client error {response.status_code}: {response.text[:200]}",
@@ -173,22 +178,22 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                     "content_type": content_type,
                     "response_text": response.text,
                     "request_info": request_info
-                }, indent=2)
+                })
                 
         elif response.status_code >= 500:
             # Server error responses
             try:
                 error_data = response.json()
-                return json.dumps({
+                return dumps({
                     "success": False,
                     "status_code": response.status_code,
                     "error": error_data.get('error', f'Server error {response.status_code}'),
                     "error_type": "server_error",
                     "error_data": error_data,
                     "request_info": request_info
-                }, indent=2)
+                })
             except json.JSONDecodeError:
-                return json.dumps({
+                return dumps({
                     "success": False,
                     "status_code": response.status_code,
                     "error": f"Server error {response.status_code}: {response.text[:200]}",
@@ -196,69 +201,67 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                     "content_type": content_type,
                     "response_text": response.text,
                     "request_info": request_info
-                }, indent=2)
+                })
         
-    except requests.exceptions.ConnectionError as e:
-        return json.dumps({
+    except httpx.ConnectError as e:
+        return dumps({
             "success": False,
             "error": f"Could not connect to Rails server at {API_ENDPOINT}",
             "error_type": "connection_error",
             "error_details": str(e),
             "stack_trace": traceback.format_exc(),
             "request_info": request_info
-        }, indent=2)
+        })
         
-    except requests.exceptions.Timeout as e:
-        return json.dumps({
+    except httpx.TimeoutException as e:
+        return dumps({
             "success": False,
             "error": "Request timed out after 30 seconds",
             "error_type": "timeout_error",
             "error_details": str(e),
             "stack_trace": traceback.format_exc(),
             "request_info": request_info
-        }, indent=2)
+        })
         
-    except requests.exceptions.TooManyRedirects as e:
-        return json.dumps({
+    except httpx.TooManyRedirects as e:
+        return dumps({
             "success": False,
             "error": "Too many redirects",
             "error_type": "redirect_error",
             "error_details": str(e),
             "stack_trace": traceback.format_exc(),
             "request_info": request_info
-        }, indent=2)
+        })
         
-    except requests.exceptions.RequestException as e:
-        return json.dumps({
+    except httpx.RequestError as e:
+        return dumps({
             "success": False,
             "error": f"HTTP request failed: {str(e)}",
             "error_type": "request_error",
             "error_details": str(e),
             "stack_trace": traceback.format_exc(),
             "request_info": request_info
-        }, indent=2)
+        })
         
     except Exception as e:
-        return json.dumps({
+        return dumps({
             "success": False,
             "error": f"Unexpected error: {str(e)}",
             "error_type": "unexpected_error",
             "error_details": str(e),
             "stack_trace": traceback.format_exc(),
             "request_info": request_info
-        }, indent=2)
+        })
 
 # Tools
 @tool
-def run_rails_console_command(rails_console_command: str, message_to_user: str, internal_thoughts: str, state: Annotated[LlamaBotState, InjectedState]) -> str:
+async def run_rails_console_command(rails_console_command: str, message_to_user: str, internal_thoughts: str, state: Annotated[LlamaBotState, InjectedState]) -> str:
     """
     Run a Rails console command.
     Message to user is a string to tell the user what you're doing.
     Internal thoughts are your thoughts about the command.
     State is the state of the agent.
     """
-    print ("API TOKEN", state.get("api_token")) # empty. only messages is getting passed through.
-    
     # Configuration
     RAILS_SERVER_URL = os.getenv("LLAMAPRESS_API_URL")
 
@@ -266,12 +269,13 @@ def run_rails_console_command(rails_console_command: str, message_to_user: str,
     
     try:
         # Make HTTP request to Rails AP
-        response = requests.post(
-            API_ENDPOINT,
-            json={'command': rails_console_command},
-            headers={'Content-Type': 'application/json', 'Authorization': f'LlamaBot {state.get("api_token")}'},
-            timeout=30  # 30 second timeout
-        )
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                API_ENDPOINT,
+                json={'command': rails_console_command},
+                headers={'Content-Type': 'application/json', 'Authorization': f'LlamaBot {state.get("api_token")}'},
+                timeout=30  # 30 second timeout
+            )
         
         # Parse the response
         if response.status_code == 200:
@@ -281,7 +285,7 @@ def run_rails_console_command(rails_console_command: str, message_to_user: str,
             
             # Format the output nicely
             if isinstance(result, (list, dict)):
-                formatted_result = json.dumps(result, indent=2, default=str)
+                formatted_result = dumps(result)
             else:
                 formatted_result = str(result)
             
@@ -293,7 +297,7 @@ def run_rails_console_command(rails_console_command: str, message_to_user: str,
             }
             
             # Serialize to JSON string for safe transmission
-            return json.dumps(result_data, ensure_ascii=False, indent=2)
+            return dumps(result_data)
         elif response.status_code == 403:
             error_data = response.json()
             return f"Error: {error_data.get('error', 'Command not allowed')}"
@@ -305,13 +309,13 @@ def run_rails_console_command(rails_console_command: str, message_to_user: str,
         else:
             return f"HTTP Error {response.status_code}: {response.text}"
             
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         return "Error: Could not connect to Rails server. Make sure your Rails app is running on http://localhost:3000"
         
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         return "Error: Request timed out. The Rails command may be taking too long to execute."
         
-    except requests.exceptions.RequestException as e:
+    except httpx.RequestError as e:
         return f"Request Error: {str(e)}"
         
     except json.JSONDecodeError:
@@ -334,15 +338,17 @@ tools = []
 # tools = []
 
 # Node
-def llamabot(state: LlamaBotState):
+async def llamabot(state: LlamaBotState):
    additional_instructions = state.get("agent_prompt")
 #    breakpoint()
 
-   # System message
-   sys_msg = SystemMessage(content=f"""You are LlamaBot, a helpful AI assistant.
+   # System message: static, so every turn starts with the same prefix (see prompt_assembly.py).
+   sys_msg = """You are LlamaBot, a helpful AI assistant.
                         In normal chat conversations, feel free to implement markdown formatting to make your responses more readable, if it's appropriate.
-                        Here are additional instructions provided by the user: <USER_INSTRUCTIONS> {additional_instructions} </USER_INSTRUCTIONS> 
-                        You can do HTTP requests to the Rails server using the rails_https_request tool and the following routes: <RAILS_ROUTES> {state.get("available_routes")} </RAILS_ROUTES>""")
+                        Follow the additional instructions provided by the user in <USER_INSTRUCTIONS>.
+                        You can do HTTP requests to the Rails server using the rails_https_request tool and the routes in <RAILS_ROUTES>."""
+   user_context = f"""Here are additional instructions provided by the user: <USER_INSTRUCTIONS> {additional_instructions} </USER_INSTRUCTIONS>
+                        <RAILS_ROUTES> {state.get("available_routes")} </RAILS_ROUTES>"""
 
 #    sys_msg = SystemMessage(content=f"""“Leonardo, Business Discovery v1.1”
 
@@ -405,11 +411,12 @@ def llamabot(state: LlamaBotState):
 # """)
 
 #    llm = ChatOpenAI(model="o3-2025-04-16")
-   llm = ChatOpenAI(model="gpt-4o")
+   llm = get_routed_chat_model("llamabot", messages=state["messages"])
 
 
-   llm_with_tools = llm.bind_tools(tools)
-   return {"messages": [llm_with_tools.invoke([sys_msg] + state["messages"])], "created_at": datetime.now()}
+   prompt = assemble_prompt(sys_msg, state["messages"], tools=tools, user_context=user_context, agent="llamabot")
+   llm_with_tools = prompt.bind(llm.bind_tools(tools))
+   return {"messages": [await llm_with_tools.ainvoke(prompt.messages)], "created_at": datetime.now()}
 
 def build_workflow(checkpointer=None):
     # Graph
@@ -417,7 +424,7 @@ def build_workflow(checkpointer=None):
 
     # Define nodes: these do the work
     builder.add_node("llamabot", llamabot)
-    builder.add_node("tools", ToolNode(tools))
+    builder.add_node("tools", BoundedToolNode(tools))
 
     # Define edges: these determine how the control flow moves
     builder.add_edge(START, "llamabot")
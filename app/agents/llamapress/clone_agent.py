@@ -1,4 +1,4 @@
-from langchain_openai import ChatOpenAI
+from app.llm_client import get_routed_chat_model
 from langchain_core.tools import tool
 from dotenv import load_dotenv
 from functools import partial
@@ -28,7 +28,8 @@ from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, Tool
 
 from langgraph.graph import START, END, StateGraph
 from langgraph.prebuilt import tools_condition
-from langgraph.prebuilt import ToolNode, InjectedState
+from langgraph.prebuilt import InjectedState
+from app.tool_execution import BoundedToolNode
 
 
 logger = logging.getLogger(__name__)
@@ -56,7 +57,7 @@ async def write_html_page(
     internal_thoughts are your thoughts about the command.
     """
     # Debug logging
-    logger.info(f"API TOKEN: {state.get('api_token')}")
+    logger.info(f"API token provided: {bool(state.get('api_token'))}")
     logger.info(f"Page ID: {state.get('page_id')}")
     logger.info(
         f"State keys: {list(state.keys()) if isinstance(state, dict) else 'Not a dict'}"
@@ -129,7 +130,7 @@ async def get_screenshot_and_html_content_using_playwright(url: str, state: Anno
     return {'tool_name': 'get_screenshot_and_html_content_using_playwright', 'tool_args': {'url': url, 'image_path': image_path}, 'tool_data': {'trimmed_html_content': trimmed_html_content}}
 
 # Node
-def url_clone_agent(state: MessagesState):
+async def url_clone_agent(state: MessagesState):
    last_message = state.get("messages")[-1]
    if type(last_message) == ToolMessage:
         data = json.loads(last_message.content)
@@ -137,11 +138,11 @@ def url_clone_agent(state: MessagesState):
             # force a tool call to the LLM with write_html_page
             image_path = data.get("tool_args").get("image_path")
             base64_image = encode_image(image_path)
-            llm_forced_tool_call = ChatOpenAI(model="o4-mini").bind_tools([write_html_page], tool_choice="write_html_page")
+            llm_forced_tool_call = get_routed_chat_model("llamapress", "url_clone_agent").bind_tools([write_html_page], tool_choice="write_html_page")
             
             print(f"Making our call to o3 vision right now")
     
-            response = llm_forced_tool_call.invoke([
+            response = await llm_forced_tool_call.ainvoke([
                 SystemMessage(content="""
                     ### SYSTEM
         You are "Pixel-Perfect Front-End", a senior web-platform engineer who specialises in
@@ -207,9 +208,9 @@ def url_clone_agent(state: MessagesState):
         # In the default case force it to call the get_screenshot_and_html_content_using_playwright tool
         # System message
         sys_msg = SystemMessage(content="You are an agent that can 'deep clone' by using playwright to navigate to a URL, take a screenshot of the page, look at the HTML structure, and clone the HTML page out. You have access to the tool `get_screenshot_and_html_content_using_playwright` to do this. If the user requests a deep clone, you should use this tool.")
-        llm = ChatOpenAI(model="o4-mini")
+        llm = get_routed_chat_model("llamapress", "clone_request")
         llm_with_tools = llm.bind_tools(url_clone_tools, tool_choice="get_screenshot_and_html_content_using_playwright")
-        return {"messages": [llm_with_tools.invoke([sys_msg] + state["messages"])]}
+        return {"messages": [await llm_with_tools.ainvoke([sys_msg] + state["messages"])]}
 
 @tool
 def clone_image_tool(image_url: str, state: Annotated[dict, InjectedState]):
@@ -274,11 +275,11 @@ async def image_clone_agent(state: LlamaPressState):
                         base64_image = base64.b64encode(image_data).decode('utf-8')
 
             # base64_image = encode_image(image_data)
-            llm_forced_tool_call = ChatOpenAI(model="o4-mini").bind_tools([write_html_page], tool_choice="write_html_page")
+            llm_forced_tool_call = get_routed_chat_model("llamapress", "image_clone_agent").bind_tools([write_html_page], tool_choice="write_html_page")
             
             print(f"Making our call to o4-mini right now")
     
-            response = llm_forced_tool_call.invoke([
+            response = await llm_forced_tool_call.ainvoke([
                 SystemMessage(content="""
                     ### SYSTEM
         You are "Pixel-Perfect Front-End", a senior web-platform engineer who specialises in
@@ -333,9 +334,9 @@ async def image_clone_agent(state: LlamaPressState):
     )
 
     ##TODO: We need to do a tool call to get the URL, and then pull down the data from the URL, and then pass that into the LLM to clone the image.
-    model = ChatOpenAI(model="gpt-4o")
+    model = get_routed_chat_model("llamapress", "clone_request")
     llm_with_tools = model.bind_tools(image_clone_tools, tool_choice="clone_image_tool") # force the LLM to call the clone_image_tool to get the URL.
-    llm_response_message = llm_with_tools.invoke([SystemMessage(content=system_content)] + state["messages"])
+    llm_response_message = await llm_with_tools.ainvoke([SystemMessage(content=system_content)] + state["messages"])
     llm_response_message.response_metadata["created_at"] = str(datetime.now())
 
     return {"messages": [llm_response_message]}
@@ -353,8 +354,8 @@ def build_workflow(checkpointer=None):
     builder.add_node("url_clone_agent", url_clone_agent)
     builder.add_node("image_clone_agent", image_clone_agent)
     # builder.add_node("html_agent", image_clone_agent)
-    builder.add_node("url_clone_tools", ToolNode(url_clone_tools))
-    builder.add_node("image_clone_tools", ToolNode(image_clone_tools)) #... why does adding this node break the workflow?
+    builder.add_node("url_clone_tools", BoundedToolNode(url_clone_tools))
+    builder.add_node("image_clone_tools", BoundedToolNode(image_clone_tools)) #... why does adding this node break the workflow?
 
     # Define edges: these determine how the control flow moves
     builder.add_edge(START, "router")
@@ -1,4 +1,4 @@
-from langchain_openai import ChatOpenAI
+from app.llm_client import get_routed_chat_model
 from langchain_core.tools import tool
 from dotenv import load_dotenv
 from functools import partial
@@ -7,24 +7,37 @@ import os
 import logging
 import requests
 import json
-from typing import Annotated
+from typing import Annotated, List
 from datetime import datetime
 import httpx
 
+from app.serialization import dumps
+from app.context_window import CHARS_PER_TOKEN, LOW_WATER
+from app.metrics import metrics
+from app.prompt_assembly import assemble_prompt, page_token_budget
+from app.agents.utils.get_numbered_code_from_file import number_lines
+from app.agents.utils.line_edits import LineEdit, LineEditError, apply_line_edits
+from app.agents.utils.html_compaction import HTML_COMPACTION_ENABLED, apply_compacted_line_edits, compact_html, page_placeholders, restore_html
+
 from .helpers import reassemble_fragments
 
 load_dotenv()
 
 from langgraph.graph import MessagesState
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, ToolMessage
 
 from langgraph.graph import START, END, StateGraph
 from langgraph.prebuilt import tools_condition
-from langgraph.prebuilt import ToolNode, InjectedState
+from langgraph.prebuilt import InjectedState
+from app.tool_execution import BoundedToolNode
 
 
 logger = logging.getLogger(__name__)
 
+# "patch": the page is shown with line numbers and edited with edit_html_page_lines (write_html_page stays available
+# as the fallback for rewrites). "full": every edit rewrites the whole document with write_html_page.
+HTML_EDIT_MODE = os.getenv("LLAMABOT_HTML_EDIT_MODE", "patch").lower()
+
 # Warning: Brittle - None type will break this when it's injected into the state for the tool call, and it silently fails. So if it doesn't map state types properly from the frontend, it will break. (must be exactly what's defined here).
 class LlamaPressState(MessagesState):
     api_token: str
@@ -35,7 +48,92 @@ class LlamaPressState(MessagesState):
     javascript_console_errors: Optional[str]
     created_at: Optional[datetime] = datetime.now()
 
+async def put_page_content(api_endpoint: str, api_token: str, html: str) -> httpx.Response:
+    async with httpx.AsyncClient() as client:
+        return await client.put(
+            api_endpoint,
+            json={"content": html},
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"LlamaBot {api_token}",
+            },
+            timeout=30,  # 30 second timeout
+        )
+
+def latest_page_html(state: dict) -> str:
+    """
+    The page as it is now: current_page_html (what the browser sent with the message), or, if the page was already
+    written during this turn, what was written last.
+    """
+    page_html = state.get("current_page_html") or ""
+    written_documents = {}
+    for message in state.get("messages", []):
+        if isinstance(message, HumanMessage):
+            page_html = state.get("current_page_html") or "" # only this turn's writes count
+        elif isinstance(message, AIMessage):
+            for tool_call in message.tool_calls:
+                if tool_call.get("name") == "write_html_page":
+                    written_documents[tool_call.get("id")] = tool_call.get("args", {}).get("full_html_document")
+        elif isinstance(message, ToolMessage):
+            if message.name == "edit_html_page_lines" and isinstance(message.artifact, str):
+                page_html = message.artifact
+            elif message.tool_call_id in written_documents and str(message.content).startswith("{"): # errors are plain strings
+                # the document was written from the compacted page: its placeholders were restored before the PUT
+                page_html = restore_html(written_documents[message.tool_call_id], page_placeholders(page_html))
+    return page_html
+
 # Tools
+@tool(response_format="content_and_artifact")
+async def edit_html_page_lines(
+    edits: List[LineEdit],
+    message_to_user: str,
+    internal_thoughts: str,
+    state: Annotated[dict, InjectedState],
+):
+    """
+    Edit the current HTML page by line ranges, using the line numbers shown in CURRENT_PAGE_HTML.
+    edits is a list of operations, all referring to the line numbers you were shown:
+      - {"op": "replace", "start_line": 12, "end_line": 14, "content": "new lines"} replaces lines 12 to 14
+      - {"op": "delete", "start_line": 12, "end_line": 14} removes lines 12 to 14
+      - {"op": "insert", "start_line": 12, "content": "new lines"} inserts after line 12 (0 inserts at the top)
+    Don't include the line number prefixes in content. Ranges must not overlap. Put every change in one call.
+    message_to_user is a string to tell the user what you're doing.
+    internal_thoughts are your thoughts about the command.
+    """
+    page_id = state.get("page_id")
+    if not page_id:
+        return "Error: page_id is required but not provided in state", None
+    api_token = state.get("api_token")
+    if not api_token:
+        return "Error: api_token is required but not provided in state", None
+
+    try:
+        # The patched page is the tool message's artifact: kept in the thread for the next edit, never sent to the model.
+        # The line numbers the model was shown are those of the compacted page; the edits go to the original lines.
+        page_html = latest_page_html(state)
+        if HTML_COMPACTION_ENABLED:
+            new_html = apply_compacted_line_edits(page_html, compact_html(page_html, report=False), edits)
+        else:
+            new_html = apply_line_edits(page_html, edits)
+    except LineEditError as e:
+        return f"Error: {e}. Nothing was written; fix the edits, or rewrite the page with write_html_page.", None
+
+    logger.info(f"📝 Applying {len(edits)} line edits to page {page_id}")
+    API_ENDPOINT = f"{os.getenv('LLAMAPRESS_API_URL')}/pages/{page_id}.json"
+    try:
+        response = await put_page_content(API_ENDPOINT, api_token, new_html)
+    except httpx.ConnectError:
+        return "Error: Could not connect to Rails server. Make sure your Rails app is running.", None
+    except httpx.TimeoutException:
+        return "Error: Request timed out. The Rails request may be taking too long to execute.", None
+    except httpx.RequestError as e:
+        return f"Request Error: {str(e)}", None
+
+    if response.status_code != 200:
+        return f"HTTP Error {response.status_code}: {response.text}", None
+    result = {'tool_name': 'edit_html_page_lines', 'tool_args': {'edits': [edit.model_dump() for edit in edits], 'message_to_user': message_to_user, 'internal_thoughts': internal_thoughts}, 'line_count': new_html.count("\n") + 1}
+    return dumps(result), new_html
+
 @tool
 async def write_html_page(
     full_html_document: str,
@@ -50,7 +148,7 @@ async def write_html_page(
     internal_thoughts are your thoughts about the command.
     """
     # Debug logging
-    logger.info(f"API TOKEN: {state.get('api_token')}")
+    logger.info(f"API token provided: {bool(state.get('api_token'))}")
     logger.info(f"Page ID: {state.get('page_id')}")
     logger.info(
         f"State keys: {list(state.keys()) if isinstance(state, dict) else 'Not a dict'}"
@@ -73,16 +171,8 @@ async def write_html_page(
         if not api_token:
             return "Error: api_token is required but not provided in state"
 
-        async with httpx.AsyncClient() as client:
-            response = await client.put(
-                API_ENDPOINT,
-                json={"content": full_html_document},
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"LlamaBot {api_token}",
-                },
-                timeout=30,  # 30 second timeout
-            )
+        full_html_document = restore_html(full_html_document, page_placeholders(latest_page_html(state)))
+        response = await put_page_content(API_ENDPOINT, api_token, full_html_document)
 
         # Parse the response
         if response.status_code == 200:
@@ -141,7 +231,7 @@ async def overwrite_html_snippet(new_html_code: str, state: LlamaPressState) ->
 
     if response.status_code == 200:
         data = response.json()
-        return json.dumps(data, ensure_ascii=False, indent=2)
+        return dumps(data)
     else:
         return f"HTTP Error {response.status_code}: {response.text}"
 
@@ -156,24 +246,61 @@ def router_node(state: LlamaPressState):
     return {"next": next_node}
 
 # Node
-def selected_element_agent(state: LlamaPressState):
+async def selected_element_agent(state: LlamaPressState):
     instructions = state.get("agent_prompt", "")
+    # Static, so it's the same prefix every turn (see prompt_assembly.py); the snippet itself goes last.
     system_content = (
-        f"You are given an HTML and Tailwind snippet of code to inspect. Here it is: {state.get('selected_element')}"
+        "You are given an HTML and Tailwind snippet of code to inspect, inside <SELECTED_ELEMENT>."
         "You are able to modify the HTML and Tailwind snippet of code, if the user asks you to by using the tool/function `overwrite_html_snippet`"
         ""
         "You are able to write the new HTML and Tailwind snippet of code to the filesystem, if the user asks you to."
     )
 
-    model = ChatOpenAI(model="gpt-4.1-2025-04-14")
-    llm_with_tools = model.bind_tools([overwrite_html_snippet])
-    llm_response_message = llm_with_tools.invoke([SystemMessage(content=system_content)] + state["messages"])
+    tools = [overwrite_html_snippet]
+    model = get_routed_chat_model("llamapress", "selected_element_agent", state["messages"])
+    prompt = assemble_prompt(system_content, state["messages"], tools=tools,
+                             turn_context=f"<SELECTED_ELEMENT>{state.get('selected_element')}</SELECTED_ELEMENT>",
+                             agent="llamapress", model=model.model_name)
+    llm_with_tools = prompt.bind(model.bind_tools(tools))
+    llm_response_message = await llm_with_tools.ainvoke(prompt.messages)
     llm_response_message.response_metadata["created_at"] = str(datetime.now())
 
     return {"messages": [llm_response_message]}
 
+PATCH_EDIT_INSTRUCTIONS = (
+    " CURRENT_PAGE_HTML is shown with a 5-digit line number in front of each line."
+    " To change part of the page, use `edit_html_page_lines` with line ranges: it is much faster than rewriting the page,"
+    " and the CODE_EXPLANATION comments are only needed around the new code you write."
+    " Only use `write_html_page` to create a new page or to change most of it."
+)
+
+COMPACTION_INSTRUCTIONS = (
+    " In CURRENT_PAGE_HTML, inline assets (data URIs, large SVGs) are replaced by placeholders like __ASSET_0123456789ab__."
+    " Keep the placeholders as they are in the code you write: they are put back when the page is saved."
+)
+
+PARTIAL_PAGE_INSTRUCTIONS = (
+    " The page is too long to show whole: CURRENT_PAGE_HTML only has its first lines. Change it with"
+    " `edit_html_page_lines` on the lines shown; `write_html_page` isn't available, it would lose the rest of the page."
+)
+
+
+def page_head(numbered_page: str, max_tokens: int) -> str:
+    """The first lines of a numbered page that fit in `max_tokens`, and a note saying which lines were left out."""
+    lines = numbered_page.split("\n")
+    room = max(0, max_tokens) * CHARS_PER_TOKEN
+    shown = []
+    for line in lines:
+        room -= len(line) + 1
+        if room < 0:
+            break
+        shown.append(line)
+    shown.append(f"[... lines {len(shown) + 1}-{len(lines)} not shown, the page is too long ...]")
+    return "\n".join(shown)
+
+
 # Node
-def write_html_page_agent(state: LlamaPressState):
+async def write_html_page_agent(state: LlamaPressState):
     # instructions = state.get("agent_prompt", "")
     system_content = (
         f"You are currently viewing an HTML Page and Tailwind CSS full page."
@@ -197,16 +324,40 @@ def write_html_page_agent(state: LlamaPressState):
         "You can also just respond and answer questions, or even ask clarifying questions, etc. Parse the user's intent and make a decision."
     )
 
-    model = ChatOpenAI(model="gpt-4.1-2025-04-14")
-    llm_with_tools = model.bind_tools([write_html_page])
-    llm_response_message = llm_with_tools.invoke([SystemMessage(content=system_content)] + state["messages"] + [SystemMessage(content="<CURRENT_PAGE_HTML>" + state.get("current_page_html") + "</CURRENT_PAGE_HTML>")])
+    # Page HTML ahead of the history, so the prefix up to the last turn is reused while the page is unchanged.
+    page_html = latest_page_html(state)
+    if HTML_COMPACTION_ENABLED:
+        page_html = compact_html(page_html).html
+        system_content += COMPACTION_INSTRUCTIONS
+    model = get_routed_chat_model("llamapress", "write_html_page_agent", state["messages"])
+    # What's left for the page with the longest instructions and every tool: if it doesn't fit whole, the model is
+    # shown its first lines and can only edit them (a rewrite from part of the page would lose the rest).
+    page_budget = page_token_budget(system_content + PATCH_EDIT_INSTRUCTIONS + PARTIAL_PAGE_INSTRUCTIONS, state["messages"],
+                                    tools=[edit_html_page_lines, write_html_page], agent="llamapress", model=model.model_name)
+    numbered_page = number_lines(page_html)
+    if len(numbered_page) // CHARS_PER_TOKEN > page_budget:
+        logger.warning(f"✂️ Page of ~{len(numbered_page) // CHARS_PER_TOKEN} tokens is over its budget of {page_budget}, showing its first lines")
+        metrics.increment("llamapress.page_truncated")
+        system_content += PATCH_EDIT_INSTRUCTIONS + PARTIAL_PAGE_INSTRUCTIONS
+        tools = [edit_html_page_lines]
+        page_html = page_head(numbered_page, int(page_budget * LOW_WATER)) # the rest goes to recent history
+    elif HTML_EDIT_MODE == "patch":
+        system_content += PATCH_EDIT_INSTRUCTIONS
+        tools = [edit_html_page_lines, write_html_page]
+        page_html = numbered_page
+    else:
+        tools = [write_html_page]
+    prompt = assemble_prompt(system_content, state["messages"], tools=tools, page_html=page_html, agent="llamapress",
+                             model=model.model_name)
+    llm_with_tools = prompt.bind(model.bind_tools(tools))
+    llm_response_message = await llm_with_tools.ainvoke(prompt.messages)
     llm_response_message.response_metadata["created_at"] = str(datetime.now())
     # breakpoint()
 
     return {"messages": [llm_response_message]}
 
 # Global tools list
-tools = [write_html_page, overwrite_html_snippet]
+tools = [edit_html_page_lines, write_html_page, overwrite_html_snippet]
 
 def build_workflow(checkpointer=None):
     # Graph
@@ -216,7 +367,7 @@ def build_workflow(checkpointer=None):
     builder.add_node("router", router_node)
     builder.add_node("selected_element_agent", selected_element_agent)
     builder.add_node("write_html_page_agent", write_html_page_agent)
-    builder.add_node("tools", ToolNode(tools))
+    builder.add_node("tools", BoundedToolNode(tools))
 
     # Define edges: these determine how the control flow moves
     builder.add_edge(START, "router")
@@ -1,4 +1,7 @@
 from langchain_openai import ChatOpenAI
+from app.llm_client import get_routed_chat_model, BACKGROUND_PRIORITY
+from app.context_window import fit_history
+from app.prompt_assembly import reserved_tokens
 from langchain_core.tools import tool
 from dotenv import load_dotenv
 from functools import partial
@@ -12,12 +15,15 @@ from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 
 from langgraph.graph import START, StateGraph
 from langgraph.prebuilt import tools_condition
-from langgraph.prebuilt import ToolNode, InjectedState
+from langgraph.prebuilt import InjectedState
+from app.tool_execution import BoundedToolNode
 
-import requests
+import httpx
 import json
 from typing import Annotated
 
+from app.serialization import dumps
+
 # Warning: Brittle - None type will break this when it's injected into the state for the tool call, and it silently fails. So if it doesn't map state types properly from the frontend, it will break. (must be exactly what's defined here).
 class LlamaBotState(MessagesState): 
     api_token: str
@@ -27,15 +33,15 @@ class LlamaBotState(MessagesState):
     sent_to: Optional[str] = None
 
 @tool
-def send_text_message(message: str, state: Annotated[dict, InjectedState]) -> str:
+async def send_text_message(message: str, state: Annotated[dict, InjectedState]) -> str:
     """
     Send an SMS text message to the user.
     """
     send_from = state.get("sent_to") #intentionally swap. We received their message from this number, so we need to send the response to this number.
     send_to = state.get("sent_from") #same as above.
-    return rails_https_request("/messages", "POST", {"message": {"body": message, "sent_to": send_to, "sent_from": send_from}}, state)
+    return await rails_https_request("/messages", "POST", {"message": {"body": message, "sent_to": send_to, "sent_from": send_from}}, state)
 
-def rails_https_request(route: Optional[str], method: Optional[str], params: Optional[dict], state: Annotated[dict, InjectedState]) -> str:
+async def rails_https_request(route: Optional[str], method: Optional[str], params: Optional[dict], state: Annotated[dict, InjectedState]) -> str:
     """
     Make an HTTP request to the Rails server with robust error handling.
     Returns a JSON string with structured information about the request and response.
@@ -45,11 +51,11 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
     
     RAILS_SERVER_URL = os.getenv("LLAMAPRESS_API_URL")
     if not RAILS_SERVER_URL:
-        return json.dumps({
+        return dumps({
             "success": False,
             "error": "LLAMAPRESS_API_URL environment variable not set",
             "error_type": "configuration_error"
-        }, indent=2)
+        })
     
     # Build the API endpoint
     if route:
@@ -66,20 +72,20 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
     }
     
     try:
-        # Make the HTTP request
-        response = requests.request(
-            method=method or "GET",
-            url=API_ENDPOINT,
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': f'LlamaBot {state.get("api_token")}',
-                'Accept': 'application/json, text/html, text/plain, */*'
-            },
-            json=params if params and method and method.upper() in ['POST', 'PUT', 'PATCH'] else None,
-            params=params if params and method and method.upper() == 'GET' else None,
-            timeout=30,
-            allow_redirects=True
-        )
+        # Make the HTTP request (async, so cancelling the run aborts it instead of leaving it running in a thread)
+        async with httpx.AsyncClient(follow_redirects=True) as client:
+            response = await client.request(
+                method=method or "GET",
+                url=API_ENDPOINT,
+                headers={
+                    'Content-Type': 'application/json',
+                    'Authorization': f'LlamaBot {state.get("api_token")}',
+                    'Accept': 'application/json, text/html, text/plain, */*'
+                },
+                json=params if params and method and method.upper() in ['POST', 'PUT', 'PATCH'] else None,
+                params=params if params and method and method.upper() == 'GET' else None,
+                timeout=30
+            )
         
         # Get response metadata
         content_type = response.headers.get('content-type', '').lower()
@@ -91,13 +97,13 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
             try:
                 # Try to parse as JSON first
                 json_data = response.json()
-                return json.dumps({
+                return dumps({
                     "success": True,
                     "status_code": response.status_code,
                     "content_type": content_type,
                     "data": json_data,
                     "request_info": request_info
-                }, indent=2, default=str)
+                })
                 
             except json.JSONDecodeError:
                 # Not valid JSON, handle based on content type
@@ -112,7 +118,7 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                     else:
                         title = "No title found"
                     
-                    return json.dumps({
+                    return dumps({
                         "success": True,
                         "status_code": response.status_code,
                         "content_type": content_type,
@@ -121,22 +127,22 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                         "html_content": response_text[:1000] + "..." if len(response_text) > 1000 else response_text,
                         "full_html_length": len(response_text),
                         "request_info": request_info
-                    }, indent=2)
+                    })
                     
                 elif 'text' in content_type or 'plain' in content_type:
                     # Plain text response
-                    return json.dumps({
+                    return dumps({
                         "success": True,
                         "status_code": response.status_code,
                         "content_type": content_type,
                         "data_type": "text",
                         "text_content": response_text,
                         "request_info": request_info
-                    }, indent=2)
+                    })
                     
                 else:
                     # Unknown content type
-                    return json.dumps({
+                    return dumps({
                         "success": True,
                         "status_code": response.status_code,
                         "content_type": content_type,
@@ -144,12 +150,12 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                         "raw_content": response_text[:500] + "..." if len(response_text) > 500 else response_text,
                         "content_length": len(response_text),
                         "request_info": request_info
-                    }, indent=2)
+                    })
         
         elif response.status_code >= 300 and response.status_code < 400:
             # Redirection responses
             location = response.headers.get('location', 'Not specified')
-            return json.dumps({
+            return dumps({
                 "success": False,
                 "status_code": response.status_code,
                 "error": f"Redirection to: {location}",
@@ -158,22 +164,22 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                 "content_type": content_type,
                 "response_text": response.text[:500] + "..." if len(response.text) > 500 else response.text,
                 "request_info": request_info
-            }, indent=2)
+            })
             
         elif response.status_code >= 400 and response.status_code < 500:
             # Client error responses
             try:
                 error_data = response.json()
-                return json.dumps({
+                return dumps({
                     "success": False,
                     "status_code": response.status_code,
                     "error": error_data.get('error', f'Client error {response.status_code}'),
                     "error_type": "client_error",
                     "error_data": error_data,
                     "request_info": request_info
-                }, indent=2)
+                })
             except json.JSONDecodeError:
-                return json.dumps({
+                return dumps({
                     "success": False,
                     "status_code": response.status_code,
                     "error": f"Client error {response.status_code}: {response.text[:200]}",
@@ -181,22 +187,22 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                     "content_type": content_type,
                     "response_text": response.text,
                     "request_info": request_info
-                }, indent=2)
+                })
                 
         elif response.status_code >= 500:
             # Server error responses
             try:
                 error_data = response.json()
-                return json.dumps({
+                return dumps({
                     "success": False,
                     "status_code": response.status_code,
                     "error": error_data.get('error', f'Server error {response.status_code}'),
                     "error_type": "server_error",
                     "error_data": error_data,
                     "request_info": request_info
-                }, indent=2)
+                })
             except json.JSONDecodeError:
-                return json.dumps({
+                return dumps({
                     "success": False,
                     "status_code": response.status_code,
                     "error": f"Server error {response.status_code}: {response.text[:200]}",
@@ -204,69 +210,67 @@ def rails_https_request(route: Optional[str], method: Optional[str], params: Opt
                     "content_type": content_type,
                     "response_text": response.text,
                     "request_info": request_info
-                }, indent=2)
+                })
         
-    except requests.exceptions.ConnectionError as e:
-        return json.dumps({
+    except httpx.ConnectError as e:
+        return dumps({
             "success": False,
             "error": f"Could not connect to Rails server at {API_ENDPOINT}",
             "error_type": "connection_error",
             "error_details": str(e),
             "stack_trace": traceback.format_exc(),
             "request_info": request_info
-        }, indent=2)
+        })
         
-    except requests.exceptions.Timeout as e:
-        return json.dumps({
+    except httpx.TimeoutException as e:
+        return dumps({
             "success": False,
             "error": "Request timed out after 30 seconds",
             "error_type": "timeout_error",
             "error_details": str(e),
             "stack_trace": traceback.format_exc(),
             "request_info": request_info
-        }, indent=2)
+        })
         
-    except requests.exceptions.TooManyRedirects as e:
-        return json.dumps({
+    except httpx.TooManyRedirects as e:
+        return dumps({
             "success": False,
             "error": "Too many redirects",
             "error_type": "redirect_error",
             "error_details": str(e),
             "stack_trace": traceback.format_exc(),
             "request_info": request_info
-        }, indent=2)
+        })
         
-    except requests.exceptions.RequestException as e:
-        return json.dumps({
+    except httpx.RequestError as e:
+        return dumps({
             "success": False,
             "error": f"HTTP request failed: {str(e)}",
             "error_type": "request_error",
             "error_details": str(e),
             "stack_trace": traceback.format_exc(),
             "request_info": request_info
-        }, indent=2)
+        })
         
     except Exception as e:
-        return json.dumps({
+        return dumps({
             "success": False,
             "error": f"Unexpected error: {str(e)}",
             "error_type": "unexpected_error",
             "error_details": str(e),
             "stack_trace": traceback.format_exc(),
             "request_info": request_info
-        }, indent=2)
+        })
 
 # Tools
 @tool
-def run_rails_console_command(rails_console_command: str, message_to_user: str, internal_thoughts: str, state: Annotated[dict, InjectedState]) -> str:
+async def run_rails_console_command(rails_console_command: str, message_to_user: str, internal_thoughts: str, state: Annotated[dict, InjectedState]) -> str:
     """
     Run a Rails console command.
     Message to user is a string to tell the user what you're doing.
     Internal thoughts are your thoughts about the command.
     State is the state of the agent.
     """
-    print ("API TOKEN", state.get("api_token")) # empty. only messages is getting passed through.
-    
     # Configuration
     RAILS_SERVER_URL = os.getenv("LLAMAPRESS_API_URL")
 
@@ -274,12 +278,13 @@ def run_rails_console_command(rails_console_command: str, message_to_user: str,
     
     try:
         # Make HTTP request to Rails AP
-        response = requests.post(
-            API_ENDPOINT,
-            json={'command': rails_console_command},
-            headers={'Content-Type': 'application/json', 'Authorization': f'LlamaBot {state.get("api_token")}'},
-            timeout=30  # 30 second timeout
-        )
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                API_ENDPOINT,
+                json={'command': rails_console_command},
+                headers={'Content-Type': 'application/json', 'Authorization': f'LlamaBot {state.get("api_token")}'},
+                timeout=30  # 30 second timeout
+            )
         
         # Parse the response
         if response.status_code == 200:
@@ -289,7 +294,7 @@ def run_rails_console_command(rails_console_command: str, message_to_user: str,
             
             # Format the output nicely
             if isinstance(result, (list, dict)):
-                formatted_result = json.dumps(result, indent=2, default=str)
+                formatted_result = dumps(result)
             else:
                 formatted_result = str(result)
             
@@ -301,7 +306,7 @@ def run_rails_console_command(rails_console_command: str, message_to_user: str,
             }
             
             # Serialize to JSON string for safe transmission
-            return json.dumps(result_data, ensure_ascii=False, indent=2)
+            return dumps(result_data)
         elif response.status_code == 403:
             error_data = response.json()
             return f"Error: {error_data.get('error', 'Command not allowed')}"
@@ -313,13 +318,13 @@ def run_rails_console_command(rails_console_command: str, message_to_user: str,
         else:
             return f"HTTP Error {response.status_code}: {response.text}"
             
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         return "Error: Could not connect to Rails server. Make sure your Rails app is running on http://localhost:3000"
         
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         return "Error: Request timed out. The Rails command may be taking too long to execute."
         
-    except requests.exceptions.RequestException as e:
+    except httpx.RequestError as e:
         return f"Request Error: {str(e)}"
         
     except json.JSONDecodeError:
@@ -335,7 +340,7 @@ def run_rails_console_command(rails_console_command: str, message_to_user: str,
 tools = [send_text_message]
 
 # Node
-def public_leonardo(state: LlamaBotState):
+async def public_leonardo(state: LlamaBotState):
    additional_instructions = state.get("agent_prompt")
 
    # System message
@@ -345,12 +350,14 @@ def public_leonardo(state: LlamaBotState):
                         """)
                         # You can do HTTP requests to the Rails server using the rails_https_request tool and the following routes: <RAILS_ROUTES> {state.get("available_routes")} </RAILS_ROUTES>""")
 
-   llm = ChatOpenAI(model="o4-mini")
+   llm = get_routed_chat_model("public_leonardo", messages=state["messages"], priority=BACKGROUND_PRIORITY) # SMS replies: nobody is watching a stream, so interactive runs go first
 #    llm = ChatOpenAI(model="gpt-4.1")
 #    breakpoint()
 
    llm_with_tools = llm.bind_tools(tools)
-   return {"messages": [llm_with_tools.invoke([sys_msg] + state["messages"])]}
+   history = fit_history(state["messages"], reserved_tokens=reserved_tokens([sys_msg], tools), agent="public_leonardo",
+                         model=llm.model_name) # long SMS threads
+   return {"messages": [await llm_with_tools.ainvoke([sys_msg] + history)]}
 
 def build_workflow(checkpointer=None):
     # Graph
@@ -358,7 +365,7 @@ def build_workflow(checkpointer=None):
 
     # Define nodes: these do the work
     builder.add_node("public_leonardo", public_leonardo)
-    builder.add_node("tools", ToolNode(tools))
+    builder.add_node("tools", BoundedToolNode(tools))
 
     # Define edges: these determine how the control flow moves
     builder.add_edge(START, "public_leonardo")
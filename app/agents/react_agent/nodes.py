@@ -1,4 +1,6 @@
-from langchain_openai import ChatOpenAI
+from app.llm_client import get_routed_chat_model
+from app.context_window import fit_history
+from app.prompt_assembly import reserved_tokens
 from langchain_core.tools import tool
 from dotenv import load_dotenv
 load_dotenv()
@@ -8,7 +10,7 @@ from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 
 from langgraph.graph import START, StateGraph
 from langgraph.prebuilt import tools_condition
-from langgraph.prebuilt import ToolNode
+from app.tool_execution import BoundedToolNode
 
 import asyncio
 
@@ -78,10 +80,12 @@ interface transaction {
 }""")
 
 # Node
-def software_developer_assistant(state: MessagesState):
-   llm = ChatOpenAI(model="o4-mini")
+async def software_developer_assistant(state: MessagesState):
+   llm = get_routed_chat_model("software_developer_assistant", messages=state["messages"])
    llm_with_tools = llm.bind_tools(tools)
-   return {"messages": [llm_with_tools.invoke([sys_msg] + state["messages"])]}
+   history = fit_history(state["messages"], reserved_tokens=reserved_tokens([sys_msg], tools),
+                         agent="software_developer_assistant", model=llm.model_name)
+   return {"messages": [await llm_with_tools.ainvoke([sys_msg] + history)]}
 
 
 # //TODO: This is where you'll implement opto logic
@@ -91,7 +95,7 @@ def build_workflow(checkpointer=None):
 
     # Define nodes: these do the work
     builder.add_node("software_developer_assistant", software_developer_assistant)
-    builder.add_node("tools", ToolNode(tools))
+    builder.add_node("tools", BoundedToolNode(tools))
 
     # Define edges: these determine how the control flow moves
     builder.add_edge(START, "software_developer_assistant")
@@ -7,15 +7,19 @@ Usage:
 numbered = get_numbered_code_from_file("page.html")
 print(numbered)
 """
-def get_numbered_code_from_file(file_path: str) -> str:
+def number_lines(code: str) -> str:
     numbered = [
         f"{i:05d}: {ln.rstrip()}"           # 5–6 digits = ≤ 999 999 lines
-        for i, ln in enumerate(open(file_path), 1)
+        for i, ln in enumerate(code.split("\n"), 1) # the numbering apply_line_edits uses (not splitlines: \r, \u2028...)
     ]
     return "\n".join(numbered)
 
+def get_numbered_code_from_file(file_path: str) -> str:
+    with open(file_path) as f:
+        return number_lines(f.read())
+
 # Example Usage:
 # python agents/utils/get_numbered_code_from_file.py
 if __name__ == "__main__":   
     numbered = get_numbered_code_from_file("page.html")
-    print(numbered)
\ No newline at end of file
+    print(numbered)
@@ -0,0 +1,187 @@
+"""
+Compacts a page before it's shown to the model, and restores what the model writes back.
+
+compact_html():
+- large inline <svg> elements, then data URIs, become placeholders (__ASSET_<hash>__, the same for the same asset)
+- comments are dropped (not inside <script>/<style>, where they aren't HTML comments)
+- indentation, trailing whitespace and blank lines are dropped, everywhere but inside <pre> and <textarea>
+
+Every line of the compacted page remembers which lines of the original page it came from (line_map), so line-range
+edits made against the numbered compacted page are applied to the original page (apply_compacted_line_edits): the
+lines the model didn't touch keep their comments and indentation.
+
+restore_html() puts the assets back in place of their placeholders, so pages the model writes in full from the
+compacted view keep their images and icons. Those lose the original comments and indentation: lossless enough.
+
+Usage:
+
+compacted = compact_html(page_html)
+prompt_page = compacted.html
+...
+page_to_write = restore_html(model_output, compacted.placeholders)
+page_to_write = apply_compacted_line_edits(page_html, compacted, edits)
+"""
+from dataclasses import dataclass, field
+from typing import Dict, List, Sequence, Tuple
+import hashlib
+import logging
+import os
+import re
+
+from app.agents.utils.line_edits import LineEdit, apply_line_edits
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+HTML_COMPACTION_ENABLED = os.getenv("LLAMABOT_HTML_COMPACTION", "true").lower() in ("1", "true", "yes")
+HTML_COMPACT_MIN_ASSET_CHARS = int(os.getenv("LLAMABOT_HTML_COMPACT_MIN_ASSET_CHARS", "256"))
+
+CHARS_PER_TOKEN = 4
+
+PLACEHOLDER_PATTERN = re.compile(r"__ASSET_[0-9a-f]{12}__")
+_DATA_URI = re.compile(r"data:[\w.+-]+/[\w.+-]+(?:;[\w=.+-]+)*,[^\"')\s]+")
+_SVG = re.compile(r"<svg\b.*?</svg\s*>", re.IGNORECASE | re.DOTALL)
+_COMMENT = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+# Blocks whose text isn't HTML markup (comments inside them aren't comments), and the ones whose whitespace is content.
+_RAW_BLOCK = re.compile(r"<(script|style|pre|textarea)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_PREFORMATTED = ("pre", "textarea")
+
+LineRange = Tuple[int, int] # first and last line (0-based) of the original page
+
+
+@dataclass
+class CompactedHtml:
+    html: str
+    placeholders: Dict[str, str] = field(default_factory=dict) # placeholder -> original asset
+    line_map: List[LineRange] = field(default_factory=list) # compacted line -> the original lines it came from
+
+
+def _placeholder(asset: str, placeholders: Dict[str, str]) -> str:
+    key = f"__ASSET_{hashlib.blake2b(asset.encode('utf-8'), digest_size=6).hexdigest()}__"
+    placeholders[key] = asset
+    return key
+
+
+def _sub_tracking_lines(pattern: re.Pattern, replace, text: str, origins: List[LineRange]) -> Tuple[str, List[LineRange]]:
+    """
+    pattern.sub(replace, text) for replacements without newlines, keeping origins (the original lines of every line
+    of text) up to date: a match spanning several lines merges them into one.
+    """
+    out, new_origins = [], []
+    pos, line = 0, 0
+    first = origins[0][0]
+
+    def close_lines(segment: str):
+        nonlocal line, first
+        for _ in range(segment.count("\n")):
+            new_origins.append((first, origins[line][1]))
+            line += 1
+            first = origins[line][0]
+
+    for match in pattern.finditer(text):
+        replacement = replace(match)
+        if replacement == match.group(0):
+            continue
+        close_lines(text[pos:match.start()])
+        out.append(text[pos:match.start()])
+        out.append(replacement)
+        line += match.group(0).count("\n")
+        pos = match.end()
+    close_lines(text[pos:])
+    out.append(text[pos:])
+    new_origins.append((first, origins[line][1]))
+    return "".join(out), new_origins
+
+
+def compact_html(html: str, min_asset_chars: int = None, report: bool = True) -> CompactedHtml:
+    """report=False when only recomputing the placeholders of a page already shown to the model."""
+    if not html:
+        return CompactedHtml(html or "", line_map=[(0, 0)])
+    min_asset_chars = HTML_COMPACT_MIN_ASSET_CHARS if min_asset_chars is None else min_asset_chars
+    placeholders: Dict[str, str] = {}
+    origins = [(index, index) for index in range(html.count("\n") + 1)]
+
+    def replace_asset(match: re.Match) -> str:
+        asset = match.group(0)
+        return _placeholder(asset, placeholders) if len(asset) >= min_asset_chars else asset
+
+    # SVGs first: an SVG embedding a data URI goes as a whole, instead of a placeholder inside a placeholder.
+    text, origins = _sub_tracking_lines(_SVG, replace_asset, html, origins)
+    text, origins = _sub_tracking_lines(_DATA_URI, replace_asset, text, origins)
+
+    raw_blocks = [(match.start(), match.end()) for match in _RAW_BLOCK.finditer(text)]
+    text, origins = _sub_tracking_lines(
+        _COMMENT, lambda match: match.group(0) if any(start < match.start() < end for start, end in raw_blocks) else "",
+        text, origins)
+
+    preformatted = [(match.start(), match.end()) for match in _RAW_BLOCK.finditer(text) if match.group(1).lower() in _PREFORMATTED]
+
+    def inside_preformatted(offset: int) -> bool:
+        return any(start < offset < end for start, end in preformatted)
+
+    lines, line_map = [], []
+    offset = 0
+    for line, origin in zip(text.split("\n"), origins):
+        line_start, line_end = offset, offset + len(line)
+        offset = line_end + 1
+        keep_start, keep_end = inside_preformatted(line_start), inside_preformatted(line_end)
+        compacted_line = line if keep_start else line.lstrip()
+        compacted_line = compacted_line if keep_end else compacted_line.rstrip()
+        if compacted_line or keep_start:
+            lines.append(compacted_line)
+            line_map.append(origin)
+    if not lines: # nothing but comments and whitespace: one empty line standing for the whole page
+        lines, line_map = [""], [(0, html.count("\n"))]
+    compacted = "\n".join(lines)
+
+    if report:
+        _report(html, compacted, len(placeholders))
+    return CompactedHtml(compacted, placeholders, line_map)
+
+
+def _report(html: str, compacted: str, assets: int):
+    before, after = len(html) // CHARS_PER_TOKEN, len(compacted) // CHARS_PER_TOKEN
+    metrics.increment("html_compaction.tokens_before", before)
+    metrics.increment("html_compaction.tokens_after", after)
+    logger.info(f"🗜️ Page compacted from ~{before} to ~{after} tokens ({assets} assets replaced)")
+
+
+def restore_html(html: str, placeholders: Dict[str, str]) -> str:
+    """Put the assets back in place of their placeholders. Placeholders we don't know are left as they are."""
+    if not placeholders or not html:
+        return html
+    # An asset could itself contain a placeholder, so go again until nothing known is left.
+    for _ in range(len(placeholders)):
+        restored = PLACEHOLDER_PATTERN.sub(lambda match: placeholders.get(match.group(0), match.group(0)), html)
+        if restored == html:
+            break
+        html = restored
+    return html
+
+
+def page_placeholders(page_html: str) -> Dict[str, str]:
+    """The placeholders the model was shown for this page's assets (same page, same placeholders)."""
+    if not HTML_COMPACTION_ENABLED or not page_html:
+        return {}
+    return compact_html(page_html, report=False).placeholders
+
+
+def apply_compacted_line_edits(page_html: str, compacted: CompactedHtml, edits: Sequence[LineEdit]) -> str:
+    """
+    Apply edits made against the numbered compacted page to the original page. The edits are validated against the
+    compacted page (raising LineEditError with the line numbers the model knows), then moved to the original lines:
+    a replaced or deleted range covers the original lines of its first to last line, an insert goes after the
+    original lines of the line it follows. Everything else stays as it was, comments and indentation included.
+    """
+    apply_line_edits(compacted.html, edits)
+    original_edits = []
+    for edit in edits:
+        content = restore_html(edit.content, compacted.placeholders)
+        if edit.op == "insert":
+            start_line = compacted.line_map[edit.start_line - 1][1] + 1 if edit.start_line else 0
+            original_edits.append(LineEdit(op="insert", start_line=start_line, content=content))
+        else:
+            end_line = edit.end_line if edit.end_line is not None else edit.start_line
+            original_edits.append(LineEdit(op=edit.op, start_line=compacted.line_map[edit.start_line - 1][0] + 1,
+                                           end_line=compacted.line_map[end_line - 1][1] + 1, content=content))
+    return apply_line_edits(page_html, original_edits)
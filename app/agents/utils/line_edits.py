@@ -0,0 +1,75 @@
+"""
+Line-range edits over a document, as a model emits them against a numbered view (see get_numbered_code_from_file).
+
+Every edit refers to the line numbers of the document it's applied to (not to the result of the edits before it),
+so a model can describe several changes to the page it was shown in one go:
+
+- replace: lines start_line..end_line (inclusive) become `content`
+- delete:  lines start_line..end_line are removed
+- insert:  `content` goes after line start_line (0 = before the first line)
+
+Edits are validated before anything is applied: out of range or overlapping edits raise LineEditError, and the
+document is left as it was.
+
+Usage:
+
+apply_line_edits(page_html, [LineEdit(op="replace", start_line=12, end_line=14, content="<h1>Hi</h1>")])
+"""
+from typing import List, Literal, Optional, Sequence
+
+from pydantic import BaseModel, Field
+
+
+class LineEditError(ValueError):
+    pass
+
+
+class LineEdit(BaseModel):
+    op: Literal["replace", "insert", "delete"] = Field(description="replace or delete lines start_line..end_line, or insert after start_line")
+    start_line: int = Field(description="First line of the range (for insert: the line to insert after, 0 for the top)")
+    end_line: Optional[int] = Field(default=None, description="Last line of the range, inclusive (defaults to start_line)")
+    content: str = Field(default="", description="New lines, without line numbers (replace and insert only)")
+
+
+def _strip_line_numbers(content: str) -> List[str]:
+    # Models sometimes copy the "00012: " prefix of the numbered view back into their edits.
+    lines = content.split("\n")
+    if lines and all(len(line) > 6 and line[:5].isdigit() and line[5:7] == ": " for line in lines if line):
+        lines = [line[7:] for line in lines]
+    return lines
+
+
+def apply_line_edits(document: str, edits: Sequence[LineEdit]) -> str:
+    lines = document.split("\n")
+    line_count = len(lines)
+
+    ranges = [] # (start, end) of the replaced/deleted ranges, to check for overlaps
+    for edit in edits:
+        end_line = edit.end_line if edit.end_line is not None else edit.start_line
+        if edit.op == "insert":
+            if not 0 <= edit.start_line <= line_count:
+                raise LineEditError(f"Can't insert after line {edit.start_line}: the page has lines 1-{line_count}")
+        elif not 1 <= edit.start_line <= end_line <= line_count:
+            raise LineEditError(f"Invalid range {edit.start_line}-{end_line} for {edit.op}: the page has lines 1-{line_count}")
+        else:
+            ranges.append((edit.start_line, end_line))
+
+    ranges.sort()
+    for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+        if next_start <= end:
+            raise LineEditError(f"Edits on lines {start}-{end} and {next_start}-{next_end} overlap")
+    for edit in edits:
+        if edit.op == "insert" and any(start <= edit.start_line < end for start, end in ranges):
+            raise LineEditError(f"Insert after line {edit.start_line} falls inside a replaced or deleted range")
+
+    # Bottom up, so each edit's line numbers still point at the original lines. On the same line, inserts (after it)
+    # go before the edit of the line itself, and several inserts end up in the order they were listed.
+    ordered = sorted(enumerate(edits), key=lambda item: (item[1].start_line, item[1].op == "insert", item[0]), reverse=True)
+    for _, edit in ordered:
+        new_lines = _strip_line_numbers(edit.content) if edit.content else []
+        if edit.op == "insert":
+            lines[edit.start_line:edit.start_line] = new_lines
+        else:
+            end_line = edit.end_line if edit.end_line is not None else edit.start_line
+            lines[edit.start_line - 1:end_line] = new_lines if edit.op == "replace" else []
+    return "\n".join(lines)
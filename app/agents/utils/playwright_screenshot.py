@@ -16,19 +16,21 @@ async def capture_page_and_img_src(url: str, image_path: str) -> tuple[str, list
     try:
         async with async_playwright() as p:
             browser = await p.chromium.launch(headless=True)
-            page = await browser.new_page()
+            try:
+                page = await browser.new_page()
 
-            await page.goto(url)
-            await page.screenshot(path=image_path, full_page=True)
-            print(f"Screenshot saved to {image_path}")
+                await page.goto(url)
+                await page.screenshot(path=image_path, full_page=True)
+                print(f"Screenshot saved to {image_path}")
 
-            html = await page.content()
-            
-            image_sources = await page.query_selector_all('img')
-            image_sources = [await img.get_attribute('src') for img in image_sources]
-            print(f"Image sources: {image_sources}")
-
-            await browser.close()
+                html = await page.content()
+                
+                image_sources = await page.query_selector_all('img')
+                image_sources = [await img.get_attribute('src') for img in image_sources]
+                print(f"Image sources: {image_sources}")
+            finally:
+                # Also when the run is cancelled mid-capture, so the browser doesn't outlive it.
+                await asyncio.shield(browser.close())
 
             trimmed_html = trim_html_for_llm(html)
 
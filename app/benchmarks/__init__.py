@@ -0,0 +1 @@
+# Microbenchmarks for streaming hot paths. Run from the repository root, e.g. python -m app.benchmarks.serialization_benchmark
@@ -0,0 +1,74 @@
+"""
+Microbenchmark for JSON encoding on the streaming path: app.serialization vs. the stdlib json module.
+
+Usage (from the repository root):
+
+python -m app.benchmarks.serialization_benchmark
+python -m app.benchmarks.serialization_benchmark --iterations 20000
+"""
+import argparse
+import json
+import timeit
+from datetime import datetime
+
+from langchain_core.load import dumpd
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from app import serialization
+
+
+def build_payloads() -> dict:
+    """Representative payloads: a token frame, a finished message frame, an HTML-heavy tool call and a tool result."""
+    token_chunk = AIMessageChunk(content="Hello", id="run--b6f1c2")
+    html_document = "<!DOCTYPE html><html><head><script src='https://cdn.tailwindcss.com'></script></head><body>" + (
+        "<section class='flex flex-col items-center justify-center p-8 bg-white rounded-lg shadow'>"
+        "<h2 class='text-2xl font-bold text-gray-900'>Section</h2><p class='text-gray-600'>Lorem ipsum dolor sit amet.</p></section>"
+    ) * 200 + "</body></html>"
+    message = AIMessage(
+        content="I've updated your page.",
+        id="run--ce385bc4",
+        tool_calls=[{"name": "write_html_page", "args": {"full_html_document": html_document}, "id": "call_1"}],
+        response_metadata={"finish_reason": "tool_calls", "model_name": "gpt-4.1-2025-04-14", "created_at": str(datetime.now())},
+    )
+    token_frame = {"type": "AIMessageChunk", "content": "Hello", "tool_calls": [], "base_message": dumpd(token_chunk)["kwargs"]}
+    message_frame = {"type": "ai", "content": message.content, "tool_calls": message.tool_calls, "base_message": dumpd(message)["kwargs"]}
+    tool_result = {
+        "success": True,
+        "status_code": 200,
+        "content_type": "application/json",
+        "data": [{"id": i, "name": f"Record {i}", "updated_at": "2025-01-01T00:00:00Z"} for i in range(200)],
+        "request_info": {"method": "GET", "url": "http://localhost:3000/records.json"},
+    }
+    return {"token_frame": token_frame, "message_frame": message_frame, "tool_result": tool_result}
+
+
+def stdlib_frame(payload) -> str:
+    # What Starlette's WebSocket.send_json does.
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+def stdlib_tool_result(payload) -> str:
+    # What the tools used to do.
+    return json.dumps(payload, indent=2, default=str)
+
+
+def run(iterations: int) -> None:
+    payloads = build_payloads()
+    print(f"orjson available: {serialization.ORJSON_AVAILABLE}")
+    print(f"{'payload':<16}{'bytes':>10}{'stdlib us/op':>16}{'fast us/op':>14}{'speedup':>10}")
+    for name, payload in payloads.items():
+        baseline = stdlib_tool_result if name == "tool_result" else stdlib_frame
+        stdlib_seconds = timeit.timeit(lambda: baseline(payload), number=iterations)
+        fast_seconds = timeit.timeit(lambda: serialization.dumps(payload), number=iterations)
+        size = len(serialization.dumpb(payload))
+        print(
+            f"{name:<16}{size:>10}{stdlib_seconds / iterations * 1e6:>16.2f}"
+            f"{fast_seconds / iterations * 1e6:>14.2f}{stdlib_seconds / fast_seconds:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JSON encoding of streaming payloads")
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+    run(args.iterations)
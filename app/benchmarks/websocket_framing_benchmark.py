@@ -0,0 +1,103 @@
+"""
+Bytes on the wire and encoding CPU per agent turn, for each websocket framing mode:
+
+- json:            JSON text frames, no compression
+- json+deflate:    JSON text frames with permessage-deflate (what uvicorn/websockets negotiates with browsers)
+- msgpack:         binary MessagePack frames, compression disabled
+- msgpack+zlib:    binary MessagePack frames, zlib above LLAMABOT_WS_COMPRESS_MIN_BYTES (the "msgpack" encoding's default)
+
+The turn is a write_html_page run: streamed text, a streamed tool call carrying a full HTML page, the
+finished message and the tool result, encoded with both protocol versions.
+
+Usage (from the repository root):
+
+python -m app.benchmarks.websocket_framing_benchmark
+python -m app.benchmarks.websocket_framing_benchmark --iterations 200 --page-sections 400
+"""
+import argparse
+import time
+import zlib
+
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+
+from app.websocket.frame_codec import JsonFrameCodec, MsgpackFrameCodec
+from app.websocket.stream_protocol import LegacyStreamEncoder, DeltaStreamEncoder
+
+
+def build_turn(page_sections: int) -> list:
+    """(kind, message) pairs for one turn: 'chunk' messages are streamed tokens, 'update' ones finished messages."""
+    html_document = "<!DOCTYPE html><html><head><script src='https://cdn.tailwindcss.com'></script></head><body>" + "".join(
+        f"<section class='flex flex-col items-center justify-center p-8 bg-white rounded-lg shadow' id='s{i}'>"
+        f"<h2 class='text-2xl font-bold text-gray-900'>Section {i}</h2><p class='text-gray-600'>Lorem ipsum dolor sit amet.</p></section>"
+        for i in range(page_sections)
+    ) + "</body></html>"
+    args = '{"full_html_document": ' + repr(html_document) + ', "message_to_user": "Updated your page"}'
+
+    turn = []
+    for word in ("Sure", ", I'll", " add", " a", " pricing", " section", " to", " your", " page", "."):
+        turn.append(("chunk", AIMessageChunk(content=word, id="run--1")))
+    # Tool call arguments stream in ~coalesced 1KB pieces.
+    for index, start in enumerate(range(0, len(args), 1024)):
+        tool_call_chunk = {"index": 0, "args": args[start:start + 1024], "id": "call_1" if index == 0 else None,
+                           "name": "write_html_page" if index == 0 else None}
+        turn.append(("chunk", AIMessageChunk(content="", id="run--1", tool_call_chunks=[tool_call_chunk])))
+    turn.append(("update", AIMessage(content="Sure, I'll add a pricing section to your page.", id="run--1", tool_calls=[
+        {"name": "write_html_page", "args": {"full_html_document": html_document, "message_to_user": "Updated your page"}, "id": "call_1"}
+    ])))
+    turn.append(("update", ToolMessage(content="HTML page written successfully", tool_call_id="call_1", id="tool--1")))
+    return turn
+
+
+def build_frames(turn: list, encoder) -> list:
+    frames = []
+    for kind, message in turn:
+        frame = encoder.message_chunk(message, "write_html_page_agent") if kind == "chunk" else \
+            encoder.message_update(message, "write_html_page_agent", getattr(message, "tool_calls", []))
+        if frame is not None:
+            frames.append(frame)
+    return frames
+
+
+def json_deflate_turn(frames: list) -> int:
+    # permessage-deflate with context takeover, as websockets does it: one raw deflate stream per connection,
+    # sync-flushed after every message, with the trailing 00 00 ff ff removed.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    codec = JsonFrameCodec()
+    total = 0
+    for frame in frames:
+        data = compressor.compress(codec.encode(frame).encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        total += len(data) - 4
+    return total
+
+
+def msgpack_zlib_turn(frames: list) -> int:
+    codec = MsgpackFrameCodec() # one per connection, like the real thing
+    return sum(len(codec.encode(frame)) for frame in frames)
+
+
+def run(iterations: int, page_sections: int) -> None:
+    turn = build_turn(page_sections)
+    modes = {
+        "json": lambda frames: sum(len(JsonFrameCodec().encode(frame).encode("utf-8")) for frame in frames),
+        "json+deflate": json_deflate_turn,
+        "msgpack": lambda frames: sum(len(MsgpackFrameCodec(min_bytes=-1).encode(frame)) for frame in frames),
+        "msgpack+zlib": msgpack_zlib_turn,
+    }
+    print(f"{'protocol':<10}{'mode':<14}{'frames':>8}{'bytes/turn':>12}{'cpu us/turn':>14}")
+    for protocol, encoder in (("v1", LegacyStreamEncoder()), ("v2", DeltaStreamEncoder())):
+        frames = build_frames(turn, encoder)
+        for mode, encode_turn in modes.items():
+            size = encode_turn(frames)
+            started = time.process_time()
+            for _ in range(iterations):
+                encode_turn(frames)
+            cpu = (time.process_time() - started) / iterations
+            print(f"{protocol:<10}{mode:<14}{len(frames):>8}{size:>12}{cpu * 1e6:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark websocket frame encodings")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--page-sections", type=int, default=200, help="size of the generated HTML page")
+    args = parser.parse_args()
+    run(args.iterations, args.page_sections)
@@ -0,0 +1,40 @@
+"""
+Cancelling agent runs, and measuring how long they take to actually stop.
+
+task.cancel() only asks: the run stops at its next await. Agent nodes and tools are async all the way down
+(ainvoke on the chat model, httpx for Rails / LlamaPress, async Playwright), so that next await is the in-flight
+provider stream or HTTP request itself, which is aborted on the spot. A node that blocks (a sync .invoke(), a
+`requests` call) would keep the provider generating in a worker thread while the run looks cancelled.
+
+The time from cancel to the task being done is reported as runs.cancel_latency_seconds; a cancel slower than
+LLAMABOT_CANCEL_LATENCY_WARN_SECONDS is logged, since it usually means something blocking crept back in.
+"""
+from typing import Optional
+import asyncio
+import logging
+import os
+import time
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CANCEL_LATENCY_WARN_SECONDS = float(os.getenv("LLAMABOT_CANCEL_LATENCY_WARN_SECONDS", "1"))
+
+
+def cancel_run_task(task: asyncio.Task, run_id: Optional[str] = None, reason: str = "cancel") -> bool:
+    """Cancel a run's task and report how long it takes to stop. Returns False if it was already done."""
+    if task.done():
+        return False
+    requested_at = time.monotonic()
+
+    def stopped(_):
+        latency = time.monotonic() - requested_at
+        metrics.observe("runs.cancel_latency_seconds", latency, reason=reason)
+        if latency > CANCEL_LATENCY_WARN_SECONDS:
+            logger.warning(f"🐢 Run {run_id} took {latency:.2f}s to stop after {reason}, is something blocking the event loop?")
+
+    task.add_done_callback(stopped)
+    task.cancel()
+    metrics.increment("runs.cancelled", reason=reason)
+    return True
@@ -0,0 +1,290 @@
+"""
+Context-window budgeting: what part of a thread's history is sent to the model.
+
+Nodes used to send the whole of state["messages"], so a long page-editing session (every write_html_page call
+carries the full document, and its tool result echoes it back) got slower and more expensive with every turn.
+fit_history() keeps the history under a ceiling, in this order:
+
+1. Superseded page versions: only the latest write_html_page call keeps its document; earlier ones (and the
+   documents echoed in their tool results) are replaced by a short placeholder.
+2. Old turns: outside the most recent `keep_turns` turns, tool-call arguments and tool results longer than
+   `tool_arg_chars` are abbreviated.
+3. Still over budget: the oldest turns are dropped, whole, down to LOW_WATER of the budget (so the prefix then
+   stays put for a few turns, which keeps provider prompt caching useful; see prompt_assembly.py).
+4. Still over budget (one enormous turn): everything in what's left is abbreviated, then the longest messages are
+   cut. Once there's no content left to cut (a message that is all per-call overhead, e.g. thousands of small tool
+   calls), tool calls are collapsed along with their results, then the oldest messages are dropped.
+
+The latest human message (the request being answered) is never cut or dropped. So the result is under the ceiling
+unless the rest of the prompt (reserved_tokens) and that message alone are over it: then only that message is left,
+and context.budget_exceeded is counted. It's up to the caller to keep the rest of the prompt in bounds (the HTML
+agent shows part of an oversized page, see html_agent.py).
+
+The ceiling is the routed model's context window minus CONTEXT_OUTPUT_TOKENS for the reply (MODEL_CONTEXT_WINDOWS,
+by model name prefix), lowered by LLAMABOT_CONTEXT_MAX_TOKENS or a per-agent policy.
+
+A turn starts at a human message, and turns are only ever dropped whole, so an AI message with tool calls always
+travels with its tool results (the API rejects one without the other). The state itself is never changed:
+the checkpoint keeps the full history.
+
+The "old" boundary moves `keep_turns` turns at a time rather than every turn, for the same caching reason: between
+keep_turns and 2 * keep_turns recent turns are sent verbatim.
+
+Defaults come from LLAMABOT_CONTEXT_MAX_TOKENS (unset: the model's ceiling) / LLAMABOT_CONTEXT_KEEP_TURNS /
+LLAMABOT_CONTEXT_TOOL_ARG_CHARS, per agent overrides from LLAMABOT_CONTEXT_POLICIES, e.g. "llamapress=40000/4,public_leonardo=20000/10"
+(max tokens / turns kept verbatim).
+"""
+from dataclasses import dataclass, replace
+from typing import Any, Dict, List, Optional, Sequence
+import logging
+import os
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+
+from app.metrics import metrics
+from app.serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4 # role, separators, tool call ids...
+
+CONTEXT_MAX_TOKENS = int(os.getenv("LLAMABOT_CONTEXT_MAX_TOKENS", "0") or 0) # 0: the routed model's ceiling
+CONTEXT_KEEP_TURNS = int(os.getenv("LLAMABOT_CONTEXT_KEEP_TURNS", "6"))
+CONTEXT_TOOL_ARG_CHARS = int(os.getenv("LLAMABOT_CONTEXT_TOOL_ARG_CHARS", "500"))
+CONTEXT_POLICIES = os.getenv("LLAMABOT_CONTEXT_POLICIES", "")
+
+LOW_WATER = 0.75
+# Context windows by model name prefix (the longest matching prefix wins), and what's kept free for the reply.
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4.1": 1047576,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-3.5-turbo": 16385,
+    "o1": 200000,
+    "o3": 200000,
+    "o4-mini": 200000,
+}
+DEFAULT_MODEL_CONTEXT_WINDOW = 128000
+CONTEXT_OUTPUT_TOKENS = 16384
+# Tool calls whose argument is a whole page: only the latest one matters.
+PAGE_VERSION_TOOLS = {"write_html_page": "full_html_document"}
+
+
+def model_context_ceiling(model: Optional[str] = None) -> int:
+    """Tokens a prompt may take with `model`: its context window, less room for the reply."""
+    name = model if isinstance(model, str) else ""
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if name.startswith(prefix)]
+    window = MODEL_CONTEXT_WINDOWS[max(matches, key=len)] if matches else DEFAULT_MODEL_CONTEXT_WINDOW
+    return window - min(CONTEXT_OUTPUT_TOKENS, window // 4)
+
+
+@dataclass(frozen=True)
+class ContextPolicy:
+    max_tokens: int = CONTEXT_MAX_TOKENS or model_context_ceiling()
+    keep_turns: int = CONTEXT_KEEP_TURNS
+    tool_arg_chars: int = CONTEXT_TOOL_ARG_CHARS
+
+
+def parse_context_policies(value: str) -> Dict[str, ContextPolicy]:
+    """Parse "agent=max_tokens/keep_turns,..." into {agent: ContextPolicy}, ignoring malformed entries."""
+    policies = {}
+    for entry in value.split(","):
+        if "=" not in entry or "/" not in entry:
+            continue
+        agent, budget = entry.split("=", 1)
+        max_tokens, keep_turns = budget.split("/", 1)
+        try:
+            policies[agent.strip()] = ContextPolicy(max_tokens=int(max_tokens), keep_turns=int(keep_turns))
+        except ValueError:
+            continue
+    return policies
+
+
+_policies = parse_context_policies(CONTEXT_POLICIES)
+
+
+def get_context_policy(agent: Optional[str] = None, model: Optional[str] = None) -> ContextPolicy:
+    """The agent's policy (or the defaults), with its ceiling capped at what `model` takes."""
+    ceiling = model_context_ceiling(model)
+    policy = _policies.get(agent or "")
+    if policy is None:
+        return ContextPolicy(max_tokens=min(CONTEXT_MAX_TOKENS or ceiling, ceiling))
+    return replace(policy, max_tokens=min(policy.max_tokens, ceiling))
+
+
+def _content_chars(content: Any) -> int:
+    return len(content) if isinstance(content, str) else len(dumps(content))
+
+
+def estimate_message_tokens(message: BaseMessage) -> int:
+    """~4 characters per token, counting tool-call arguments (where a written page lives) as well as the content."""
+    chars = _content_chars(message.content)
+    for tool_call in getattr(message, "tool_calls", None) or []:
+        chars += len(tool_call.get("name") or "") + len(dumps(tool_call.get("args") or {}))
+    return chars // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+
+
+def estimate_history_tokens(messages: Sequence[BaseMessage]) -> int:
+    return sum(estimate_message_tokens(message) for message in messages)
+
+
+def _abbreviate(text: str, limit: int, label: str = "omitted") -> str:
+    if len(text) <= limit:
+        return text
+    head = max(0, limit // 2)
+    return f"{text[:head]} [... {len(text) - head} chars {label} ...]"
+
+
+def _abbreviate_args(args: dict, limit: int) -> dict:
+    return {key: _abbreviate(value, limit) if isinstance(value, str) else value for key, value in args.items()}
+
+
+def _with_tool_calls(message: AIMessage, tool_calls: list) -> AIMessage:
+    # The raw OpenAI tool calls in additional_kwargs would carry the old arguments along; tool_calls is what's sent.
+    additional_kwargs = {key: value for key, value in message.additional_kwargs.items() if key != "tool_calls"}
+    return message.model_copy(update={"tool_calls": tool_calls, "additional_kwargs": additional_kwargs})
+
+
+def _abbreviate_message(message: BaseMessage, limit: int) -> BaseMessage:
+    if isinstance(message, AIMessage) and message.tool_calls:
+        tool_calls = [{**call, "args": _abbreviate_args(call.get("args") or {}, limit)} for call in message.tool_calls]
+        if tool_calls != message.tool_calls:
+            return _with_tool_calls(message, tool_calls)
+        return message
+    if isinstance(message, ToolMessage) and isinstance(message.content, str) and len(message.content) > limit:
+        return message.model_copy(update={"content": _abbreviate(message.content, limit)})
+    return message
+
+
+def _strip_superseded_pages(messages: List[BaseMessage]) -> List[BaseMessage]:
+    """Replace every page version but the latest one (in calls and their echoed results) by a placeholder."""
+    latest_call_id = None
+    superseded_ids = set()
+    for message in messages:
+        for call in getattr(message, "tool_calls", None) or []:
+            if call.get("name") in PAGE_VERSION_TOOLS:
+                if latest_call_id is not None:
+                    superseded_ids.add(latest_call_id)
+                latest_call_id = call.get("id")
+    if not superseded_ids:
+        return messages
+
+    stripped = []
+    for message in messages:
+        if isinstance(message, AIMessage) and any(call.get("id") in superseded_ids for call in message.tool_calls):
+            tool_calls = []
+            for call in message.tool_calls:
+                argument = PAGE_VERSION_TOOLS.get(call.get("name"))
+                if call.get("id") in superseded_ids and argument in (call.get("args") or {}):
+                    size = len(call["args"][argument])
+                    call = {**call, "args": {**call["args"], argument: f"[superseded page version, {size} chars omitted]"}}
+                tool_calls.append(call)
+            message = _with_tool_calls(message, tool_calls)
+        elif isinstance(message, ToolMessage) and message.tool_call_id in superseded_ids:
+            message = message.model_copy(update={"content": "[superseded page version omitted]"})
+        stripped.append(message)
+    return stripped
+
+
+def split_turns(messages: Sequence[BaseMessage]) -> List[List[BaseMessage]]:
+    """Group messages into turns, each starting at a human message (whatever comes before the first one is a turn too)."""
+    turns: List[List[BaseMessage]] = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def latest_human_message(messages: Sequence[BaseMessage]) -> Optional[BaseMessage]:
+    return next((message for message in reversed(messages) if isinstance(message, HumanMessage)), None)
+
+
+def _drop_overhead(messages: List[BaseMessage], keep: Optional[BaseMessage]) -> List[BaseMessage]:
+    """
+    No content left to cut: collapse the biggest message's tool calls (and drop their results, so no result is left
+    without its call), or if it has none, drop the oldest message but `keep` (and the results that followed it).
+    """
+    index = max((i for i in range(len(messages)) if messages[i] is not keep),
+                key=lambda i: estimate_message_tokens(messages[i]))
+    message = messages[index]
+    if isinstance(message, AIMessage) and message.tool_calls:
+        call_ids = {call.get("id") for call in message.tool_calls}
+        collapsed = _with_tool_calls(message, []).model_copy(
+            update={"content": f"[{len(call_ids)} tool calls and their results omitted]"})
+        return [collapsed if i == index else other for i, other in enumerate(messages)
+                if not (isinstance(other, ToolMessage) and other.tool_call_id in call_ids)]
+    oldest = next(i for i in range(len(messages)) if messages[i] is not keep)
+    end = oldest + 1
+    while end < len(messages) and isinstance(messages[end], ToolMessage):
+        end += 1
+    return messages[:oldest] + messages[end:]
+
+
+def _truncate_to_fit(messages: List[BaseMessage], budget: int) -> List[BaseMessage]:
+    """
+    Last resort: cut the longest message contents until the history fits, then drop what can't be cut.
+    The latest human message is left as it is, even if the history can't fit without cutting it.
+    """
+    messages = list(messages)
+    keep = latest_human_message(messages)
+    while estimate_history_tokens(messages) > budget and any(message is not keep for message in messages):
+        index = max((i for i in range(len(messages)) if messages[i] is not keep),
+                    key=lambda i: estimate_message_tokens(messages[i]))
+        message = messages[index]
+        excess_chars = (estimate_history_tokens(messages) - budget) * CHARS_PER_TOKEN
+        content = message.content if isinstance(message.content, str) else dumps(message.content)
+        limit = max(0, len(content) - excess_chars - 64)
+        if isinstance(message, AIMessage) and message.tool_calls:
+            message = _abbreviate_message(message, 0)
+            if estimate_message_tokens(message) >= estimate_message_tokens(messages[index]):
+                message = message.model_copy(update={"content": _abbreviate(content, limit, "cut")})
+        else:
+            message = message.model_copy(update={"content": _abbreviate(content, limit, "cut")})
+        if estimate_message_tokens(message) >= estimate_message_tokens(messages[index]):
+            messages = _drop_overhead(messages, keep) # nothing left to cut in it (only overhead)
+            continue
+        messages[index] = message
+    return messages
+
+
+def fit_history(messages: Sequence[BaseMessage], policy: Optional[ContextPolicy] = None, reserved_tokens: int = 0,
+                agent: Optional[str] = None, model: Optional[str] = None) -> List[BaseMessage]:
+    """
+    The part of `messages` to send, estimated at no more than the ceiling (the policy's, or the agent's for `model`)
+    less reserved_tokens (what the rest of the prompt takes), short of cutting the latest human message.
+    """
+    policy = policy or get_context_policy(agent, model)
+    budget = policy.max_tokens - reserved_tokens
+    original_tokens = estimate_history_tokens(messages)
+    messages = _strip_superseded_pages(list(messages))
+
+    turns = split_turns(messages)
+    keep = max(1, policy.keep_turns)
+    old_count = ((len(turns) - keep) // keep) * keep if len(turns) > keep else 0
+    turns = [[_abbreviate_message(message, policy.tool_arg_chars) for message in turn] if index < old_count else turn
+             for index, turn in enumerate(turns)]
+
+    tokens = sum(estimate_history_tokens(turn) for turn in turns)
+    if tokens > budget:
+        low_water = int(budget * LOW_WATER)
+        while len(turns) > 1 and tokens > low_water:
+            tokens -= estimate_history_tokens(turns.pop(0))
+            metrics.increment("context.turns_dropped", agent=agent or "")
+
+    fitted = [message for turn in turns for message in turn]
+    if tokens > budget:
+        fitted = [_abbreviate_message(message, policy.tool_arg_chars) for message in fitted]
+        fitted = _truncate_to_fit(fitted, budget)
+
+    fitted_tokens = estimate_history_tokens(fitted)
+    if fitted_tokens > budget:
+        metrics.increment("context.budget_exceeded", agent=agent or "")
+        logger.warning(f"⚠️ Prompt of ~{reserved_tokens + fitted_tokens} tokens is over the {policy.max_tokens} token "
+                       f"ceiling of {agent or 'this agent'}, even with only the latest request left in the history")
+    if fitted_tokens < original_tokens:
+        metrics.increment("context.tokens_trimmed", original_tokens - fitted_tokens, agent=agent or "")
+        logger.info(f"✂️ History of {original_tokens} tokens trimmed to {fitted_tokens} (budget {budget})")
+    metrics.observe("context.history_tokens", fitted_tokens, agent=agent or "")
+    return fitted
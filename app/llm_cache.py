@@ -0,0 +1,239 @@
+"""
+Opt-in exact-match cache of LLM responses, plugged into the shared model client (llm_client.get_chat_model).
+
+A call is a hit when the same model, with the same parameters and tools, gets the same messages. Messages are
+normalized first: their ids and response/usage metadata are left out of the key, so replaying a conversation
+(a page edit re-sent after a cancel, an SMS FAQ, a test suite) matches even though LangGraph gave every message
+a fresh id. Only exact repeats hit; paraphrases don't.
+
+LLAMABOT_LLM_CACHE picks the store:
+- "memory": in-process LRU of LLAMABOT_LLM_CACHE_MAX_ENTRIES responses
+- "sqlite": a SQLite file at LLAMABOT_LLM_CACHE_PATH, shared by workers and kept across restarts (and handy for
+            running test suites offline and deterministically against recorded responses)
+- "" / "off": (default) no caching
+Entries expire after LLAMABOT_LLM_CACHE_TTL_SECONDS (0 keeps them forever).
+
+Caching is per agent: only the agents listed in LLAMABOT_LLM_CACHE_AGENTS (comma separated, "*" for all) get a
+cache; an agent opts its calls in with get_chat_model(..., agent="public_leonardo").
+
+Hits, misses and the tokens hits saved are reported as llm_cache.hits / llm_cache.misses / llm_cache.saved_tokens.
+"""
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps as lc_dumps, loads as lc_loads
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_BACKEND = os.getenv("LLAMABOT_LLM_CACHE", "")
+LLM_CACHE_AGENTS = os.getenv("LLAMABOT_LLM_CACHE_AGENTS", "*")
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLAMABOT_LLM_CACHE_TTL_SECONDS", "86400"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLAMABOT_LLM_CACHE_MAX_ENTRIES", "1000"))
+LLM_CACHE_PATH = os.getenv("LLAMABOT_LLM_CACHE_PATH", "llm_cache.sqlite")
+
+# Per-message fields that change between otherwise identical calls.
+VOLATILE_MESSAGE_FIELDS = ("id", "response_metadata", "usage_metadata")
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, dict):
+        if value.get("type") == "constructor" and isinstance(value.get("kwargs"), dict):
+            kwargs = {key: _normalize(item) for key, item in value["kwargs"].items() if key not in VOLATILE_MESSAGE_FIELDS}
+            return {**value, "kwargs": kwargs}
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    """
+    Key for a call: `prompt` is the serialized messages and `llm_string` the serialized model, parameters and
+    tools, as LangChain passes them to BaseCache.
+    """
+    try:
+        normalized = json.dumps(_normalize(json.loads(prompt)), sort_keys=True, ensure_ascii=False)
+    except ValueError:
+        normalized = prompt
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(llm_string.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(normalized.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _fresh_copy(generations: RETURN_VAL_TYPE) -> RETURN_VAL_TYPE:
+    """A hit gets new message ids (assigned downstream), or LangGraph would treat it as the cached original."""
+    copies = []
+    for generation in generations:
+        generation = generation.model_copy(deep=True)
+        message = getattr(generation, "message", None)
+        if message is not None:
+            message.id = None
+        copies.append(generation)
+    return copies
+
+
+def _saved_tokens(generations: RETURN_VAL_TYPE) -> int:
+    total = 0
+    for generation in generations:
+        usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+        if usage:
+            total += usage.get("total_tokens") or 0
+    return total
+
+
+class _ReportingCache(BaseCache):
+    backend = "base"
+
+    def __init__(self, ttl_seconds: Optional[float] = None):
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else LLM_CACHE_TTL_SECONDS
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - created_at > self.ttl_seconds
+
+    def _get(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        raise NotImplementedError
+
+    def _set(self, key: str, generations: RETURN_VAL_TYPE):
+        raise NotImplementedError
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        generations = self._get(cache_key(prompt, llm_string))
+        if generations is None:
+            metrics.increment("llm_cache.misses", backend=self.backend)
+            return None
+        metrics.increment("llm_cache.hits", backend=self.backend)
+        metrics.increment("llm_cache.saved_tokens", _saved_tokens(generations), backend=self.backend)
+        return _fresh_copy(generations)
+
+    def hit_rate(self) -> float:
+        hits = metrics.counter("llm_cache.hits", backend=self.backend)
+        misses = metrics.counter("llm_cache.misses", backend=self.backend)
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE):
+        self._set(cache_key(prompt, llm_string), return_val)
+
+
+class InMemoryLlmCache(_ReportingCache):
+    """LRU of up to `max_entries` responses, in this process only."""
+
+    backend = "memory"
+
+    def __init__(self, max_entries: Optional[int] = None, ttl_seconds: Optional[float] = None):
+        super().__init__(ttl_seconds)
+        self.max_entries = max(1, max_entries if max_entries is not None else LLM_CACHE_MAX_ENTRIES)
+        self.entries: "OrderedDict[str, Tuple[float, RETURN_VAL_TYPE]]" = OrderedDict()
+        self._lock = threading.Lock() # sync model calls run in worker threads
+
+    def _get(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry[0]):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def _set(self, key: str, generations: RETURN_VAL_TYPE):
+        with self._lock:
+            self.entries[key] = (time.time(), [generation.model_copy(deep=True) for generation in generations])
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # No I/O, so no need for BaseCache's run-in-executor default.
+    async def alookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        return self.lookup(prompt, llm_string)
+
+    async def aupdate(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE):
+        self.update(prompt, llm_string, return_val)
+
+    def clear(self, **kwargs: Any):
+        with self._lock:
+            self.entries.clear()
+
+
+class SqliteLlmCache(_ReportingCache):
+    """Responses in a SQLite file: shared by the workers on a machine and kept across restarts."""
+
+    backend = "sqlite"
+
+    def __init__(self, path: Optional[str] = None, ttl_seconds: Optional[float] = None):
+        super().__init__(ttl_seconds)
+        self.path = path or LLM_CACHE_PATH
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, created_at REAL NOT NULL, generations TEXT NOT NULL)"
+            )
+
+    def _get(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        with self._lock:
+            row = self._connection.execute("SELECT created_at, generations FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if self._expired(row[0]):
+            with self._lock, self._connection:
+                self._connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            return None
+        try:
+            return lc_loads(row[1])
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable LLM cache entry {key}: {e}")
+            return None
+
+    def _set(self, key: str, generations: RETURN_VAL_TYPE):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, created_at, generations) VALUES (?, ?, ?)",
+                (key, time.time(), lc_dumps(generations)),
+            )
+
+    def clear(self, **kwargs: Any):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM llm_cache")
+
+    def close(self):
+        self._connection.close()
+
+
+def create_llm_cache(backend: Optional[str] = None) -> Optional[BaseCache]:
+    backend = (backend if backend is not None else LLM_CACHE_BACKEND).lower()
+    if backend in ("", "off", "none", "false"):
+        return None
+    if backend == "memory":
+        return InMemoryLlmCache()
+    if backend == "sqlite":
+        return SqliteLlmCache()
+    logger.warning(f"❌ Unknown LLAMABOT_LLM_CACHE backend {backend!r}, LLM responses are not cached")
+    return None
+
+
+_shared_cache: Dict[str, Optional[BaseCache]] = {} # backend -> cache, so every agent shares one store
+
+
+def get_llm_cache(agent: Optional[str]) -> Optional[BaseCache]:
+    """The cache for `agent`'s model calls, or None if caching is off or the agent isn't opted in."""
+    agents = {name.strip() for name in LLM_CACHE_AGENTS.split(",") if name.strip()}
+    if not agent or not ("*" in agents or agent in agents):
+        return None
+    backend = LLM_CACHE_BACKEND.lower()
+    if backend not in _shared_cache:
+        _shared_cache[backend] = create_llm_cache(backend)
+    return _shared_cache[backend]
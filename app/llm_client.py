@@ -0,0 +1,147 @@
+"""
+The chat model client agents should use: ChatOpenAI, with every call going through the process-wide
+LLM rate limiter (llm_rate_limiter.py) first.
+
+llm = get_chat_model("o4-mini")                                   # interactive
+llm = get_chat_model("o4-mini", priority=BACKGROUND_PRIORITY)     # e.g. SMS replies nobody is watching stream
+llm = get_chat_model("o4-mini", agent="public_leonardo")          # may answer repeats from the LLM cache (llm_cache.py)
+llm = get_routed_chat_model("llamapress", "write_html_page_agent", state["messages"])  # model from the routes (model_routing.py)
+
+Before a call, its size is estimated (prompt + tool schemas at ~4 characters per token, plus a completion reserve)
+and that much budget is taken. Afterwards the reservation is settled against the reported usage, and the
+x-ratelimit-* headers of the response update the budget. The headers are removed from the message again, so they
+don't end up in the checkpointed state or in frames sent to clients. Cached prompt tokens are reported too
+(see prompt_assembly.py).
+"""
+from typing import Any, AsyncIterator, Iterator, List, Optional, Sequence
+import logging
+import os
+import time
+
+import openai
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_openai import ChatOpenAI
+
+from app.llm_cache import get_llm_cache
+from app.model_routing import record_tier_usage, route_model
+from app.llm_rate_limiter import BACKGROUND_PRIORITY, INTERACTIVE_PRIORITY, llm_rate_limiter
+from app.prompt_assembly import record_prompt_cache_usage
+from app.serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+# Tokens reserved for the answer when the model has no max_tokens set.
+COMPLETION_TOKENS_ESTIMATE = int(os.getenv("LLAMABOT_LLM_COMPLETION_TOKENS_ESTIMATE", "1000"))
+
+
+def estimate_tokens(messages: List[BaseMessage], tools: Optional[list] = None, completion_tokens: int = COMPLETION_TOKENS_ESTIMATE) -> int:
+    chars = sum(len(message.content) if isinstance(message.content, str) else len(dumps(message.content)) for message in messages)
+    if tools:
+        chars += len(dumps(tools))
+    return chars // CHARS_PER_TOKEN + completion_tokens
+
+
+class ScheduledChatOpenAI(ChatOpenAI):
+    """ChatOpenAI that waits for rate limit budget before each call, and reports back what the call used."""
+
+    priority: int = INTERACTIVE_PRIORITY
+    include_response_headers: bool = True # needed to read x-ratelimit-*; stripped again before the message is returned
+    stream_usage: bool = True # so streamed calls report their token usage too
+    tier: Optional[str] = None # set by get_routed_chat_model, for per-tier latency/usage reporting
+
+    def _reserve(self, messages: List[BaseMessage], kwargs: dict) -> int:
+        return estimate_tokens(messages, kwargs.get("tools"), self.max_tokens or COMPLETION_TOKENS_ESTIMATE)
+
+    def _settle(self, headers: Optional[dict], reserved: int, usage: Optional[dict], started: float, first_token_at: Optional[float] = None):
+        settled = bool(headers) and llm_rate_limiter.update_from_headers(self.model_name, headers)
+        if not settled: # no remaining tokens header to go by: refund (or charge) the difference with the estimate
+            llm_rate_limiter.record_usage(self.model_name, reserved, usage.get("total_tokens") if usage else None)
+        record_prompt_cache_usage(self.model_name, usage)
+        if self.tier:
+            now = time.monotonic()
+            record_tier_usage(self.tier, self.model_name, usage, now - started, first_token_at - started if first_token_at else None)
+
+    def _settle_result(self, result: ChatResult, reserved: int, started: float):
+        headers, usage = None, None
+        for generation in result.generations:
+            if generation.generation_info and "headers" in generation.generation_info:
+                headers = generation.generation_info.pop("headers")
+            usage = getattr(generation.message, "usage_metadata", None) or usage
+        self._settle(headers, reserved, usage, started)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        reserved = self._reserve(messages, kwargs)
+        llm_rate_limiter.acquire(self.model_name, reserved, self.priority)
+        started = time.monotonic()
+        try:
+            result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        except openai.RateLimitError:
+            llm_rate_limiter.penalize(self.model_name)
+            raise
+        self._settle_result(result, reserved, started)
+        return result
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        reserved = self._reserve(messages, kwargs)
+        await llm_rate_limiter.aacquire(self.model_name, reserved, self.priority)
+        started = time.monotonic()
+        try:
+            result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        except openai.RateLimitError:
+            llm_rate_limiter.penalize(self.model_name)
+            raise
+        self._settle_result(result, reserved, started)
+        return result
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        reserved = self._reserve(messages, kwargs)
+        llm_rate_limiter.acquire(self.model_name, reserved, self.priority)
+        started, first_token_at = time.monotonic(), None
+        headers, usage = None, None
+        try:
+            for chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                if chunk.generation_info and "headers" in chunk.generation_info:
+                    headers = chunk.generation_info.pop("headers")
+                usage = getattr(chunk.message, "usage_metadata", None) or usage
+                if first_token_at is None and (chunk.message.content or getattr(chunk.message, "tool_call_chunks", None)):
+                    first_token_at = time.monotonic()
+                yield chunk
+        except openai.RateLimitError:
+            llm_rate_limiter.penalize(self.model_name)
+            raise
+        self._settle(headers, reserved, usage, started, first_token_at)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        reserved = self._reserve(messages, kwargs)
+        await llm_rate_limiter.aacquire(self.model_name, reserved, self.priority)
+        started, first_token_at = time.monotonic(), None
+        headers, usage = None, None
+        try:
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                if chunk.generation_info and "headers" in chunk.generation_info:
+                    headers = chunk.generation_info.pop("headers")
+                usage = getattr(chunk.message, "usage_metadata", None) or usage
+                if first_token_at is None and (chunk.message.content or getattr(chunk.message, "tool_call_chunks", None)):
+                    first_token_at = time.monotonic()
+                yield chunk
+        except openai.RateLimitError:
+            llm_rate_limiter.penalize(self.model_name)
+            raise
+        self._settle(headers, reserved, usage, started, first_token_at)
+
+
+def get_chat_model(model: str, priority: int = INTERACTIVE_PRIORITY, agent: Optional[str] = None, **kwargs: Any) -> ScheduledChatOpenAI:
+    if "cache" not in kwargs:
+        cache = get_llm_cache(agent)
+        if cache is not None:
+            kwargs["cache"] = cache # hits skip the rate limiter too: they never reach the provider
+    return ScheduledChatOpenAI(model=model, priority=priority, **kwargs)
+
+
+def get_routed_chat_model(agent: str, node: Optional[str] = None, messages: Sequence[BaseMessage] = (),
+                          priority: int = INTERACTIVE_PRIORITY, **kwargs: Any) -> ScheduledChatOpenAI:
+    """The model the routes assign to `agent` (and `node`), for a turn made of `messages` (see model_routing.py)."""
+    route = route_model(agent, node, messages)
+    return get_chat_model(route.model, priority=priority, agent=agent, tier=route.tier, **kwargs)
@@ -0,0 +1,256 @@
+"""
+Process-wide rate limiting of LLM calls, so bursts queue up here instead of turning into provider 429s
+(and LangChain retry storms).
+
+Every model has two token buckets, refilled continuously: requests per minute and tokens per minute. A call
+takes one request plus its estimated token count (prompt estimate + completion reserve) before it's sent.
+Calls that don't fit wait, ordered by priority and then arrival: interactive runs (websocket / SSE users waiting
+on the answer) go before background ones (e.g. public_leonardo's SMS replies). The queue is strict: a cheap
+background call doesn't overtake an interactive one that is waiting for budget.
+
+The buckets start from LLAMABOT_LLM_RPM / LLAMABOT_LLM_TPM (or LLAMABOT_LLM_RATE_LIMITS per model) and are then
+corrected from what the provider tells us: the x-ratelimit-* response headers (limits and remaining budget, which
+also covers other processes sharing the API key), the actual token usage of each response, and 429s.
+
+Works from both worker threads (sync LangGraph nodes) and the event loop. See llm_client.py for the model client.
+"""
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Mapping, Optional, Tuple
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE_PRIORITY = 0
+BACKGROUND_PRIORITY = 10
+
+DEFAULT_RPM = float(os.getenv("LLAMABOT_LLM_RPM", "500"))
+DEFAULT_TPM = float(os.getenv("LLAMABOT_LLM_TPM", "200000"))
+# Per-model overrides, e.g. "gpt-4o=500/30000,o4-mini=1000/200000" (requests/tokens per minute).
+RATE_LIMITS = os.getenv("LLAMABOT_LLM_RATE_LIMITS", "")
+
+# A waiter re-checks its budget at least this often, in case a wake-up got lost.
+MAX_WAIT_SLICE_SECONDS = 1.0
+
+
+def parse_rate_limits(value: str) -> Dict[str, Tuple[float, float]]:
+    """Parse "model=rpm/tpm,model=rpm/tpm" into {model: (rpm, tpm)}, ignoring malformed entries."""
+    limits = {}
+    for entry in value.split(","):
+        if "=" not in entry or "/" not in entry:
+            continue
+        model, budget = entry.split("=", 1)
+        rpm, tpm = budget.split("/", 1)
+        try:
+            limits[model.strip()] = (float(rpm), float(tpm))
+        except ValueError:
+            continue
+    return limits
+
+
+class TokenBucket:
+    """`capacity` units, refilled at `capacity` per minute. May go negative when a call used more than it reserved."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated_at = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def seconds_until(self, amount: float) -> float:
+        amount = min(amount, self.capacity) # a call bigger than the whole budget waits for a full bucket
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate if self.rate > 0 else MAX_WAIT_SLICE_SECONDS
+
+    def resize(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = min(self.level, per_minute)
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    tokens: int = field(compare=False)
+    wake: Callable[[], None] = field(compare=False)
+    enqueued_at: float = field(compare=False, default_factory=time.monotonic)
+
+
+@dataclass
+class ModelBudget:
+    requests: TokenBucket
+    tokens: TokenBucket
+    waiters: list = field(default_factory=list) # heap of _Waiter
+
+    def refill(self, now: float):
+        self.requests.refill(now)
+        self.tokens.refill(now)
+
+
+class LlmRateLimiter:
+    def __init__(self, default_rpm: Optional[float] = None, default_tpm: Optional[float] = None,
+                 limits: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.default_rpm = default_rpm if default_rpm is not None else DEFAULT_RPM
+        self.default_tpm = default_tpm if default_tpm is not None else DEFAULT_TPM
+        self.limits = limits if limits is not None else parse_rate_limits(RATE_LIMITS)
+        self.budgets: Dict[str, ModelBudget] = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def _budget(self, model: str) -> ModelBudget:
+        budget = self.budgets.get(model)
+        if budget is None:
+            rpm, tpm = self.limits.get(model, (self.default_rpm, self.default_tpm))
+            budget = self.budgets[model] = ModelBudget(TokenBucket(rpm), TokenBucket(tpm))
+        return budget
+
+    def acquire(self, model: str, tokens: int, priority: int = INTERACTIVE_PRIORITY) -> float:
+        """Block the calling (worker) thread until the call fits the model's budget. Returns the seconds waited."""
+        wake_up = threading.Event()
+        waiter = self._enqueue(model, tokens, priority, wake_up.set)
+        granted = False
+        try:
+            while True:
+                wake_up.clear()
+                delay = self._poll(model, waiter)
+                if delay == 0:
+                    granted = True
+                    return self._granted(model, waiter)
+                wake_up.wait(delay)
+        finally:
+            if not granted:
+                self._abandon(model, waiter)
+
+    async def aacquire(self, model: str, tokens: int, priority: int = INTERACTIVE_PRIORITY) -> float:
+        """Like acquire(), without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        wake_up = asyncio.Event()
+        waiter = self._enqueue(model, tokens, priority, lambda: loop.call_soon_threadsafe(wake_up.set))
+        granted = False
+        try:
+            while True:
+                wake_up.clear()
+                delay = self._poll(model, waiter)
+                if delay == 0:
+                    granted = True
+                    return self._granted(model, waiter)
+                try:
+                    await asyncio.wait_for(wake_up.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if not granted:
+                self._abandon(model, waiter)
+
+    def _enqueue(self, model: str, tokens: int, priority: int, wake: Callable[[], None]) -> _Waiter:
+        waiter = _Waiter(priority, next(self._seq), max(0, int(tokens)), wake)
+        with self._lock:
+            budget = self._budget(model)
+            heapq.heappush(budget.waiters, waiter)
+            metrics.set_gauge("llm.rate_limit_queue_depth", len(budget.waiters), model=model)
+        return waiter
+
+    def _poll(self, model: str, waiter: _Waiter) -> float:
+        """Take the budget if `waiter` is first in line and it fits (returns 0), else how long to wait before asking again."""
+        with self._lock:
+            budget = self._budget(model)
+            if budget.waiters[0] is not waiter:
+                return MAX_WAIT_SLICE_SECONDS # woken up when it's our turn
+            budget.refill(time.monotonic())
+            delay = max(budget.requests.seconds_until(1), budget.tokens.seconds_until(waiter.tokens))
+            if delay > 0:
+                return min(delay, MAX_WAIT_SLICE_SECONDS)
+            budget.requests.level -= 1
+            budget.tokens.level -= min(waiter.tokens, budget.tokens.capacity)
+            heapq.heappop(budget.waiters)
+            self._wake_next(model, budget)
+            return 0
+
+    def _granted(self, model: str, waiter: _Waiter) -> float:
+        waited = time.monotonic() - waiter.enqueued_at
+        metrics.observe("llm.rate_limit_wait_seconds", waited, priority=waiter.priority)
+        if waited > 1:
+            logger.info(f"🚦 LLM call to {model} waited {waited:.1f}s for rate limit budget")
+        return waited
+
+    def _abandon(self, model: str, waiter: _Waiter):
+        """The caller gave up (cancelled): leave the queue and let the next one go."""
+        with self._lock:
+            budget = self._budget(model)
+            if waiter in budget.waiters:
+                budget.waiters.remove(waiter)
+                heapq.heapify(budget.waiters)
+            self._wake_next(model, budget)
+
+    def _wake_next(self, model: str, budget: ModelBudget):
+        metrics.set_gauge("llm.rate_limit_queue_depth", len(budget.waiters), model=model)
+        if budget.waiters:
+            budget.waiters[0].wake()
+
+    def record_usage(self, model: str, reserved_tokens: int, used_tokens: Optional[int]):
+        """Settle a call's reservation against its actual token usage."""
+        if used_tokens is None:
+            return
+        with self._lock:
+            budget = self._budget(model)
+            budget.tokens.level = min(budget.tokens.capacity, budget.tokens.level + min(reserved_tokens, budget.tokens.capacity) - used_tokens)
+            self._wake_next(model, budget)
+
+    def update_from_headers(self, model: str, headers: Mapping[str, str]) -> bool:
+        """
+        Adopt the provider's view of our budget from x-ratelimit-{limit,remaining}-{requests,tokens} headers.
+        Returns True if they had the remaining tokens: that count already includes this call's usage, so the call's
+        reservation is settled and mustn't go through record_usage as well.
+        """
+        headers = {key.lower(): value for key, value in headers.items()}
+        remaining_tokens = None
+        with self._lock:
+            budget = self._budget(model)
+            budget.refill(time.monotonic())
+            for kind, bucket in (("requests", budget.requests), ("tokens", budget.tokens)):
+                limit = _header_number(headers, f"x-ratelimit-limit-{kind}")
+                remaining = _header_number(headers, f"x-ratelimit-remaining-{kind}")
+                if limit is not None and limit > 0 and limit != bucket.capacity:
+                    bucket.resize(limit)
+                if remaining is not None:
+                    bucket.level = min(bucket.level, remaining)
+                if kind == "tokens":
+                    remaining_tokens = remaining
+            self._wake_next(model, budget)
+        return remaining_tokens is not None
+
+    def penalize(self, model: str):
+        """The provider answered 429: we were over budget, so start refilling from empty."""
+        metrics.increment("llm.rate_limited", model=model)
+        logger.warning(f"🚦 {model} is rate limited by the provider, draining its budget")
+        with self._lock:
+            budget = self._budget(model)
+            budget.refill(time.monotonic())
+            budget.requests.level = min(budget.requests.level, 0)
+            budget.tokens.level = min(budget.tokens.level, 0)
+
+
+def _header_number(headers: Mapping[str, str], name: str) -> Optional[float]:
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# Process-wide, since the provider's limits are per API key, not per agent.
+llm_rate_limiter = LlmRateLimiter()
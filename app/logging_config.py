@@ -0,0 +1,202 @@
+"""
+Logging setup for the server.
+
+Log calls on the event loop only put the record on an in-memory queue (QueueHandler); a QueueListener thread
+does the formatting and the actual (blocking) writes to stderr / the log file. Records are written as one JSON
+object per line by default.
+
+Two filters run before a record is queued:
+- sampling: records tagged with a category (`extra={"category": "stream.update"}`) can be sampled, e.g.
+  LLAMABOT_LOG_SAMPLE_RATES="stream.update=0.1,stream.tool_call=0.5" keeps every 10th / every 2nd record.
+- truncation: the message and any extra fields are capped at LLAMABOT_LOG_MAX_FIELD_CHARS characters,
+  so a state update carrying a whole HTML page doesn't end up in the log in full.
+
+Per-token chunk logs and full state updates are emitted at DEBUG (categories "stream.chunk", "stream.update") and
+are off unless LOG_LEVEL=DEBUG; at INFO a state update is logged as a summary (describe_update), which is cheap
+to build on the event loop. Use lazy %-style arguments on the hot path so the repr is only built if the record will
+actually be logged.
+"""
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timezone
+from typing import Dict, Optional
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from app.serialization import dumps
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LLAMABOT_LOG_FORMAT", "json") # "json" or "text"
+LOG_FILE = os.getenv("LLAMABOT_LOG_FILE", "") # no file unless asked for; a relative path lands wherever the server runs
+MAX_FIELD_CHARS = int(os.getenv("LLAMABOT_LOG_MAX_FIELD_CHARS", "2000"))
+SAMPLE_RATES = os.getenv("LLAMABOT_LOG_SAMPLE_RATES", "")
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else on a record came in through `extra=`.
+_STANDARD_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[QueueHandler] = None
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    """Parse "category=rate,category=rate" into a dict, ignoring malformed entries."""
+    rates = {}
+    for entry in value.split(","):
+        if "=" not in entry:
+            continue
+        category, rate = entry.split("=", 1)
+        try:
+            rates[category.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+def truncate(value: str, max_chars: int) -> str:
+    if max_chars <= 0 or len(value) <= max_chars:
+        return value
+    return f"{value[:max_chars]}… [truncated {len(value) - max_chars} chars]"
+
+
+def describe_update(update) -> str:
+    """
+    A one-line summary of a LangGraph state update: node names, keys and sizes, never the values themselves
+    (they can carry a whole page). e.g. "write_html_page_agent: messages=1, current_page_html=18342 chars"
+    """
+    if not isinstance(update, dict):
+        return type(update).__name__
+    nodes = []
+    for node, data in update.items():
+        if isinstance(data, dict):
+            fields = []
+            for key, value in data.items():
+                if isinstance(value, str):
+                    fields.append(f"{key}={len(value)} chars")
+                elif isinstance(value, (list, tuple, dict)):
+                    fields.append(f"{key}={len(value)}")
+                else:
+                    fields.append(key)
+            nodes.append(f"{node}: {', '.join(fields)}")
+        else:
+            nodes.append(f"{node}: {type(data).__name__}")
+    return "; ".join(nodes)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps roughly `rate` of the records of each configured category. Deterministic (every Nth record) rather than
+    random, so a rate of 0.1 keeps exactly 1 in 10. Warnings and errors are never sampled away.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = getattr(record, "category", None)
+        rate = self.rates.get(category) if category else None
+        if rate is None or rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        if rate <= 0.0:
+            return False
+        every = max(1, round(1 / rate))
+        with self._lock:
+            seen = self._counters.get(category, 0)
+            self._counters[category] = seen + 1
+        return seen % every == 0
+
+
+class TruncatingFilter(logging.Filter):
+    """Renders the message once and caps it (and any extra fields) at `max_chars` characters."""
+
+    def __init__(self, max_chars: int):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.max_chars <= 0:
+            return True
+        try:
+            record.msg = truncate(record.getMessage(), self.max_chars)
+            record.args = None
+        except Exception:
+            pass # leave badly formatted records to the handler's usual error reporting
+        for key, value in list(vars(record).items()):
+            if key not in _STANDARD_RECORD_ATTRIBUTES and isinstance(value, str):
+                setattr(record, key, truncate(value, self.max_chars))
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: timestamp, level, logger, message, plus any `extra=` fields."""
+
+    def __init__(self, max_chars: int = MAX_FIELD_CHARS):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        for key, value in vars(record).items():
+            if key not in _STANDARD_RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = truncate(value, self.max_chars) if isinstance(value, str) else value
+        return dumps(entry)
+
+
+def setup_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT, log_file: Optional[str] = LOG_FILE,
+                  max_field_chars: int = MAX_FIELD_CHARS, sample_rates: Optional[Dict[str, float]] = None) -> QueueListener:
+    """
+    Route all logging through a queue to a background writer thread. Safe to call more than once;
+    each call replaces the previous setup.
+    """
+    global _listener, _queue_handler
+    shutdown_logging()
+
+    formatter = JsonFormatter(max_field_chars) if log_format == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rates if sample_rates is not None else parse_sample_rates(SAMPLE_RATES)))
+    queue_handler.addFilter(TruncatingFilter(max_field_chars))
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+
+    _queue_handler = queue_handler
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging():
+    """Flush whatever is still queued and stop the writer thread."""
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
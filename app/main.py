@@ -3,9 +3,9 @@ from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 import asyncio
+from typing import Optional
 
 from langchain_core.load import dumpd
-from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage
 from langsmith import Client
 
@@ -25,6 +25,7 @@ import os
 import logging
 import time
 import json
+import uuid
 
 from datetime import datetime
 from app.agents.react_agent.nodes import build_workflow
@@ -32,23 +33,36 @@ from app.agents.llamabot_v1.nodes import build_workflow as build_workflow_llamab
 from app.websocket.web_socket_connection_manager import WebSocketConnectionManager
 from app.websocket.web_socket_handler import WebSocketHandler
 from app.websocket.request_handler import RequestHandler
-from collections import defaultdict
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('chat_app.log'),
-        logging.StreamHandler()
-    ]
-)
+from app.websocket.resumable_runs import RunIdInUse, run_registry, task_outcome
+from app.websocket.stream_protocol import negotiate_protocol_version, DELTA_PROTOCOL_VERSION
+from app.admission_scheduler import admission_scheduler
+from app.run_manager import RunManager, RunQueueFull
+from app.sse import SseSubscriber, SSE_HEADERS, parse_event_id, sse_run_events
+from app.serialization import dumps, ndjson_line
+from app.metrics import metrics
+from app.logging_config import setup_logging, describe_update
+from contextlib import asynccontextmanager
+
+# Configure logging: records are queued on the event loop and written as JSON by a background thread.
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Ping quiet websockets and reap the dead ones in the background (see WebSocketConnectionManager.heartbeat).
+    manager.start_heartbeat()
+    await manager.start_pubsub() # broadcasts reach sockets on the other workers too (see websocket/pubsub.py)
+    yield
+    manager.cleanup()
+    await manager.stop_pubsub()
+    await run_manager.shutdown()
+    if admission_scheduler.thread_lock is not None:
+        await admission_scheduler.thread_lock.close() # the Postgres advisory lock pool, if one was opened
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware for React frontend
 app.add_middleware(
@@ -63,16 +77,17 @@ app.add_middleware(
 # app.mount("/assets", StaticFiles(directory="../assets"), name="assets")
 # app.mount("/examples", StaticFiles(directory="../examples"), name="examples")
 
-# Initialize the ChatOpenAI client
-llm = ChatOpenAI(
-    model="o4-mini-2025-04-16"
-)
-
 client = Client(api_key=os.getenv("LANGSMITH_API_KEY"))
 
 # This is responsible for holding and managing all active websocket connections.
 manager = WebSocketConnectionManager(app) 
 
+# Runs streamed over SSE (/llamabot-chat-message-v2) go through the same RequestHandler as websocket runs.
+sse_request_handler = RequestHandler(app)
+# Background runs (/runs) execute on a bounded worker pool, whether or not a client is connected (see run_manager.py).
+run_manager = RunManager(app)
+app.state.run_manager = run_manager
+
 # Pydantic model for chat request
 class ChatMessage(BaseModel):
     message: str
@@ -82,6 +97,8 @@ class ChatMessage(BaseModel):
 # Application state to hold persistent checkpointer, important for session-based persistence.
 app.state.checkpointer = None
 app.state.async_checkpointer = None
+# Per-thread ordering plus global / per-tenant caps on concurrent agent runs (HTTP, SSE and websocket alike).
+app.state.admission_scheduler = admission_scheduler
 
 # Suppress psycopg connection error spam when PostgreSQL is unavailable
 psycopg_logger = logging.getLogger('psycopg.pool')
@@ -150,11 +167,6 @@ def get_langgraph_app_and_state_helper(message: dict):
     request_handler = RequestHandler(app)
     return request_handler.get_langgraph_app_and_state(message)
 
-# At module level
-thread_locks = defaultdict(asyncio.Lock)
-thread_queues = defaultdict(asyncio.Queue)
-MAX_QUEUE_SIZE = 10
-
 @app.get("/", response_class=HTMLResponse)
 async def root():
     # Serve the home.html file
@@ -165,6 +177,11 @@ async def root():
 async def hello():
     return {"message": "Hello, World! 🦙💬"}
 
+@app.get("/metrics", response_class=JSONResponse)
+async def get_metrics():
+    # In-process counters/summaries, e.g. websocket outbound queue depth and send latency.
+    return metrics.snapshot()
+
 @app.post("/chat-message")
 async def chat_message(chat_message: ChatMessage):
     request_id = f"req_{int(time.time())}_{hash(chat_message.message)%1000}"
@@ -186,10 +203,10 @@ async def chat_message(chat_message: ChatMessage):
             logger.info(f"[{request_id}] Starting streaming response")
 
             # Initial response with request ID
-            yield json.dumps({
+            yield ndjson_line({
                 "type": "start",
                 "request_id": request_id
-            }) + "\n"
+            })
 
             # Use the provided thread_id or default to "5"
             thread_id = chat_message.thread_id or "5"
@@ -228,11 +245,11 @@ async def chat_message(chat_message: ChatMessage):
                             logger.info(f"[{request_id}] Stream update from {langgraph_node_info['langgraph_node']}: {str(message_from_llm)[:100]}...")
 
                             # Send streaming update for React frontend
-                            yield json.dumps({
+                            yield ndjson_line({
                                 "type": "update",
                                 "node": langgraph_node_info['langgraph_node'],
                                 "value": str(message_from_llm.content)  # Convert value to string for safety
-                            }) + "\n"
+                            })
                     
                     elif is_this_chunk_an_update_stream_type:
                         updated_langgraph_state_object = chunk[1] # Dict object
@@ -253,20 +270,20 @@ async def chat_message(chat_message: ChatMessage):
                         logger.info(f"[{request_id}] Received chunk in unknown format: {type(chunk)}")
         except Exception as e:
             logger.error(f"[{request_id}] Error in stream: {str(e)}", exc_info=True)
-            yield json.dumps({
+            yield ndjson_line({
                 "type": "error",
                 "error": str(e),
                 "request_id": request_id
-            }) + "\n"
+            })
         finally:
             logger.info(f"[{request_id}] Stream completed")
             # Send final update with complete messages
-            yield json.dumps({
+            yield ndjson_line({
                 "type": "final",
                 "node": "final",
                 "value": "final",
                 "messages": final_state.get("messages", []) if final_state else []
-            }) + "\n"
+            })
 
     # Return a streaming response
     return StreamingResponse(
@@ -283,42 +300,31 @@ async def llamabot_chat_message(chat_message: dict): #NOTE: This could be arbitr
     thread_id = chat_message.get("thread_id") or "5"
     request_id = f"req_{int(time.time())}_{hash(chat_message.get('message'))%1000}"
     
-    # Get the queue for this thread
-    queue = thread_queues[thread_id]
-    
-    # If queue is full, return error
-    if queue.qsize() >= MAX_QUEUE_SIZE:
+    tenant = chat_message.pop("tenant", None)
+
+    # Refuse straight away if this thread already has a full backlog
+    if admission_scheduler.is_thread_queue_full(thread_id):
         return JSONResponse({
             "error": "Too many pending messages",
             "request_id": request_id
         }, status_code=429)
     
-    # Add message to queue
-    await queue.put((request_id, chat_message))
-    
     async def response_generator():
         try:
-            # Get the lock for this thread
-            async with thread_locks[thread_id]:
-                logger.info(f"[{request_id}] Processing message from queue for thread {thread_id}")
-                
-                # Get our message from the queue
-                current_request_id, current_message = await queue.get()
-                if current_request_id != request_id:
-                    # This shouldn't happen due to the lock, but just in case
-                    logger.error(f"[{request_id}] Queue mismatch!")
-                    return
+            # Wait for our turn on this thread (and a free slot, see admission_scheduler.py)
+            async with admission_scheduler.admit(thread_id, tenant=tenant):
+                logger.info(f"[{request_id}] Processing message for thread {thread_id}")
                 
                 try:
                     checkpointer = get_or_create_async_checkpointer()
-                    graph, state = get_langgraph_app_and_state_helper(current_message)
+                    graph, state = get_langgraph_app_and_state_helper(chat_message)
                     # breakpoint()
                     
-                    yield json.dumps({
+                    yield ndjson_line({
                         "type": "start",
                         "content": "start",
                         "request_id": request_id
-                    }) + "\n"
+                    })
 
                     stream = graph.astream(state,
                         config={"configurable": {"thread_id": thread_id}},
@@ -332,29 +338,26 @@ async def llamabot_chat_message(chat_message: dict): #NOTE: This could be arbitr
                         
                         if is_this_chunk_an_update_stream_type:
                             state_object = chunk[1]
-                            logger.info(f"🧠🧠🧠 LangGraph Output (State Update): {state_object}")
+                            logger.info("🧠🧠🧠 LangGraph Output (State Update): %s", describe_update(state_object), extra={"category": "stream.update"})
+                            logger.debug("🧠 Full state update: %s", state_object, extra={"category": "stream.update"})
 
                             for agent_key, agent_data in state_object.items():
                                 if isinstance(agent_data, dict) and 'messages' in agent_data:
                                     messages = agent_data['messages']
-                                    base_message_as_dict = dumpd(messages[0])["kwargs"]
-                                    yield json.dumps(base_message_as_dict) + "\n"
+                                    yield ndjson_line(messages[0]) # serialized as the dumpd(...)["kwargs"] base_message shape
 
                 finally:
-                    # Mark task as done
-                    queue.task_done()
-                    
-                    yield json.dumps({
+                    yield ndjson_line({
                         "type": "final",
                         "content": "final"
-                    }) + "\n"
+                    })
 
         except Exception as e:
             logger.error(f"[{request_id}] Error in stream: {str(e)}", exc_info=True)
-            yield json.dumps({
+            yield ndjson_line({
                 "type": "error",
                 "content": str(e)
-            }) + "\n"
+            })
 
     return StreamingResponse(
         response_generator(),
@@ -363,20 +366,114 @@ async def llamabot_chat_message(chat_message: dict): #NOTE: This could be arbitr
 
 
 @app.post("/llamabot-chat-message-v2")
-async def llamabot_chat_message_v2(chat_message: dict):
-    request_id = f"req_{int(time.time())}"
-    logger.info(f"[{request_id}] new message: {chat_message.get('message')!r}")
-
-    async def event_stream():
-        # ----- BEGIN: replace this with your real agent loop ----------
-        for i in range(5):
-            payload = {"chunk": i, "text": f"token-{i}"}
-            # Every Server-Sent-Event must end with a blank line
-            yield f"data: {json.dumps(payload)}\n\n"
-            await asyncio.sleep(1)           # <-- forces a real pause
-        # ----- END -----------------------------------------------------
-    return StreamingResponse(event_stream(),
-                             media_type="text/event-stream")
+async def llamabot_chat_message_v2(chat_message: dict, request: Request):
+    """
+    Token-level streaming of any langgraph.json agent over Server-Sent Events (see sse.py).
+    Frames are the websocket's, in the delta protocol unless the body asks for `"protocol": 1`.
+    Send the same request again with a Last-Event-ID header to resume a run after a dropped connection.
+    """
+    subscriber = SseSubscriber()
+    resume_run_id, last_seq = parse_event_id(request.headers.get("last-event-id"))
+    if resume_run_id is not None:
+        # Same body as the original request: its thread_id (and tenant) must be the run's.
+        run = run_registry.get(resume_run_id)
+        if run is None or not run.belongs_to(chat_message.get("thread_id"), chat_message.get("tenant")):
+            return JSONResponse({"error": "Run not found, it may have expired", "run_id": resume_run_id}, status_code=404)
+        replayed, _ = run.attach(subscriber, last_seq)
+        logger.info(f"SSE resume of run {resume_run_id}: replayed {replayed} frame(s)")
+    else:
+        message = dict(chat_message)
+        protocol_version = negotiate_protocol_version(message.pop("protocol", DELTA_PROTOCOL_VERSION))
+        thread_id = f"{message.get('thread_id') or '5'}"
+        message["thread_id"] = thread_id
+        run_id = message.pop("run_id", None) or str(uuid.uuid4())
+        logger.info(f"SSE run {run_id} on thread {thread_id}: {message.get('message')!r}")
+
+        # The request stands in for the websocket: it keys the RequestHandler's per-connection state.
+        context = sse_request_handler.get_context(request)
+        context.protocol_version = protocol_version
+        context.tenant = message.pop("tenant", None)
+        try:
+            run = run_registry.create(run_id, thread_id, subscriber=subscriber, tenant=context.tenant)
+        except RunIdInUse as e:
+            sse_request_handler.cleanup_connection(request)
+            return JSONResponse({"error": str(e), "run_id": run_id}, status_code=409)
+
+        async def run_agent():
+            await sse_request_handler.handle_request(message, request, run_id=run_id)
+
+        def finish_run(task: asyncio.Task):
+            run_registry.finish(run_id, task_outcome(task))
+            sse_request_handler.cleanup_connection(request)
+            if not task.cancelled() and task.exception() is not None:
+                logger.info(f"SSE run {run_id} ended with an error: {task.exception()}") # already sent as an error event
+
+        run.task = asyncio.create_task(run_agent())
+        run.task.add_done_callback(finish_run)
+
+    return StreamingResponse(sse_run_events(run, subscriber, request.is_disconnected),
+                             media_type="text/event-stream",
+                             headers=SSE_HEADERS)
+
+@app.post("/runs", status_code=202)
+async def create_run(run_request: dict):
+    """
+    Start a background run: same body as /llamabot-chat-message-v2, but it returns the run_id right away and the run
+    keeps going with nobody connected. Follow it with the /runs/{run_id}/... endpoints or a websocket `resume`,
+    on this worker: runs and their events are kept in memory (see run_manager.py).
+    """
+    try:
+        run = run_manager.submit(run_request)
+    except RunQueueFull as e:
+        return JSONResponse({"error": str(e)}, status_code=429)
+    except RunIdInUse as e:
+        return JSONResponse({"error": str(e), "run_id": run_request.get("run_id")}, status_code=409)
+    return run_manager.describe(run)
+
+@app.get("/runs/{run_id}")
+async def get_run(run_id: str, thread_id: Optional[str] = None, tenant: Optional[str] = None):
+    """A background run's status. thread_id (and tenant) must be the run's, as for a resume."""
+    run = run_manager.get(run_id, thread_id, tenant)
+    if run is None:
+        return JSONResponse({"error": "Run not found, it may have expired", "run_id": run_id}, status_code=404)
+    return run_manager.describe(run)
+
+@app.get("/runs/{run_id}/events")
+async def get_run_events(run_id: str, after: int = 0, thread_id: Optional[str] = None, tenant: Optional[str] = None):
+    """Poll a run: the frames after sequence number `after`. `gap` is true if some of them were already dropped."""
+    run = run_manager.get(run_id, thread_id, tenant)
+    if run is None:
+        return JSONResponse({"error": "Run not found, it may have expired", "run_id": run_id}, status_code=404)
+    events, gap = run.log.events_after(after)
+    return {"run_id": run_id, "status": run.status, "last_seq": run.log.last_seq, "gap": gap, "events": events}
+
+@app.get("/runs/{run_id}/stream")
+async def stream_run(run_id: str, request: Request, after: int = 0, thread_id: Optional[str] = None,
+                     tenant: Optional[str] = None):
+    """
+    Stream a run over SSE, starting with the frames after `after` (or after the Last-Event-ID). Closing the stream
+    doesn't stop a background run; attach again whenever.
+    """
+    run = run_manager.get(run_id, thread_id, tenant)
+    if run is None:
+        return JSONResponse({"error": "Run not found, it may have expired", "run_id": run_id}, status_code=404)
+    resume_run_id, last_seq = parse_event_id(request.headers.get("last-event-id"))
+    if resume_run_id == run_id:
+        after = last_seq
+    subscriber = SseSubscriber()
+    run.attach(subscriber, after)
+    return StreamingResponse(sse_run_events(run, subscriber, request.is_disconnected),
+                             media_type="text/event-stream",
+                             headers=SSE_HEADERS)
+
+@app.post("/runs/{run_id}/cancel")
+async def cancel_run(run_id: str, thread_id: Optional[str] = None, tenant: Optional[str] = None):
+    run = run_manager.get(run_id, thread_id, tenant)
+    if run is None:
+        return JSONResponse({"error": "Run not found, it may have expired", "run_id": run_id}, status_code=404)
+    if not run_manager.cancel(run_id, thread_id, tenant):
+        return JSONResponse({"error": "Run already ended", **run_manager.describe(run)}, status_code=409)
+    return run_manager.describe(run)
 
 @app.get("/chat", response_class=HTMLResponse)
 async def chat():
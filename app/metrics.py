@@ -0,0 +1,87 @@
+"""
+Minimal in-process metrics: counters, gauges and summaries (count/sum/min/max/last).
+
+Exposed as JSON on GET /metrics. Thread-safe, since sync LangGraph nodes and tools run in worker threads.
+
+Usage:
+
+from app.metrics import metrics
+metrics.increment("websocket.frames_dropped", 3)
+metrics.observe("websocket.send_latency_seconds", 0.012)
+metrics.set_gauge("websocket.outbound_queue_depth", 4, connection="1234")
+"""
+import threading
+from typing import Dict
+
+
+def _metric_key(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    label_string = ",".join(f"{key}={labels[key]}" for key in sorted(labels))
+    return f"{name}{{{label_string}}}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._summaries: Dict[str, dict] = {}
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def remove_gauge(self, name: str, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges.pop(key, None)
+
+    def observe(self, name: str, value: float, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self._summaries[key] = {"count": 1, "sum": value, "min": value, "max": value, "last": value}
+            else:
+                summary["count"] += 1
+                summary["sum"] += value
+                summary["min"] = min(summary["min"], value)
+                summary["max"] = max(summary["max"], value)
+                summary["last"] = value
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(_metric_key(name, labels), 0)
+
+    def gauge(self, name: str, **labels):
+        with self._lock:
+            return self._gauges.get(_metric_key(name, labels))
+
+    def summary(self, name: str, **labels) -> dict | None:
+        with self._lock:
+            summary = self._summaries.get(_metric_key(name, labels))
+            return dict(summary) if summary else None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            summaries = {}
+            for key, summary in self._summaries.items():
+                summaries[key] = dict(summary, avg=summary["sum"] / summary["count"])
+            return {"counters": dict(self._counters), "gauges": dict(self._gauges), "summaries": summaries}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._summaries.clear()
+
+
+# Process-wide registry.
+metrics = MetricsRegistry()
@@ -0,0 +1,126 @@
+"""
+Which model each agent (and node) calls, in configuration instead of hardcoded in the nodes.
+
+Models come in tiers: a cheap, fast one for conversational turns and a strong one for code generation.
+LLAMABOT_MODEL_TIERS overrides the models, e.g. "fast=gpt-4.1-mini,strong=gpt-4.1-2025-04-14".
+
+A route maps "agent" or "agent.node" to a tier, to "auto", or to a model name (pinned, whatever the tiers are).
+LLAMABOT_MODEL_ROUTES overrides DEFAULT_MODEL_ROUTES, e.g. "llamabot=strong,llamapress.write_html_page_agent=auto".
+"agent.node" wins over "agent"; an agent without a route gets the strong tier.
+
+"auto" picks the fast tier unless the turn looks like it needs the strong one (see needs_strong_model): a request
+to build or change something, code in the message, a long message, or a tool call of this turn that failed.
+With LLAMABOT_MODEL_ESCALATION=false, "auto" always means strong.
+
+Calls report per tier: llm.tier_calls, llm.tier_tokens, llm.tier_latency_seconds and, when streamed,
+llm.tier_first_token_seconds (see record_tier_usage, called by llm_client.ScheduledChatOpenAI).
+"""
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence
+import logging
+import os
+import re
+
+from langchain_core.messages import BaseMessage, HumanMessage, ToolMessage
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+FAST_TIER = "fast"
+STRONG_TIER = "strong"
+AUTO_ROUTE = "auto"
+
+DEFAULT_MODEL_TIERS = {FAST_TIER: "gpt-4.1-mini", STRONG_TIER: "gpt-4.1-2025-04-14"}
+DEFAULT_MODEL_ROUTES = {
+    "llamabot": AUTO_ROUTE,
+    "public_leonardo": FAST_TIER, # SMS replies
+    "llamapress.write_html_page_agent": AUTO_ROUTE,
+    "llamapress.selected_element_agent": STRONG_TIER,
+    "llamapress.clone_request": FAST_TIER, # only fills in the forced tool call (the URL to clone)
+    "llamapress.url_clone_agent": "o4-mini", # writes the page from a screenshot
+    "llamapress.image_clone_agent": "o4-mini",
+    "software_developer_assistant": AUTO_ROUTE,
+}
+
+MODEL_TIERS = os.getenv("LLAMABOT_MODEL_TIERS", "")
+MODEL_ROUTES = os.getenv("LLAMABOT_MODEL_ROUTES", "")
+MODEL_ESCALATION_ENABLED = os.getenv("LLAMABOT_MODEL_ESCALATION", "true").lower() in ("1", "true", "yes")
+MODEL_ESCALATION_CHARS = int(os.getenv("LLAMABOT_MODEL_ESCALATION_CHARS", "400"))
+
+# Asking to build or change something.
+_ACTION_WORDS = re.compile(
+    r"\b(build|create|write|generate|add|change|update|edit|make|modify|redesign|replace|remove|delete|move|fix|debug|"
+    r"refactor|implement|style|restyle|code|migrate|query|sql|clone|convert|translate)\b",
+    re.IGNORECASE,
+)
+_CODE_MARKERS = re.compile(r"```|</?[a-zA-Z][\w-]*[\s>]|\bdef |\bfunction\b|=>|;\s*$", re.MULTILINE)
+
+
+def parse_assignments(value: str) -> Dict[str, str]:
+    """Parse "key=value,..." into a dict, ignoring malformed entries."""
+    assignments = {}
+    for entry in value.split(","):
+        if "=" not in entry:
+            continue
+        key, assigned = (part.strip() for part in entry.split("=", 1))
+        if key and assigned:
+            assignments[key] = assigned
+    return assignments
+
+
+_tiers = {**DEFAULT_MODEL_TIERS, **parse_assignments(MODEL_TIERS)}
+_routes = {**DEFAULT_MODEL_ROUTES, **parse_assignments(MODEL_ROUTES)}
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    model: str
+    tier: str # "fast" / "strong", or "pinned" for a route naming a model
+    escalated: bool = False # "auto" went for the strong tier
+
+
+def _text(message: BaseMessage) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return " ".join(part.get("text", "") for part in message.content if isinstance(part, dict))
+
+
+def needs_strong_model(messages: Sequence[BaseMessage]) -> bool:
+    """The escalation heuristic of "auto" routes, looking at the current turn (from the last human message on)."""
+    turn_start = max((index for index, message in enumerate(messages) if isinstance(message, HumanMessage)), default=None)
+    if turn_start is None:
+        return True # nothing to judge by
+    for message in messages[turn_start + 1:]:
+        if isinstance(message, ToolMessage) and (message.status == "error" or _text(message).startswith(("Error", "HTTP Error"))):
+            return True # a tool call failed, the retry gets the better model
+
+    text = _text(messages[turn_start])
+    return len(text) > MODEL_ESCALATION_CHARS or bool(_ACTION_WORDS.search(text)) or bool(_CODE_MARKERS.search(text))
+
+
+def route_model(agent: str, node: Optional[str] = None, messages: Sequence[BaseMessage] = ()) -> ModelRoute:
+    route = _routes.get(f"{agent}.{node}") if node else None
+    route = route or _routes.get(agent) or STRONG_TIER
+
+    escalated = False
+    if route == AUTO_ROUTE:
+        escalated = not MODEL_ESCALATION_ENABLED or needs_strong_model(messages)
+        route = STRONG_TIER if escalated else FAST_TIER
+    if route in _tiers:
+        resolved = ModelRoute(model=_tiers[route], tier=route, escalated=escalated)
+    else:
+        resolved = ModelRoute(model=route, tier="pinned")
+
+    metrics.increment("llm.routed", agent=agent, node=node or "", tier=resolved.tier)
+    logger.debug(f"🧭 {agent}.{node or '*'} -> {resolved.model} ({resolved.tier})")
+    return resolved
+
+
+def record_tier_usage(tier: str, model: str, usage: Optional[dict], seconds: float, first_token_seconds: Optional[float] = None):
+    metrics.increment("llm.tier_calls", tier=tier, model=model)
+    if usage and usage.get("total_tokens"):
+        metrics.increment("llm.tier_tokens", usage["total_tokens"], tier=tier, model=model)
+    metrics.observe("llm.tier_latency_seconds", seconds, tier=tier, model=model)
+    if first_token_seconds is not None:
+        metrics.observe("llm.tier_first_token_seconds", first_token_seconds, tier=tier, model=model)
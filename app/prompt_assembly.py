@@ -0,0 +1,134 @@
+"""
+Prompt assembly ordered for provider-side prompt caching.
+
+OpenAI caches the longest prompt prefix it has seen recently (from 1024 tokens, in steps of 128), so a turn is
+only cheap and fast if its prompt starts with exactly the same bytes as the previous one. assemble_prompt lays a
+prompt out from the most stable part to the least stable one:
+
+1. static instructions   - the agent's system prompt, never interpolated
+2. tool schemas          - sent by the API ahead of the messages; bound in a fixed order by the agent
+3. user context          - per user (agent_prompt, the app's routes...), the same from one turn to the next
+4. page HTML             - changes only when the page is edited
+5. history               - grows by a few messages per turn
+6. turn context          - whatever changes every turn (e.g. the selected element), so it invalidates nothing
+
+Anything that used to be interpolated into the system prompt goes in its own segment instead, so it can't shift
+the bytes of the stable part. `breakpoints` are the message positions where each segment ends, always the same for
+the same layout, for providers with explicit cache markers. `cache_key` identifies the static prefix (instructions +
+tool schemas); with LLAMABOT_PROMPT_CACHE_KEY=true it's sent as OpenAI's prompt_cache_key, so requests sharing a
+prefix are routed to the same cache.
+
+How much of the prompt was served from cache is read from the usage metadata and reported as
+llm.prompt_tokens / llm.cached_prompt_tokens / llm.prompt_cache_hit_ratio (see record_prompt_cache_usage).
+
+With `agent`, the history is fitted to that agent's context policy for `model` first (see context_window.py), with
+what the other segments and the tool schemas take counted against the budget. page_token_budget says how much room
+that leaves for the page, for callers that have to show less of it.
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence
+import hashlib
+import os
+
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from app.context_window import (
+    CHARS_PER_TOKEN,
+    MESSAGE_OVERHEAD_TOKENS,
+    estimate_history_tokens,
+    estimate_message_tokens,
+    fit_history,
+    get_context_policy,
+    latest_human_message,
+)
+from app.metrics import metrics
+from app.serialization import dumps
+
+PROMPT_CACHE_KEY_ENABLED = os.getenv("LLAMABOT_PROMPT_CACHE_KEY", "false").lower() in ("1", "true", "yes")
+
+
+@dataclass
+class AssembledPrompt:
+    messages: List[BaseMessage]
+    breakpoints: List[int] = field(default_factory=list) # index just past each stable segment
+    cache_key: str = ""
+
+    def model_kwargs(self) -> dict:
+        """Extra request parameters for the model call."""
+        if not PROMPT_CACHE_KEY_ENABLED or not self.cache_key:
+            return {}
+        # Not in the openai SDK we pin yet, so it goes in as a raw body field.
+        return {"extra_body": {"prompt_cache_key": self.cache_key}}
+
+    def bind(self, model):
+        """`model` (usually already bound to its tools) with model_kwargs() bound too, if there are any."""
+        kwargs = self.model_kwargs()
+        return model.bind(**kwargs) if kwargs else model
+
+
+def prompt_cache_key(instructions: str, tools: Sequence = ()) -> str:
+    return _cache_key(instructions, [convert_to_openai_tool(tool) for tool in tools])
+
+
+def _cache_key(instructions: str, schemas: list) -> str:
+    digest = hashlib.blake2b(digest_size=12)
+    digest.update(instructions.encode("utf-8"))
+    digest.update(dumps(schemas).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def reserved_tokens(messages: Sequence[BaseMessage], tools: Sequence = ()) -> int:
+    """Estimated tokens of the non-history messages and the tool schemas, to pass to fit_history."""
+    return _reserved_tokens(messages, [convert_to_openai_tool(tool) for tool in tools])
+
+
+def _reserved_tokens(messages: Sequence[BaseMessage], schemas: list) -> int:
+    return estimate_history_tokens(messages) + len(dumps(schemas)) // CHARS_PER_TOKEN
+
+
+def page_token_budget(instructions: str, history: Sequence[BaseMessage], tools: Sequence = (),
+                      user_context: Optional[str] = None, turn_context: Optional[str] = None,
+                      agent: Optional[str] = None, model: Optional[str] = None) -> int:
+    """
+    Tokens the page segment may take: the ceiling, less the other segments, the tool schemas and the latest human
+    message (always sent). Whatever the page leaves of that goes to the rest of the history.
+    """
+    segments = [SystemMessage(content=content) for content in (instructions, user_context, turn_context) if content]
+    request = latest_human_message(history)
+    taken = reserved_tokens(segments, tools) + (estimate_message_tokens(request) if request is not None else 0)
+    return get_context_policy(agent, model).max_tokens - taken - MESSAGE_OVERHEAD_TOKENS
+
+
+def assemble_prompt(instructions: str, history: Sequence[BaseMessage], tools: Sequence = (),
+                    user_context: Optional[str] = None, page_html: Optional[str] = None,
+                    turn_context: Optional[str] = None, agent: Optional[str] = None,
+                    model: Optional[str] = None) -> AssembledPrompt:
+    schemas = [convert_to_openai_tool(tool) for tool in tools]
+    messages: List[BaseMessage] = [SystemMessage(content=instructions)]
+    breakpoints = [len(messages)]
+    if user_context:
+        messages.append(SystemMessage(content=user_context))
+        breakpoints.append(len(messages))
+    if page_html:
+        messages.append(SystemMessage(content=f"<CURRENT_PAGE_HTML>{page_html}</CURRENT_PAGE_HTML>"))
+        breakpoints.append(len(messages))
+    turn_message = SystemMessage(content=turn_context) if turn_context else None
+    if agent:
+        reserved = _reserved_tokens(messages + ([turn_message] if turn_message else []), schemas)
+        history = fit_history(history, reserved_tokens=reserved, agent=agent, model=model)
+    messages.extend(history)
+    if turn_message:
+        messages.append(turn_message)
+    return AssembledPrompt(messages, breakpoints, _cache_key(instructions, schemas))
+
+
+def record_prompt_cache_usage(model: str, usage: Optional[dict]):
+    """Report prompt tokens, and how many of them were cache hits, from a response's usage_metadata."""
+    if not usage or not usage.get("input_tokens"):
+        return
+    prompt_tokens = usage["input_tokens"]
+    cached_tokens = (usage.get("input_token_details") or {}).get("cache_read") or 0
+    metrics.increment("llm.prompt_tokens", prompt_tokens, model=model)
+    metrics.increment("llm.cached_prompt_tokens", cached_tokens, model=model)
+    metrics.observe("llm.prompt_cache_hit_ratio", cached_tokens / prompt_tokens, model=model)
@@ -0,0 +1,138 @@
+"""
+Background runs: agent runs that belong to the server, not to the connection that asked for them.
+
+POST /runs queues a run for a thread and agent and returns its run_id right away. Runs execute on a pool of
+LLAMABOT_BACKGROUND_RUN_WORKERS workers (and, like every run, through the admission scheduler), so a burst
+queues up instead of starting everything at once. Nobody has to stay connected: a run keeps going with no client
+attached and is only stopped by an explicit cancel.
+
+A background run is a resumable run (websocket/resumable_runs.py) that is never cancelled for lack of a client.
+Its frames are kept in its event log (LLAMABOT_BACKGROUND_RUN_EVENT_LOG_SIZE frames) and stay available for
+LLAMABOT_BACKGROUND_RUN_RETENTION_SECONDS after it ends, so a late subscriber catches up from the start. Clients
+can poll GET /runs/{run_id} and /runs/{run_id}/events, stream /runs/{run_id}/stream (SSE), or attach over the
+websocket with {"type": "resume", "run_id": ..., "thread_id": ...}. The thread's checkpoint keeps the final state
+for good. Like a resume, every /runs/{run_id}/... request names the run's thread_id (and tenant, if it was started
+with one) as query parameters, and only background runs are served there: the websocket and SSE runs in the same
+registry belong to their connections.
+
+Limitation: the event log lives in the memory of the worker that runs it. It's gone after a restart, and other
+workers don't know the run: with several workers, /runs/{run_id}/... only answers on the worker that accepted the
+POST (route by run_id, e.g. sticky sessions), and 404s elsewhere. What survives is the thread's checkpoint
+(GET /chat-history/{thread_id}).
+"""
+from typing import Optional
+import asyncio
+import logging
+import os
+import uuid
+
+from fastapi import FastAPI
+
+from app.cancellation import cancel_run_task
+from app.metrics import metrics
+from app.websocket.request_handler import RequestHandler
+from app.websocket.resumable_runs import ResumableRun, run_registry, task_outcome
+from app.websocket.stream_protocol import DELTA_PROTOCOL_VERSION, negotiate_protocol_version
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND_RUN_WORKERS = int(os.getenv("LLAMABOT_BACKGROUND_RUN_WORKERS", "4"))
+BACKGROUND_RUN_MAX_QUEUED = int(os.getenv("LLAMABOT_BACKGROUND_RUN_MAX_QUEUED", "100"))
+BACKGROUND_RUN_EVENT_LOG_SIZE = int(os.getenv("LLAMABOT_BACKGROUND_RUN_EVENT_LOG_SIZE", "5000"))
+BACKGROUND_RUN_RETENTION_SECONDS = float(os.getenv("LLAMABOT_BACKGROUND_RUN_RETENTION_SECONDS", "3600"))
+
+
+class RunQueueFull(Exception):
+    """Too many background runs are already waiting for a worker."""
+
+
+class RunManager:
+    def __init__(self, app: FastAPI, workers: Optional[int] = None, max_queued: Optional[int] = None, registry=run_registry):
+        self.request_handler = RequestHandler(app)
+        self.registry = registry
+        self.max_queued = max_queued if max_queued is not None else BACKGROUND_RUN_MAX_QUEUED
+        self.workers = asyncio.Semaphore(workers if workers is not None else BACKGROUND_RUN_WORKERS)
+        self.runs: dict = {} # run_id -> ResumableRun, for runs started here that haven't ended yet
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for run in self.runs.values() if run.queued)
+
+    def submit(self, message: dict) -> ResumableRun:
+        """
+        Queue a run of message["agent_name"] on message["thread_id"]. Raises RunQueueFull if the queue is full, and
+        RunIdInUse if message["run_id"] is the id of a run that's still around.
+        """
+        if self.queued >= self.max_queued:
+            metrics.increment("runs.background_rejected")
+            raise RunQueueFull(f"{self.queued} background runs are already queued")
+        message = dict(message)
+        protocol_version = negotiate_protocol_version(message.pop("protocol", DELTA_PROTOCOL_VERSION))
+        tenant = message.pop("tenant", None)
+        thread_id = f"{message.get('thread_id') or uuid.uuid4()}"
+        message["thread_id"] = thread_id
+        run_id = message.pop("run_id", None) or str(uuid.uuid4())
+
+        run = self.registry.create(run_id, thread_id, log_size=BACKGROUND_RUN_EVENT_LOG_SIZE, background=True, tenant=tenant)
+        run.queued = True
+        run.task = asyncio.create_task(self._execute(run, message, protocol_version, tenant))
+        run.task.add_done_callback(lambda task: self._finish(run, task))
+        self.runs[run_id] = run
+        metrics.set_gauge("runs.background_queued", self.queued)
+        logger.info(f"📥 Queued background run {run_id} on thread {thread_id} ({message.get('agent_name')})")
+        return run
+
+    async def _execute(self, run: ResumableRun, message: dict, protocol_version: int, tenant: Optional[str]):
+        async with self.workers:
+            run.queued = False
+            metrics.set_gauge("runs.background_queued", self.queued)
+            # The run stands in for a connection: it keys the RequestHandler's per-connection state.
+            context = self.request_handler.get_context(run)
+            context.protocol_version = protocol_version
+            context.tenant = tenant
+            try:
+                await self.request_handler.handle_request(message, run, run_id=run.run_id)
+            finally:
+                self.request_handler.cleanup_connection(run)
+
+    def _finish(self, run: ResumableRun, task: asyncio.Task):
+        outcome = task_outcome(task)
+        if outcome == "failed":
+            logger.info(f"Background run {run.run_id} failed: {task.exception()}") # already in its event log
+        self.runs.pop(run.run_id, None)
+        self.registry.finish(run.run_id, outcome, retention_seconds=BACKGROUND_RUN_RETENTION_SECONDS)
+        metrics.increment("runs.background_finished", outcome=outcome)
+        metrics.set_gauge("runs.background_queued", self.queued)
+
+    def get(self, run_id: str, thread_id: Optional[str] = None, tenant: Optional[str] = None) -> Optional[ResumableRun]:
+        """The background run `run_id`, if the caller named its thread (and tenant). None otherwise."""
+        run = self.registry.get(run_id)
+        if run is None or not run.background or not run.belongs_to(thread_id, tenant):
+            return None
+        return run
+
+    def cancel(self, run_id: str, thread_id: Optional[str] = None, tenant: Optional[str] = None) -> bool:
+        """Cancel a queued or running background run. Returns False if there is no such run or it already ended."""
+        run = self.get(run_id, thread_id, tenant)
+        if run is None or run.finished or run.task is None:
+            return False
+        return cancel_run_task(run.task, run_id)
+
+    def describe(self, run: ResumableRun) -> dict:
+        return {
+            "run_id": run.run_id,
+            "thread_id": run.thread_id,
+            "status": run.status,
+            "background": run.background,
+            "attached": run.subscriber is not None,
+            "last_seq": run.log.last_seq,
+            "created_at": run.created_at,
+            "finished_at": run.finished_at,
+        }
+
+    async def shutdown(self):
+        """Cancel whatever is still queued or running (on server shutdown)."""
+        tasks = [run.task for run in self.runs.values() if run.task is not None and not run.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,113 @@
+"""
+Server-Sent Events transport for agent runs, for clients that can't use the websocket (POST /llamabot-chat-message-v2).
+
+A run streamed over SSE is an ordinary resumable run (see websocket/resumable_runs.py): its frames are the same
+v1/v2 frames the websocket sends, numbered per run. Every event carries `id: <run_id>:<seq>`, so a client that
+lost the response can send the same request again with a `Last-Event-ID` header and gets the events it missed,
+then the live ones. While no event is due, a comment line is sent every LLAMABOT_SSE_HEARTBEAT_SECONDS so proxies
+neither buffer the response nor time it out.
+"""
+from typing import Awaitable, Callable, Optional, Tuple
+import asyncio
+import logging
+import os
+
+from app.serialization import dumps
+from app.websocket.resumable_runs import ResumableRun
+
+logger = logging.getLogger(__name__)
+
+SSE_HEARTBEAT_SECONDS = float(os.getenv("LLAMABOT_SSE_HEARTBEAT_SECONDS", "15"))
+# Reconnect delay we suggest to the client (the `retry:` field).
+SSE_RETRY_MS = int(os.getenv("LLAMABOT_SSE_RETRY_MS", "2000"))
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no", # nginx: don't buffer the stream
+}
+
+
+def format_sse_event(data: dict, event_id: Optional[str] = None, event: Optional[str] = None) -> str:
+    """One SSE event. The JSON payload never contains a raw newline, so it fits on a single `data:` line."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def format_sse_comment(text: str = "") -> str:
+    return f": {text}\n\n"
+
+
+def make_event_id(run_id: str, seq: int) -> str:
+    return f"{run_id}:{seq}"
+
+
+def parse_event_id(value: Optional[str]) -> Tuple[Optional[str], int]:
+    """Split a Last-Event-ID into (run_id, seq). Returns (None, 0) for a missing or malformed id."""
+    if not value or ":" not in value:
+        return None, 0
+    run_id, seq = value.rsplit(":", 1)
+    try:
+        return run_id, int(seq)
+    except ValueError:
+        return None, 0
+
+
+class SseSubscriber:
+    """Takes the place of a websocket's OutboundQueue as a run's subscriber: frames wait here for the SSE response."""
+
+    def __init__(self):
+        self.frames: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+
+    def put(self, frame: Optional[dict]):
+        self.frames.put_nowait(frame)
+
+    def end(self):
+        self.put(None) # the run is over, once everything queued before this is sent
+
+    def close(self):
+        self.closed = True
+
+
+async def sse_run_events(run: ResumableRun, subscriber: SseSubscriber,
+                         is_disconnected: Callable[[], Awaitable[bool]],
+                         heartbeat_seconds: Optional[float] = None):
+    """
+    The body of an SSE response streaming `run`, whose frames are published to `subscriber` (already attached).
+    Ends with a `final` event once the run is over. If the client goes away first (the response is cancelled, or
+    a heartbeat finds the request disconnected), the run is detached, and cancelled unless it's resumed in time.
+    """
+    heartbeat_seconds = heartbeat_seconds if heartbeat_seconds is not None else SSE_HEARTBEAT_SECONDS
+    if run.task is not None:
+        run.task.add_done_callback(lambda _: subscriber.end())
+    elif run.finished:
+        subscriber.end()
+
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        while True:
+            try:
+                frame = await asyncio.wait_for(subscriber.frames.get(), heartbeat_seconds)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    logger.info(f"SSE client of run {run.run_id} went away")
+                    break
+                yield format_sse_comment("heartbeat")
+                continue
+            if frame is None:
+                yield format_sse_event({
+                    "type": "final",
+                    "run_id": run.run_id,
+                    "thread_id": run.thread_id,
+                    "last_seq": run.log.last_seq
+                })
+                break
+            yield format_sse_event(frame, event_id=make_event_id(run.run_id, frame["seq"]))
+    finally:
+        subscriber.close()
+        run.detach(subscriber)
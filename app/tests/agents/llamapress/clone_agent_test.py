@@ -60,7 +60,7 @@ def test_clone_routing():
     assert result["next"] == "image_clone_agent"
 
 @pytest.mark.asyncio
-@patch('app.agents.llamapress.clone_agent.ChatOpenAI')
+@patch('app.agents.llamapress.clone_agent.get_routed_chat_model')
 async def test_clone_workflow(mock_chat_openai):
     """Test that a message containing 'clone' (but not 'deep clone') routes through the image_clone_agent path."""
     # Mock the LLM response for image_clone_agent with proper AIMessage (no tool calls)
@@ -73,7 +73,7 @@ async def test_clone_workflow(mock_chat_openai):
     )
     
     mock_bind_tools = MagicMock()
-    mock_bind_tools.invoke.return_value = mock_response
+    mock_bind_tools.ainvoke = AsyncMock(return_value=mock_response)
     mock_llm_instance.bind_tools.return_value = mock_bind_tools
     
     # Build workflow
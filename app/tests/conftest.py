@@ -15,6 +15,8 @@ os.environ.pop("LANGCHAIN_ENDPOINT", None)
 os.environ.pop("LANGSMITH_RUNS_ENDPOINTS", None)
 os.environ.pop("LANGCHAIN_API_KEY", None)
 os.environ.pop("LANGSMITH_API_KEY", None)
+# Test runs log to stderr only, never into a file in the source tree
+os.environ["LLAMABOT_LOG_FILE"] = ""
 
 # Add the backend directory to the Python path
 import sys
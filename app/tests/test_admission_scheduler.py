@@ -0,0 +1,102 @@
+"""
+Tests for the admission scheduler (per-thread ordering, global/tenant caps, fairness, timeouts).
+"""
+import asyncio
+import pytest
+
+from app.admission_scheduler import AdmissionRejected, AdmissionScheduler
+from app.metrics import metrics
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+class TestAdmissionScheduler:
+    """Test admitting runs through the scheduler."""
+
+    @pytest.mark.asyncio
+    async def test_runs_on_one_thread_are_serialized(self):
+        scheduler = AdmissionScheduler(max_concurrent=10)
+        order = []
+
+        async def run(name):
+            async with scheduler.admit("t1"):
+                order.append(f"start {name}")
+                await asyncio.sleep(0.01)
+                order.append(f"end {name}")
+
+        await asyncio.gather(run("a"), run("b"))
+        assert order == ["start a", "end a", "start b", "end b"]
+        assert scheduler.threads == {} # idle entries are dropped
+
+    @pytest.mark.asyncio
+    async def test_global_cap_and_round_robin_across_threads(self):
+        scheduler = AdmissionScheduler(max_concurrent=1)
+        admitted = []
+        release = asyncio.Event()
+
+        async def run(thread_id, name):
+            async with scheduler.admit(thread_id):
+                admitted.append(name)
+                await release.wait()
+
+        # t1 is busy and has another run queued before t2's run arrives; t2 still goes next.
+        tasks = [asyncio.create_task(run("t1", "t1-a")), asyncio.create_task(run("t1", "t1-b")), asyncio.create_task(run("t2", "t2-a"))]
+        await settle()
+        assert admitted == ["t1-a"]
+        assert scheduler.queued == 2
+        release.set()
+        await asyncio.gather(*tasks)
+        assert admitted == ["t1-a", "t2-a", "t1-b"]
+
+    @pytest.mark.asyncio
+    async def test_tenant_cap_lets_other_tenants_through(self):
+        scheduler = AdmissionScheduler(max_concurrent=10, max_per_tenant=1)
+        release = asyncio.Event()
+        admitted = []
+
+        async def run(thread_id, tenant):
+            async with scheduler.admit(thread_id, tenant=tenant):
+                admitted.append(thread_id)
+                await release.wait()
+
+        tasks = [asyncio.create_task(run(thread_id, tenant)) for thread_id, tenant in (("a1", "acme"), ("a2", "acme"), ("b1", "globex"))]
+        await settle()
+        assert admitted == ["a1", "b1"]
+        release.set()
+        await asyncio.gather(*tasks)
+        assert scheduler.stats() == {"running": 0, "queued": 0, "threads": 0, "running_by_tenant": {}}
+
+    @pytest.mark.asyncio
+    async def test_full_thread_queue_is_rejected(self):
+        scheduler = AdmissionScheduler(max_queued_per_thread=1)
+        release = asyncio.Event()
+
+        async def run():
+            async with scheduler.admit("t1"):
+                await release.wait()
+
+        tasks = [asyncio.create_task(run()), asyncio.create_task(run())]
+        await settle()
+        assert scheduler.is_thread_queue_full("t1")
+        with pytest.raises(AdmissionRejected):
+            await scheduler.acquire("t1")
+        release.set()
+        await asyncio.gather(*tasks)
+
+    @pytest.mark.asyncio
+    async def test_queued_run_times_out_and_is_removed(self):
+        scheduler = AdmissionScheduler(max_concurrent=1)
+        timeouts = metrics.counter("admission.timeouts")
+        await scheduler.acquire("t1")
+
+        with pytest.raises(AdmissionRejected):
+            await scheduler.acquire("t2", timeout=0.01)
+        assert scheduler.queued == 0
+        assert "t2" not in scheduler.threads
+        assert metrics.counter("admission.timeouts") == timeouts + 1
+
+        scheduler.release("t1")
+        assert scheduler.stats()["running"] == 0
@@ -4,7 +4,7 @@ Tests for agent functionality.
 import pytest
 import asyncio
 from unittest.mock import AsyncMock, MagicMock, patch
-import requests
+import httpx
 
 from app.agents.base_agent import BaseAgent
 from app.agents.llamabot_v1.nodes import run_rails_console_command, LlamaBotState
@@ -36,10 +36,20 @@ class TestBaseAgent:
 
 class TestLlamaBotV1Nodes:
     """Test LlamaBot V1 node functionality."""
-    
-    @patch('agents.llamabot_v1.nodes.requests.post')
+
+    @staticmethod
+    def mock_async_client(mock_httpx_client, response=None, side_effect=None):
+        mock_client_instance = MagicMock()
+        mock_client_instance.__aenter__.return_value = mock_client_instance
+        mock_client_instance.__aexit__.return_value = None
+        mock_client_instance.post = AsyncMock(return_value=response, side_effect=side_effect)
+        mock_httpx_client.return_value = mock_client_instance
+        return mock_client_instance
+
+    @pytest.mark.asyncio
+    @patch('agents.llamabot_v1.nodes.httpx.AsyncClient')
     @patch('agents.llamabot_v1.nodes.os.getenv')
-    def test_run_rails_console_command_success(self, mock_getenv, mock_post):
+    async def test_run_rails_console_command_success(self, mock_getenv, mock_httpx_client):
         """Test successful rails console command execution."""
         # Setup mocks
         mock_getenv.return_value = "http://test-server.com"
@@ -49,7 +59,7 @@ class TestLlamaBotV1Nodes:
             'result': {'data': 'test_result'},
             'type': 'success'
         }
-        mock_post.return_value = mock_response
+        mock_client = self.mock_async_client(mock_httpx_client, mock_response)
         
         # Create test state with all required fields
         state = {
@@ -58,8 +68,8 @@ class TestLlamaBotV1Nodes:
             'messages': []
         }
         
-        # Execute function using tool invoke
-        result = run_rails_console_command.invoke({
+        # Execute function using async tool invoke
+        result = await run_rails_console_command.ainvoke({
             'rails_console_command': 'User.count',
             'message_to_user': 'Counting users',
             'internal_thoughts': 'Getting user count',
@@ -67,7 +77,7 @@ class TestLlamaBotV1Nodes:
         })
         
         # Verify the request was made correctly
-        mock_post.assert_called_once_with(
+        mock_client.post.assert_called_once_with(
             "http://test-server.com/llama_bot/agent/command",
             json={'command': 'User.count'},
             headers={
@@ -81,16 +91,17 @@ class TestLlamaBotV1Nodes:
         assert 'test_result' in result
         assert isinstance(result, str)
     
-    @patch('agents.llamabot_v1.nodes.requests.post')
+    @pytest.mark.asyncio
+    @patch('agents.llamabot_v1.nodes.httpx.AsyncClient')
     @patch('agents.llamabot_v1.nodes.os.getenv')
-    def test_run_rails_console_command_http_error(self, mock_getenv, mock_post):
+    async def test_run_rails_console_command_http_error(self, mock_getenv, mock_httpx_client):
         """Test rails console command with HTTP error."""
         # Setup mocks
         mock_getenv.return_value = "http://test-server.com"
         mock_response = MagicMock()
         mock_response.status_code = 401
         mock_response.text = "Unauthorized"
-        mock_post.return_value = mock_response
+        self.mock_async_client(mock_httpx_client, mock_response)
         
         # Create test state with all required fields
         state = {
@@ -99,8 +110,8 @@ class TestLlamaBotV1Nodes:
             'messages': []
         }
         
-        # Execute function using tool invoke
-        result = run_rails_console_command.invoke({
+        # Execute function using async tool invoke
+        result = await run_rails_console_command.ainvoke({
             'rails_console_command': 'User.count',
             'message_to_user': 'Counting users',
             'internal_thoughts': 'Getting user count',
@@ -111,13 +122,14 @@ class TestLlamaBotV1Nodes:
         assert "HTTP Error 401" in result
         assert "Unauthorized" in result
     
-    @patch('agents.llamabot_v1.nodes.requests.post')
+    @pytest.mark.asyncio
+    @patch('agents.llamabot_v1.nodes.httpx.AsyncClient')
     @patch('agents.llamabot_v1.nodes.os.getenv')
-    def test_run_rails_console_command_connection_error(self, mock_getenv, mock_post):
+    async def test_run_rails_console_command_connection_error(self, mock_getenv, mock_httpx_client):
         """Test rails console command with connection error."""
         # Setup mocks
         mock_getenv.return_value = "http://test-server.com"
-        mock_post.side_effect = requests.exceptions.ConnectionError("Connection failed")
+        self.mock_async_client(mock_httpx_client, side_effect=httpx.ConnectError("Connection failed"))
         
         # Create test state with all required fields
         state = {
@@ -126,8 +138,8 @@ class TestLlamaBotV1Nodes:
             'messages': []
         }
         
-        # Execute function using tool invoke
-        result = run_rails_console_command.invoke({
+        # Execute function using async tool invoke
+        result = await run_rails_console_command.ainvoke({
             'rails_console_command': 'User.count',
             'message_to_user': 'Counting users',
             'internal_thoughts': 'Getting user count',
@@ -137,16 +149,17 @@ class TestLlamaBotV1Nodes:
         # Verify error handling
         assert "Could not connect to Rails server" in result
     
-    @patch('agents.llamabot_v1.nodes.requests.post')
+    @pytest.mark.asyncio
+    @patch('agents.llamabot_v1.nodes.httpx.AsyncClient')
     @patch('agents.llamabot_v1.nodes.os.getenv')
-    def test_run_rails_console_command_missing_token(self, mock_getenv, mock_post):
+    async def test_run_rails_console_command_missing_token(self, mock_getenv, mock_httpx_client):
         """Test rails console command with missing API token."""
         # Setup mocks
         mock_getenv.return_value = "http://test-server.com"
         mock_response = MagicMock()
         mock_response.status_code = 401
         mock_response.text = "Unauthorized"
-        mock_post.return_value = mock_response
+        mock_client = self.mock_async_client(mock_httpx_client, mock_response)
         
         # Create test state with empty api_token to simulate missing token
         state = {
@@ -155,8 +168,8 @@ class TestLlamaBotV1Nodes:
             'messages': []
         }
         
-        # Execute function using tool invoke
-        result = run_rails_console_command.invoke({
+        # Execute function using async tool invoke
+        result = await run_rails_console_command.ainvoke({
             'rails_console_command': 'User.count',
             'message_to_user': 'Counting users',
             'internal_thoughts': 'Getting user count',
@@ -164,7 +177,7 @@ class TestLlamaBotV1Nodes:
         })
         
         # Verify the request was made with empty token
-        mock_post.assert_called_once_with(
+        mock_client.post.assert_called_once_with(
             "http://test-server.com/llama_bot/agent/command",
             json={'command': 'User.count'},
             headers={
@@ -0,0 +1,133 @@
+"""
+Tests for end-to-end cancellation (cancellation.py): cancelling a run aborts the in-flight provider request and
+tool HTTP calls, quickly.
+"""
+import asyncio
+import time
+import pytest
+import httpx
+from unittest.mock import MagicMock, patch
+from langchain_core.messages import HumanMessage
+from langgraph.checkpoint.memory import MemorySaver
+
+from app.cancellation import cancel_run_task
+from app.llm_client import get_chat_model
+from app.metrics import metrics
+from app.agents.llamabot_v1 import nodes as llamabot_nodes
+
+# Cancel-to-stop must stay well under this, or the provider keeps generating tokens nobody will read.
+CANCEL_LATENCY_BOUND_SECONDS = 0.5
+
+
+class HangingRequests:
+    """An httpx transport handler that never answers, and notes when a request is aborted."""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.aborted = asyncio.Event()
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.started.set()
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.aborted.set()
+            raise
+
+
+async def cancel_and_time(task: asyncio.Task, run_id: str = "run-1") -> float:
+    started_at = time.monotonic()
+    assert cancel_run_task(task, run_id)
+    await asyncio.gather(task, return_exceptions=True)
+    return time.monotonic() - started_at
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+class TestCancelRunTask:
+    """Test the cancel helper and its latency metric."""
+
+    @pytest.mark.asyncio
+    async def test_records_cancel_latency(self):
+        task = asyncio.create_task(asyncio.Event().wait())
+        await asyncio.sleep(0)
+        latency = await cancel_and_time(task)
+        await asyncio.sleep(0)
+
+        assert task.cancelled()
+        summary = metrics.summary("runs.cancel_latency_seconds", reason="cancel")
+        assert summary["count"] == 1
+        assert latency < CANCEL_LATENCY_BOUND_SECONDS
+        assert metrics.counter("runs.cancelled", reason="cancel") == 1
+
+    @pytest.mark.asyncio
+    async def test_done_task_is_left_alone(self):
+        task = asyncio.create_task(asyncio.sleep(0))
+        await task
+        assert not cancel_run_task(task)
+        assert metrics.summary("runs.cancel_latency_seconds", reason="cancel") is None
+
+
+class TestEndToEndCancellation:
+    """Test that cancelling aborts the underlying I/O, not just the asyncio task."""
+
+    @pytest.mark.asyncio
+    async def test_aborts_provider_stream(self):
+        hanging = HangingRequests()
+        llm = get_chat_model("gpt-4o", api_key="test", max_retries=0,
+                             http_async_client=httpx.AsyncClient(transport=httpx.MockTransport(hanging)))
+
+        async def consume():
+            async for _ in llm.astream([HumanMessage(content="hi")]):
+                pass
+
+        task = asyncio.create_task(consume())
+        await asyncio.wait_for(hanging.started.wait(), 5)
+        latency = await cancel_and_time(task)
+
+        assert hanging.aborted.is_set()
+        assert latency < CANCEL_LATENCY_BOUND_SECONDS
+
+    @pytest.mark.asyncio
+    async def test_aborts_llm_call_inside_agent_node(self):
+        llm_call = HangingRequests()
+
+        async def hanging_ainvoke(messages, *args, **kwargs):
+            return await llm_call(None)
+
+        llm = MagicMock()
+        llm.bind_tools.return_value.ainvoke = hanging_ainvoke
+        workflow = llamabot_nodes.build_workflow(checkpointer=MemorySaver())
+        state = {"messages": [HumanMessage(content="hi")], "api_token": "", "agent_prompt": ""}
+
+        with patch.object(llamabot_nodes, "get_routed_chat_model", return_value=llm):
+            task = asyncio.create_task(workflow.ainvoke(state, config={"configurable": {"thread_id": "cancel-1"}}))
+            await asyncio.wait_for(llm_call.started.wait(), 5)
+            latency = await cancel_and_time(task)
+
+        assert llm_call.aborted.is_set()
+        assert latency < CANCEL_LATENCY_BOUND_SECONDS
+
+    @pytest.mark.asyncio
+    async def test_aborts_rails_request_in_tool(self):
+        hanging = HangingRequests()
+        real_async_client = httpx.AsyncClient
+
+        def client_with_hanging_transport(**kwargs):
+            return real_async_client(transport=httpx.MockTransport(hanging), **kwargs)
+
+        with patch.object(llamabot_nodes.httpx, "AsyncClient", side_effect=client_with_hanging_transport), \
+             patch.dict("os.environ", {"LLAMAPRESS_API_URL": "http://rails.test"}):
+            task = asyncio.create_task(llamabot_nodes.rails_https_request.ainvoke({
+                "route": "users", "method": "GET", "params": None, "state": {"api_token": "token"}
+            }))
+            await asyncio.wait_for(hanging.started.wait(), 5)
+            latency = await cancel_and_time(task)
+
+        assert hanging.aborted.is_set()
+        assert latency < CANCEL_LATENCY_BOUND_SECONDS
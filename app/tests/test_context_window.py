@@ -0,0 +1,180 @@
+"""
+Tests for context-window budgeting (context_window.py).
+"""
+import pytest
+from unittest.mock import patch
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+
+from app import context_window
+from app.context_window import (
+    ContextPolicy, estimate_history_tokens, estimate_message_tokens, fit_history, get_context_policy, model_context_ceiling,
+    parse_context_policies, split_turns,
+)
+from app.metrics import metrics
+from app.prompt_assembly import assemble_prompt
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def page_edit_turn(index: int, page_chars: int = 20000):
+    """A page-editing turn: request, write_html_page call carrying the whole page, its echoed result, answer."""
+    call_id = f"call_{index}"
+    page = f"<html>{index}" + "x" * page_chars + "</html>"
+    return [
+        HumanMessage(content=f"edit {index}"),
+        AIMessage(content="", tool_calls=[{"name": "write_html_page", "args": {"full_html_document": page}, "id": call_id}],
+                  additional_kwargs={"tool_calls": [{"id": call_id, "function": {"arguments": page}}]}),
+        ToolMessage(content=page, tool_call_id=call_id),
+        AIMessage(content=f"done {index}"),
+    ]
+
+
+def assert_pairs_intact(messages):
+    call_ids = {call["id"] for message in messages for call in getattr(message, "tool_calls", None) or []}
+    result_ids = {message.tool_call_id for message in messages if isinstance(message, ToolMessage)}
+    assert call_ids == result_ids
+
+
+class TestPolicies:
+    """Test per-agent policies and the estimator."""
+
+    def test_parse_context_policies(self):
+        policies = parse_context_policies("llamapress=40000/4, public_leonardo=20000/10,bad,worse=x/1")
+        assert policies == {"llamapress": ContextPolicy(max_tokens=40000, keep_turns=4),
+                            "public_leonardo": ContextPolicy(max_tokens=20000, keep_turns=10)}
+        assert get_context_policy("nobody") == ContextPolicy()
+
+    def test_ceiling_comes_from_the_model(self):
+        assert model_context_ceiling("gpt-4.1-mini") == 1047576 - 16384
+        assert model_context_ceiling("o4-mini") == 200000 - 16384
+        assert model_context_ceiling("gpt-3.5-turbo") == 16385 - 16385 // 4
+        assert model_context_ceiling("some-new-model") == 128000 - 16384
+        with patch.object(context_window, "CONTEXT_MAX_TOKENS", 0):
+            assert get_context_policy("nobody", "o4-mini").max_tokens == 200000 - 16384
+        with patch.object(context_window, "CONTEXT_MAX_TOKENS", 60000):
+            assert get_context_policy("nobody", "o4-mini").max_tokens == 60000
+        with patch.dict(context_window._policies, {"llamapress": ContextPolicy(max_tokens=500000, keep_turns=2)}):
+            assert get_context_policy("llamapress", "gpt-4o").max_tokens == 128000 - 16384
+
+    def test_estimate_counts_tool_call_arguments(self):
+        call = AIMessage(content="", tool_calls=[{"name": "write_html_page", "args": {"full_html_document": "x" * 4000}, "id": "1"}])
+        assert estimate_message_tokens(call) > 1000
+        assert estimate_message_tokens(HumanMessage(content="x" * 400)) == 104
+
+    def test_split_turns(self):
+        turns = split_turns([SystemMessage(content="s")] + page_edit_turn(1) + page_edit_turn(2))
+        assert [len(turn) for turn in turns] == [1, 4, 4]
+
+
+class TestFitHistory:
+    """Test what's kept, abbreviated and dropped."""
+
+    def test_short_history_is_untouched(self):
+        history = [HumanMessage(content="hi"), AIMessage(content="hello")]
+        assert fit_history(history, ContextPolicy(max_tokens=1000)) == history
+
+    def test_superseded_page_versions_are_replaced(self):
+        history = page_edit_turn(1) + page_edit_turn(2)
+        fitted = fit_history(history, ContextPolicy(max_tokens=100000, keep_turns=6))
+
+        old_call, old_result = fitted[1], fitted[2]
+        assert "superseded page version" in old_call.tool_calls[0]["args"]["full_html_document"]
+        assert "tool_calls" not in old_call.additional_kwargs # the raw call would have carried the page along
+        assert old_result.content == "[superseded page version omitted]"
+        assert fitted[5:] == history[5:] # the latest page is kept whole
+        assert len(history[1].tool_calls[0]["args"]["full_html_document"]) > 20000 # the state isn't changed
+
+    def test_old_turns_get_abbreviated_tool_results(self):
+        history = []
+        for index in range(4):
+            history += [HumanMessage(content=f"q{index}"),
+                        AIMessage(content="", tool_calls=[{"name": "lookup", "args": {"q": "y" * 2000}, "id": f"c{index}"}]),
+                        ToolMessage(content="z" * 2000, tool_call_id=f"c{index}"), AIMessage(content=f"a{index}")]
+        fitted = fit_history(history, ContextPolicy(max_tokens=100000, keep_turns=2, tool_arg_chars=100))
+
+        assert len(fitted) == len(history)
+        assert len(fitted[2].content) < 200 and "chars omitted" in fitted[2].content
+        assert len(fitted[1].tool_calls[0]["args"]["q"]) < 200
+        assert fitted[8:] == history[8:] # the last keep_turns turns are verbatim
+
+    def test_drops_oldest_whole_turns_under_budget(self):
+        history = []
+        for index in range(20):
+            history += [HumanMessage(content=f"q{index}"),
+                        AIMessage(content="", tool_calls=[{"name": "lookup", "args": {"q": "y" * 50}, "id": f"c{index}"}]),
+                        ToolMessage(content="z" * 400, tool_call_id=f"c{index}"), AIMessage(content=f"a{index}" * 100)]
+        policy = ContextPolicy(max_tokens=1500, keep_turns=4)
+        fitted = fit_history(history, policy)
+
+        assert estimate_history_tokens(fitted) <= policy.max_tokens
+        assert isinstance(fitted[0], HumanMessage)
+        assert fitted[-4:] == history[-4:]
+        assert_pairs_intact(fitted)
+        assert metrics.counter("context.turns_dropped", agent="") > 0
+
+    def test_ceiling_holds_for_one_huge_turn(self):
+        history = page_edit_turn(1, page_chars=400000)
+        fitted = fit_history(history, ContextPolicy(max_tokens=2000))
+        assert estimate_history_tokens(fitted) <= 2000
+        assert_pairs_intact(fitted)
+
+    def test_ceiling_holds_for_calls_that_are_all_overhead(self):
+        calls = [{"name": "lookup", "args": {"q": "y"}, "id": f"c{index}"} for index in range(3000)]
+        history = [HumanMessage(content="look everything up"), AIMessage(content="", tool_calls=calls)]
+        history += [ToolMessage(content="ok", tool_call_id=f"c{index}") for index in range(3000)]
+        history.append(AIMessage(content="found it"))
+
+        fitted = fit_history(history, ContextPolicy(max_tokens=1000, keep_turns=2, tool_arg_chars=100))
+        assert estimate_history_tokens(fitted) <= 1000
+        assert_pairs_intact(fitted)
+        assert fitted[-1] == history[-1]
+        assert "3000 tool calls" in fitted[1].content
+
+    def test_latest_request_is_never_cut(self):
+        request = HumanMessage(content="make the hero section match this: " + "x" * 6000)
+        history = page_edit_turn(1, page_chars=8000) + [request, AIMessage(content="y" * 8000)]
+        fitted = fit_history(history, ContextPolicy(max_tokens=3000))
+        assert request in fitted
+        assert estimate_history_tokens(fitted) <= 3000
+
+    def test_prompt_over_the_ceiling_degrades_to_the_latest_request(self):
+        history = page_edit_turn(1, page_chars=2000) + [HumanMessage(content="hi")]
+        fitted = fit_history(history, ContextPolicy(max_tokens=1000), reserved_tokens=1200)
+        assert fitted == [history[-1]]
+        assert metrics.counter("context.budget_exceeded", agent="") == 1
+        # Whatever room is left is respected, however small, as long as the request fits in it.
+        history = [AIMessage(content="x" * 4000), HumanMessage(content="hi")]
+        assert estimate_history_tokens(fit_history(history, ContextPolicy(max_tokens=1000), reserved_tokens=900)) <= 100
+
+    def test_prefix_is_stable_between_boundary_moves(self):
+        history = []
+        for index in range(7):
+            history += page_edit_turn(index, page_chars=2000)
+        policy = ContextPolicy(max_tokens=100000, keep_turns=3, tool_arg_chars=100)
+        first = fit_history(history, policy)
+        second = fit_history(history + [HumanMessage(content="one more")], policy)
+        assert second[:len(first)] == first
+
+
+class TestAssemblePromptBudget:
+    """Test that assemble_prompt budgets the history with the rest of the prompt."""
+
+    def test_other_segments_count_against_the_budget(self):
+        history = []
+        for index in range(30):
+            history += [HumanMessage(content="q" * 400), AIMessage(content="a" * 400)]
+        page = "<p>" + "x" * 20000 + "</p>"
+
+        prompt = assemble_prompt("STATIC", history, page_html=page)
+        assert prompt.messages[2:] == history # no agent, no budgeting
+
+        with patch.dict(context_window._policies, {"llamapress": ContextPolicy(max_tokens=8000, keep_turns=2)}):
+            prompt = assemble_prompt("STATIC", history, page_html=page, agent="llamapress")
+        assert estimate_history_tokens(prompt.messages) <= 8000
+        assert prompt.messages[-1] == history[-1]
+        assert prompt.breakpoints == [1, 2]
@@ -0,0 +1,123 @@
+"""
+Tests for websocket frame encodings (JSON text and binary MessagePack).
+"""
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from fastapi import WebSocketDisconnect
+
+from app.websocket.frame_codec import (
+    JsonFrameCodec,
+    MsgpackFrameCodec,
+    negotiate_frame_encoding,
+    RAW_FRAME_HEADER,
+    ZLIB_FRAME_HEADER,
+    ZLIB_RESET_FRAME_HEADER,
+)
+from app.websocket.web_socket_handler import WebSocketHandler
+
+
+HTML_FRAME = {"type": "message", "v": 2, "id": "m1", "message": {"content": "<section class='p-8'>Hello</section>" * 200}}
+
+
+class TestFrameEncodingNegotiation:
+    """Test picking a frame encoding from what the client offers."""
+
+    def test_defaults_to_json(self):
+        assert negotiate_frame_encoding(None) == "json"
+        assert negotiate_frame_encoding(["cbor"]) == "json"
+
+    def test_honours_client_preference(self):
+        assert negotiate_frame_encoding(["msgpack", "json"]) == "msgpack"
+        assert negotiate_frame_encoding("msgpack") == "msgpack"
+
+
+class TestMsgpackFrameCodec:
+    """Test binary frames and their compression."""
+
+    def test_small_frames_are_not_compressed(self):
+        frame = {"type": "delta", "v": 2, "id": "m1", "text": "Hi"}
+        data = MsgpackFrameCodec(min_bytes=1024).encode(frame)
+
+        assert data[:1] == RAW_FRAME_HEADER
+        assert MsgpackFrameCodec().decode(data) == frame
+
+    def test_large_frames_are_compressed(self):
+        data = MsgpackFrameCodec(min_bytes=1024).encode(HTML_FRAME)
+
+        assert data[:1] == ZLIB_FRAME_HEADER
+        assert len(data) < len(json.dumps(HTML_FRAME)) / 10
+        assert MsgpackFrameCodec().decode(data) == HTML_FRAME
+
+    def test_compression_context_is_kept_across_frames(self):
+        page = "".join(f"<p id='p{i * 7919 % 10007}'>{i ** 3}</p>" for i in range(300))
+        frame = {"type": "message", "id": "m1", "message": {"content": page}}
+        sender, receiver = MsgpackFrameCodec(min_bytes=0), MsgpackFrameCodec()
+        first = sender.encode(frame)
+        second = sender.encode(dict(frame, id="m2"))
+
+        # The second frame repeats the first, so it compresses to a fraction of it.
+        assert len(second) < len(first) / 4
+        assert receiver.decode(first) == frame
+        assert receiver.decode(second) == dict(frame, id="m2")
+
+    def test_rejects_unknown_header(self):
+        with pytest.raises(ValueError):
+            MsgpackFrameCodec().decode(b"\x07abc")
+
+    @pytest.mark.asyncio
+    async def test_send_uses_binary_frames(self):
+        websocket = AsyncMock()
+        size = await MsgpackFrameCodec().send(websocket, {"type": "pong"})
+
+        websocket.send_bytes.assert_called_once()
+        assert size == len(websocket.send_bytes.call_args.args[0])
+
+    @pytest.mark.asyncio
+    async def test_failed_send_starts_a_new_stream(self):
+        sender, receiver = MsgpackFrameCodec(min_bytes=0), MsgpackFrameCodec()
+        websocket = AsyncMock()
+        await sender.send(websocket, HTML_FRAME)
+        assert receiver.decode(websocket.send_bytes.call_args.args[0]) == HTML_FRAME
+
+        websocket.send_bytes.side_effect = [RuntimeError("send failed"), None, None]
+        with pytest.raises(RuntimeError):
+            await sender.send(websocket, dict(HTML_FRAME, id="lost"))
+        await sender.send(websocket, dict(HTML_FRAME, id="m2"))
+        await sender.send(websocket, dict(HTML_FRAME, id="m3"))
+
+        # The receiver never got the lost frame, yet stays in sync with the sender.
+        second, third = (call.args[0] for call in websocket.send_bytes.call_args_list[-2:])
+        assert second[:1] == ZLIB_RESET_FRAME_HEADER
+        assert third[:1] == ZLIB_FRAME_HEADER
+        assert receiver.decode(second) == dict(HTML_FRAME, id="m2")
+        assert receiver.decode(third) == dict(HTML_FRAME, id="m3")
+
+    @pytest.mark.asyncio
+    async def test_json_codec_sends_text(self):
+        websocket = AsyncMock()
+        await JsonFrameCodec().send(websocket, {"type": "pong"})
+        websocket.send_text.assert_called_once_with('{"type":"pong"}')
+
+
+class TestFrameEncodingOverWebSocket:
+    """Test negotiating binary frames through the hello message."""
+
+    @pytest.mark.asyncio
+    async def test_hello_switches_connection_to_msgpack(self):
+        mock_websocket = AsyncMock()
+        mock_manager = MagicMock()
+        mock_manager.connect = AsyncMock()
+        mock_manager.send_personal_message = AsyncMock()
+        mock_websocket.receive_json.side_effect = [
+            {"type": "hello", "protocols": [2], "encodings": ["msgpack", "json"]},
+            WebSocketDisconnect(code=1000, reason="done"),
+        ]
+
+        handler = WebSocketHandler(mock_websocket, mock_manager)
+        context = handler.request_handler.get_context(mock_websocket)
+        await handler.handle_websocket()
+
+        assert context.codec.encoding == "msgpack"
+        reply = mock_manager.send_personal_message.call_args_list[0].args[0]
+        assert reply["encoding"] == "msgpack"
@@ -0,0 +1,121 @@
+"""
+Tests for the websocket heartbeat and the dead-connection reaper.
+"""
+import asyncio
+import json
+import time
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from fastapi import WebSocketDisconnect
+from starlette.websockets import WebSocketState
+
+from app.websocket.web_socket_connection_manager import WebSocketConnectionManager
+from app.websocket.web_socket_handler import WebSocketHandler
+
+
+def make_websocket():
+    websocket = AsyncMock()
+    websocket.client_state = WebSocketState.CONNECTED
+    return websocket
+
+
+def register(manager, websocket, silent_for=0, heartbeat=True):
+    info = manager.register(websocket)
+    info.heartbeat = heartbeat
+    info.last_seen = time.monotonic() - silent_for
+    return info
+
+
+@pytest.fixture
+def heartbeat_settings():
+    with patch("app.websocket.web_socket_connection_manager.HEARTBEAT_INTERVAL_SECONDS", 10), \
+         patch("app.websocket.web_socket_connection_manager.PING_TIMEOUT_SECONDS", 5), \
+         patch("app.websocket.web_socket_connection_manager.REAP_GRACE_SECONDS", 0.1):
+        yield
+
+
+class TestHeartbeat:
+    """Test pinging quiet connections and reaping dead ones."""
+
+    @pytest.mark.asyncio
+    async def test_pings_quiet_connections_only(self, heartbeat_settings):
+        manager = WebSocketConnectionManager(MagicMock())
+        quiet, chatty = make_websocket(), make_websocket()
+        register(manager, quiet, silent_for=11)
+        register(manager, chatty)
+
+        assert await manager.heartbeat() == 0
+        quiet.send_text.assert_called_once_with('{"type":"ping"}')
+        chatty.send_text.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_reaps_connections_that_never_answered(self, heartbeat_settings):
+        manager = WebSocketConnectionManager(MagicMock())
+        dead, alive = make_websocket(), make_websocket()
+        register(manager, dead, silent_for=16)
+        register(manager, alive)
+
+        assert await manager.heartbeat() == 1
+        dead.close.assert_called_once_with(code=1001)
+        assert manager.active_connections == [alive]
+        assert manager.reaped_total == 1
+
+    @pytest.mark.asyncio
+    async def test_quiet_clients_without_the_heartbeat_feature_are_left_alone(self, heartbeat_settings):
+        manager = WebSocketConnectionManager(MagicMock())
+        streaming, closed = make_websocket(), make_websocket()
+        register(manager, streaming, silent_for=600, heartbeat=False) # e.g. a long page generation, nothing sent back
+        register(manager, closed, silent_for=1, heartbeat=False)
+        closed.client_state = WebSocketState.DISCONNECTED # e.g. after a protocol-level ping went unanswered
+
+        assert await manager.heartbeat() == 1
+        streaming.send_text.assert_not_called()
+        streaming.close.assert_not_called()
+        assert manager.active_connections == [streaming]
+
+    @pytest.mark.asyncio
+    async def test_hello_opts_in_to_the_heartbeat(self):
+        manager = WebSocketConnectionManager(MagicMock())
+        websocket = make_websocket()
+        websocket.receive_json.side_effect = [{"type": "hello", "protocols": [2], "features": ["heartbeat"]},
+                                              WebSocketDisconnect()]
+        manager.register(websocket)
+        handler = WebSocketHandler(websocket, manager)
+        info = manager.get_info(websocket)
+
+        await handler.handle_websocket()
+        assert info.heartbeat
+        assert json.loads(websocket.send_text.call_args_list[0].args[0])["features"] == ["heartbeat"]
+
+    @pytest.mark.asyncio
+    async def test_reaping_cleans_up_the_handler(self, heartbeat_settings):
+        manager = WebSocketConnectionManager(MagicMock())
+        websocket = make_websocket()
+        # A half-open socket: nothing ever arrives, and closing it doesn't wake up the receive loop.
+        async def never_receives():
+            await asyncio.Event().wait()
+        websocket.receive_json.side_effect = never_receives
+        handler = WebSocketHandler(websocket, manager)
+        handler.request_handler._get_lock(websocket, "t1")
+
+        handler_task = asyncio.create_task(handler.handle_websocket())
+        await asyncio.sleep(0.01)
+        manager.get_info(websocket).heartbeat = True
+        manager.get_info(websocket).last_seen = time.monotonic() - 60
+
+        assert await manager.heartbeat() == 1
+        assert handler_task.done()
+        assert handler.request_handler.locks == {}
+        assert handler.request_handler.contexts == {}
+        assert manager.connections == {}
+
+    @pytest.mark.asyncio
+    async def test_start_heartbeat_populates_active_tasks(self, heartbeat_settings):
+        manager = WebSocketConnectionManager(MagicMock())
+        manager.start_heartbeat()
+        manager.start_heartbeat() # only one heartbeat task
+
+        assert len(manager.active_tasks) == 1
+        manager.cleanup()
+        await asyncio.sleep(0)
+        assert manager.active_tasks == set()
@@ -0,0 +1,152 @@
+"""
+Tests for page compaction (agents/utils/html_compaction.py) and its write-back in the HTML agent.
+"""
+import pytest
+import httpx
+from unittest.mock import AsyncMock, MagicMock, patch
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.prebuilt import ToolNode
+
+from app.agents.llamapress import html_agent
+from app.agents.utils.html_compaction import apply_compacted_line_edits, compact_html, restore_html
+from app.agents.utils.line_edits import LineEdit, LineEditError
+from app.metrics import metrics
+
+LOGO = "data:image/png;base64," + "iVBORw0KGgo" * 40
+ICON = "<svg viewBox='0 0 24 24'>" + "<path d='M12 2L2 7l10 5 10-5-10-5z'/>" * 10 + "</svg>"
+PAGE = f"""<html>
+    <body>
+        <!-- CODE_EXPLANATION: the header -->
+        <header>
+            <img src="{LOGO}">
+            {ICON}
+        </header>
+
+        <pre>  keep   this
+    as is</pre>
+        <script>
+            const html = "<!-- not a comment -->";
+        </script>
+    </body>
+</html>"""
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+class TestCompactHtml:
+    """Test compacting and restoring pages."""
+
+    def test_compacts_and_restores(self):
+        compacted = compact_html(PAGE)
+
+        assert LOGO not in compacted.html and ICON not in compacted.html
+        assert "CODE_EXPLANATION" not in compacted.html
+        assert "<pre>  keep   this\n    as is</pre>" in compacted.html
+        assert 'const html = "<!-- not a comment -->";' in compacted.html
+        assert "\n\n" not in compacted.html and compacted.html.count("\n ") == 1 # only the <pre> line
+        assert len(compacted.placeholders) == 2
+
+        restored = restore_html(compacted.html, compacted.placeholders)
+        assert LOGO in restored and ICON in restored
+        assert metrics.counter("html_compaction.tokens_before") == len(PAGE) // 4
+        assert metrics.counter("html_compaction.tokens_after") == len(compacted.html) // 4
+
+    def test_placeholders_are_stable_and_small_assets_stay(self):
+        small = '<img src="data:image/gif;base64,R0lGOD">'
+        first, second = compact_html(PAGE + small), compact_html(PAGE + small)
+        assert first.html == second.html and small in first.html
+        assert restore_html("__ASSET_000000000000__", first.placeholders) == "__ASSET_000000000000__"
+
+    def test_svg_embedding_a_data_uri_is_restored_whole(self):
+        svg = "<svg>" + "<path d='M0 0L10 10'/>" * 20 + f'<image href="{LOGO}"/></svg>'
+        compacted = compact_html(f"<div>{svg}</div>")
+        assert compacted.html.count("__ASSET_") == 1
+        assert restore_html(compacted.html, compacted.placeholders) == f"<div>{svg}</div>"
+        # Placeholders nested in assets are restored too.
+        nested = {"__ASSET_aaaaaaaaaaaa__": "<svg>__ASSET_bbbbbbbbbbbb__</svg>", "__ASSET_bbbbbbbbbbbb__": LOGO}
+        assert restore_html("__ASSET_aaaaaaaaaaaa__", nested) == f"<svg>{LOGO}</svg>"
+
+
+class TestCompactedLineEdits:
+    """Test that edits against the compacted page leave the rest of the original page alone."""
+
+    def test_edits_keep_comments_and_indentation_of_untouched_lines(self):
+        compacted = compact_html(PAGE)
+        lines = compacted.html.split("\n")
+        header, image = lines.index("<header>") + 1, lines.index("<header>") + 2
+        edits = [LineEdit(op="replace", start_line=header, content="<header class='blue'>"),
+                 LineEdit(op="insert", start_line=image, content="<h1>Hi</h1>")]
+
+        written = apply_compacted_line_edits(PAGE, compacted, edits)
+        assert written == PAGE.replace("        <header>", "<header class='blue'>").replace(
+            f'<img src="{LOGO}">', f'<img src="{LOGO}">\n<h1>Hi</h1>')
+        assert "<!-- CODE_EXPLANATION: the header -->" in written
+
+    def test_ranges_span_the_original_lines(self):
+        compacted = compact_html(PAGE)
+        lines = compacted.html.split("\n")
+        start, end = lines.index("<header>") + 1, lines.index("</header>") + 1
+        written = apply_compacted_line_edits(PAGE, compacted, [LineEdit(op="delete", start_line=start, end_line=end)])
+        assert LOGO not in written and "<pre>" in written and "    <body>" in written
+
+    def test_invalid_edits_refer_to_the_compacted_lines(self):
+        compacted = compact_html(PAGE)
+        with pytest.raises(LineEditError, match=f"lines 1-{len(compacted.line_map)}"):
+            apply_compacted_line_edits(PAGE, compacted, [LineEdit(op="delete", start_line=40)])
+
+
+class TestWriteBack:
+    """Test that the agent sees the compacted page and its writes get the assets back."""
+
+    @pytest.mark.asyncio
+    async def test_line_edits_apply_to_the_compacted_page(self):
+        compacted = compact_html(PAGE)
+        lines = compacted.html.split("\n")
+        header = lines.index("<header>") + 1
+        put = AsyncMock(return_value=httpx.Response(200, json={"id": 1}))
+        call = AIMessage(content="", tool_calls=[{"name": "edit_html_page_lines", "id": "c1", "args": {
+            "edits": [{"op": "insert", "start_line": header, "content": "<h1>Hi</h1>"}],
+            "message_to_user": "Adding a title", "internal_thoughts": ""}}])
+        state = {"messages": [HumanMessage(content="add a title"), call], "current_page_html": PAGE, "page_id": "7", "api_token": "token"}
+
+        with patch.object(html_agent, "put_page_content", put):
+            await ToolNode(html_agent.tools).ainvoke(state)
+
+        written = put.call_args.args[2]
+        assert "<header>\n<h1>Hi</h1>\n            <img" in written
+        assert LOGO in written and ICON in written and "CODE_EXPLANATION" in written
+
+    @pytest.mark.asyncio
+    async def test_written_documents_get_their_assets_back(self):
+        compacted = compact_html(PAGE)
+        put = AsyncMock(return_value=httpx.Response(200, json={"id": 1}))
+        call = AIMessage(content="", tool_calls=[{"name": "write_html_page", "id": "c1", "args": {
+            "full_html_document": compacted.html.replace("<header>", "<header class='blue'>"),
+            "message_to_user": "Blue header", "internal_thoughts": ""}}])
+        state = {"messages": [HumanMessage(content="blue header"), call], "current_page_html": PAGE, "page_id": "7", "api_token": "token"}
+
+        with patch.object(html_agent, "put_page_content", put):
+            result = await ToolNode(html_agent.tools).ainvoke(state)
+
+        assert LOGO in put.call_args.args[2] and ICON in put.call_args.args[2]
+        state["messages"].append(result["messages"][0])
+        assert html_agent.latest_page_html(state) == put.call_args.args[2]
+
+    @pytest.mark.asyncio
+    async def test_agent_is_shown_the_compacted_page(self):
+        bound = MagicMock()
+        bound.ainvoke = AsyncMock(return_value=AIMessage(content="ok"))
+        model = MagicMock()
+        model.bind_tools.return_value = bound
+        state = {"messages": [HumanMessage(content="what's on this page?")], "current_page_html": PAGE}
+
+        with patch.object(html_agent, "get_routed_chat_model", return_value=model), patch.object(html_agent, "HTML_EDIT_MODE", "full"):
+            await html_agent.write_html_page_agent(state)
+
+        assert bound.ainvoke.call_args.args[0][1].content == f"<CURRENT_PAGE_HTML>{compact_html(PAGE).html}</CURRENT_PAGE_HTML>"
+        assert metrics.counter("html_compaction.tokens_before") > metrics.counter("html_compaction.tokens_after")
@@ -0,0 +1,129 @@
+"""
+Tests for progressive write_html_page previews (websocket/html_preview.py).
+"""
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from starlette.websockets import WebSocketState
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from app.websocket.html_preview import HtmlPreviewStreamer, JsonStringFieldExtractor
+from app.websocket.request_handler import RequestHandler
+
+PAGE = ('<html><head><script>if (a < b) { x = "caf\\u00e9"; }</script></head>'
+        '<body><div class="hero">Héllo 😀<img src="x.png"><p>para</p></div></body></html>')
+
+
+def argument_chunks(document: str, size: int = 7, message_id: str = "m1"):
+    args = json.dumps({"full_html_document": document, "message_to_user": "Writing", "internal_thoughts": "..."})
+    chunks = [AIMessageChunk(content="", id=message_id, tool_call_chunks=[
+        {"name": "write_html_page", "args": "", "id": "call_1", "index": 0}])]
+    for start in range(0, len(args), size):
+        chunks.append(AIMessageChunk(content="", id=message_id, tool_call_chunks=[{"args": args[start:start + size], "index": 0}]))
+    return chunks
+
+
+class TestJsonStringFieldExtractor:
+    """Test incremental decoding of one JSON string field."""
+
+    @pytest.mark.parametrize("size", [1, 3, 64])
+    def test_decodes_the_field_across_any_split(self, size):
+        args = json.dumps({"message_to_user": "full_html_document", "full_html_document": PAGE, "other": "x"})
+        extractor = JsonStringFieldExtractor("full_html_document")
+        decoded = "".join(extractor.feed(args[start:start + size]) for start in range(0, len(args), size))
+        assert decoded == PAGE
+        assert extractor.done
+
+    def test_ignores_nested_keys_and_non_string_values(self):
+        extractor = JsonStringFieldExtractor("full_html_document")
+        assert extractor.feed('{"meta": {"full_html_document": "nested"}, "full_html_document": 3}') == ""
+        assert not extractor.done
+
+
+class TestHtmlPreviewStreamer:
+    """Test the preview frames built from streamed tool-call arguments."""
+
+    def test_frames_rebuild_the_page_and_are_well_formed(self):
+        streamer = HtmlPreviewStreamer(interval_seconds=0)
+        frames = [frame for chunk in argument_chunks(PAGE) for frame in streamer.add(chunk, "write_html_page_agent")]
+
+        page = ""
+        for frame in frames:
+            assert frame["offset"] == len(page)
+            page += frame["html"]
+            assert "if (a" not in frame["html"] or "</script>" in frame["html"] # script bodies aren't cut in half
+        assert page == PAGE
+        assert frames[-1]["done"] and frames[-1]["closing"] == ""
+        assert [frame for frame in frames if "hero" in frame["html"]][0]["closing"] == "</div></body></html>"
+        assert streamer.flush() == [] # already sent in full when the argument ended
+
+    def test_asset_placeholders_are_restored(self):
+        logo = "data:image/png;base64," + "iVBORw0KGgo" * 40
+        placeholder = "__ASSET_0123456789ab__"
+        streamer = HtmlPreviewStreamer(interval_seconds=0, placeholders={placeholder: logo})
+        frames = [frame for chunk in argument_chunks(f'<body><img src="{placeholder}"><p>hi</p></body>', size=3)
+                  for frame in streamer.add(chunk, "write_html_page_agent")]
+
+        page = ""
+        for frame in frames:
+            assert frame["offset"] == len(page)
+            page += frame["html"]
+        assert page == f'<body><img src="{logo}"><p>hi</p></body>'
+
+    def test_rate_limited(self):
+        now = [0.0]
+        streamer = HtmlPreviewStreamer(interval_seconds=1, clock=lambda: now[0])
+        chunks = argument_chunks("<div>" + "<p>x</p>" * 200 + "</div>")
+        frames = [frame for chunk in chunks[:-10] for frame in streamer.add(chunk, "node")]
+        assert len(frames) == 1 # the first frame, then nothing for a second
+
+        now[0] = 1.5
+        frames = streamer.add(chunks[-10], "node")
+        assert len(frames) == 1 and frames[0]["offset"] > 0
+
+    def test_other_tools_and_text_are_ignored(self):
+        streamer = HtmlPreviewStreamer(interval_seconds=0)
+        chunk = AIMessageChunk(content="hi", id="m1", tool_call_chunks=[
+            {"name": "edit_html_page_lines", "args": '{"edits": []}', "id": "call_1", "index": 0}])
+        assert streamer.add(chunk, "node") == []
+
+    def test_flush_sends_the_rest_of_an_unfinished_page(self):
+        streamer = HtmlPreviewStreamer(interval_seconds=60)
+        for chunk in argument_chunks(PAGE)[:20]:
+            streamer.add(chunk, "node")
+        frames = streamer.flush()
+        assert len(frames) == 1 and frames[0]["done"]
+
+
+class TestPreviewOverWebSocket:
+    """Test that handle_request sends previews to clients that asked for them."""
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("enabled", [True, False])
+    async def test_handle_request_sends_preview_frames(self, enabled):
+        metadata = {"langgraph_node": "write_html_page_agent"}
+        final_message = AIMessage(content="", id="m1", tool_calls=[
+            {"name": "write_html_page", "args": {"full_html_document": PAGE}, "id": "call_1"}])
+
+        async def fake_astream(*args, **kwargs):
+            for chunk in argument_chunks(PAGE, size=40):
+                yield ((), "messages", (chunk, metadata))
+            yield ((), "updates", {"write_html_page_agent": {"messages": [final_message]}})
+
+        fake_app = MagicMock()
+        fake_app.astream = fake_astream
+        websocket = AsyncMock()
+        websocket.client_state = WebSocketState.CONNECTED
+
+        handler = RequestHandler(MagicMock())
+        handler.get_context(websocket).html_preview = enabled
+        with patch.object(handler, "get_langgraph_app_and_state", return_value=(fake_app, {})):
+            await handler.handle_request({"thread_id": "t1"}, websocket)
+
+        frames = [json.loads(call.args[0]) for call in websocket.send_text.call_args_list]
+        previews = [frame for frame in frames if frame["type"] == "html_preview"]
+        if not enabled:
+            assert previews == []
+            return
+        assert "".join(frame["html"] for frame in previews) == PAGE
+        assert previews[0]["thread_id"] == "t1"
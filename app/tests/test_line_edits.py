@@ -0,0 +1,118 @@
+"""
+Tests for line-range page edits (agents/utils/line_edits.py and the HTML agent's edit_html_page_lines tool).
+"""
+import json
+import pytest
+import httpx
+from unittest.mock import AsyncMock, MagicMock, patch
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.prebuilt import ToolNode
+
+from app.agents.llamapress import html_agent
+from app.agents.utils.get_numbered_code_from_file import number_lines
+from app.agents.utils.line_edits import LineEdit, LineEditError, apply_line_edits
+
+PAGE = "\n".join(["<html>", "<body>", "<h1>Old</h1>", "<p>one</p>", "<p>two</p>", "</body>", "</html>"])
+
+
+class TestApplyLineEdits:
+    """Test applying and validating edits."""
+
+    def test_edits_refer_to_the_original_numbering(self):
+        edits = [
+            LineEdit(op="replace", start_line=3, content="<h1>New</h1>\n<h2>Sub</h2>"),
+            LineEdit(op="delete", start_line=5),
+            LineEdit(op="insert", start_line=5, content="<p>three</p>"),
+            LineEdit(op="insert", start_line=0, content="<!DOCTYPE html>"),
+        ]
+        assert apply_line_edits(PAGE, edits).split("\n") == [
+            "<!DOCTYPE html>", "<html>", "<body>", "<h1>New</h1>", "<h2>Sub</h2>", "<p>one</p>", "<p>three</p>", "</body>", "</html>"
+        ]
+
+    def test_inserts_after_a_replaced_line_keep_their_order(self):
+        edits = [LineEdit(op="insert", start_line=4, content="<p>a</p>"), LineEdit(op="insert", start_line=4, content="<p>b</p>"),
+                 LineEdit(op="replace", start_line=4, content="<p>ONE</p>\n<p>ONE bis</p>")]
+        assert apply_line_edits(PAGE, edits).split("\n")[3:7] == ["<p>ONE</p>", "<p>ONE bis</p>", "<p>a</p>", "<p>b</p>"]
+
+    def test_copied_line_numbers_are_stripped(self):
+        edits = [LineEdit(op="replace", start_line=3, end_line=3, content="00003: <h1>New</h1>")]
+        assert apply_line_edits(PAGE, edits).split("\n")[2] == "<h1>New</h1>"
+
+    @pytest.mark.parametrize("edits", [
+        [LineEdit(op="replace", start_line=6, end_line=9, content="x")],
+        [LineEdit(op="delete", start_line=0)],
+        [LineEdit(op="insert", start_line=8, content="x")],
+        [LineEdit(op="delete", start_line=2, end_line=4), LineEdit(op="replace", start_line=4, content="x")],
+        [LineEdit(op="delete", start_line=2, end_line=4), LineEdit(op="insert", start_line=3, content="x")],
+    ])
+    def test_invalid_edits_are_rejected(self, edits):
+        with pytest.raises(LineEditError):
+            apply_line_edits(PAGE, edits)
+
+    def test_number_lines(self):
+        assert number_lines("<p>\n</p>") == "00001: <p>\n00002: </p>"
+
+    def test_displayed_line_numbers_are_the_applied_ones(self):
+        page = "<p>a\u2028b</p>\r\n<h1>Title</h1>\n<p>end</p>"
+        assert number_lines(page).split("\n")[1] == "00002: <h1>Title</h1>"
+
+        edited = apply_line_edits(page, [LineEdit(op="replace", start_line=2, content="<h1>New</h1>")])
+        assert edited == "<p>a\u2028b</p>\r\n<h1>New</h1>\n<p>end</p>"
+
+
+class TestEditHtmlPageLinesTool:
+    """Test the tool end to end through a ToolNode."""
+
+    def call(self, call_id: str, edits: list) -> AIMessage:
+        return AIMessage(content="", tool_calls=[{"name": "edit_html_page_lines", "id": call_id, "args": {
+            "edits": edits, "message_to_user": "Updating the title", "internal_thoughts": "small change"}}])
+
+    @pytest.mark.asyncio
+    async def test_applies_edits_and_puts_the_page(self):
+        put = AsyncMock(return_value=httpx.Response(200, json={"id": 1}))
+        state = {"messages": [HumanMessage(content="rename"), self.call("c1", [{"op": "replace", "start_line": 3, "content": "<h1>New</h1>"}])],
+                 "current_page_html": PAGE, "page_id": "7", "api_token": "token"}
+
+        with patch.object(html_agent, "put_page_content", put):
+            result = await ToolNode(html_agent.tools).ainvoke(state)
+
+        tool_message = result["messages"][0]
+        assert json.loads(tool_message.content)["tool_name"] == "edit_html_page_lines"
+        assert put.call_args.args[0].endswith("/pages/7.json")
+        assert put.call_args.args[2].split("\n")[2] == "<h1>New</h1>"
+        assert tool_message.artifact == put.call_args.args[2]
+
+        # A second edit in the same turn builds on the first one.
+        state["messages"] += [tool_message, self.call("c2", [{"op": "delete", "start_line": 4, "end_line": 5}])]
+        assert html_agent.latest_page_html(state) == tool_message.artifact
+        with patch.object(html_agent, "put_page_content", put):
+            await ToolNode(html_agent.tools).ainvoke(state)
+        assert put.call_args.args[2] == "\n".join(["<html>", "<body>", "<h1>New</h1>", "</body>", "</html>"])
+
+        # The next message comes with the page the browser has.
+        state["messages"].append(HumanMessage(content="thanks"))
+        assert html_agent.latest_page_html(state) == PAGE
+
+    @pytest.mark.asyncio
+    async def test_invalid_edits_are_reported_without_writing(self):
+        put = AsyncMock()
+        state = {"messages": [self.call("c1", [{"op": "delete", "start_line": 40}])],
+                 "current_page_html": PAGE, "page_id": "7", "api_token": "token"}
+        with patch.object(html_agent, "put_page_content", put):
+            result = await ToolNode(html_agent.tools).ainvoke(state)
+        assert result["messages"][0].content.startswith("Error: Invalid range 40-40")
+        put.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_patch_mode_shows_numbered_page(self):
+        bound = MagicMock()
+        bound.ainvoke = AsyncMock(return_value=AIMessage(content="ok"))
+        model = MagicMock()
+        model.bind_tools.return_value = bound
+        state = {"messages": [HumanMessage(content="make it blue")], "current_page_html": "<p>\npage</p>"}
+
+        with patch.object(html_agent, "get_routed_chat_model", return_value=model), patch.object(html_agent, "HTML_EDIT_MODE", "patch"):
+            await html_agent.write_html_page_agent(state)
+
+        assert bound.ainvoke.call_args.args[0][1].content == "<CURRENT_PAGE_HTML>00001: <p>\n00002: page</p></CURRENT_PAGE_HTML>"
+        assert model.bind_tools.call_args.args[0] == [html_agent.edit_html_page_lines, html_agent.write_html_page]
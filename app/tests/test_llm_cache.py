@@ -0,0 +1,133 @@
+"""
+Tests for the exact-match LLM response cache (llm_cache.py).
+"""
+import pytest
+import httpx
+from unittest.mock import patch
+from langchain_core.load import dumps as lc_dumps
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration
+
+from app import llm_cache
+from app.llm_cache import InMemoryLlmCache, SqliteLlmCache, cache_key, get_llm_cache
+from app.llm_client import get_chat_model
+from app.metrics import metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def generations(text: str = "cached answer", total_tokens: int = 42):
+    message = AIMessage(content=text, id="run-original",
+                        usage_metadata={"input_tokens": 40, "output_tokens": 2, "total_tokens": total_tokens})
+    return [ChatGeneration(message=message)]
+
+
+class TestCacheKey:
+    """Test message normalization."""
+
+    def test_ignores_message_ids_and_metadata(self):
+        first = lc_dumps([SystemMessage(content="be brief", id="a"), HumanMessage(content="hours?", id="b")])
+        second = lc_dumps([SystemMessage(content="be brief", id="c"),
+                           HumanMessage(content="hours?", id="d", response_metadata={"created_at": "now"})])
+        assert cache_key(first, "model") == cache_key(second, "model")
+
+    def test_content_and_model_matter(self):
+        prompt = lc_dumps([HumanMessage(content="hours?")])
+        assert cache_key(prompt, "model") != cache_key(lc_dumps([HumanMessage(content="prices?")]), "model")
+        assert cache_key(prompt, "model") != cache_key(prompt, "other model")
+
+
+class TestInMemoryLlmCache:
+    """Test the in-process LRU store."""
+
+    def test_hit_returns_fresh_copy_and_reports(self):
+        cache = InMemoryLlmCache()
+        prompt = lc_dumps([HumanMessage(content="hours?")])
+        assert cache.lookup(prompt, "m") is None
+        cache.update(prompt, "m", generations())
+
+        hit = cache.lookup(prompt, "m")
+        assert hit[0].message.content == "cached answer"
+        assert hit[0].message.id is None # gets a new id downstream, instead of replacing the original in the thread
+        assert metrics.counter("llm_cache.hits", backend="memory") == 1
+        assert metrics.counter("llm_cache.misses", backend="memory") == 1
+        assert metrics.counter("llm_cache.saved_tokens", backend="memory") == 42
+        assert cache.hit_rate() == 0.5
+
+    def test_lru_eviction_and_ttl(self):
+        cache = InMemoryLlmCache(max_entries=2)
+        for name in ("a", "b"):
+            cache.update(name, "m", generations(name))
+        cache.lookup("a", "m") # a is now the most recently used
+        cache.update("c", "m", generations("c"))
+        assert cache.lookup("b", "m") is None
+        assert cache.lookup("a", "m") is not None
+
+        expiring = InMemoryLlmCache(ttl_seconds=10)
+        expiring.update("a", "m", generations())
+        with patch.object(llm_cache.time, "time", return_value=llm_cache.time.time() + 11):
+            assert expiring.lookup("a", "m") is None
+
+
+class TestSqliteLlmCache:
+    """Test the SQLite store."""
+
+    def test_persists_across_instances(self, tmp_path):
+        path = str(tmp_path / "llm_cache.sqlite")
+        prompt = lc_dumps([HumanMessage(content="hours?")])
+        first = SqliteLlmCache(path)
+        first.update(prompt, "m", generations())
+        first.close()
+
+        second = SqliteLlmCache(path)
+        hit = second.lookup(prompt, "m")
+        assert hit[0].message.content == "cached answer"
+        assert hit[0].message.usage_metadata["total_tokens"] == 42
+        assert metrics.counter("llm_cache.hits", backend="sqlite") == 1
+
+        with patch.object(llm_cache.time, "time", return_value=llm_cache.time.time() + second.ttl_seconds + 1):
+            assert second.lookup(prompt, "m") is None
+        second.close()
+
+
+class TestChatModelCaching:
+    """Test the cache wired into the shared model client."""
+
+    @pytest.mark.asyncio
+    async def test_repeat_call_skips_the_provider(self):
+        requests = []
+
+        def completion(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            return httpx.Response(200, json={
+                "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "o4-mini",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "9 to 5"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 3, "total_tokens": 13},
+            })
+
+        llm = get_chat_model("o4-mini", api_key="test", max_retries=0, cache=InMemoryLlmCache(),
+                             http_async_client=httpx.AsyncClient(transport=httpx.MockTransport(completion)))
+        first = await llm.ainvoke([HumanMessage(content="hours?", id="1")])
+        second = await llm.ainvoke([HumanMessage(content="hours?", id="2")])
+
+        assert len(requests) == 1
+        assert second.content == first.content == "9 to 5"
+        assert metrics.counter("llm_cache.saved_tokens", backend="memory") == 13
+
+    def test_enabled_per_agent(self):
+        with patch.object(llm_cache, "LLM_CACHE_BACKEND", "memory"), \
+             patch.object(llm_cache, "LLM_CACHE_AGENTS", "public_leonardo"), \
+             patch.dict(llm_cache._shared_cache, clear=True):
+            cache = get_llm_cache("public_leonardo")
+            assert isinstance(cache, InMemoryLlmCache)
+            assert get_llm_cache("llamapress") is None
+            assert get_llm_cache(None) is None
+            assert get_chat_model("o4-mini", api_key="test", agent="public_leonardo").cache is cache
+            assert get_chat_model("o4-mini", api_key="test", agent="llamapress").cache is None
+
+        assert get_llm_cache("public_leonardo") is None # LLAMABOT_LLM_CACHE is off by default
@@ -0,0 +1,135 @@
+"""
+Tests for the LLM rate limiter and the scheduled chat model client.
+"""
+import asyncio
+import threading
+import time
+import pytest
+from unittest.mock import patch
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from app.llm_client import ScheduledChatOpenAI, estimate_tokens
+from app.llm_rate_limiter import BACKGROUND_PRIORITY, INTERACTIVE_PRIORITY, LlmRateLimiter, TokenBucket, parse_rate_limits
+
+
+class TestTokenBucket:
+    """Test the token bucket accounting."""
+
+    def test_refill_and_wait_time(self):
+        bucket = TokenBucket(60) # one per second
+        bucket.level = 0
+        assert bucket.seconds_until(2) == pytest.approx(2)
+        bucket.refill(bucket.updated_at + 1.5)
+        assert bucket.level == pytest.approx(1.5)
+        bucket.refill(bucket.updated_at + 1000)
+        assert bucket.level == 60 # capped at capacity
+
+    def test_parse_rate_limits(self):
+        assert parse_rate_limits("gpt-4o=500/30000, o4-mini=1000/200000,bad,x=1/y") == {
+            "gpt-4o": (500.0, 30000.0), "o4-mini": (1000.0, 200000.0)
+        }
+
+
+class TestLlmRateLimiter:
+    """Test budgets, priorities and feedback from the provider."""
+
+    @pytest.mark.asyncio
+    async def test_waits_for_token_budget(self):
+        limiter = LlmRateLimiter(default_rpm=6000, default_tpm=600) # 10 tokens per second
+        await limiter.aacquire("m", 600)
+        started = time.monotonic()
+        await limiter.aacquire("m", 2)
+        assert time.monotonic() - started >= 0.15
+
+    @pytest.mark.asyncio
+    async def test_interactive_goes_before_background(self):
+        limiter = LlmRateLimiter(default_rpm=6000, default_tpm=6000) # 100 tokens per second
+        await limiter.aacquire("m", 6000) # empty the bucket
+        order = []
+
+        async def call(name, priority):
+            await limiter.aacquire("m", 10, priority)
+            order.append(name)
+
+        background = asyncio.create_task(call("background", BACKGROUND_PRIORITY))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(call("interactive", INTERACTIVE_PRIORITY))
+        await asyncio.gather(background, interactive)
+        assert order == ["interactive", "background"]
+
+    def test_sync_acquire_from_threads(self):
+        limiter = LlmRateLimiter(default_rpm=60, default_tpm=100000) # one request per second
+        for _ in range(60):
+            limiter.acquire("m", 1)
+        waited = []
+        thread = threading.Thread(target=lambda: waited.append(limiter.acquire("m", 1)))
+        thread.start()
+        thread.join(5)
+        assert waited and waited[0] > 0.5
+
+    def test_headers_and_usage_feed_back(self):
+        limiter = LlmRateLimiter(default_rpm=100, default_tpm=1000)
+        limiter.acquire("m", 500)
+        assert limiter.update_from_headers("m", {
+            "X-RateLimit-Limit-Requests": "5000", "x-ratelimit-remaining-requests": "4999",
+            "x-ratelimit-limit-tokens": "2000000", "x-ratelimit-remaining-tokens": "300",
+        }) # the tokens are settled by the headers
+        budget = limiter.budgets["m"]
+        assert budget.requests.capacity == 5000
+        assert budget.tokens.capacity == 2000000
+        assert budget.tokens.level == 300 # the provider knows better (other processes use the key too)
+        assert not limiter.update_from_headers("m", {"x-ratelimit-remaining-requests": "4998"})
+
+        limiter.record_usage("m", reserved_tokens=500, used_tokens=100) # no headers, used less than reserved: refund
+        assert budget.tokens.level == pytest.approx(700, abs=50)
+
+        limiter.penalize("m")
+        assert budget.tokens.level <= 0
+
+
+class TestScheduledChatOpenAI:
+    """Test that the model client goes through the limiter and strips the headers."""
+
+    def test_generate_acquires_and_settles(self):
+        llm = ScheduledChatOpenAI(model="gpt-4o", api_key="test")
+        message = AIMessage(content="hi", usage_metadata={"input_tokens": 10, "output_tokens": 5, "total_tokens": 15})
+        result = ChatResult(generations=[ChatGeneration(message=message, generation_info={"headers": {"x-ratelimit-remaining-tokens": "10"}})])
+
+        with patch("langchain_openai.ChatOpenAI._generate", return_value=result), \
+             patch("app.llm_client.llm_rate_limiter") as limiter:
+            response = llm.invoke([HumanMessage(content="x" * 400)])
+
+        limiter.acquire.assert_called_once_with("gpt-4o", 100 + 1000, INTERACTIVE_PRIORITY)
+        limiter.update_from_headers.assert_called_once_with("gpt-4o", {"x-ratelimit-remaining-tokens": "10"})
+        limiter.record_usage.assert_not_called() # the provider's remaining count already has this call's usage
+        assert "headers" not in response.response_metadata
+
+    def test_usage_settles_the_reservation_without_headers(self):
+        llm = ScheduledChatOpenAI(model="gpt-4o", api_key="test")
+        message = AIMessage(content="hi", usage_metadata={"input_tokens": 10, "output_tokens": 5, "total_tokens": 15})
+        result = ChatResult(generations=[ChatGeneration(message=message, generation_info={})])
+
+        with patch("langchain_openai.ChatOpenAI._generate", return_value=result), \
+             patch("app.llm_client.llm_rate_limiter") as limiter:
+            llm.invoke([HumanMessage(content="x" * 400)])
+
+        limiter.update_from_headers.assert_not_called()
+        limiter.record_usage.assert_called_once_with("gpt-4o", 1100, 15)
+
+    def test_headers_leave_the_budget_at_the_providers_view(self):
+        limiter = LlmRateLimiter(default_rpm=100, default_tpm=100000)
+        llm = ScheduledChatOpenAI(model="m", api_key="test")
+        message = AIMessage(content="hi", usage_metadata={"input_tokens": 10, "output_tokens": 5, "total_tokens": 15})
+        headers = {"x-ratelimit-limit-tokens": "100000", "x-ratelimit-remaining-tokens": "50000"}
+        result = ChatResult(generations=[ChatGeneration(message=message, generation_info={"headers": headers})])
+
+        with patch("langchain_openai.ChatOpenAI._generate", return_value=result), \
+             patch("app.llm_client.llm_rate_limiter", limiter):
+            llm.invoke([HumanMessage(content="x" * 400)]) # reserves far more than the 15 tokens it uses
+
+        assert limiter.budgets["m"].tokens.level == pytest.approx(50000, abs=100)
+
+    def test_estimate_counts_tools(self):
+        assert estimate_tokens([HumanMessage(content="x" * 40)], tools=None, completion_tokens=0) == 10
+        assert estimate_tokens([HumanMessage(content="x" * 40)], tools=[{"name": "t" * 40}], completion_tokens=0) > 10
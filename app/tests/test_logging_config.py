@@ -0,0 +1,76 @@
+"""
+Tests for the queue-based, sampled, truncating logging setup.
+"""
+import json
+import logging
+
+from app.logging_config import JsonFormatter, describe_update, SamplingFilter, TruncatingFilter, parse_sample_rates, setup_logging, shutdown_logging
+
+
+def make_record(message="hello", *args, level=logging.INFO, **extra):
+    record = logging.LogRecord("app.test", level, __file__, 1, message, args or None, None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+class TestLoggingFilters:
+    """Test sampling and truncation of log records."""
+
+    def test_parse_sample_rates(self):
+        assert parse_sample_rates("stream.update=0.1, stream.chunk=0,bogus,x=nope") == {"stream.update": 0.1, "stream.chunk": 0.0}
+
+    def test_sampling_keeps_every_nth_record_of_a_category(self):
+        sampling = SamplingFilter({"stream.update": 0.25})
+        kept = [sampling.filter(make_record(category="stream.update")) for _ in range(8)]
+        assert kept.count(True) == 2
+        # Uncategorized records and warnings are always kept.
+        assert sampling.filter(make_record())
+        assert SamplingFilter({"stream.update": 0.0}).filter(make_record(level=logging.WARNING, category="stream.update"))
+
+    def test_truncates_message_and_extra_fields(self):
+        record = make_record("state: %s", "x" * 500, page_html="y" * 500)
+        TruncatingFilter(100).filter(record)
+
+        assert len(record.getMessage()) < 150
+        assert "truncated" in record.getMessage()
+        assert record.page_html.startswith("y" * 100)
+        assert "truncated 400 chars" in record.page_html
+
+
+class TestJsonFormatter:
+    """Test the structured record format."""
+
+    def test_formats_record_as_json(self):
+        entry = json.loads(JsonFormatter().format(make_record("hi %s", "there", category="stream.update", thread_id="t1")))
+
+        assert entry["message"] == "hi there"
+        assert entry["level"] == "INFO"
+        assert entry["logger"] == "app.test"
+        assert entry["category"] == "stream.update"
+        assert entry["thread_id"] == "t1"
+        assert "timestamp" in entry
+
+    def test_state_updates_are_summarized_without_their_values(self):
+        update = {"write_html_page_agent": {"messages": [1, 2], "current_page_html": "<p>" * 1000, "page_id": 7}}
+        assert describe_update(update) == "write_html_page_agent: messages=2, current_page_html=3000 chars, page_id"
+
+
+class TestSetupLogging:
+    """Test that records go through the queue to the writer thread."""
+
+    def test_writes_sampled_json_lines_to_file(self, tmp_path):
+        log_file = tmp_path / "app.log"
+        setup_logging(level="INFO", log_format="json", log_file=str(log_file), max_field_chars=50,
+                      sample_rates={"stream.update": 0.5})
+        try:
+            test_logger = logging.getLogger("app.test_logging")
+            for i in range(4):
+                test_logger.info("update %s %s", i, "z" * 200, extra={"category": "stream.update"})
+            test_logger.debug("chunk", extra={"category": "stream.chunk"}) # below the level, never queued
+        finally:
+            shutdown_logging() # stops the listener, which flushes the queue
+
+        lines = [json.loads(line) for line in log_file.read_text().splitlines()]
+        assert [line["message"][:8] for line in lines] == ["update 0", "update 2"]
+        assert all("truncated" in line["message"] for line in lines)
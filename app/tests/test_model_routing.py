@@ -0,0 +1,89 @@
+"""
+Tests for per-agent/per-node model routing (model_routing.py) and per-tier reporting.
+"""
+import pytest
+import httpx
+from unittest.mock import patch
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from app import model_routing
+from app.model_routing import needs_strong_model, parse_assignments, route_model
+from app.llm_client import get_routed_chat_model
+from app.metrics import metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+class TestRouteModel:
+    """Test resolving routes to tiers and models."""
+
+    def test_node_route_wins_over_agent_route(self):
+        routes = {"llamapress": "fast", "llamapress.selected_element_agent": "strong", "pinned": "o4-mini"}
+        with patch.dict(model_routing._routes, routes, clear=True):
+            assert route_model("llamapress", "selected_element_agent").tier == "strong"
+            assert route_model("llamapress", "other_node").tier == "fast"
+            assert route_model("pinned") == model_routing.ModelRoute(model="o4-mini", tier="pinned")
+            assert route_model("unknown").model == model_routing._tiers["strong"]
+        assert metrics.counter("llm.routed", agent="llamapress", node="other_node", tier="fast") == 1
+
+    def test_auto_escalates_for_code_generation(self):
+        chat = [HumanMessage(content="thanks, what does this page do?")]
+        edit = [HumanMessage(content="make the header blue")]
+        assert route_model("llamapress", "write_html_page_agent", chat).tier == "fast"
+        escalated = route_model("llamapress", "write_html_page_agent", edit)
+        assert escalated.tier == "strong" and escalated.escalated
+
+        with patch.object(model_routing, "MODEL_ESCALATION_ENABLED", False):
+            assert route_model("llamapress", "write_html_page_agent", chat).tier == "strong"
+
+    def test_parse_assignments(self):
+        assert parse_assignments("fast=gpt-4.1-mini, strong = o3 ,bad,=x") == {"fast": "gpt-4.1-mini", "strong": "o3"}
+
+
+class TestNeedsStrongModel:
+    """Test the escalation heuristic."""
+
+    @pytest.mark.parametrize("text,strong", [
+        ("hi there!", False),
+        ("What are your opening hours?", False),
+        ("Add a pricing section", True),
+        ("<div class='x'>why is this broken</div>", True),
+        ("why " * 200, True),
+    ])
+    def test_judges_the_last_human_message(self, text, strong):
+        assert needs_strong_model([AIMessage(content="earlier"), HumanMessage(content=text)]) is strong
+
+    def test_failed_tool_call_escalates_the_rest_of_the_turn(self):
+        call = AIMessage(content="", tool_calls=[{"name": "rails_https_request", "args": {}, "id": "c1"}])
+        turn = [HumanMessage(content="how many users signed up?"), call]
+        assert not needs_strong_model(turn + [ToolMessage(content="42", tool_call_id="c1")])
+        assert needs_strong_model(turn + [ToolMessage(content="HTTP Error 500: boom", tool_call_id="c1")])
+
+
+class TestTierReporting:
+    """Test that calls report latency and usage per tier."""
+
+    @pytest.mark.asyncio
+    async def test_routed_model_reports_per_tier(self):
+        def completion(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, json={
+                "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "gpt-4.1-mini",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "hello"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+            })
+
+        messages = [HumanMessage(content="hi")]
+        llm = get_routed_chat_model("public_leonardo", messages=messages, api_key="test", max_retries=0,
+                                    http_async_client=httpx.AsyncClient(transport=httpx.MockTransport(completion)))
+        assert llm.tier == "fast" and llm.model_name == model_routing._tiers["fast"]
+        await llm.ainvoke(messages)
+
+        labels = {"tier": "fast", "model": llm.model_name}
+        assert metrics.counter("llm.tier_calls", **labels) == 1
+        assert metrics.counter("llm.tier_tokens", **labels) == 12
+        assert metrics.summary("llm.tier_latency_seconds", **labels)["count"] == 1
@@ -0,0 +1,116 @@
+"""
+Tests for running several threads over one websocket connection.
+"""
+import asyncio
+import json
+import pytest
+from unittest.mock import MagicMock, AsyncMock, patch
+from starlette.websockets import WebSocketState
+from langchain_core.messages import AIMessage
+
+from app.websocket.request_handler import RequestHandler
+from app.websocket.web_socket_handler import WebSocketHandler
+
+
+def make_websocket():
+    websocket = AsyncMock()
+    websocket.client_state = WebSocketState.CONNECTED
+    return websocket
+
+
+class FakeGraph:
+    """Streams one message per run, after waiting for the test to release that thread."""
+
+    def __init__(self):
+        self.release = {}
+        self.running = []
+        self.max_running = 0
+
+    def astream(self, state, config=None, **kwargs):
+        thread_id = config["configurable"]["thread_id"]
+        release = self.release.setdefault(thread_id, asyncio.Event())
+
+        async def stream():
+            self.running.append(thread_id)
+            self.max_running = max(self.max_running, len(self.running))
+            try:
+                await release.wait()
+                yield ((), "updates", {"llamabot": {"messages": [AIMessage(content=f"done {thread_id}", id=f"m-{thread_id}")]}})
+            finally:
+                self.running.remove(thread_id)
+        return stream()
+
+
+class TestMultiplexedRuns:
+    """Test concurrency across threads and serialization within a thread."""
+
+    @pytest.mark.asyncio
+    async def test_threads_run_concurrently_and_frames_are_tagged(self):
+        websocket = make_websocket()
+        graph = FakeGraph()
+        handler = RequestHandler(MagicMock())
+        with patch.object(handler, "get_langgraph_app_and_state", return_value=(graph, {})):
+            runs = [
+                asyncio.create_task(handler.handle_request({"thread_id": "a"}, websocket, run_id="run-a")),
+                asyncio.create_task(handler.handle_request({"thread_id": "b"}, websocket, run_id="run-b")),
+            ]
+            await asyncio.sleep(0.01)
+            assert sorted(graph.running) == ["a", "b"]
+
+            graph.release["b"].set()
+            graph.release["a"].set()
+            await asyncio.gather(*runs)
+
+        frames = [json.loads(call.args[0]) for call in websocket.send_text.call_args_list]
+        assert {(frame["thread_id"], frame["run_id"], frame["content"]) for frame in frames} == {
+            ("a", "run-a", "done a"), ("b", "run-b", "done b")
+        }
+
+    @pytest.mark.asyncio
+    async def test_runs_on_the_same_thread_are_serialized(self):
+        websocket = make_websocket()
+        graph = FakeGraph()
+        handler = RequestHandler(MagicMock())
+        with patch.object(handler, "get_langgraph_app_and_state", return_value=(graph, {})):
+            runs = [asyncio.create_task(handler.handle_request({"thread_id": "a"}, websocket)) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            assert graph.running == ["a"]
+
+            graph.release["a"].set()
+            await asyncio.gather(*runs)
+        assert graph.max_running == 1
+        assert websocket.send_text.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_concurrency_limit_per_connection(self):
+        websocket = make_websocket()
+        graph = FakeGraph()
+        handler = RequestHandler(MagicMock())
+        handler.get_context(websocket).run_slots = asyncio.Semaphore(2)
+        with patch.object(handler, "get_langgraph_app_and_state", return_value=(graph, {})):
+            runs = [asyncio.create_task(handler.handle_request({"thread_id": t}, websocket)) for t in "abc"]
+            await asyncio.sleep(0.01)
+            assert len(graph.running) == 2
+
+            for thread_id in "abc":
+                graph.release.setdefault(thread_id, asyncio.Event()).set()
+            await asyncio.gather(*runs)
+        assert graph.max_running == 2
+
+    @pytest.mark.asyncio
+    async def test_cancel_only_affects_the_given_thread(self):
+        websocket = make_websocket()
+        handler = WebSocketHandler(websocket, MagicMock())
+
+        async def never_finishes(message, websocket, run_id=None):
+            await asyncio.Event().wait()
+
+        with patch.object(handler.request_handler, "handle_request", side_effect=never_finishes):
+            handler._start_run({"thread_id": "a", "message": "hi"})
+            handler._start_run({"thread_id": "b", "message": "hi"})
+            cancelled = handler._cancel_runs(thread_id="a")
+            await asyncio.gather(*cancelled, return_exceptions=True)
+
+            assert [thread_id for thread_id, _ in handler.runs.values()] == ["b"]
+            await asyncio.gather(*handler._cancel_runs(), return_exceptions=True)
+        assert handler.runs == {}
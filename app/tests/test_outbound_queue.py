@@ -0,0 +1,174 @@
+"""
+Tests for the per-connection outbound websocket queue.
+"""
+import asyncio
+import json
+import pytest
+from unittest.mock import AsyncMock
+from starlette.websockets import WebSocketState
+
+from app.metrics import metrics
+from app.websocket.outbound_queue import OutboundQueue
+from app.websocket.stream_protocol import merge_token_frames
+
+
+def delta(text, message_id="m1"):
+    return {"type": "delta", "v": 2, "id": message_id, "node": "llamabot", "text": text}
+
+
+def make_websocket():
+    websocket = AsyncMock()
+    websocket.client_state = WebSocketState.CONNECTED
+    return websocket
+
+
+def sent_frames(websocket):
+    return [json.loads(call.args[0]) for call in websocket.send_text.call_args_list]
+
+
+class TestMergeTokenFrames:
+    """Test folding token frames together."""
+
+    def test_merges_delta_text_and_tool_call_args(self):
+        earlier = {"type": "delta", "v": 2, "id": "m1", "node": "n", "tool_calls": [{"index": 0, "id": "call_1", "name": "write_html_page", "args": '{"a'}]}
+        later = {"type": "delta", "v": 2, "id": "m1", "node": "n", "text": "!", "tool_calls": [{"index": 0, "args": '": 1}'}]}
+
+        merged = merge_token_frames(earlier, later)
+        assert merged["text"] == "!"
+        assert merged["tool_calls"] == [{"index": 0, "id": "call_1", "name": "write_html_page", "args": '{"a": 1}'}]
+
+    def test_merges_legacy_text_chunks(self):
+        earlier = {"type": "AIMessageChunk", "content": "Hel", "tool_calls": [], "base_message": {"id": "m1", "content": "Hel"}}
+        later = {"type": "AIMessageChunk", "content": "lo", "tool_calls": [], "base_message": {"id": "m1", "content": "lo"}}
+
+        merged = merge_token_frames(earlier, later)
+        assert merged["content"] == "Hello"
+        assert merged["base_message"]["content"] == "Hello"
+
+    def test_does_not_merge_different_messages_or_non_token_frames(self):
+        assert merge_token_frames(delta("a", "m1"), delta("b", "m2")) is None
+        assert merge_token_frames(delta("a"), {"type": "message", "id": "m1"}) is None
+
+
+class TestOutboundQueue:
+    """Test sending, merging and dropping under backpressure."""
+
+    def setup_method(self):
+        metrics.reset()
+
+    @pytest.mark.asyncio
+    async def test_sends_frames_in_order(self):
+        websocket = make_websocket()
+        queue = OutboundQueue(websocket, max_size=10)
+        queue.start()
+        for frame in (delta("Hel"), delta("lo"), {"type": "message", "id": "m1"}):
+            queue.put(frame)
+
+        assert await queue.drain(timeout=1)
+        await queue.close()
+        assert [frame.get("text", frame["type"]) for frame in sent_frames(websocket)] == ["Hel", "lo", "message"]
+        assert metrics.summary("websocket.send_latency_seconds")["count"] == 3
+
+    @pytest.mark.asyncio
+    async def test_put_never_blocks_and_merges_when_full(self):
+        queue = OutboundQueue(make_websocket(), max_size=2, overflow_policy="merge")
+        # Not started, so nothing drains: the queue has to absorb everything without blocking.
+        queue.put({"type": "message", "id": "m0"})
+        for text in "Hello":
+            queue.put(delta(text))
+
+        assert len(queue) == 2
+        assert queue._frames[1]["text"] == "Hello"
+        assert metrics.counter("websocket.frames_merged") == 4
+
+    @pytest.mark.asyncio
+    async def test_drops_token_frames_to_a_summary_frame(self):
+        queue = OutboundQueue(make_websocket(), max_size=2, overflow_policy="drop")
+        queue.put(delta("a"))
+        queue.put({"type": "message", "id": "m0"})
+        queue.put(delta("b"))
+        queue.put(delta("c"))
+
+        frames = list(queue._frames)
+        assert [frame["type"] for frame in frames] == ["message", "stream_summary"]
+        assert frames[1]["dropped_frames"] == 3
+        assert metrics.counter("websocket.frames_dropped") == 3
+
+    @pytest.mark.asyncio
+    async def test_never_drops_non_token_frames(self):
+        queue = OutboundQueue(make_websocket(), max_size=1)
+        for i in range(3):
+            queue.put({"type": "message", "id": f"m{i}"})
+        assert len(queue) == 3
+
+    @pytest.mark.asyncio
+    async def test_slow_client_does_not_block_producer(self):
+        websocket = make_websocket()
+        release = asyncio.Event()
+
+        async def slow_send(text):
+            await release.wait()
+        websocket.send_text.side_effect = slow_send
+
+        queue = OutboundQueue(websocket, max_size=4)
+        queue.start()
+        for i in range(100):
+            queue.put(delta(str(i)))
+        # The producer got through all 100 frames while the first send is still stuck.
+        assert len(queue) <= 4
+
+        release.set()
+        assert await queue.drain(timeout=1)
+        await queue.close()
+        assert "".join(frame.get("text", "") for frame in sent_frames(websocket)) == "".join(str(i) for i in range(100))
+
+    @pytest.mark.asyncio
+    async def test_send_timeout_closes_connection(self):
+        websocket = make_websocket()
+
+        async def hung_send(text):
+            await asyncio.sleep(10)
+        websocket.send_text.side_effect = hung_send
+
+        queue = OutboundQueue(websocket, send_timeout=0.01)
+        queue.start()
+        queue.put(delta("a"))
+        queue.put(delta("b"))
+
+        assert await queue.drain(timeout=1)
+        assert queue.closed
+        websocket.close.assert_called_once_with(code=1013)
+        assert metrics.counter("websocket.send_timeouts") == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_send_skips_the_frame_while_connected(self):
+        websocket = make_websocket()
+        websocket.send_text.side_effect = [RuntimeError("send failed"), None]
+
+        queue = OutboundQueue(websocket)
+        queue.start()
+        queue.put(delta("a"))
+        queue.put(delta("b"))
+
+        assert await queue.drain(timeout=1)
+        assert not queue.closed
+        assert websocket.send_text.call_count == 2
+        await queue.close()
+
+    @pytest.mark.asyncio
+    async def test_failed_send_on_closed_socket_stops_the_writer(self):
+        websocket = make_websocket()
+
+        async def failing_send(text):
+            websocket.client_state = WebSocketState.DISCONNECTED
+            raise RuntimeError("socket closed")
+        websocket.send_text.side_effect = failing_send
+
+        queue = OutboundQueue(websocket)
+        queue.start()
+        queue.put(delta("a"))
+        queue.put(delta("b"))
+
+        assert await queue.drain(timeout=1)
+        assert queue.closed
+        assert websocket.send_text.call_count == 1
@@ -0,0 +1,131 @@
+"""
+Tests for cache-friendly prompt assembly (prompt_assembly.py) and cached-token reporting.
+"""
+import pytest
+import httpx
+from unittest.mock import AsyncMock, MagicMock, patch
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from app import context_window, prompt_assembly
+from app.context_window import ContextPolicy, estimate_history_tokens
+from app.prompt_assembly import assemble_prompt, prompt_cache_key, record_prompt_cache_usage
+from app.llm_client import get_chat_model
+from app.metrics import metrics
+from app.agents.llamapress import html_agent
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+class TestAssemblePrompt:
+    """Test segment order, breakpoints and the cache key."""
+
+    def test_orders_from_most_to_least_stable(self):
+        history = [HumanMessage(content="hi"), AIMessage(content="hello")]
+        prompt = assemble_prompt("STATIC", history, user_context="USER", page_html="<p>page</p>", turn_context="TURN")
+
+        assert [message.content for message in prompt.messages] == [
+            "STATIC", "USER", "<CURRENT_PAGE_HTML><p>page</p></CURRENT_PAGE_HTML>", "hi", "hello", "TURN"
+        ]
+        assert prompt.breakpoints == [1, 2, 3]
+
+    def test_next_turn_extends_the_previous_prompt(self):
+        history = [HumanMessage(content="make it blue")]
+        first = assemble_prompt("STATIC", history, page_html="<p/>", turn_context="<SELECTED_ELEMENT>a</SELECTED_ELEMENT>")
+        history = history + [AIMessage(content="done"), HumanMessage(content="now red")]
+        second = assemble_prompt("STATIC", history, page_html="<p/>", turn_context="<SELECTED_ELEMENT>b</SELECTED_ELEMENT>")
+
+        stable = len(first.messages) - 1 # everything but the previous turn context
+        assert second.messages[:stable] == first.messages[:stable]
+        assert second.breakpoints == first.breakpoints
+
+    def test_cache_key_covers_instructions_and_tools_only(self):
+        key = prompt_cache_key("STATIC", [html_agent.write_html_page])
+        assert assemble_prompt("STATIC", [HumanMessage(content="x")], tools=[html_agent.write_html_page], page_html="a").cache_key == key
+        assert prompt_cache_key("STATIC", [html_agent.overwrite_html_snippet]) != key
+        assert prompt_cache_key("OTHER", [html_agent.write_html_page]) != key
+
+    def test_prompt_cache_key_is_opt_in(self):
+        prompt = assemble_prompt("STATIC", [])
+        model = MagicMock()
+        assert prompt.model_kwargs() == {}
+        assert prompt.bind(model) is model
+        with patch.object(prompt_assembly, "PROMPT_CACHE_KEY_ENABLED", True):
+            assert prompt.model_kwargs() == {"extra_body": {"prompt_cache_key": prompt.cache_key}}
+            prompt.bind(model)
+        model.bind.assert_called_once_with(extra_body={"prompt_cache_key": prompt.cache_key})
+
+
+class TestCachedTokenReporting:
+    """Test that cached prompt tokens are reported from usage metadata."""
+
+    def test_record_prompt_cache_usage(self):
+        record_prompt_cache_usage("gpt-4.1", {"input_tokens": 2000, "output_tokens": 10, "total_tokens": 2010,
+                                              "input_token_details": {"cache_read": 1536}})
+        record_prompt_cache_usage("gpt-4.1", {"input_tokens": 0})
+        assert metrics.counter("llm.prompt_tokens", model="gpt-4.1") == 2000
+        assert metrics.counter("llm.cached_prompt_tokens", model="gpt-4.1") == 1536
+        assert metrics.summary("llm.prompt_cache_hit_ratio", model="gpt-4.1")["count"] == 1
+
+    @pytest.mark.asyncio
+    async def test_chat_model_reports_cached_tokens(self):
+        def completion(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, json={
+                "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "gpt-4.1",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+                "usage": {"prompt_tokens": 1200, "completion_tokens": 1, "total_tokens": 1201,
+                          "prompt_tokens_details": {"cached_tokens": 1024}},
+            })
+
+        llm = get_chat_model("gpt-4.1", api_key="test", max_retries=0,
+                             http_async_client=httpx.AsyncClient(transport=httpx.MockTransport(completion)))
+        await llm.ainvoke([HumanMessage(content="hi")])
+        assert metrics.counter("llm.cached_prompt_tokens", model="gpt-4.1") == 1024
+        assert metrics.counter("llm.prompt_tokens", model="gpt-4.1") == 1200
+
+
+class TestHtmlAgentPrompt:
+    """Test that the HTML agent sends the page ahead of the history."""
+
+    @pytest.mark.asyncio
+    async def test_write_html_page_agent_layout(self):
+        bound = MagicMock()
+        bound.ainvoke = AsyncMock(return_value=AIMessage(content="ok"))
+        model = MagicMock()
+        model.bind_tools.return_value = bound
+        state = {"messages": [HumanMessage(content="make it blue")], "current_page_html": "<p>page</p>"}
+
+        with patch.object(html_agent, "get_routed_chat_model", return_value=model), patch.object(html_agent, "HTML_EDIT_MODE", "full"):
+            await html_agent.write_html_page_agent(state)
+
+        messages = bound.ainvoke.call_args.args[0]
+        assert isinstance(messages[0], SystemMessage) and "<CURRENT_PAGE_HTML>" not in messages[0].content
+        assert messages[1].content == "<CURRENT_PAGE_HTML><p>page</p></CURRENT_PAGE_HTML>"
+        assert messages[2].content == "make it blue"
+
+    @pytest.mark.asyncio
+    async def test_page_over_the_ceiling_is_shown_in_part_with_line_edits_only(self):
+        bound = MagicMock()
+        bound.ainvoke = AsyncMock(return_value=AIMessage(content="ok"))
+        model = MagicMock()
+        model.model_name = "gpt-4.1"
+        model.bind_tools.return_value = bound
+        page = "\n".join(f"<p class='row'>line {index}</p>" for index in range(2000))
+        request = HumanMessage(content="make the first paragraph blue")
+        state = {"messages": [request], "current_page_html": page}
+
+        with patch.object(html_agent, "get_routed_chat_model", return_value=model), \
+             patch.dict(context_window._policies, {"llamapress": ContextPolicy(max_tokens=6000, keep_turns=2)}):
+            await html_agent.write_html_page_agent(state)
+
+        assert model.bind_tools.call_args.args[0] == [html_agent.edit_html_page_lines]
+        messages = bound.ainvoke.call_args.args[0]
+        assert messages[-1] == request
+        assert messages[1].content.startswith("<CURRENT_PAGE_HTML>00001: <p class='row'>line 0</p>")
+        assert "lines" in messages[1].content and "not shown" in messages[1].content
+        assert estimate_history_tokens(messages) <= 6000
+        assert metrics.counter("llamapress.page_truncated") == 1
@@ -0,0 +1,112 @@
+"""
+Tests for cross-worker broadcast fan-out (websocket/pubsub.py).
+"""
+import asyncio
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from starlette.websockets import WebSocketState
+
+from app.metrics import metrics
+from app.websocket.pubsub import InMemoryHub, InMemoryPubSub, PostgresPubSub, create_pubsub, make_envelope
+from app.websocket.web_socket_connection_manager import WebSocketConnectionManager
+
+
+def make_websocket():
+    websocket = AsyncMock()
+    websocket.client_state = WebSocketState.CONNECTED
+    return websocket
+
+
+class FakeNotifyConnection:
+    """Records pg_notify calls; never produces notifications of its own."""
+
+    def __init__(self):
+        self.notified = []
+        self.closed = False
+
+    async def execute(self, query, params=None):
+        if params and "pg_notify" in query:
+            self.notified.append(params)
+
+    async def notifies(self):
+        await asyncio.Event().wait()
+        yield # pragma: no cover
+
+    async def close(self):
+        self.closed = True
+
+
+class TestInMemoryFanOut:
+    """Test broadcasting across managers ("workers") sharing a hub."""
+
+    @pytest.mark.asyncio
+    async def test_broadcast_reaches_other_workers(self):
+        hub = InMemoryHub()
+        worker_a, worker_b = WebSocketConnectionManager(MagicMock()), WebSocketConnectionManager(MagicMock())
+        await worker_a.start_pubsub(InMemoryPubSub(hub))
+        await worker_b.start_pubsub(InMemoryPubSub(hub))
+        socket_a, socket_b, other_tenant = make_websocket(), make_websocket(), make_websocket()
+        worker_a.register(socket_a, tenant="acme")
+        worker_b.register(socket_b, tenant="acme")
+        worker_b.register(other_tenant, tenant="globex")
+
+        assert await worker_a.broadcast("hello", tenant="acme") == 1 # local count
+        socket_a.send_text.assert_called_once_with('{"message":"hello"}')
+        socket_b.send_text.assert_called_once_with('{"message":"hello"}')
+        other_tenant.send_text.assert_not_called()
+
+        await worker_a.stop_pubsub()
+        await worker_b.broadcast("bye")
+        assert socket_a.send_text.call_count == 1 # worker_a no longer listens
+
+
+class TestPostgresPubSub:
+    """Test batching and payload limits of the LISTEN/NOTIFY backend."""
+
+    @pytest.mark.asyncio
+    async def test_batches_envelopes_into_one_notify(self):
+        connection = FakeNotifyConnection()
+        pubsub = PostgresPubSub("postgresql://db", batch_seconds=0.01, connect=AsyncMock(return_value=connection))
+        for i in range(3):
+            assert await pubsub.publish(make_envelope(pubsub.origin, f"m{i}"))
+        await asyncio.sleep(0.05)
+
+        assert len(connection.notified) == 1
+        channel, payload = connection.notified[0]
+        assert channel == "llamabot_ws"
+        assert [envelope["message"] for envelope in json.loads(payload)] == ["m0", "m1", "m2"]
+        await pubsub.close()
+
+    @pytest.mark.asyncio
+    async def test_payloads_stay_under_the_limit(self):
+        connection = FakeNotifyConnection()
+        pubsub = PostgresPubSub("postgresql://db", batch_seconds=0.01, max_payload_bytes=400, connect=AsyncMock(return_value=connection))
+        for i in range(4):
+            await pubsub.publish(make_envelope(pubsub.origin, "x" * 100))
+        assert not await pubsub.publish(make_envelope(pubsub.origin, "x" * 500)) # too big for any NOTIFY
+        await asyncio.sleep(0.05)
+
+        assert len(connection.notified) >= 2
+        assert all(len(payload.encode("utf-8")) <= 400 for _, payload in connection.notified)
+        assert sum(len(json.loads(payload)) for _, payload in connection.notified) == 4
+        await pubsub.close()
+
+    @pytest.mark.asyncio
+    async def test_delivers_other_workers_envelopes_and_records_latency(self):
+        pubsub = PostgresPubSub("postgresql://db")
+        received = []
+
+        async def on_message(envelope):
+            received.append(envelope["message"])
+        pubsub.on_message = on_message
+        before = (metrics.summary("websocket.pubsub_latency_seconds") or {}).get("count", 0)
+
+        await pubsub._deliver(json.dumps([make_envelope("other-worker", "hi"), make_envelope(pubsub.origin, "mine")]))
+        assert received == ["hi"]
+        assert metrics.summary("websocket.pubsub_latency_seconds")["count"] == before + 1
+
+    def test_backend_selection(self):
+        assert isinstance(create_pubsub("memory", "postgresql://db"), InMemoryPubSub)
+        assert isinstance(create_pubsub("postgres", "postgresql://db"), PostgresPubSub)
+        assert isinstance(create_pubsub("postgres", ""), InMemoryPubSub)
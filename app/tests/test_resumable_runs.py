@@ -0,0 +1,187 @@
+"""
+Tests for resumable runs: the per-run event log, the disconnect grace period and resume over a new socket.
+"""
+import asyncio
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from fastapi import WebSocketDisconnect
+from starlette.websockets import WebSocketState
+from langchain_core.messages import AIMessage
+
+from app.websocket.request_handler import RequestHandler
+from app.websocket.resumable_runs import ResumableRun, ResumableRunRegistry, RunEventLog, RunIdInUse, run_registry
+from app.websocket.web_socket_handler import WebSocketHandler
+
+
+class FakeSubscriber:
+    def __init__(self):
+        self.frames = []
+        self.closed = False
+
+    def put(self, frame):
+        self.frames.append(frame)
+
+
+class TestRunEventLog:
+    """Test numbering and replay from the bounded log."""
+
+    def test_numbers_frames_and_replays_after_seq(self):
+        log = RunEventLog(max_size=10)
+        for i in range(3):
+            log.append({"n": i})
+
+        missed, gap = log.events_after(1)
+        assert [frame["seq"] for frame in missed] == [2, 3]
+        assert gap is False
+
+    def test_reports_gap_when_frames_were_evicted(self):
+        log = RunEventLog(max_size=2)
+        for i in range(5):
+            log.append({"n": i})
+
+        missed, gap = log.events_after(1)
+        assert [frame["seq"] for frame in missed] == [4, 5]
+        assert gap is True
+        assert log.events_after(3) == (missed, False)
+
+
+class TestResumableRun:
+    """Test attaching, detaching and the grace period."""
+
+    @pytest.mark.asyncio
+    async def test_frames_published_while_detached_are_replayed(self):
+        run = ResumableRun("r1", "t1", grace_seconds=10)
+        first = FakeSubscriber()
+        run.attach(first)
+        run.publish({"text": "a"})
+        run.detach(first)
+        run.publish({"text": "b"})
+        run.publish({"text": "c"})
+
+        second = FakeSubscriber()
+        replayed, gap = run.attach(second, last_seq=1)
+        run.publish({"text": "d"})
+
+        assert [frame["text"] for frame in first.frames] == ["a"]
+        assert [frame["text"] for frame in second.frames] == ["b", "c", "d"]
+        assert (replayed, gap) == (2, False)
+
+    @pytest.mark.asyncio
+    async def test_run_is_cancelled_when_nobody_resumes(self):
+        run = ResumableRun("r1", "t1", grace_seconds=0.01)
+        run.task = asyncio.create_task(asyncio.sleep(10))
+        run.detach()
+
+        await asyncio.sleep(0.05)
+        assert run.task.cancelled()
+
+    @pytest.mark.asyncio
+    async def test_resuming_within_grace_keeps_run_alive(self):
+        run = ResumableRun("r1", "t1", grace_seconds=0.01)
+        run.task = asyncio.create_task(asyncio.sleep(10))
+        run.detach()
+        run.attach(FakeSubscriber())
+
+        await asyncio.sleep(0.05)
+        assert not run.task.done()
+        run.task.cancel()
+
+
+class TestRunRegistry:
+    """Test that run ids can't be taken over."""
+
+    @pytest.mark.asyncio
+    async def test_run_ids_in_use_are_rejected(self):
+        registry = ResumableRunRegistry(retention_seconds=10)
+        run = registry.create("r1", "t1")
+        with pytest.raises(RunIdInUse):
+            registry.create("r1", "t2")
+        registry.finish("r1")
+        with pytest.raises(RunIdInUse): # still replayable
+            registry.create("r1", "t2")
+        assert registry.get("r1") is run
+
+    def test_resume_requires_the_runs_thread_and_tenant(self):
+        run = ResumableRun("r1", "t1", tenant="acme")
+        assert run.belongs_to("t1", "acme")
+        assert not run.belongs_to(None, "acme")
+        assert not run.belongs_to("t2", "acme")
+        assert not run.belongs_to("t1", "other")
+        assert ResumableRun("r2", "7").belongs_to(7)
+
+
+class TestResumeOverWebSocket:
+    """Test a client losing its socket mid-run and resuming on a new one."""
+
+    @pytest.mark.asyncio
+    async def test_finished_runs_report_how_they_ended(self):
+        async def fail():
+            raise RuntimeError("boom")
+
+        handler = WebSocketHandler(AsyncMock(), MagicMock())
+        failed, cancelled = asyncio.create_task(fail()), asyncio.create_task(asyncio.Event().wait())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(failed, cancelled, return_exceptions=True)
+        try:
+            for run_id, task in (("failed-run", failed), ("cancelled-run", cancelled)):
+                run_registry.create(run_id, "t1")
+                handler._finish_run(run_id, task)
+            assert run_registry.get("failed-run").status == "failed"
+            assert run_registry.get("cancelled-run").status == "cancelled"
+        finally:
+            run_registry.runs.pop("failed-run", None)
+            run_registry.runs.pop("cancelled-run", None)
+
+    @pytest.mark.asyncio
+    async def test_run_survives_disconnect_and_replays_on_resume(self):
+        release = asyncio.Event()
+
+        async def fake_astream(*args, **kwargs):
+            yield ((), "updates", {"llamabot": {"messages": [AIMessage(content="first", id="m1")]}})
+            await release.wait()
+            yield ((), "updates", {"llamabot": {"messages": [AIMessage(content="second", id="m2")]}})
+
+        fake_graph = MagicMock()
+        fake_graph.astream = fake_astream
+        manager = MagicMock()
+        manager.connect = AsyncMock()
+        manager.send_personal_message = AsyncMock()
+
+        first_socket = AsyncMock()
+        first_socket.receive_json.side_effect = [
+            {"message": "hi", "thread_id": "t1", "run_id": "resume-run"},
+            WebSocketDisconnect(code=1006, reason="wifi"),
+        ]
+        second_socket = AsyncMock()
+        second_socket.client_state = WebSocketState.CONNECTED
+        finished = asyncio.Event()
+
+        async def second_socket_messages():
+            if not hasattr(second_socket_messages, "sent"):
+                second_socket_messages.sent = True
+                return {"type": "resume", "run_id": "resume-run", "thread_id": "t1", "last_seq": 0}
+            release.set()
+            await finished.wait()
+            raise WebSocketDisconnect(code=1000, reason="done")
+        second_socket.receive_json.side_effect = second_socket_messages
+
+        with patch.object(RequestHandler, "get_langgraph_app_and_state", return_value=(fake_graph, {})):
+            await WebSocketHandler(first_socket, manager).handle_websocket()
+            run = run_registry.get("resume-run")
+            assert run is not None and not run.task.done() # still running without a client
+            while run.log.last_seq < 1: # the first message is produced while nobody is listening
+                await asyncio.sleep(0.001)
+
+            second_handler = WebSocketHandler(second_socket, manager)
+            second_run = asyncio.create_task(second_handler.handle_websocket())
+            await asyncio.wait_for(run.task, 1)
+            await second_handler.outbound.drain(1)
+            finished.set()
+            await second_run
+
+        frames = [json.loads(call.args[0]) for call in second_socket.send_text.call_args_list]
+        assert [frame.get("content", frame["type"]) for frame in frames] == ["first", "resumed", "second"]
+        assert [frame.get("seq") for frame in frames] == [1, None, 2]
+        assert frames[1]["status"] == "running"
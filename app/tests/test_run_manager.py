@@ -0,0 +1,157 @@
+"""
+Tests for background runs (run_manager.py) and the /runs endpoints.
+"""
+import asyncio
+import pytest
+from unittest.mock import MagicMock, patch
+from fastapi.testclient import TestClient
+
+import main
+from app.run_manager import RunManager, RunQueueFull
+from app.sse import SseSubscriber
+from app.websocket.resumable_runs import ResumableRunRegistry
+
+
+def make_manager(**kwargs):
+    return RunManager(MagicMock(), registry=ResumableRunRegistry(), **kwargs)
+
+
+class TestRunManager:
+    """Test queueing, running and cancelling background runs."""
+
+    @pytest.mark.asyncio
+    async def test_runs_without_a_subscriber_and_keeps_its_frames(self):
+        manager = make_manager(workers=1)
+
+        async def fake_handle_request(message, connection, run_id=None):
+            for text in ("Hel", "lo"):
+                manager.registry.get(run_id).publish({"type": "delta", "text": text})
+                await asyncio.sleep(0)
+
+        with patch.object(manager.request_handler, "handle_request", side_effect=fake_handle_request):
+            run = manager.submit({"message": "hi", "agent_name": "llamabot", "thread_id": "t1"})
+            assert run.status == "queued"
+            await asyncio.gather(run.task, return_exceptions=True)
+            await asyncio.sleep(0)
+
+        assert run.status == "finished"
+        assert run.finished_at is not None
+        assert manager.request_handler.contexts == {}
+
+        # A late subscriber catches up from the start.
+        subscriber = SseSubscriber()
+        replayed, gap = run.attach(subscriber)
+        assert (replayed, gap) == (2, False)
+        assert [subscriber.frames.get_nowait()["text"] for _ in range(2)] == ["Hel", "lo"]
+
+    @pytest.mark.asyncio
+    async def test_worker_pool_bounds_concurrency_and_queue(self):
+        manager = make_manager(workers=1, max_queued=1)
+        release = asyncio.Event()
+
+        async def fake_handle_request(message, connection, run_id=None):
+            await release.wait()
+
+        with patch.object(manager.request_handler, "handle_request", side_effect=fake_handle_request):
+            first = manager.submit({"thread_id": "t1"})
+            await asyncio.sleep(0)
+            second = manager.submit({"thread_id": "t2"})
+            await asyncio.sleep(0)
+            assert (first.status, second.status) == ("running", "queued")
+            with pytest.raises(RunQueueFull):
+                manager.submit({"thread_id": "t3"})
+
+            release.set()
+            await asyncio.gather(first.task, second.task)
+            await asyncio.sleep(0)
+        assert (first.status, second.status) == ("finished", "finished")
+
+    @pytest.mark.asyncio
+    async def test_detach_does_not_cancel_but_cancel_does(self):
+        manager = make_manager()
+
+        async def fake_handle_request(message, connection, run_id=None):
+            await asyncio.Event().wait()
+
+        with patch.object(manager.request_handler, "handle_request", side_effect=fake_handle_request):
+            run = manager.submit({"thread_id": "t1"})
+            await asyncio.sleep(0)
+            subscriber = SseSubscriber()
+            run.attach(subscriber)
+            run.detach(subscriber)
+            await asyncio.sleep(0.01)
+            assert run.status == "running"
+
+            assert manager.cancel(run.run_id, "t1")
+            await asyncio.gather(run.task, return_exceptions=True)
+            await asyncio.sleep(0)
+        assert run.status == "cancelled"
+        assert not manager.cancel(run.run_id, "t1")
+
+    @pytest.mark.asyncio
+    async def test_failed_run(self):
+        manager = make_manager()
+
+        with patch.object(manager.request_handler, "handle_request", side_effect=RuntimeError("boom")):
+            run = manager.submit({"thread_id": "t1"})
+            await asyncio.gather(run.task, return_exceptions=True)
+            await asyncio.sleep(0)
+        assert run.status == "failed"
+
+
+class TestRunEndpoints:
+    """Test the /runs endpoints, with the agent run faked."""
+
+    def test_submit_poll_and_stream(self):
+        async def fake_handle_request(message, connection, run_id=None):
+            for text in ("Hel", "lo"):
+                main.run_manager.registry.get(run_id).publish({"type": "delta", "text": text})
+
+        with TestClient(main.app) as client, \
+             patch.object(main.run_manager.request_handler, "handle_request", side_effect=fake_handle_request):
+            response = client.post("/runs", json={"message": "hi", "agent_name": "llamabot", "thread_id": "t1", "run_id": "bg-run"})
+            assert response.status_code == 202
+            assert response.json()["run_id"] == "bg-run"
+
+            streamed = client.get("/runs/bg-run/stream", params={"after": 1, "thread_id": "t1"})
+            assert '"text":"lo"' in streamed.text and '"type":"final"' in streamed.text
+            assert '"text":"Hel"' not in streamed.text
+
+            assert client.get("/runs/bg-run", params={"thread_id": "t1"}).json()["status"] == "finished"
+            events = client.get("/runs/bg-run/events", params={"after": 0, "thread_id": "t1"}).json()
+            assert [event["text"] for event in events["events"]] == ["Hel", "lo"]
+            assert events["gap"] is False
+            assert client.post("/runs/bg-run/cancel", params={"thread_id": "t1"}).status_code == 409
+
+            taken = client.post("/runs", json={"message": "hi", "agent_name": "llamabot", "thread_id": "t2", "run_id": "bg-run"})
+            assert taken.status_code == 409 # still replayable, so still in use
+            assert client.get("/runs/bg-run", params={"thread_id": "t1"}).json()["thread_id"] == "t1"
+
+    def test_unknown_run_is_404(self):
+        client = TestClient(main.app)
+        assert client.get("/runs/nope").status_code == 404
+        assert client.get("/runs/nope/events").status_code == 404
+        assert client.post("/runs/nope/cancel").status_code == 404
+
+    def test_other_threads_tenants_and_connection_runs_are_404(self):
+        async def fake_handle_request(message, connection, run_id=None):
+            pass
+
+        with TestClient(main.app) as client, \
+             patch.object(main.run_manager.request_handler, "handle_request", side_effect=fake_handle_request):
+            client.post("/runs", json={"agent_name": "llamabot", "thread_id": "t1", "tenant": "acme", "run_id": "bg-owned"})
+            assert client.get("/runs/bg-owned", params={"thread_id": "t1", "tenant": "acme"}).status_code == 200
+            assert client.get("/runs/bg-owned").status_code == 404
+            assert client.get("/runs/bg-owned", params={"thread_id": "t2", "tenant": "acme"}).status_code == 404
+            assert client.get("/runs/bg-owned/events", params={"thread_id": "t1"}).status_code == 404
+
+            # A websocket run in the same registry belongs to its connection.
+            main.run_registry.create("ws-run", "t3", subscriber=object())
+            try:
+                params = {"thread_id": "t3"}
+                assert client.get("/runs/ws-run", params=params).status_code == 404
+                assert client.get("/runs/ws-run/events", params=params).status_code == 404
+                assert client.get("/runs/ws-run/stream", params=params).status_code == 404
+                assert client.post("/runs/ws-run/cancel", params=params).status_code == 404
+            finally:
+                main.run_registry.runs.pop("ws-run", None)
@@ -0,0 +1,61 @@
+"""
+Tests for the shared JSON serialization module.
+"""
+import json
+import pytest
+from datetime import datetime
+from unittest.mock import AsyncMock, patch
+from langchain_core.messages import AIMessage, HumanMessage
+
+from app import serialization
+from app.serialization import dumps, dumpb, loads, ndjson_line, send_websocket_json
+
+
+class TestSerialization:
+    """Test encoding of the payloads we stream."""
+
+    def test_round_trips_plain_data(self):
+        payload = {"type": "ai", "content": "héllo 🦙", "tool_calls": [], "n": 1}
+        assert loads(dumps(payload)) == payload
+        assert loads(dumpb(payload)) == payload
+
+    def test_encodes_datetimes(self):
+        created_at = datetime(2025, 1, 2, 3, 4, 5)
+        assert loads(dumps({"created_at": created_at})) == {"created_at": "2025-01-02T03:04:05"}
+
+    def test_encodes_langchain_messages_as_base_message_dicts(self):
+        message = AIMessage(content="Hi there", id="m1")
+        encoded = loads(dumps({"messages": [message, HumanMessage(content="Hello")]}))
+
+        assert encoded["messages"][0]["content"] == "Hi there"
+        assert encoded["messages"][0]["type"] == "ai"
+        assert encoded["messages"][0]["id"] == "m1"
+        assert encoded["messages"][1]["type"] == "human"
+
+    def test_unknown_objects_fall_back_to_str(self):
+        class Custom:
+            def __str__(self):
+                return "custom!"
+        assert loads(dumps({"value": Custom()})) == {"value": "custom!"}
+
+    def test_indent_option(self):
+        assert "\n" in dumps({"a": 1}, indent=True)
+        assert "\n" not in dumps({"a": 1})
+
+    def test_ndjson_line(self):
+        line = ndjson_line({"type": "final"})
+        assert line.endswith("\n")
+        assert line.count("\n") == 1
+        assert loads(line) == {"type": "final"}
+
+    def test_stdlib_fallback_matches(self):
+        payload = {"created_at": datetime(2025, 1, 2), "message": AIMessage(content="x", id="m1")}
+        with patch.object(serialization, "ORJSON_AVAILABLE", False):
+            fallback = dumps(payload)
+        assert json.loads(fallback) == loads(dumps(payload))
+
+    @pytest.mark.asyncio
+    async def test_send_websocket_json_sends_text(self):
+        websocket = AsyncMock()
+        await send_websocket_json(websocket, {"type": "pong"})
+        websocket.send_text.assert_called_once_with('{"type":"pong"}')
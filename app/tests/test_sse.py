@@ -0,0 +1,111 @@
+"""
+Tests for the SSE transport (sse.py) and the /llamabot-chat-message-v2 endpoint.
+"""
+import asyncio
+import json
+import pytest
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+import main
+from app.sse import SseSubscriber, format_sse_event, parse_event_id, sse_run_events
+from app.websocket.resumable_runs import ResumableRun, run_registry
+
+
+def parse_events(body: str) -> list:
+    """(id, data) for every data event of an SSE body."""
+    events = []
+    for block in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if line and not line.startswith(":") and ": " in line)
+        if "data" in fields:
+            events.append((fields.get("id"), json.loads(fields["data"])))
+    return events
+
+
+async def never_disconnected():
+    return False
+
+
+class TestSseFormatting:
+    """Test event formatting and Last-Event-ID parsing."""
+
+    def test_format_event(self):
+        assert format_sse_event({"type": "delta", "text": "a\nb"}, event_id="run-1:3") == \
+            'id: run-1:3\ndata: {"type":"delta","text":"a\\nb"}\n\n'
+
+    def test_parse_event_id(self):
+        assert parse_event_id("run-1:3") == ("run-1", 3)
+        assert parse_event_id("a:b:12") == ("a:b", 12)
+        assert parse_event_id("garbage") == (None, 0)
+        assert parse_event_id(None) == (None, 0)
+
+
+class TestSseRunEvents:
+    """Test streaming a run's frames as SSE events."""
+
+    @pytest.mark.asyncio
+    async def test_streams_frames_then_final(self):
+        run = ResumableRun("run-1", "t1")
+        subscriber = SseSubscriber()
+        run.subscriber = subscriber
+
+        async def agent():
+            for text in ("Hel", "lo"):
+                run.publish({"type": "delta", "text": text})
+                await asyncio.sleep(0)
+        run.task = asyncio.create_task(agent())
+
+        body = "".join([event async for event in sse_run_events(run, subscriber, never_disconnected)])
+        events = parse_events(body)
+        assert body.startswith("retry: ")
+        assert [event_id for event_id, _ in events] == ["run-1:1", "run-1:2", None]
+        assert events[-1][1] == {"type": "final", "run_id": "run-1", "thread_id": "t1", "last_seq": 2}
+        assert run.subscriber is None
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_and_disconnect_cancel_the_run(self):
+        run = ResumableRun("run-1", "t1", grace_seconds=0)
+        subscriber = SseSubscriber()
+        run.subscriber = subscriber
+        run.task = asyncio.create_task(asyncio.Event().wait())
+        checks = []
+
+        async def disconnected_on_second_check():
+            checks.append(1)
+            return len(checks) > 1
+
+        body = "".join([event async for event in sse_run_events(run, subscriber, disconnected_on_second_check, heartbeat_seconds=0.01)])
+        assert ": heartbeat\n\n" in body
+        await asyncio.sleep(0)
+        assert run.task.cancelled()
+
+
+class TestSseEndpoint:
+    """Test /llamabot-chat-message-v2 end to end, with the agent run faked."""
+
+    def test_streams_run_and_resumes_from_last_event_id(self):
+        async def fake_handle_request(message, connection, run_id=None):
+            for text in ("Hel", "lo"):
+                run_registry.get(run_id).publish({"type": "delta", "text": text, "thread_id": message["thread_id"], "run_id": run_id})
+
+        # One client (and event loop) for both requests, like one server process.
+        with TestClient(main.app) as client, \
+             patch.object(main.sse_request_handler, "handle_request", side_effect=fake_handle_request):
+            response = client.post("/llamabot-chat-message-v2", json={"message": "hi", "agent_name": "llamabot", "thread_id": "t1", "run_id": "sse-run"})
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            events = parse_events(response.text)
+            assert [data["text"] for _, data in events[:-1]] == ["Hel", "lo"]
+            assert events[-1][1]["type"] == "final"
+            assert main.sse_request_handler.contexts == {}
+
+            assert client.post("/llamabot-chat-message-v2", json={"thread_id": "t2"}, headers={"Last-Event-ID": "sse-run:1"}).status_code == 404
+            taken = client.post("/llamabot-chat-message-v2", json={"message": "hi", "agent_name": "llamabot", "thread_id": "t2", "run_id": "sse-run"})
+            assert taken.status_code == 409 # the run_id is still in use
+            resumed = client.post("/llamabot-chat-message-v2", json={"thread_id": "t1"}, headers={"Last-Event-ID": "sse-run:1"})
+        events = parse_events(resumed.text)
+        assert [(event_id, data.get("text")) for event_id, data in events] == [("sse-run:2", "lo"), (None, None)]
+
+    def test_resume_of_unknown_run_is_404(self):
+        response = TestClient(main.app).post("/llamabot-chat-message-v2", json={}, headers={"Last-Event-ID": "nope:3"})
+        assert response.status_code == 404
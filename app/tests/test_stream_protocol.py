@@ -0,0 +1,128 @@
+"""
+Tests for the versioned websocket streaming protocol.
+"""
+import json
+import pytest
+from unittest.mock import MagicMock, AsyncMock, patch
+from starlette.websockets import WebSocketState
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+
+from app.websocket.stream_protocol import (
+    negotiate_protocol_version,
+    LegacyStreamEncoder,
+    DeltaStreamEncoder,
+    LEGACY_PROTOCOL_VERSION,
+    DELTA_PROTOCOL_VERSION,
+)
+from app.websocket.request_handler import RequestHandler
+from app.websocket.web_socket_handler import WebSocketHandler
+
+
+class TestProtocolNegotiation:
+    """Test picking a protocol version from what the client offers."""
+
+    def test_defaults_to_legacy(self):
+        assert negotiate_protocol_version(None) == LEGACY_PROTOCOL_VERSION
+
+    def test_picks_highest_supported_version(self):
+        assert negotiate_protocol_version([1, 2, 99]) == DELTA_PROTOCOL_VERSION
+        assert negotiate_protocol_version("2") == DELTA_PROTOCOL_VERSION
+
+    def test_unsupported_versions_fall_back_to_legacy(self):
+        assert negotiate_protocol_version([99, "bogus"]) == LEGACY_PROTOCOL_VERSION
+
+
+class TestStreamEncoders:
+    """Test the frame shapes of each protocol version."""
+
+    def test_legacy_chunk_frame_keeps_base_message(self):
+        frame = LegacyStreamEncoder().message_chunk(AIMessageChunk(content="Hi", id="m1"), "llamabot")
+
+        assert frame["type"] == "AIMessageChunk"
+        assert frame["content"] == "Hi"
+        assert frame["tool_calls"] == []
+        assert frame["base_message"]["id"] == "m1"
+
+    def test_delta_chunk_frame_only_carries_deltas(self):
+        chunk = AIMessageChunk(content="", id="m1", tool_call_chunks=[
+            {"name": "write_html_page", "args": '{"full_html', "id": "call_1", "index": 0}
+        ])
+        frame = DeltaStreamEncoder().message_chunk(chunk, "write_html_page_agent")
+
+        assert frame == {
+            "type": "delta",
+            "v": DELTA_PROTOCOL_VERSION,
+            "id": "m1",
+            "node": "write_html_page_agent",
+            "tool_calls": [{"index": 0, "id": "call_1", "name": "write_html_page", "args": '{"full_html'}]
+        }
+
+    def test_delta_encoder_skips_empty_and_non_chunk_messages(self):
+        encoder = DeltaStreamEncoder()
+
+        assert encoder.message_chunk(AIMessageChunk(content="", id="m1"), "llamabot") is None
+        assert encoder.message_chunk(ToolMessage(content="done", tool_call_id="call_1"), "tools") is None
+
+    def test_delta_message_frame_is_smaller_than_legacy(self):
+        message = AIMessage(content="Hello world", id="m1")
+        chunk = AIMessageChunk(content="Hello world", id="m1")
+
+        legacy = json.dumps(LegacyStreamEncoder().message_chunk(chunk, "llamabot"))
+        delta = json.dumps(DeltaStreamEncoder().message_chunk(chunk, "llamabot"))
+        assert len(delta) < len(legacy)
+
+        frame = DeltaStreamEncoder().message_update(message, "llamabot", [])
+        assert frame["type"] == "message"
+        assert frame["message"]["content"] == "Hello world"
+
+
+class TestProtocolOverWebSocket:
+    """Test negotiation and streaming through the websocket handlers."""
+
+    @pytest.mark.asyncio
+    async def test_hello_negotiates_delta_protocol(self):
+        from fastapi import WebSocketDisconnect
+
+        mock_websocket = AsyncMock()
+        mock_manager = MagicMock()
+        mock_manager.connect = AsyncMock()
+        mock_manager.send_personal_message = AsyncMock()
+        mock_websocket.receive_json.side_effect = [
+            {"type": "hello", "protocols": [1, 2]},
+            WebSocketDisconnect(code=1000, reason="done"),
+        ]
+
+        handler = WebSocketHandler(mock_websocket, mock_manager)
+        context = handler.request_handler.get_context(mock_websocket)
+        with patch.object(handler.request_handler, "cleanup_connection"):
+            await handler.handle_websocket()
+
+        assert context.protocol_version == DELTA_PROTOCOL_VERSION
+        reply = mock_manager.send_personal_message.call_args_list[0].args[0]
+        assert reply["type"] == "hello"
+        assert reply["protocol"] == DELTA_PROTOCOL_VERSION
+
+    @pytest.mark.asyncio
+    async def test_handle_request_sends_delta_frames(self):
+        metadata = {"langgraph_node": "llamabot"}
+        final_message = AIMessage(content="Hello", id="m1")
+
+        async def fake_astream(*args, **kwargs):
+            yield ((), "messages", (AIMessageChunk(content="Hello", id="m1"), metadata))
+            yield ((), "updates", {"llamabot": {"messages": [final_message]}})
+
+        fake_app = MagicMock()
+        fake_app.astream = fake_astream
+        websocket = AsyncMock()
+        websocket.client_state = WebSocketState.CONNECTED
+
+        handler = RequestHandler(MagicMock())
+        handler.get_context(websocket).protocol_version = DELTA_PROTOCOL_VERSION
+        with patch.object(handler, "get_langgraph_app_and_state", return_value=(fake_app, {})):
+            await handler.handle_request({"thread_id": "t1"}, websocket)
+
+        frames = [json.loads(call.args[0]) for call in websocket.send_text.call_args_list]
+        assert [frame["type"] for frame in frames] == ["delta", "message"]
+        assert frames[0]["text"] == "Hello"
+        assert frames[1]["node"] == "llamabot"
+        assert "base_message" not in frames[0]
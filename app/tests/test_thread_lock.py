@@ -0,0 +1,191 @@
+"""
+Tests for cross-worker thread locks (thread_lock.py) and their use by the admission scheduler.
+"""
+import asyncio
+import pytest
+import time
+from contextlib import asynccontextmanager, nullcontext
+from unittest.mock import patch
+from psycopg_pool import PoolTimeout
+
+from app.admission_scheduler import AdmissionScheduler
+from app.metrics import metrics
+from app.thread_lock import (
+    LocalThreadLock,
+    PostgresAdvisoryThreadLock,
+    ThreadLockUnavailable,
+    advisory_lock_key,
+    create_thread_lock,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+class FakeCursor:
+    def __init__(self, row):
+        self.row = row
+
+    async def fetchone(self):
+        return self.row
+
+
+class FakeConnection:
+    """Answers pg_try_advisory_lock with False `busy_polls` times, then True."""
+
+    def __init__(self, busy_polls=0, unlock_error=None):
+        self.busy_polls = busy_polls
+        self.unlock_error = unlock_error
+        self.statements = []
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+    async def execute(self, query, params):
+        self.statements.append((query, params))
+        if "pg_advisory_unlock" in query and self.unlock_error is not None:
+            raise self.unlock_error
+        if "pg_try_advisory_lock" in query:
+            acquired = self.busy_polls <= 0
+            self.busy_polls -= 1
+            return FakeCursor((acquired,))
+        return FakeCursor((True,))
+
+
+class FakePool:
+    """Hands out `size` connections; a checkout finding them all in use times out, like psycopg_pool's."""
+
+    def __init__(self, connection, size=1):
+        self._connection = connection
+        self.size = size
+        self.in_use = 0
+
+    @asynccontextmanager
+    async def connection(self):
+        if self.in_use >= self.size:
+            await asyncio.sleep(0.01)
+            raise PoolTimeout("couldn't get a connection after 0.01 sec")
+        self.in_use += 1
+        try:
+            yield self._connection
+        finally:
+            self.in_use -= 1
+
+
+class TestThreadLockBackends:
+    """Test picking a backend and the Postgres advisory lock protocol."""
+
+    def test_key_is_stable_signed_bigint(self):
+        assert advisory_lock_key("42") == advisory_lock_key("42")
+        assert advisory_lock_key("42") != advisory_lock_key("43")
+        assert -2**63 <= advisory_lock_key("42") < 2**63
+
+    def test_backend_selection(self):
+        assert isinstance(create_thread_lock("local", "postgresql://db"), LocalThreadLock)
+        assert isinstance(create_thread_lock("postgres", "postgresql://db"), PostgresAdvisoryThreadLock)
+        assert isinstance(create_thread_lock("postgres", ""), LocalThreadLock) # nothing to lock on
+        with patch.dict("os.environ", {"WEB_CONCURRENCY": "4"}):
+            assert isinstance(create_thread_lock("auto", "postgresql://db"), PostgresAdvisoryThreadLock)
+        with patch.dict("os.environ", {"WEB_CONCURRENCY": "1"}):
+            assert isinstance(create_thread_lock("auto", "postgresql://db"), LocalThreadLock)
+
+    @pytest.mark.asyncio
+    async def test_pool_is_sized_from_the_admission_cap(self):
+        scheduler = AdmissionScheduler(max_concurrent=32)
+        postgres_lock = lambda **kwargs: create_thread_lock("postgres", "postgresql://db", **kwargs)
+        with patch("app.admission_scheduler.create_thread_lock", side_effect=postgres_lock), \
+                patch.object(PostgresAdvisoryThreadLock, "hold", return_value=LocalThreadLock().hold("t1")):
+            async with scheduler.admit("t1"):
+                pass
+        assert scheduler.thread_lock.pool_size == 32 # one connection per run it admits
+
+    @pytest.mark.asyncio
+    async def test_waits_for_the_lock_then_releases_it(self):
+        connection = FakeConnection(busy_polls=2)
+        lock = PostgresAdvisoryThreadLock("postgresql://db", poll_seconds=0.001, pool=FakePool(connection))
+        key = advisory_lock_key("t1")
+
+        async with lock.hold("t1"):
+            assert [query for query, _ in connection.statements].count("SELECT pg_try_advisory_lock(%s)") == 3
+        assert connection.statements[-1] == ("SELECT pg_advisory_unlock(%s)", (key,))
+        assert not connection.closed # back to the pool
+
+    @pytest.mark.asyncio
+    async def test_exhausted_pool_waits_instead_of_running_unlocked(self):
+        connection = FakeConnection()
+        lock = PostgresAdvisoryThreadLock("postgresql://db", pool_size=1, pool=FakePool(connection))
+        events = []
+
+        async def run(thread_id, seconds):
+            async with lock.hold(thread_id):
+                events.append(f"start {thread_id}")
+                await asyncio.sleep(seconds)
+                events.append(f"end {thread_id}")
+
+        first = asyncio.create_task(run("t1", 0.05))
+        await asyncio.sleep(0)
+        await asyncio.gather(first, run("t2", 0))
+
+        assert events == ["start t1", "end t1", "start t2", "end t2"]
+        assert metrics.counter("thread_lock.pool_exhausted") >= 1
+        assert metrics.counter("thread_lock.unavailable") == 0
+        assert lock.checked_out == 0
+
+    @pytest.mark.asyncio
+    async def test_exhausted_pool_wait_is_bounded(self):
+        lock = PostgresAdvisoryThreadLock("postgresql://db", pool_size=1, pool=FakePool(FakeConnection()),
+                                          max_pool_wait_seconds=0.03)
+        async with lock.hold("t1"):
+            with pytest.raises(ThreadLockUnavailable):
+                async with lock.hold("t2"):
+                    pass # never runs unlocked
+        assert metrics.counter("thread_lock.unavailable") == 0
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("unlock_error", [OSError("server closed the connection"), asyncio.CancelledError()])
+    async def test_connection_is_discarded_when_unlock_does_not_go_through(self, unlock_error):
+        connection = FakeConnection(unlock_error=unlock_error)
+        lock = PostgresAdvisoryThreadLock("postgresql://db", pool=FakePool(connection))
+        with pytest.raises(asyncio.CancelledError) if isinstance(unlock_error, asyncio.CancelledError) else nullcontext():
+            async with lock.hold("t1"):
+                pass
+        assert connection.closed
+
+    @pytest.mark.asyncio
+    async def test_unreachable_database_falls_back_to_local_ordering(self):
+        lock = PostgresAdvisoryThreadLock("postgresql://u:p@127.0.0.1:1/db", pool_timeout=0.2)
+        try:
+            started_at = time.monotonic()
+            async with lock.hold("t1"):
+                pass # the run still goes ahead
+            assert time.monotonic() - started_at < 2
+            assert metrics.counter("thread_lock.unavailable") == 1
+            assert metrics.counter("thread_lock.pool_exhausted") == 0
+        finally:
+            await lock.close()
+
+
+class TestSchedulerUsesThreadLock:
+    """Test that admitted runs hold the thread lock."""
+
+    @pytest.mark.asyncio
+    async def test_admit_holds_thread_lock(self):
+        events = []
+
+        class RecordingLock:
+            @asynccontextmanager
+            async def hold(self, thread_id):
+                events.append(f"lock {thread_id}")
+                yield
+                events.append(f"unlock {thread_id}")
+
+        scheduler = AdmissionScheduler(thread_lock=RecordingLock())
+        async with scheduler.admit("t1"):
+            events.append("run")
+        assert events == ["lock t1", "run", "unlock t1"]
+        assert scheduler.running == 0
@@ -0,0 +1,147 @@
+"""
+Tests for token chunk coalescing on the websocket streaming path.
+"""
+import asyncio
+import json
+import pytest
+from unittest.mock import MagicMock, AsyncMock, patch
+from starlette.websockets import WebSocketState
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+
+from app.websocket.token_chunk_coalescer import TokenChunkCoalescer, iterate_with_flush_deadline, FLUSH_DUE
+from app.websocket.request_handler import RequestHandler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenChunkCoalescer:
+    """Test the coalescing buffer itself."""
+
+    def test_merges_chunks_until_flush(self):
+        coalescer = TokenChunkCoalescer(window_ms=50, max_chars=1000, clock=FakeClock())
+
+        assert coalescer.add(("ns", "agent"), AIMessageChunk(content="Hel", id="m1"), {}) == []
+        assert coalescer.add(("ns", "agent"), AIMessageChunk(content="lo", id="m1"), {}) == []
+
+        ready = coalescer.flush()
+        assert len(ready) == 1
+        assert ready[0][0].content == "Hello"
+        assert coalescer.flush() == []
+
+    def test_time_window_releases_chunks(self):
+        clock = FakeClock()
+        coalescer = TokenChunkCoalescer(window_ms=50, max_chars=1000, clock=clock)
+
+        coalescer.add(("ns", "agent"), AIMessageChunk(content="a", id="m1"), {})
+        assert coalescer.time_until_flush() == pytest.approx(0.05)
+
+        clock.now = 0.06
+        ready = coalescer.add(("ns", "agent"), AIMessageChunk(content="b", id="m1"), {})
+        assert [message.content for message, _ in ready] == ["ab"]
+        assert not coalescer.has_pending
+
+    def test_size_window_releases_chunks(self):
+        coalescer = TokenChunkCoalescer(window_ms=1000, max_chars=4, clock=FakeClock())
+
+        assert coalescer.add(("ns", "agent"), AIMessageChunk(content="ab", id="m1"), {}) == []
+        ready = coalescer.add(("ns", "agent"), AIMessageChunk(content="cd", id="m1"), {})
+        assert [message.content for message, _ in ready] == ["abcd"]
+
+    def test_node_change_flushes_previous_chunks(self):
+        coalescer = TokenChunkCoalescer(window_ms=1000, max_chars=1000, clock=FakeClock())
+
+        coalescer.add(("ns", "router"), AIMessageChunk(content="first", id="m1"), {"langgraph_node": "router"})
+        ready = coalescer.add(("ns", "agent"), AIMessageChunk(content="second", id="m2"), {"langgraph_node": "agent"})
+
+        assert [message.content for message, _ in ready] == ["first"]
+        assert ready[0][1] == {"langgraph_node": "router"}
+        assert [message.content for message, _ in coalescer.flush()] == ["second"]
+
+    def test_non_chunk_messages_are_not_merged(self):
+        coalescer = TokenChunkCoalescer(window_ms=1000, max_chars=1000, clock=FakeClock())
+
+        coalescer.add(("ns", "agent"), AIMessageChunk(content="thinking", id="m1"), {})
+        tool_message = ToolMessage(content="result", tool_call_id="call_1")
+        ready = coalescer.add(("ns", "tools"), tool_message, {})
+
+        assert [message.content for message, _ in ready] == ["thinking", "result"]
+        assert ready[1][0] is tool_message
+
+    def test_disabled_window_passes_chunks_through(self):
+        coalescer = TokenChunkCoalescer(window_ms=0, max_chars=1000)
+        chunk = AIMessageChunk(content="a", id="m1")
+
+        assert coalescer.add(("ns", "agent"), chunk, {}) == [(chunk, {})]
+        assert not coalescer.has_pending
+
+    def test_tool_call_argument_chunks_are_merged(self):
+        coalescer = TokenChunkCoalescer(window_ms=1000, max_chars=1000, clock=FakeClock())
+
+        coalescer.add(("ns", "agent"), AIMessageChunk(content="", id="m1", tool_call_chunks=[
+            {"name": "write_html_page", "args": '{"full_html', "id": "call_1", "index": 0}
+        ]), {})
+        coalescer.add(("ns", "agent"), AIMessageChunk(content="", id="m1", tool_call_chunks=[
+            {"name": None, "args": '_document": "<html>"}', "id": None, "index": 0}
+        ]), {})
+
+        merged = coalescer.flush()[0][0]
+        assert merged.tool_call_chunks[0]["args"] == '{"full_html_document": "<html>"}'
+
+
+class TestIterateWithFlushDeadline:
+    """Test the deadline-aware stream iterator."""
+
+    @pytest.mark.asyncio
+    async def test_yields_flush_marker_when_stream_stalls(self):
+        coalescer = TokenChunkCoalescer(window_ms=10, max_chars=1000)
+
+        async def stalled_stream():
+            yield "first"
+            await asyncio.sleep(0.1)
+            yield "second"
+
+        items = []
+        async for item in iterate_with_flush_deadline(stalled_stream(), coalescer):
+            items.append(item)
+            if item == "first":
+                coalescer.add(("ns", "agent"), AIMessageChunk(content="x", id="m1"), {})
+            elif item is FLUSH_DUE:
+                coalescer.flush()
+
+        assert items == ["first", FLUSH_DUE, "second"]
+
+
+class TestRequestHandlerCoalescing:
+    """Test that handle_request sends coalesced frames."""
+
+    @pytest.mark.asyncio
+    async def test_token_chunks_are_sent_as_one_frame(self):
+        metadata = {"langgraph_node": "llamabot"}
+        final_message = AIMessage(content="Hello world", id="m1")
+
+        async def fake_astream(*args, **kwargs):
+            for token in ["Hel", "lo", " wor", "ld"]:
+                yield ((), "messages", (AIMessageChunk(content=token, id="m1"), metadata))
+            yield ((), "updates", {"llamabot": {"messages": [final_message]}})
+
+        fake_app = MagicMock()
+        fake_app.astream = fake_astream
+
+        websocket = AsyncMock()
+        websocket.client_state = WebSocketState.CONNECTED
+
+        handler = RequestHandler(MagicMock())
+        with patch.object(handler, "get_langgraph_app_and_state", return_value=(fake_app, {})), \
+             patch("app.websocket.token_chunk_coalescer.DEFAULT_COALESCE_WINDOW_MS", 10_000):
+            await handler.handle_request({"thread_id": "t1"}, websocket)
+
+        frames = [json.loads(call.args[0]) for call in websocket.send_text.call_args_list]
+        assert [frame["content"] for frame in frames] == ["Hello world", "Hello world"]
+        assert frames[0]["type"] == "AIMessageChunk"
+        assert frames[1]["type"] == "ai"
@@ -0,0 +1,99 @@
+"""
+Tests for concurrent, bounded tool execution (tool_execution.py).
+"""
+import asyncio
+import threading
+import time
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.tools import tool
+
+from app.metrics import metrics
+from app.tool_execution import BoundedToolNode, TenantToolSlots
+
+running = {"now": 0, "peak": 0}
+
+
+@pytest.fixture(autouse=True)
+def reset_state():
+    metrics.reset()
+    running.update(now=0, peak=0)
+    yield
+    metrics.reset()
+
+
+@tool
+async def slow_fetch(path: str, seconds: float = 0.2) -> str:
+    """Fetch a path, slowly."""
+    running["now"] += 1
+    running["peak"] = max(running["peak"], running["now"])
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        running["now"] -= 1
+    return f"fetched {path}"
+
+
+@tool
+def blocking_fetch(path: str) -> str:
+    """Fetch a path with a blocking client."""
+    time.sleep(0.2)
+    return f"{path} on {threading.current_thread().name}"
+
+
+@tool
+def failing_tool(path: str) -> str:
+    """Always fails."""
+    raise ValueError("boom")
+
+
+def tool_calls(*calls):
+    return {"messages": [AIMessage(content="", tool_calls=[
+        {"name": name, "args": args, "id": f"call_{index}"} for index, (name, args) in enumerate(calls)])]}
+
+
+class TestBoundedToolNode:
+    """Test concurrency, ordering and bounds."""
+
+    @pytest.mark.asyncio
+    async def test_calls_run_concurrently_and_keep_their_order(self):
+        node = BoundedToolNode([slow_fetch, blocking_fetch])
+        state = tool_calls(("slow_fetch", {"path": "/a", "seconds": 0.3}), ("blocking_fetch", {"path": "/b"}),
+                           ("slow_fetch", {"path": "/c", "seconds": 0.1}))
+
+        started = time.monotonic()
+        result = await node.ainvoke(state)
+        elapsed = time.monotonic() - started
+
+        assert elapsed < 0.5 # the slowest call, not the 0.6s sum
+        messages = result["messages"]
+        assert [message.tool_call_id for message in messages] == ["call_0", "call_1", "call_2"]
+        assert messages[0].content == "fetched /a"
+        assert "llamabot-tool" in messages[1].content # sync tools run on the tool thread pool
+        assert metrics.summary("tools.duration_seconds", tool="slow_fetch")["count"] == 2
+        assert metrics.counter("tools.calls", tool="blocking_fetch", status="success") == 1
+
+    @pytest.mark.asyncio
+    async def test_per_step_bound(self):
+        node = BoundedToolNode([slow_fetch], max_concurrency=2)
+        await node.ainvoke(tool_calls(*[("slow_fetch", {"path": f"/{index}", "seconds": 0.05}) for index in range(5)]))
+        assert running["peak"] == 2
+
+    @pytest.mark.asyncio
+    async def test_per_tenant_bound_spans_steps(self):
+        slots = TenantToolSlots(limit=3)
+        node = BoundedToolNode([slow_fetch], max_concurrency=4, tenant_slots=slots)
+        state = tool_calls(*[("slow_fetch", {"path": f"/{index}", "seconds": 0.05}) for index in range(4)])
+        config = {"configurable": {"tenant": "acme"}}
+
+        await asyncio.gather(node.ainvoke(state, config), node.ainvoke(state, config))
+        assert running["peak"] == 3
+        assert slots.active("acme") == 0 # forgotten once idle
+
+    @pytest.mark.asyncio
+    async def test_errors_are_reported_as_tool_messages(self):
+        node = BoundedToolNode([failing_tool, slow_fetch])
+        result = await node.ainvoke(tool_calls(("failing_tool", {"path": "/x"}), ("slow_fetch", {"path": "/y", "seconds": 0})))
+        assert result["messages"][0].status == "error" and "boom" in result["messages"][0].content
+        assert result["messages"][1].content == "fetched /y"
+        assert metrics.counter("tools.calls", tool="failing_tool", status="error") == 1
@@ -7,11 +7,12 @@ from unittest.mock import patch, MagicMock, AsyncMock
 from fastapi.testclient import TestClient
 from fastapi import WebSocketDisconnect
 from starlette.websockets import WebSocketState
-from app.websockets.exceptions import ConnectionClosed
+from websockets.exceptions import ConnectionClosed
 
 from app.websocket.web_socket_connection_manager import WebSocketConnectionManager
 from app.websocket.web_socket_handler import WebSocketHandler
 from app.websocket.web_socket_request_context import WebSocketRequestContext
+from app.serialization import dumps
 
 
 class TestWebSocketConnectionManager:
@@ -47,8 +48,7 @@ class TestWebSocketConnectionManager:
         
         mock_websocket = AsyncMock()
         # Simulate the websocket being connected first
-        manager.active_connections.append(mock_websocket)
-        manager._connection_ids.add(id(mock_websocket))
+        manager.register(mock_websocket)
         
         manager.disconnect(mock_websocket)
         
@@ -77,20 +77,21 @@ class TestWebSocketConnectionManager:
         
         # Create multiple mock WebSockets
         mock_ws1 = AsyncMock()
-        mock_ws1.send_json = AsyncMock()
+        mock_ws1.send_text = AsyncMock()
         mock_ws1.client_state = WebSocketState.CONNECTED
         mock_ws2 = AsyncMock()
-        mock_ws2.send_json = AsyncMock()
+        mock_ws2.send_text = AsyncMock()
         mock_ws2.client_state = WebSocketState.CONNECTED
         
-        manager.active_connections = [mock_ws1, mock_ws2]
+        manager.register(mock_ws1)
+        manager.register(mock_ws2)
         
         test_message = "Broadcast message to all!"
         await manager.broadcast(test_message)
         
-        # The broadcast method uses send_json with a message wrapper
-        mock_ws1.send_json.assert_called_once_with({"message": test_message})
-        mock_ws2.send_json.assert_called_once_with({"message": test_message})
+        # The broadcast method sends the JSON-encoded message wrapper as text
+        mock_ws1.send_text.assert_called_once_with(dumps({"message": test_message}))
+        mock_ws2.send_text.assert_called_once_with(dumps({"message": test_message}))
     
     @pytest.mark.asyncio
     async def test_broadcast_with_failed_connection(self):
@@ -100,16 +101,15 @@ class TestWebSocketConnectionManager:
         
         # Create mock WebSockets, one that will fail
         mock_ws1 = AsyncMock()
-        mock_ws1.send_json = AsyncMock()
+        mock_ws1.send_text = AsyncMock()
         mock_ws1.client_state = WebSocketState.CONNECTED
         mock_ws2 = AsyncMock()
-        mock_ws2.send_json = AsyncMock(side_effect=ConnectionClosed(None, None))
+        mock_ws2.send_text = AsyncMock(side_effect=ConnectionClosed(None, None))
         mock_ws2.client_state = WebSocketState.CONNECTED
         
         # Properly set up the manager's tracking
-        manager.active_connections = [mock_ws1, mock_ws2]
-        manager._connection_ids.add(id(mock_ws1))
-        manager._connection_ids.add(id(mock_ws2))
+        manager.register(mock_ws1)
+        manager.register(mock_ws2)
         
         test_message = "Broadcast with failure"
         
@@ -118,14 +118,59 @@ class TestWebSocketConnectionManager:
         await manager.broadcast(test_message)
         
         # The first websocket should have been called
-        mock_ws1.send_json.assert_called_once_with({"message": test_message})
+        mock_ws1.send_text.assert_called_once_with(dumps({"message": test_message}))
         # The second websocket should have been called but failed
-        mock_ws2.send_json.assert_called_once_with({"message": test_message})
+        mock_ws2.send_text.assert_called_once_with(dumps({"message": test_message}))
         
         # The failed connection should be removed from active_connections
         assert mock_ws2 not in manager.active_connections
         assert mock_ws1 in manager.active_connections
 
+    @pytest.mark.asyncio
+    async def test_broadcast_filtered_by_tenant_and_thread(self):
+        """Test targeting a broadcast at a tenant or a thread."""
+        manager = WebSocketConnectionManager(MagicMock())
+        sockets = []
+        for tenant, thread_id in [("acme", "t1"), ("acme", "t2"), ("globex", "t1")]:
+            ws = AsyncMock()
+            ws.client_state = WebSocketState.CONNECTED
+            manager.register(ws, tenant=tenant)
+            manager.track_thread(ws, thread_id)
+            sockets.append(ws)
+
+        assert await manager.broadcast("acme only", tenant="acme") == 2
+        assert await manager.broadcast("t1 only", thread_id="t1") == 2
+        assert await manager.broadcast("acme t1", tenant="acme", thread_id="t1") == 1
+
+        assert sockets[0].send_text.call_count == 3
+        assert sockets[1].send_text.call_count == 1
+        assert sockets[2].send_text.call_count == 1
+
+        manager.disconnect(sockets[0])
+        assert manager.connections_for(tenant="acme", thread_id="t1") == []
+
+    @pytest.mark.asyncio
+    async def test_broadcast_does_not_wait_for_stalled_client(self):
+        """Test that one stalled socket doesn't hold up the broadcast."""
+        import asyncio
+        manager = WebSocketConnectionManager(MagicMock())
+        stalled = AsyncMock()
+        stalled.client_state = WebSocketState.CONNECTED
+
+        async def hang(text):
+            await asyncio.sleep(10)
+        stalled.send_text.side_effect = hang
+        healthy = AsyncMock()
+        healthy.client_state = WebSocketState.CONNECTED
+        manager.register(stalled)
+        manager.register(healthy)
+
+        with patch("app.websocket.web_socket_connection_manager.BROADCAST_SEND_TIMEOUT_SECONDS", 0.05):
+            delivered = await asyncio.wait_for(manager.broadcast("hello"), 1)
+
+        assert delivered == 1
+        healthy.send_text.assert_called_once_with(dumps({"message": "hello"}))
+
 
 class TestWebSocketHandler:
     """Test the WebSocket handler."""
@@ -148,6 +193,7 @@ class TestWebSocketHandler:
         mock_manager = AsyncMock()
         mock_manager.connect = AsyncMock()
         mock_manager.disconnect = MagicMock()
+        mock_manager.attach_handler = MagicMock()
         mock_manager.send_personal_message = AsyncMock()
         
         # Create a mock that raises WebSocketDisconnect on the first call
@@ -0,0 +1,180 @@
+"""
+Cross-worker serialization of runs on the same thread.
+
+Within one process the admission scheduler (admission_scheduler.py) already runs a thread's messages one at a
+time. With several workers (`uvicorn --workers N`, several machines) two messages for the same thread can land on
+different processes and fork the checkpoint history. The Postgres backend closes that gap with a session-level
+advisory lock per thread on the existing DB_URI database, held by the one run per process that the scheduler
+lets through, for as long as that run lasts.
+
+LLAMABOT_THREAD_LOCK_BACKEND:
+- "local":    in-process only (the scheduler), no extra cost. Right for a single worker.
+- "postgres": advisory locks on DB_URI. Use it whenever more than one process serves the same threads.
+- "auto":     (default) "postgres" if DB_URI is set and WEB_CONCURRENCY > 1, "local" otherwise.
+              Deployments spread over several machines should say "postgres" explicitly.
+
+The lock is taken with pg_try_advisory_lock, retried every LLAMABOT_THREAD_LOCK_POLL_MS, so waiting is cancellable
+and never ties up the database. If the connection dies, Postgres releases the lock on its own.
+
+Every running run holds one pooled connection, so the pool is sized from the admission cap
+(LLAMABOT_MAX_CONCURRENT_RUNS) unless LLAMABOT_THREAD_LOCK_POOL_SIZE says otherwise. A run that finds every
+connection checked out by other runs waits for one, up to LLAMABOT_THREAD_LOCK_POOL_WAIT_SECONDS, then fails with
+ThreadLockUnavailable: it never goes ahead unlocked. A pool timeout while connections are free to be had means the
+database can't be reached: that run falls back to per-process ordering after one pool timeout. A connection whose
+unlock didn't go through (error, cancellation) is closed rather than returned to the pool, so the session and its
+lock end with it.
+"""
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Optional
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+THREAD_LOCK_BACKEND = os.getenv("LLAMABOT_THREAD_LOCK_BACKEND", "auto")
+THREAD_LOCK_POOL_SIZE = int(os.getenv("LLAMABOT_THREAD_LOCK_POOL_SIZE", "0")) # 0: one connection per run the scheduler admits
+THREAD_LOCK_POLL_MS = int(os.getenv("LLAMABOT_THREAD_LOCK_POLL_MS", "100"))
+THREAD_LOCK_POOL_WAIT_SECONDS = float(os.getenv("LLAMABOT_THREAD_LOCK_POOL_WAIT_SECONDS", "60"))
+
+
+def advisory_lock_key(thread_id: str) -> int:
+    """Stable signed 64-bit key for a thread_id (pg advisory locks take a bigint)."""
+    digest = hashlib.blake2b(f"llamabot-thread:{thread_id}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class ThreadLockUnavailable(RuntimeError):
+    """Every lock connection stayed checked out by other runs for too long; the run doesn't go ahead unlocked."""
+
+
+class LocalThreadLock:
+    """Nothing to do: in-process ordering is the admission scheduler's job."""
+
+    name = "local"
+
+    @asynccontextmanager
+    async def hold(self, thread_id: str):
+        yield
+
+    async def close(self):
+        pass
+
+
+class PostgresAdvisoryThreadLock:
+    """Holds pg_advisory_lock(key(thread_id)) on a pooled connection for the duration of a run."""
+
+    name = "postgres"
+
+    def __init__(self, db_uri: str, pool_size: Optional[int] = None, poll_seconds: float = THREAD_LOCK_POLL_MS / 1000, pool=None,
+                 pool_timeout: float = 5.0, max_pool_wait_seconds: float = THREAD_LOCK_POOL_WAIT_SECONDS):
+        self.db_uri = db_uri
+        self.pool_size = THREAD_LOCK_POOL_SIZE or pool_size or 10
+        self.poll_seconds = poll_seconds
+        self.pool = pool
+        self.pool_timeout = pool_timeout
+        self.max_pool_wait_seconds = max_pool_wait_seconds
+        # Connections checked out by runs of this process. The pool's own stats count connections still being
+        # attempted as part of its size, so they can't tell "all in use" from "none could be opened".
+        self.checked_out = 0
+        self._opened = pool is not None
+        self._open_lock = asyncio.Lock()
+
+    async def _get_pool(self):
+        if not self._opened:
+            async with self._open_lock:
+                if not self._opened:
+                    from psycopg_pool import AsyncConnectionPool
+                    self.pool = AsyncConnectionPool(self.db_uri, min_size=1, max_size=self.pool_size, timeout=self.pool_timeout,
+                                                    kwargs={"autocommit": True}, open=False)
+                    await self.pool.open()
+                    self._opened = True
+                    logger.info("🔒 Using Postgres advisory locks to serialize threads across workers")
+        return self.pool
+
+    @asynccontextmanager
+    async def hold(self, thread_id: str):
+        key = advisory_lock_key(thread_id)
+        async with AsyncExitStack() as stack:
+            from psycopg_pool import PoolTimeout
+            waiting_since = time.monotonic()
+            while True:
+                exhausted = self.checked_out >= self.pool_size # a run may hand its connection back while we wait
+                try:
+                    pool = await self._get_pool()
+                    connection = await stack.enter_async_context(pool.connection())
+                    break
+                except PoolTimeout as e:
+                    if not exhausted and self.checked_out < self.pool_size:
+                        # Free slots, yet no connection: the database is down or unreachable.
+                        self._fall_back(thread_id, e)
+                        connection = None
+                        break
+                    # Every connection holds a running thread's lock: wait for one, never run unlocked.
+                    metrics.increment("thread_lock.pool_exhausted")
+                    if time.monotonic() - waiting_since >= self.max_pool_wait_seconds:
+                        raise ThreadLockUnavailable(f"No thread lock connection for thread {thread_id} after "
+                                                    f"{self.max_pool_wait_seconds}s, all {self.pool_size} in use") from e
+                    logger.warning(f"⏳ Thread lock pool exhausted, thread {thread_id} waits for a connection")
+                except Exception as e:
+                    self._fall_back(thread_id, e)
+                    connection = None
+                    break
+            if connection is None:
+                yield
+                return
+            self.checked_out += 1
+            stack.callback(self._check_in)
+
+            started_at = time.monotonic()
+            while True:
+                cursor = await connection.execute("SELECT pg_try_advisory_lock(%s)", (key,))
+                row = await cursor.fetchone()
+                if row and row[0]:
+                    break
+                await asyncio.sleep(self.poll_seconds) # another worker runs this thread right now
+            metrics.observe("thread_lock.wait_seconds", time.monotonic() - started_at)
+            try:
+                yield
+            finally:
+                released = False
+                try:
+                    await connection.execute("SELECT pg_advisory_unlock(%s)", (key,))
+                    released = True
+                except Exception as e:
+                    logger.warning(f"Failed to release advisory lock for thread {thread_id}: {e}")
+                finally:
+                    if not released:
+                        # Failed or cancelled halfway: the session may still hold the lock, so it must not go back
+                        # to the pool. A closed connection is discarded by the pool, and the lock ends with the session.
+                        await connection.close()
+
+    def _check_in(self):
+        self.checked_out -= 1
+
+    def _fall_back(self, thread_id: str, error: Exception):
+        # Same spirit as the checkpointer's MemorySaver fallback: keep serving, ordered per process only.
+        logger.warning(f"❌ Postgres unavailable for thread locks ({error}), thread {thread_id} is only serialized per process")
+        metrics.increment("thread_lock.unavailable")
+
+    async def close(self):
+        if self._opened and self.pool is not None:
+            await self.pool.close()
+            self._opened = False
+
+
+def create_thread_lock(backend: Optional[str] = None, db_uri: Optional[str] = None, pool_size: Optional[int] = None):
+    backend = (backend or THREAD_LOCK_BACKEND).lower()
+    db_uri = db_uri if db_uri is not None else os.getenv("DB_URI", "").strip()
+    if backend == "auto":
+        workers = int(os.getenv("WEB_CONCURRENCY", "1") or 1)
+        backend = "postgres" if db_uri and workers > 1 else "local"
+    if backend == "postgres":
+        if db_uri:
+            return PostgresAdvisoryThreadLock(db_uri, pool_size=pool_size)
+        logger.warning("❌ LLAMABOT_THREAD_LOCK_BACKEND=postgres but no DB_URI is set, threads are only serialized per process")
+    return LocalThreadLock()
@@ -0,0 +1,130 @@
+"""
+Tool execution for the agents' graphs: BoundedToolNode, a drop-in ToolNode.
+
+When the model asks for several tool calls in one message (e.g. a few rails_https_request GETs), they run
+concurrently, so the step takes as long as its slowest call instead of their sum. Concurrency is bounded:
+- per step: at most LLAMABOT_TOOL_CONCURRENCY_PER_STEP calls of one message at a time
+- per tenant: at most LLAMABOT_TOOL_CONCURRENCY_PER_TENANT calls at a time across all runs of a tenant
+  (the tenant comes from the run's config, see RequestHandler; runs without one only get the per-step bound)
+
+Sync tools run on a dedicated thread pool (LLAMABOT_TOOL_THREAD_POOL_SIZE threads) instead of blocking the
+event loop, or sharing the default executor with everything else. Results keep the order of the tool calls.
+
+Every call reports tools.duration_seconds and tools.wait_seconds (time spent waiting for a slot), labelled
+with the tool name, and tools.calls with its status.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+import asyncio
+import logging
+import os
+import time
+
+from langchain_core.messages import ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import run_in_executor
+from langchain_core.tools import BaseTool
+from langgraph.prebuilt import ToolNode
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+TOOL_CONCURRENCY_PER_STEP = int(os.getenv("LLAMABOT_TOOL_CONCURRENCY_PER_STEP", "4"))
+TOOL_CONCURRENCY_PER_TENANT = int(os.getenv("LLAMABOT_TOOL_CONCURRENCY_PER_TENANT", "8"))
+TOOL_THREAD_POOL_SIZE = int(os.getenv("LLAMABOT_TOOL_THREAD_POOL_SIZE", "8"))
+
+_tool_thread_pool: Optional[ThreadPoolExecutor] = None
+
+
+def get_tool_thread_pool() -> ThreadPoolExecutor:
+    global _tool_thread_pool
+    if _tool_thread_pool is None:
+        _tool_thread_pool = ThreadPoolExecutor(max_workers=TOOL_THREAD_POOL_SIZE, thread_name_prefix="llamabot-tool")
+    return _tool_thread_pool
+
+
+class TenantToolSlots:
+    """Per-tenant semaphores, created on first use and forgotten once the tenant has no tool call running."""
+
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = TOOL_CONCURRENCY_PER_TENANT if limit is None else limit
+        self._slots: Dict[str, Tuple[asyncio.Semaphore, int]] = {}
+
+    def _enter(self, tenant: str) -> asyncio.Semaphore:
+        semaphore, users = self._slots.get(tenant, (None, 0))
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.limit)
+        self._slots[tenant] = (semaphore, users + 1)
+        return semaphore
+
+    def _exit(self, tenant: str):
+        semaphore, users = self._slots[tenant]
+        if users <= 1:
+            del self._slots[tenant]
+        else:
+            self._slots[tenant] = (semaphore, users - 1)
+
+    def active(self, tenant: str) -> int:
+        return self._slots.get(tenant, (None, 0))[1]
+
+
+tenant_tool_slots = TenantToolSlots()
+
+
+def _is_sync_tool(tool: BaseTool) -> bool:
+    if hasattr(tool, "coroutine"): # StructuredTool / Tool, from @tool
+        return tool.coroutine is None
+    return type(tool)._arun is BaseTool._arun
+
+
+class BoundedToolNode(ToolNode):
+    """ToolNode running the calls of a step concurrently, within the per-step and per-tenant bounds."""
+
+    def __init__(self, tools, *args, max_concurrency: Optional[int] = None, tenant_slots: Optional[TenantToolSlots] = None, **kwargs):
+        super().__init__(tools, *args, **kwargs)
+        self.max_concurrency = max(1, TOOL_CONCURRENCY_PER_STEP if max_concurrency is None else max_concurrency)
+        self.tenant_slots = tenant_slots or tenant_tool_slots
+
+    async def _afunc(self, input: Any, config: RunnableConfig, *, store=None) -> Any:
+        tool_calls, input_type = self._parse_input(input)
+        tool_calls = [self.inject_tool_args(call, input, store) for call in tool_calls]
+        tenant = (config.get("configurable") or {}).get("tenant")
+        step_slots = asyncio.Semaphore(self.max_concurrency)
+
+        started = time.monotonic()
+        # gather keeps the results in the order of the calls, whichever finishes first
+        outputs = await asyncio.gather(*(self._arun_bounded(call, input_type, config, step_slots, tenant) for call in tool_calls))
+        if len(tool_calls) > 1:
+            logger.info(f"🔧 {len(tool_calls)} tool calls in {time.monotonic() - started:.2f}s")
+        return self._combine_tool_outputs(outputs, input_type)
+
+    async def _arun_bounded(self, call, input_type, config: RunnableConfig, step_slots: asyncio.Semaphore, tenant: Optional[str]):
+        queued = time.monotonic()
+        tenant_semaphore = self.tenant_slots._enter(tenant) if tenant else None
+        try:
+            async with step_slots:
+                if tenant_semaphore is not None:
+                    async with tenant_semaphore:
+                        return await self._arun_timed(call, input_type, config, queued)
+                return await self._arun_timed(call, input_type, config, queued)
+        finally:
+            if tenant_semaphore is not None:
+                self.tenant_slots._exit(tenant)
+
+    async def _arun_timed(self, call, input_type, config: RunnableConfig, queued: float):
+        name = call.get("name") or ""
+        started = time.monotonic()
+        metrics.observe("tools.wait_seconds", started - queued, tool=name)
+        status = "error"
+        try:
+            tool = self.tools_by_name.get(name)
+            if tool is not None and _is_sync_tool(tool):
+                output = await run_in_executor(get_tool_thread_pool(), self._run_one, call, input_type, config)
+            else:
+                output = await self._arun_one(call, input_type, config)
+            status = "error" if isinstance(output, ToolMessage) and output.status == "error" else "success"
+            return output
+        finally:
+            metrics.observe("tools.duration_seconds", time.monotonic() - started, tool=name)
+            metrics.increment("tools.calls", tool=name, status=status)
@@ -0,0 +1,133 @@
+from typing import Iterable, Optional, Union
+
+import os
+import logging
+import zlib
+
+from app.serialization import MSGPACK_AVAILABLE, dumps, loads, packb, unpackb
+
+logger = logging.getLogger(__name__)
+
+# Binary frames at least this big are zlib-compressed. Token deltas are tiny and not worth the CPU,
+# while write_html_page tool calls carry whole HTML documents that shrink 10x or more.
+COMPRESS_MIN_BYTES = int(os.getenv("LLAMABOT_WS_COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.getenv("LLAMABOT_WS_COMPRESS_LEVEL", "6"))
+
+JSON_FRAME_ENCODING = "json"
+MSGPACK_FRAME_ENCODING = "msgpack"
+
+# First byte of every binary frame.
+RAW_FRAME_HEADER = b"\x00"
+ZLIB_FRAME_HEADER = b"\x01"
+ZLIB_RESET_FRAME_HEADER = b"\x02" # first piece of a new zlib stream: the client starts a new decompressor
+
+
+def supported_frame_encodings() -> list:
+    encodings = [JSON_FRAME_ENCODING]
+    if MSGPACK_AVAILABLE:
+        encodings.append(MSGPACK_FRAME_ENCODING)
+    return encodings
+
+
+def negotiate_frame_encoding(requested: Union[str, Iterable, None]) -> str:
+    """
+    Pick the frame encoding for a connection from what the client offered (in order of preference).
+    Falls back to JSON text frames.
+    """
+    if requested is None:
+        return JSON_FRAME_ENCODING
+    offered = [requested] if isinstance(requested, str) else list(requested)
+    supported = supported_frame_encodings()
+    for encoding in offered:
+        if encoding in supported:
+            return encoding
+    logger.warning(f"None of the frame encodings offered by the client are supported: {offered!r}")
+    return JSON_FRAME_ENCODING
+
+
+class JsonFrameCodec:
+    """JSON text frames (the default). Compression is left to permessage-deflate, if the client negotiated it."""
+
+    encoding = JSON_FRAME_ENCODING
+
+    def encode(self, frame: dict) -> str:
+        return dumps(frame)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        return loads(data)
+
+    async def send(self, websocket, frame: dict) -> int:
+        """Send a frame, returning its size on the wire (before permessage-deflate)."""
+        payload = self.encode(frame)
+        await websocket.send_text(payload)
+        return len(payload)
+
+
+class MsgpackFrameCodec:
+    """
+    Binary MessagePack frames. Each frame starts with a one-byte header: 0x00 for a plain MessagePack payload,
+    0x01 for a zlib-compressed one. Frames smaller than `min_bytes` are sent uncompressed (-1 disables compression).
+
+    Compressed frames are consecutive pieces of one zlib stream per connection (sync-flushed after every frame),
+    like permessage-deflate with context takeover: the final message frame repeats the HTML that was just
+    streamed as tool-call deltas, and compresses to almost nothing. So one codec instance belongs to one
+    connection, and the client keeps a single zlib decompressor for all 0x01 frames, in order.
+
+    A compressed frame that fails to go out has already advanced the stream, so the client would be out of sync for
+    good: the codec starts a new stream instead, and its first frame has the header 0x02, telling the client to
+    replace its decompressor with a fresh one before decoding it.
+    """
+
+    encoding = MSGPACK_FRAME_ENCODING
+
+    def __init__(self, min_bytes: Optional[int] = None, level: Optional[int] = None):
+        self.min_bytes = min_bytes if min_bytes is not None else COMPRESS_MIN_BYTES
+        self.level = level if level is not None else COMPRESS_LEVEL
+        self._compressor = None
+        self._decompressor = None
+        self._stream_reset = False # the next compressed frame starts a new stream the client doesn't know about yet
+
+    def encode(self, frame: dict) -> bytes:
+        payload = packb(frame)
+        if self.min_bytes >= 0 and len(payload) >= self.min_bytes:
+            header = ZLIB_FRAME_HEADER
+            if self._compressor is None:
+                self._compressor = zlib.compressobj(self.level)
+                header = ZLIB_RESET_FRAME_HEADER if self._stream_reset else ZLIB_FRAME_HEADER
+                self._stream_reset = False
+            compressed = self._compressor.compress(payload) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            return header + compressed
+        return RAW_FRAME_HEADER + payload
+
+    def reset_stream(self):
+        """Drop the compression context; the next compressed frame tells the client to start over too."""
+        self._compressor = None
+        self._stream_reset = True
+
+    def decode(self, data: bytes) -> dict:
+        """Decode a frame from the peer's codec (the reverse of encode, for clients and tests)."""
+        header, payload = data[:1], data[1:]
+        if header in (ZLIB_FRAME_HEADER, ZLIB_RESET_FRAME_HEADER):
+            if self._decompressor is None or header == ZLIB_RESET_FRAME_HEADER:
+                self._decompressor = zlib.decompressobj()
+            payload = self._decompressor.decompress(payload)
+        elif header != RAW_FRAME_HEADER:
+            raise ValueError(f"Unknown binary frame header: {header!r}")
+        return unpackb(payload)
+
+    async def send(self, websocket, frame: dict) -> int:
+        """Send a frame, returning its size on the wire."""
+        payload = self.encode(frame)
+        try:
+            await websocket.send_bytes(payload)
+        except BaseException: # send errors, and cancellation by the writer's send timeout
+            if payload[:1] != RAW_FRAME_HEADER:
+                self.reset_stream()
+            raise
+        return len(payload)
+
+
+def get_frame_codec(encoding: str):
+    if encoding == MSGPACK_FRAME_ENCODING:
+        return MsgpackFrameCodec()
+    return JsonFrameCodec()
@@ -0,0 +1,224 @@
+import os
+import re
+import time
+from html.parser import HTMLParser
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessageChunk, BaseMessage
+
+from app.agents.utils.html_compaction import restore_html
+
+# How often, at most, a growing page is pushed to the client while write_html_page's arguments stream in.
+DEFAULT_HTML_PREVIEW_INTERVAL_SECONDS = float(os.getenv("LLAMABOT_HTML_PREVIEW_INTERVAL_SECONDS", "0.25"))
+
+# Tool calls whose (string) argument is a whole page worth previewing while it's generated.
+PREVIEW_TOOL_ARGUMENTS = {"write_html_page": "full_html_document"}
+
+# Elements that never get a closing tag.
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+
+# The start of an asset placeholder (see html_compaction.py) at the very end of the text: held back until complete.
+_PARTIAL_PLACEHOLDER = re.compile(r"_(?:_(?:A(?:S(?:S(?:E(?:T(?:_[0-9a-f]{0,12}_?)?)?)?)?)?)?)?$")
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonStringFieldExtractor:
+    """
+    Pulls the value of one top-level string field out of a JSON object that arrives in pieces (tool-call argument
+    deltas), decoding it as it goes: feed() returns the text of the value that the new piece completed.
+    Escapes split across pieces (even a \\uXXXX one) are held back until they're complete.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.depth = 0
+        self.in_string = False
+        self.escape = "" # pending escape sequence, backslash included
+        self.string = [] # the string being read, when it's not the field's value
+        self.last_key: Optional[str] = None
+        self.expect_value = False # after the field's key and its colon
+        self.in_value = False
+        self.done = False
+
+    def feed(self, piece: str) -> str:
+        out = []
+        for char in piece:
+            if self.done:
+                break
+            if self.in_string:
+                if self.escape:
+                    self.escape += char
+                    decoded = self._decode_escape()
+                    if decoded is None:
+                        continue
+                    self.escape = ""
+                    (out if self.in_value else self.string).append(decoded)
+                elif char == "\\":
+                    self.escape = "\\"
+                elif char == '"':
+                    self.in_string = False
+                    if self.in_value:
+                        self.in_value = False
+                        self.done = True
+                    else:
+                        self.last_key = "".join(self.string) if self.depth == 1 else None
+                else:
+                    (out if self.in_value else self.string).append(char)
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string = []
+                if self.expect_value:
+                    self.in_value = True
+                    self.expect_value = False
+            elif char == ":":
+                self.expect_value = self.depth == 1 and self.last_key == self.field
+            elif char in "{[":
+                self.depth += 1
+                self.expect_value = False
+            elif char in "}]":
+                self.depth -= 1
+            elif not char.isspace():
+                self.expect_value = False # the field's value isn't a string
+                self.last_key = None
+        return "".join(out)
+
+    def _decode_escape(self) -> Optional[str]:
+        kind = self.escape[1]
+        if kind != "u":
+            return _ESCAPES.get(kind, kind)
+        if len(self.escape) < 6:
+            return None
+        # A surrogate pair is two \uXXXX escapes in a row.
+        code = int(self.escape[2:6], 16)
+        if 0xD800 <= code < 0xDC00:
+            if len(self.escape) < 12:
+                return None
+            low = int(self.escape[8:12], 16)
+            return chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00))
+        return chr(code)
+
+
+class _TagStack(HTMLParser):
+    """Tracks which elements are open in the HTML fed so far."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.open_tags: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in VOID_ELEMENTS:
+            self.open_tags.append(tag)
+
+    @property
+    def closing(self) -> str:
+        return "".join(f"</{tag}>" for tag in reversed(self.open_tags))
+
+    def handle_endtag(self, tag):
+        if tag in self.open_tags:
+            index = len(self.open_tags) - 1 - self.open_tags[::-1].index(tag)
+            del self.open_tags[index:] # implicitly closes whatever was left open inside it
+
+
+class _PagePreview:
+    """The growing page of one tool call."""
+
+    def __init__(self, field: str, node: Optional[str]):
+        self.node = node
+        self.extractor = JsonStringFieldExtractor(field)
+        self.tags = _TagStack()
+        self.pending = "" # decoded but not sent yet
+        self.sent = 0 # characters of the page already sent
+        self.last_sent_at = float("-inf")
+        self.finished = False
+
+    def feed(self, args_delta: str):
+        text = self.extractor.feed(args_delta)
+        if text:
+            self.pending += text
+            self.tags.feed(text)
+
+    def sendable(self) -> str:
+        # The parser holds back whatever it can't make sense of yet (a half-written tag, an unfinished <script>),
+        # so everything before that is complete enough to render.
+        held_back = len(self.tags.rawdata)
+        html = self.pending[:len(self.pending) - held_back] if held_back else self.pending
+        partial = _PARTIAL_PLACEHOLDER.search(html)
+        return html[:partial.start()] if partial else html
+
+
+class HtmlPreviewStreamer:
+    """
+    Turns the streamed argument deltas of write_html_page calls into progressive `html_preview` frames, so the
+    client can render the page while the model is still writing it.
+
+    Every frame carries the newly written part of the page (`html`, starting at character `offset` of the page),
+    cut where the HTML seen so far is complete, plus the `closing` tags that make it well-formed: the client renders
+    page_so_far + closing. Frames go out at most once per `interval_seconds` per tool call; the rest of the page is
+    sent (with `done`: true) as soon as the argument is complete, or when the node finishes.
+
+    The model writes from the compacted page, so `placeholders` (see html_compaction.page_placeholders) are put back
+    into the frames' html, which the client gets with its assets (and `offset` counts characters of that page).
+    """
+
+    def __init__(self, interval_seconds: Optional[float] = None, clock: Callable[[], float] = time.monotonic,
+                 placeholders: Optional[Dict[str, str]] = None):
+        self.interval_seconds = DEFAULT_HTML_PREVIEW_INTERVAL_SECONDS if interval_seconds is None else interval_seconds
+        self.placeholders = placeholders or {}
+        self._clock = clock
+        self._tool_names: Dict[Tuple[Optional[str], int], str] = {}
+        self._previews: Dict[Tuple[Optional[str], int], _PagePreview] = {}
+
+    def add(self, message: BaseMessage, node: Optional[str]) -> List[dict]:
+        """Feed one streamed chunk. Returns the preview frames due now."""
+        if not isinstance(message, AIMessageChunk):
+            return []
+        frames = []
+        for tool_call_chunk in message.tool_call_chunks or []:
+            key = (message.id, tool_call_chunk.get("index") or 0)
+            if tool_call_chunk.get("name"):
+                self._tool_names[key] = tool_call_chunk["name"]
+            field = PREVIEW_TOOL_ARGUMENTS.get(self._tool_names.get(key))
+            if field is None or not tool_call_chunk.get("args"):
+                continue
+            preview = self._previews.get(key)
+            if preview is None:
+                preview = self._previews[key] = _PagePreview(field, node)
+            if preview.finished:
+                continue
+            preview.feed(tool_call_chunk["args"])
+
+            now = self._clock()
+            if preview.extractor.done:
+                frames.append(self._frame(key, preview, done=True))
+            elif now - preview.last_sent_at >= self.interval_seconds:
+                frame = self._frame(key, preview)
+                if frame is not None:
+                    preview.last_sent_at = now
+                    frames.append(frame)
+        return frames
+
+    def flush(self) -> List[dict]:
+        """The rest of every page still streaming (call when the node's update arrives), and forget them."""
+        frames = [self._frame(key, preview, done=True) for key, preview in self._previews.items() if not preview.finished]
+        self._previews.clear()
+        self._tool_names.clear()
+        return frames
+
+    def _frame(self, key: tuple, preview: _PagePreview, done: bool = False) -> Optional[dict]:
+        if done:
+            preview.tags.close() # whatever it was still holding back is as complete as it gets
+            preview.finished = True
+            html = preview.pending
+        else:
+            html = preview.sendable()
+            if not html:
+                return None
+        preview.pending = preview.pending[len(html):]
+        html = restore_html(html, self.placeholders)
+        frame = {"type": "html_preview", "id": key[0], "node": preview.node, "tool_call_index": key[1],
+                 "offset": preview.sent, "html": html, "closing": preview.tags.closing, "done": done}
+        preview.sent += len(html)
+        return frame
@@ -0,0 +1,195 @@
+from collections import deque
+from typing import Optional
+from starlette.websockets import WebSocket, WebSocketState
+import asyncio
+
+import os
+import logging
+import time
+
+from app.metrics import metrics
+from app.websocket.frame_codec import JsonFrameCodec
+from app.websocket.stream_protocol import is_token_frame, merge_token_frames
+
+logger = logging.getLogger(__name__)
+
+# How many frames may wait for a slow client before the overflow policy kicks in.
+DEFAULT_OUTBOUND_QUEUE_SIZE = int(os.getenv("LLAMABOT_WS_OUTBOUND_QUEUE_SIZE", "256"))
+# "merge" folds pending token frames of the same message together first, "drop" goes straight to dropping them.
+DEFAULT_OVERFLOW_POLICY = os.getenv("LLAMABOT_WS_OVERFLOW_POLICY", "merge")
+# A single send taking longer than this means the client is gone or hopeless, so we close the socket.
+DEFAULT_SEND_TIMEOUT_SECONDS = float(os.getenv("LLAMABOT_WS_SEND_TIMEOUT", "10"))
+
+OVERFLOW_POLICIES = ("merge", "drop")
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection send queue, drained by its own writer task.
+
+    The agent run only ever calls put(), which never blocks, so a slow client can't slow down (or hold open)
+    the LLM stream. When the queue is full, token frames are merged or dropped; other frames are never dropped,
+    because every dropped token is also part of the consolidated message frame that follows it.
+    Dropped tokens are reported to the client with a single `stream_summary` frame.
+    """
+
+    def __init__(self, websocket: WebSocket, max_size: Optional[int] = None, overflow_policy: Optional[str] = None,
+                 send_timeout: Optional[float] = None, codec=None):
+        self.websocket = websocket
+        self.codec = codec or JsonFrameCodec() # swapped when the client negotiates another frame encoding
+        self.max_size = max(1, max_size if max_size is not None else DEFAULT_OUTBOUND_QUEUE_SIZE)
+        self.overflow_policy = overflow_policy or DEFAULT_OVERFLOW_POLICY
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            logger.warning(f"Unknown websocket overflow policy {self.overflow_policy!r}, using 'merge'")
+            self.overflow_policy = "merge"
+        self.send_timeout = send_timeout if send_timeout is not None else DEFAULT_SEND_TIMEOUT_SECONDS
+
+        self._frames: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._summary_frame: Optional[dict] = None # pending stream_summary frame, updated in place while queued
+        self._writer_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def start(self):
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._writer())
+
+    def put(self, frame: dict):
+        """Queue a frame for sending. Never blocks."""
+        if self._closed:
+            return
+        if len(self._frames) >= self.max_size:
+            self._handle_overflow(frame)
+        else:
+            self._frames.append(frame)
+        metrics.observe("websocket.outbound_queue_depth", len(self._frames))
+        self._idle.clear()
+        self._wakeup.set()
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything queued so far has been sent. Returns False on timeout."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close(self, drain_timeout: float = 0):
+        """Stop the writer, optionally giving it `drain_timeout` seconds to flush what's queued first."""
+        if drain_timeout and not self._closed:
+            await self.drain(drain_timeout)
+        self._closed = True
+        self._frames.clear()
+        self._wakeup.set()
+        if self._writer_task and not self._writer_task.done():
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+
+    def _handle_overflow(self, frame: dict):
+        if self.overflow_policy == "merge" and is_token_frame(frame):
+            # Cheapest case first: the new frame continues the last queued one.
+            if self._frames:
+                merged = merge_token_frames(self._frames[-1], frame)
+                if merged is not None:
+                    self._frames[-1] = merged
+                    metrics.increment("websocket.frames_merged")
+                    return
+            self._compact()
+            if len(self._frames) < self.max_size:
+                self._frames.append(frame)
+                return
+
+        self._drop_token_frames()
+        if is_token_frame(frame):
+            self._record_dropped(1)
+        else:
+            # Never drop a non-token frame, even if that means going over the bound.
+            self._frames.append(frame)
+
+    def _compact(self):
+        """Merge adjacent token frames for the same message throughout the queue."""
+        compacted = deque()
+        merged_count = 0
+        for frame in self._frames:
+            if compacted:
+                merged = merge_token_frames(compacted[-1], frame)
+                if merged is not None:
+                    compacted[-1] = merged
+                    merged_count += 1
+                    continue
+            compacted.append(frame)
+        self._frames = compacted
+        if merged_count:
+            metrics.increment("websocket.frames_merged", merged_count)
+
+    def _drop_token_frames(self):
+        kept = deque(frame for frame in self._frames if not is_token_frame(frame))
+        dropped = len(self._frames) - len(kept)
+        self._frames = kept
+        if dropped:
+            self._record_dropped(dropped)
+
+    def _record_dropped(self, count: int):
+        metrics.increment("websocket.frames_dropped", count)
+        if self._summary_frame is None:
+            self._summary_frame = {"type": "stream_summary", "dropped_frames": 0}
+            self._frames.append(self._summary_frame)
+        self._summary_frame["dropped_frames"] += count
+        logger.warning(f"🐌 Slow websocket client, dropped {count} token frame(s)")
+
+    async def _writer(self):
+        while True:
+            while not self._frames:
+                self._idle.set()
+                if self._closed:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            frame = self._frames.popleft()
+            if frame is self._summary_frame:
+                self._summary_frame = None
+
+            if self.websocket.client_state != WebSocketState.CONNECTED:
+                logger.info("WebSocket closed, discarding outbound frames")
+                self._closed = True
+                self._frames.clear()
+                self._idle.set()
+                return
+
+            started_at = time.monotonic()
+            try:
+                sent_bytes = await asyncio.wait_for(self.codec.send(self.websocket, frame), self.send_timeout)
+            except asyncio.TimeoutError:
+                metrics.increment("websocket.send_timeouts")
+                logger.warning(f"WebSocket send took longer than {self.send_timeout}s, closing slow connection")
+                self._closed = True
+                self._frames.clear()
+                self._idle.set()
+                try:
+                    await self.websocket.close(code=1013) # "try again later"
+                except Exception as e:
+                    logger.info(f"Failed to close slow WebSocket: {e}")
+                return
+            except Exception as e:
+                logger.warning(f"Failed to send message to WebSocket: {e}")
+                if self.websocket.client_state != WebSocketState.CONNECTED:
+                    self._closed = True
+                    self._frames.clear()
+                    self._idle.set()
+                    return
+                continue # the frame is lost; a compressing codec has started a new stream (see frame_codec.py)
+            metrics.observe("websocket.send_latency_seconds", time.monotonic() - started_at)
+            metrics.increment("websocket.bytes_sent", sent_bytes, encoding=self.codec.encoding)
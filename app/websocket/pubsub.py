@@ -0,0 +1,196 @@
+"""
+Fan-out of websocket broadcasts between worker processes.
+
+WebSocketConnectionManager.broadcast() delivers to its own sockets directly and publishes an envelope here;
+every other worker receives it and delivers it to its sockets (see WebSocketConnectionManager.deliver).
+
+LLAMABOT_WS_PUBSUB_BACKEND:
+- "memory":   single process (or several managers in one process sharing an InMemoryHub, e.g. in tests).
+- "postgres": LISTEN/NOTIFY on the DB_URI database. Envelopes published within LLAMABOT_WS_PUBSUB_BATCH_MS are
+              sent as one NOTIFY whose payload is a JSON list, kept under LLAMABOT_WS_PUBSUB_MAX_PAYLOAD bytes
+              (Postgres refuses payloads of 8000 bytes or more). A single envelope over the limit is not sent
+              to other workers; push large content by reference (e.g. a URL or an id) instead.
+- "auto":     (default) "postgres" if DB_URI is set and WEB_CONCURRENCY > 1, "memory" otherwise.
+
+The time from publish to delivery on the receiving worker is reported as websocket.pubsub_latency_seconds.
+"""
+from typing import Awaitable, Callable, List, Optional
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+from app.metrics import metrics
+from app.serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+PUBSUB_BACKEND = os.getenv("LLAMABOT_WS_PUBSUB_BACKEND", "auto")
+PUBSUB_CHANNEL = os.getenv("LLAMABOT_WS_PUBSUB_CHANNEL", "llamabot_ws")
+PUBSUB_BATCH_MS = int(os.getenv("LLAMABOT_WS_PUBSUB_BATCH_MS", "10"))
+PUBSUB_MAX_PAYLOAD_BYTES = int(os.getenv("LLAMABOT_WS_PUBSUB_MAX_PAYLOAD", "7900"))
+
+EnvelopeHandler = Callable[[dict], Awaitable[None]]
+
+
+def make_envelope(origin: str, message, tenant: Optional[str] = None, thread_id: Optional[str] = None) -> dict:
+    return {"origin": origin, "sent_at": time.time(), "message": message, "tenant": tenant, "thread_id": thread_id}
+
+
+def record_delivery_latency(envelope: dict):
+    sent_at = envelope.get("sent_at")
+    if isinstance(sent_at, (int, float)):
+        metrics.observe("websocket.pubsub_latency_seconds", max(0.0, time.time() - sent_at))
+
+
+class InMemoryHub:
+    """Connects InMemoryPubSub instances living in the same process."""
+
+    def __init__(self):
+        self.subscribers: List["InMemoryPubSub"] = []
+
+
+class InMemoryPubSub:
+    name = "memory"
+
+    def __init__(self, hub: Optional[InMemoryHub] = None):
+        self.origin = str(uuid.uuid4())
+        self.hub = hub or InMemoryHub()
+        self.on_message: Optional[EnvelopeHandler] = None
+
+    async def start(self, on_message: EnvelopeHandler):
+        self.on_message = on_message
+        if self not in self.hub.subscribers:
+            self.hub.subscribers.append(self)
+
+    async def publish(self, envelope: dict) -> bool:
+        for subscriber in list(self.hub.subscribers):
+            if subscriber is not self and subscriber.on_message is not None:
+                record_delivery_latency(envelope)
+                await subscriber.on_message(envelope)
+        return True
+
+    async def close(self):
+        if self in self.hub.subscribers:
+            self.hub.subscribers.remove(self)
+
+
+class PostgresPubSub:
+    name = "postgres"
+
+    def __init__(self, db_uri: str, channel: str = PUBSUB_CHANNEL, batch_seconds: float = PUBSUB_BATCH_MS / 1000,
+                 max_payload_bytes: int = PUBSUB_MAX_PAYLOAD_BYTES, connect=None):
+        self.origin = str(uuid.uuid4())
+        self.db_uri = db_uri
+        self.channel = channel
+        self.batch_seconds = batch_seconds
+        self.max_payload_bytes = max_payload_bytes
+        self._connect = connect # for tests; psycopg.AsyncConnection.connect otherwise
+        self.on_message: Optional[EnvelopeHandler] = None
+        self._publish_connection = None
+        self._listen_task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._pending: List[str] = [] # encoded envelopes waiting for the next NOTIFY
+        self._pending_bytes = 0
+
+    async def _open_connection(self):
+        if self._connect is not None:
+            return await self._connect()
+        import psycopg
+        return await psycopg.AsyncConnection.connect(self.db_uri, autocommit=True)
+
+    async def start(self, on_message: EnvelopeHandler):
+        self.on_message = on_message
+        self._listen_task = asyncio.create_task(self._listen())
+        logger.info(f"📣 Websocket broadcasts fan out across workers via Postgres channel {self.channel}")
+
+    async def publish(self, envelope: dict) -> bool:
+        encoded = dumps(envelope)
+        size = len(encoded.encode("utf-8"))
+        if size + 2 > self.max_payload_bytes: # +2 for the surrounding [ ]
+            logger.warning(f"Broadcast of {size} bytes is over the {self.max_payload_bytes} byte NOTIFY limit, only delivered on this worker")
+            metrics.increment("websocket.pubsub_oversized")
+            return False
+        if self._pending and self._pending_bytes + len(self._pending) + size + 2 > self.max_payload_bytes:
+            await self._flush() # doesn't fit in the batch being collected, send that one first
+        self._pending.append(encoded)
+        self._pending_bytes += size
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return True
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.batch_seconds)
+        await self._flush()
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_bytes = self._pending, [], 0
+        payload = "[" + ",".join(batch) + "]"
+        try:
+            if self._publish_connection is None or self._publish_connection.closed:
+                self._publish_connection = await self._open_connection()
+            await self._publish_connection.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+            metrics.increment("websocket.pubsub_published", len(batch))
+        except Exception as e:
+            logger.warning(f"Failed to publish {len(batch)} broadcast(s) to other workers: {e}")
+            metrics.increment("websocket.pubsub_publish_errors")
+            self._publish_connection = None
+
+    async def _listen(self):
+        while True:
+            connection = None
+            try:
+                connection = await self._open_connection()
+                await connection.execute(f'LISTEN "{self.channel}"')
+                async for notify in connection.notifies():
+                    await self._deliver(notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Lost the Postgres LISTEN connection ({e}), reconnecting")
+                await asyncio.sleep(1)
+            finally:
+                if connection is not None:
+                    try:
+                        await connection.close()
+                    except Exception:
+                        pass
+
+    async def _deliver(self, payload: str):
+        try:
+            envelopes = loads(payload)
+        except Exception as e:
+            logger.warning(f"Ignoring malformed broadcast payload: {e}")
+            return
+        for envelope in envelopes:
+            if envelope.get("origin") == self.origin:
+                continue # already delivered locally when it was published
+            record_delivery_latency(envelope)
+            await self.on_message(envelope)
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._flush()
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+            await asyncio.gather(self._listen_task, return_exceptions=True)
+        if self._publish_connection is not None:
+            await self._publish_connection.close()
+            self._publish_connection = None
+
+
+def create_pubsub(backend: Optional[str] = None, db_uri: Optional[str] = None):
+    backend = (backend or PUBSUB_BACKEND).lower()
+    db_uri = db_uri if db_uri is not None else os.getenv("DB_URI", "").strip()
+    if backend == "auto":
+        workers = int(os.getenv("WEB_CONCURRENCY", "1") or 1)
+        backend = "postgres" if db_uri and workers > 1 else "memory"
+    if backend == "postgres":
+        if db_uri:
+            return PostgresPubSub(db_uri)
+        logger.warning("❌ LLAMABOT_WS_PUBSUB_BACKEND=postgres but no DB_URI is set, broadcasts stay on this worker")
+    return InMemoryPubSub()
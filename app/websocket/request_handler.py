@@ -3,8 +3,16 @@ from asyncio import Lock, CancelledError
 from fastapi import FastAPI, WebSocket
 from starlette.websockets import WebSocketState
 
+from app.admission_scheduler import admission_scheduler
+from app.serialization import send_websocket_json
+from app.logging_config import describe_update
 from app.websocket.web_socket_request_context import WebSocketRequestContext
-from typing import Dict, Optional
+from app.websocket.stream_protocol import get_stream_encoder
+from app.websocket.resumable_runs import run_registry
+from app.websocket.html_preview import HtmlPreviewStreamer
+from app.agents.utils.html_compaction import page_placeholders
+from app.websocket.token_chunk_coalescer import TokenChunkCoalescer, iterate_with_flush_deadline, FLUSH_DUE
+from typing import Dict, Optional, Tuple
 
 from langchain_core.messages import HumanMessage
 from langgraph.graph import MessagesState
@@ -18,6 +26,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 import json
 import importlib
+import uuid
 import os
 import logging
 
@@ -30,139 +39,184 @@ from datetime import datetime
 
 class RequestHandler:
     def __init__(self, app: FastAPI):
-        self.locks: Dict[int, Lock] = {}
+        self.locks: Dict[Tuple[int, str], Lock] = {} # keyed by (id(websocket), thread_id)
+        self.contexts: Dict[int, WebSocketRequestContext] = {}
         self.app = app
     
-    def _get_lock(self, websocket: WebSocket) -> Lock:
-        """Get or create a lock for a specific websocket connection"""
+    def _get_lock(self, websocket: WebSocket, thread_id: str) -> Lock:
+        """Get or create the lock that serializes runs on one thread of a websocket connection"""
+        key = (id(websocket), thread_id)
+        if key not in self.locks:
+            self.locks[key] = Lock()
+        return self.locks[key]
+
+    def get_context(self, websocket: WebSocket) -> WebSocketRequestContext:
+        """Get or create the per-connection state (negotiated protocol version, etc.) for a websocket connection"""
         ws_id = id(websocket)
-        if ws_id not in self.locks:
-            self.locks[ws_id] = Lock()
-        return self.locks[ws_id]
+        if ws_id not in self.contexts:
+            self.contexts[ws_id] = WebSocketRequestContext(websocket)
+        return self.contexts[ws_id]
 
     def _is_websocket_open(self, websocket: WebSocket) -> bool:
         """Check if the WebSocket connection is still open"""
         return websocket.client_state == WebSocketState.CONNECTED
 
-    async def handle_request(self, message: dict, websocket: WebSocket):
-        """Handle incoming WebSocket requests with proper locking and cancellation"""
-        ws_id = id(websocket)
-        lock = self._get_lock(websocket)
+    def _can_send(self, websocket: WebSocket, run_tags: Optional[dict] = None) -> bool:
+        """Frames of a resumable run are always accepted (they're logged for replay); otherwise the socket must be open."""
+        if run_tags and run_registry.get(run_tags.get("run_id")) is not None:
+            return True
+        return self._is_websocket_open(websocket)
+
+    async def handle_request(self, message: dict, websocket: WebSocket, run_id: Optional[str] = None):
+        """
+        Handle incoming WebSocket requests with proper locking and cancellation.
+        Runs on the same thread are serialized; runs on different threads of the same connection stream
+        concurrently (up to the connection's run_slots), with every frame tagged with its thread_id and run_id.
+        On top of that, every run waits for admission (admission_scheduler.py), which caps the runs of the whole process.
+        """
+        thread_id = f"{message.get('thread_id')}"
+        run_tags = {"thread_id": thread_id, "run_id": run_id or message.get("run_id") or str(uuid.uuid4())}
+        context = self.get_context(websocket)
+        lock = self._get_lock(websocket, thread_id)
+        encoder = get_stream_encoder(context.protocol_version)
         
-        async with lock:
+        async with lock, context.run_slots:
             try:
-                app, state = self.get_langgraph_app_and_state(message)
-                config = {
-                    "configurable": {
-                        "thread_id": f"{message.get('thread_id')}"
+                async with admission_scheduler.admit(thread_id, tenant=context.tenant):
+                    app, state = self.get_langgraph_app_and_state(message)
+                    config = {
+                        "configurable": {
+                            "thread_id": thread_id,
+                            "tenant": context.tenant # per-tenant tool concurrency, see tool_execution.py
+                        }
                     }
-                }
 
-                async for chunk in app.astream(state, config=config, stream_mode=["updates", "messages"], subgraphs=True):
-                    # NOTE: In LangGraph 0.5, they introduced this "subgraphs" parameter, that changes the datashape if you set it to True.
-                    # if subgraph=True, it returns a tuple with 3 elements, instead of 2 elements.
-                    # the first element is the subgraph name, the second element is the streaming data type ["updates", "messages", "values"], and the third element is the actual metadata.
-                    is_this_chunk_an_llm_message = isinstance(chunk, tuple) and len(chunk) == 3 and chunk[1] == 'messages'
-                    is_this_chunk_an_update_stream_type = isinstance(chunk, tuple) and len(chunk) == 3 and chunk[1] == 'updates'
-                    logger.info(f"🍅🍅🍅 Chunk: {chunk}")
-                    if is_this_chunk_an_llm_message:
-                        # breakpoint()
-                        message_chunk_from_llm = chunk[2][0] #AIMessageChunk object -> https://python.langchain.com/api_reference/core/messages/langchain_core.messages.ai.AIMessageChunk.html
-                        data_type = "AIMessageChunk"
-                        base_message_as_dict = dumpd(chunk[2][0])["kwargs"]
-                        logger.info(f"🍅 {base_message_as_dict['content']}")
-                        # # Only send if WebSocket is still open
-                        if self._is_websocket_open(websocket):
-                            await websocket.send_json({
-                                "type": base_message_as_dict["type"],
-                                "content": base_message_as_dict["content"],
-                                "tool_calls": [],
-                                "base_message": base_message_as_dict
-                            })
+                    # Token chunks are merged into larger frames instead of being sent one websocket frame per token.
+                    coalescer = TokenChunkCoalescer()
+                    # Pages being written by write_html_page are previewed as they stream in, for clients that asked.
+                    previews = HtmlPreviewStreamer(placeholders=page_placeholders(state.get("current_page_html"))) if context.html_preview else None
+                    stream = app.astream(state, config=config, stream_mode=["updates", "messages"], subgraphs=True)
+
+                    async for chunk in iterate_with_flush_deadline(stream, coalescer):
+                        if chunk is FLUSH_DUE: # The coalescing window expired while we were waiting on the next token.
+                            await self._send_message_chunks(websocket, encoder, coalescer.flush(), run_tags)
+                            continue
+
+                        # NOTE: In LangGraph 0.5, they introduced this "subgraphs" parameter, that changes the datashape if you set it to True.
+                        # if subgraph=True, it returns a tuple with 3 elements, instead of 2 elements.
+                        # the first element is the subgraph name, the second element is the streaming data type ["updates", "messages", "values"], and the third element is the actual metadata.
+                        is_this_chunk_an_llm_message = isinstance(chunk, tuple) and len(chunk) == 3 and chunk[1] == 'messages'
+                        is_this_chunk_an_update_stream_type = isinstance(chunk, tuple) and len(chunk) == 3 and chunk[1] == 'updates'
+                        logger.debug("🍅🍅🍅 Chunk: %s", chunk, extra={"category": "stream.chunk"})
+                        if is_this_chunk_an_llm_message:
+                            message_chunk_from_llm, langgraph_metadata = chunk[2] #AIMessageChunk object -> https://python.langchain.com/api_reference/core/messages/langchain_core.messages.ai.AIMessageChunk.html
+                            ready_to_send = coalescer.add((chunk[0], langgraph_metadata.get("langgraph_node")), message_chunk_from_llm, langgraph_metadata)
+                            await self._send_message_chunks(websocket, encoder, ready_to_send, run_tags)
+                            if previews is not None:
+                                await self._send_frames(websocket, previews.add(message_chunk_from_llm, langgraph_metadata.get("langgraph_node")), run_tags)
                     
-                    elif is_this_chunk_an_update_stream_type: # This means that LangGraph has given us a state update. This will often include a new message from the AI.
-                        state_object = chunk[2]
-                        logger.info(f"🧠🧠🧠 LangGraph Output (State Update): {state_object}")
+                        elif is_this_chunk_an_update_stream_type: # This means that LangGraph has given us a state update. This will often include a new message from the AI.
+                            # The node has finished, so whatever partial text is still buffered must go out before the update.
+                            await self._send_message_chunks(websocket, encoder, coalescer.flush(), run_tags)
+                            if previews is not None:
+                                await self._send_frames(websocket, previews.flush(), run_tags)
+
+                            state_object = chunk[2]
+                            logger.info("🧠🧠🧠 LangGraph Output (State Update): %s", describe_update(state_object), extra={"category": "stream.update"})
+                            logger.debug("🧠 Full state update: %s", state_object, extra={"category": "stream.update"})
                     
-                        # Handle dynamic agent key - look for messages in any nested dict
-                        messages = None
-                        for agent_key, agent_data in state_object.items():
-                            did_agent_have_a_message_for_us = isinstance(agent_data, dict) and 'messages' in agent_data
-                            if did_agent_have_a_message_for_us:
-                                messages = agent_data['messages'] #Question: is this ALL messages coming through, or just the latest AI message?
-
-                                # Safe check for tool calls with better error handling
-                                did_agent_evoke_a_tool = False
-                                tool_calls = []
+                            # Handle dynamic agent key - look for messages in any nested dict
+                            messages = None
+                            for agent_key, agent_data in state_object.items():
+                                did_agent_have_a_message_for_us = isinstance(agent_data, dict) and 'messages' in agent_data
+                                if did_agent_have_a_message_for_us:
+                                    messages = agent_data['messages'] #Question: is this ALL messages coming through, or just the latest AI message?
+
+                                    # Safe check for tool calls with better error handling
+                                    did_agent_evoke_a_tool = False
+                                    tool_calls = []
                                 
-                                if messages and len(messages) > 0:
-                                    message = messages[-1] # get the latest message (the last one in the list. Sometimes we have a human message and an AI message, so we want the AI message, depending on if we're using the create_react_agent tool or not)
-                                    if hasattr(message, 'additional_kwargs') and message.additional_kwargs:
-                                        tool_calls_data = message.additional_kwargs.get('tool_calls')
-                                        if tool_calls_data:
-                                            did_agent_evoke_a_tool = True
-                                            tool_calls = tool_calls_data
+                                    if messages and len(messages) > 0:
+                                        message = messages[-1] # get the latest message (the last one in the list. Sometimes we have a human message and an AI message, so we want the AI message, depending on if we're using the create_react_agent tool or not)
+                                        if hasattr(message, 'additional_kwargs') and message.additional_kwargs:
+                                            tool_calls_data = message.additional_kwargs.get('tool_calls')
+                                            if tool_calls_data:
+                                                did_agent_evoke_a_tool = True
+                                                tool_calls = tool_calls_data
                                             
-                                            # Log tool call details
-                                            if len(tool_calls) > 0:
-                                                tool_call_object = tool_calls[0]
-                                                tool_call_name = tool_call_object.get("name")
-                                                tool_call_args = tool_call_object.get("args")
-                                                logger.info(f"🔨🔨🔨 Tool Call Name: {tool_call_name}")
-                                                logger.info(f"🔨🔨🔨 Tool Call Args: {tool_call_args}")
-
-                                    # AIMessage is not serializable to JSON, so we need to convert it to a string.
-                                    messages_as_string = [msg.content if hasattr(msg, 'content') else str(msg) for msg in messages]
-
-                                    #NOTE: I found we're able to serialize AIMessage into dict using dumpd.
-                                    try:
-                                        base_message_as_dict = dumpd(message)["kwargs"]
-                                    except Exception as e:
-                                        logger.warning(f"Failed to serialize message: {e}")
-                                        base_message_as_dict = {"content": str(message), "type": "ai"}
-
-                                    # Only send if WebSocket is still open
-                                    if self._is_websocket_open(websocket):
-
-                                        # NOTE: This JSON object is a standardized format that we've been using for all our front-ends.  
-                                        # Eventually, we might want to just rely on the base_message data shape as the source of truth for all front-ends.
-                                        llamapress_user_interface_json = {
-                                            "type": message.type if hasattr(message, 'type') else "ai",
-                                            "content": messages_as_string[-1] if messages_as_string else "",
-                                            "tool_calls": tool_calls,
-                                            "base_message": base_message_as_dict
-                                        }
-                                        
-                                        await websocket.send_json(llamapress_user_interface_json)
-                                break
+                                                # Log tool call details
+                                                if len(tool_calls) > 0:
+                                                    tool_call_object = tool_calls[0]
+                                                    tool_call_name = tool_call_object.get("name")
+                                                    tool_call_args = tool_call_object.get("args")
+                                                    logger.info("🔨🔨🔨 Tool Call Name: %s", tool_call_name, extra={"category": "stream.tool_call"})
+                                                    logger.info("🔨🔨🔨 Tool Call Args: %s", tool_call_args, extra={"category": "stream.tool_call"})
+
+                                        # Only send if WebSocket is still open
+                                        if self._can_send(websocket, run_tags):
+                                            # The frame shape depends on the protocol version negotiated for this connection (see stream_protocol.py)
+                                            await self._send(websocket, encoder.message_update(message, agent_key, tool_calls), run_tags)
+                                    break
                         
-                        logger.info(f"LangGraph Output (State Update): {chunk}")
+                            logger.debug("LangGraph Output (State Update): %s", chunk, extra={"category": "stream.update"})
+
+                            # chunk will look like this:
+                            # {'llamabot': {'messages': [AIMessage(content='Hello! I hear you loud and clear. I'm LlamaBot, your full-stack Rails developer assistant. How can I help you today?', additional_kwargs={}, response_metadata={'finish_reason': 'stop', 'model_name': 'o4-mini-2025-04-16', 'service_tier': 'default'}, id='run--ce385bc4-fecb-4127-81d2-1da5814874f8')]}}
 
-                        # chunk will look like this:
-                        # {'llamabot': {'messages': [AIMessage(content='Hello! I hear you loud and clear. I'm LlamaBot, your full-stack Rails developer assistant. How can I help you today?', additional_kwargs={}, response_metadata={'finish_reason': 'stop', 'model_name': 'o4-mini-2025-04-16', 'service_tier': 'default'}, id='run--ce385bc4-fecb-4127-81d2-1da5814874f8')]}}
+                        else:
+                            logger.debug("Workflow output: %s", chunk, extra={"category": "stream.chunk"})
 
-                    else:
-                        logger.info(f"Workflow output: {chunk}")
+                    await self._send_message_chunks(websocket, encoder, coalescer.flush(), run_tags)
 
             except CancelledError as e:
                 logger.info("handle_request was cancelled")
                 # Only send error message if WebSocket is still open
-                if self._is_websocket_open(websocket):
-                    await websocket.send_json({
+                if self._can_send(websocket, run_tags):
+                    await self._send(websocket, {
                         "type": "error",
                         "content": f"Cancelled!"
-                    })
+                    }, run_tags)
                 raise e
             except Exception as e:
                 logger.error(f"Error handling request: {str(e)}", exc_info=True)
                 # Only send error message if WebSocket is still open
-                if self._is_websocket_open(websocket):
-                    await websocket.send_json({
+                if self._can_send(websocket, run_tags):
+                    await self._send(websocket, {
                         "type": "error",
                         "content": f"Error processing request: {str(e)}"
-                    })
+                    }, run_tags)
                 raise e
 
+    async def _send_message_chunks(self, websocket: WebSocket, encoder, messages_with_metadata: list, run_tags: Optional[dict] = None):
+        """Send streamed (coalesced) LLM message chunks to the client, one frame per chunk."""
+        for message_chunk, langgraph_metadata in messages_with_metadata:
+            logger.debug("🍅 %s", message_chunk.content, extra={"category": "stream.chunk"})
+            frame = encoder.message_chunk(message_chunk, langgraph_metadata.get("langgraph_node"))
+            # Only send if WebSocket is still open
+            if frame is not None and self._can_send(websocket, run_tags):
+                await self._send(websocket, frame, run_tags)
+
+    async def _send_frames(self, websocket: WebSocket, frames: list, run_tags: Optional[dict] = None):
+        for frame in frames:
+            if self._can_send(websocket, run_tags):
+                await self._send(websocket, frame, run_tags)
+
+    async def _send(self, websocket: WebSocket, frame: dict, run_tags: Optional[dict] = None):
+        """Queue a frame on the connection's outbound queue, so a slow client doesn't hold up the agent run."""
+        if run_tags:
+            frame.update(run_tags) # lets a client streaming several threads over one socket route the frame
+            run = run_registry.get(run_tags.get("run_id"))
+            if run is not None:
+                run.publish(frame) # numbered and logged, then forwarded to whichever connection is attached to the run
+                return
+        context = self.contexts.get(id(websocket))
+        if context is not None and context.outbound is not None and not context.outbound.closed:
+            context.outbound.put(frame)
+        elif context is not None:
+            await context.codec.send(websocket, frame)
+        else:
+            await send_websocket_json(websocket, frame)
+
     async def get_chat_history(self, thread_id: str):
         # For chat history, we don't need a specific agent, just get any workflow to access the checkpointer
         # This is a bit of a hack - we should refactor this to not need the workflow for just getting history
@@ -200,8 +254,9 @@ class RequestHandler:
     def cleanup_connection(self, websocket: WebSocket):
         """Clean up resources when a connection is closed"""
         ws_id = id(websocket)
-        if ws_id in self.locks:
-            del self.locks[ws_id]
+        for key in [key for key in self.locks if key[0] == ws_id]:
+            del self.locks[key]
+        self.contexts.pop(ws_id, None)
 
 
     def get_workflow_from_langgraph_json(self, message: dict) -> str | None:
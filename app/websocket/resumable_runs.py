@@ -0,0 +1,187 @@
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+import asyncio
+
+import os
+import logging
+import time
+
+from app.cancellation import cancel_run_task
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# How many frames of a run are kept for replay. Older frames are forgotten; a client resuming from before them
+# is told about the gap and should reload the thread's history instead.
+RUN_EVENT_LOG_SIZE = int(os.getenv("LLAMABOT_RUN_EVENT_LOG_SIZE", "1000"))
+# How long a run keeps going after its client disconnected, waiting for a `resume`. 0 cancels it right away.
+RUN_RESUME_GRACE_SECONDS = float(os.getenv("LLAMABOT_RUN_RESUME_GRACE_SECONDS", "30"))
+# How long a finished run stays around, so a client that reconnects just after the end can still replay it.
+RUN_RETENTION_SECONDS = float(os.getenv("LLAMABOT_RUN_RETENTION_SECONDS", "60"))
+
+
+class RunIdInUse(ValueError):
+    """A client asked for a run_id that an existing (running or still replayable) run already has."""
+
+
+def task_outcome(task: asyncio.Task) -> str:
+    """How a run's task ended: "finished", "failed" or "cancelled" (see ResumableRun.outcome)."""
+    if task.cancelled():
+        return "cancelled"
+    return "failed" if task.exception() is not None else "finished"
+
+
+class RunEventLog:
+    """Bounded, sequence-numbered log of the frames sent for one run."""
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.events: deque = deque(maxlen=max(1, max_size if max_size is not None else RUN_EVENT_LOG_SIZE))
+        self.last_seq = 0
+
+    def append(self, frame: dict) -> dict:
+        self.last_seq += 1
+        frame["seq"] = self.last_seq
+        self.events.append(frame)
+        return frame
+
+    def events_after(self, seq: int) -> Tuple[List[dict], bool]:
+        """Frames with a sequence number above `seq`, and whether some of the frames after `seq` were already evicted."""
+        missed = [frame for frame in self.events if frame["seq"] > seq]
+        first_kept = self.events[0]["seq"] if self.events else self.last_seq + 1
+        return missed, first_kept > seq + 1
+
+
+class ResumableRun:
+    """
+    One agent run that outlives the websocket it was started on.
+    Frames are published here (not to a socket): they are numbered, logged, and forwarded to whichever
+    connection's outbound queue is currently attached.
+    """
+
+    def __init__(self, run_id: str, thread_id: str, log_size: Optional[int] = None, grace_seconds: Optional[float] = None,
+                 background: bool = False, tenant: Optional[str] = None):
+        self.run_id = run_id
+        self.thread_id = thread_id
+        self.tenant = tenant
+        self.log = RunEventLog(log_size)
+        self.grace_seconds = grace_seconds if grace_seconds is not None else RUN_RESUME_GRACE_SECONDS
+        self.background = background # runs to completion whether or not anyone is attached (see run_manager.py)
+        self.task: Optional[asyncio.Task] = None
+        self.subscriber = None # an OutboundQueue, or None while no client is attached
+        self.queued = False # waiting for a worker (background runs only)
+        self.finished = False
+        self.outcome = "finished" # or "failed" / "cancelled", once finished
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.detached_at: Optional[float] = None
+        self._grace_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def status(self) -> str:
+        if self.finished:
+            return self.outcome
+        return "queued" if self.queued else "running"
+
+    def belongs_to(self, thread_id, tenant: Optional[str] = None) -> bool:
+        """
+        Whether a client resuming this run named the right thread (and tenant). A run_id alone isn't enough to take
+        over a run's frames. The tenant is whatever the client said it was (hello / request body), not a credential.
+        """
+        return thread_id is not None and f"{thread_id}" == self.thread_id and (tenant or None) == (self.tenant or None)
+
+    def publish(self, frame: dict):
+        self.log.append(frame)
+        if self.subscriber is not None and not self.subscriber.closed:
+            self.subscriber.put(frame)
+
+    def attach(self, subscriber, last_seq: int = 0) -> Tuple[int, bool]:
+        """
+        Attach a connection, replaying the frames it missed after `last_seq` before any live ones.
+        Returns how many frames were replayed and whether there was a gap.
+        """
+        self._cancel_grace_timer()
+        missed, gap = self.log.events_after(last_seq)
+        # No awaits between the replay and the switch, so no frame can slip in between.
+        for frame in missed:
+            subscriber.put(frame)
+        self.subscriber = subscriber
+        self.detached_at = None
+        metrics.increment("runs.resumed")
+        return len(missed), gap
+
+    def detach(self, subscriber=None) -> bool:
+        """
+        The client went away. Keep running for the grace period, then give up.
+        Returns True if the run was cancelled right away (no grace period).
+        """
+        if subscriber is not None and self.subscriber is not subscriber:
+            return False # already taken over by another connection
+        self.subscriber = None
+        if self.finished or self.background:
+            return False
+        self.detached_at = time.monotonic()
+        if self.grace_seconds <= 0:
+            return self._expire()
+        self._cancel_grace_timer()
+        self._grace_timer = asyncio.get_running_loop().call_later(self.grace_seconds, self._expire)
+        return False
+
+    def mark_finished(self, outcome: str = "finished"):
+        self.finished = True
+        self.outcome = outcome
+        self.finished_at = time.time()
+        self._cancel_grace_timer()
+
+    def _expire(self) -> bool:
+        self._grace_timer = None
+        if self.subscriber is None and self.task is not None and not self.task.done():
+            logger.info(f"⌛ Nobody resumed run {self.run_id} within {self.grace_seconds}s, cancelling it")
+            metrics.increment("runs.expired")
+            cancel_run_task(self.task, self.run_id, reason="expired")
+            return True
+        return False
+
+    def _cancel_grace_timer(self):
+        if self._grace_timer is not None:
+            self._grace_timer.cancel()
+            self._grace_timer = None
+
+
+class ResumableRunRegistry:
+    """All runs of this process that can still be resumed, keyed by run_id."""
+
+    def __init__(self, retention_seconds: Optional[float] = None):
+        self.runs: Dict[str, ResumableRun] = {}
+        self.retention_seconds = retention_seconds if retention_seconds is not None else RUN_RETENTION_SECONDS
+
+    def create(self, run_id: str, thread_id: str, subscriber=None, **options) -> ResumableRun:
+        """Register a new run. Raises RunIdInUse rather than replacing a run that's still around under that id."""
+        if run_id in self.runs:
+            raise RunIdInUse(f"run_id {run_id} is already in use")
+        run = ResumableRun(run_id, thread_id, **options)
+        run.subscriber = subscriber
+        self.runs[run_id] = run
+        return run
+
+    def get(self, run_id: Optional[str]) -> Optional[ResumableRun]:
+        return self.runs.get(run_id) if run_id else None
+
+    def finish(self, run_id: str, outcome: str = "finished", retention_seconds: Optional[float] = None):
+        """Mark a run as done; it can still be replayed for `retention_seconds` (the registry's default if not given)."""
+        run = self.runs.get(run_id)
+        if run is None:
+            return
+        run.mark_finished(outcome)
+        retention_seconds = retention_seconds if retention_seconds is not None else self.retention_seconds
+        if retention_seconds <= 0:
+            self.runs.pop(run_id, None)
+        else:
+            asyncio.get_running_loop().call_later(retention_seconds, self._forget, run)
+
+    def _forget(self, run: ResumableRun):
+        if self.runs.get(run.run_id) is run:
+            del self.runs[run.run_id]
+
+
+# Process-wide, since a client usually reconnects on a brand new websocket (and WebSocketHandler).
+run_registry = ResumableRunRegistry()
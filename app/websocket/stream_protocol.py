@@ -0,0 +1,177 @@
+from typing import Iterable, Optional, Union
+
+from langchain_core.load import dumpd
+from langchain_core.messages import AIMessageChunk, BaseMessage
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Version 1 is the original LlamaPress frame shape: every frame carries `content`, `tool_calls` and the full
+# dumpd() `base_message`. Version 2 streams deltas only, and sends each finished message once.
+LEGACY_PROTOCOL_VERSION = 1
+DELTA_PROTOCOL_VERSION = 2
+SUPPORTED_PROTOCOL_VERSIONS = (LEGACY_PROTOCOL_VERSION, DELTA_PROTOCOL_VERSION)
+
+
+def negotiate_protocol_version(requested: Union[int, str, Iterable, None]) -> int:
+    """
+    Pick the protocol version to use for a connection.
+    `requested` is whatever the client offered: a single version, or a list of versions it can speak.
+    Falls back to the legacy protocol if nothing offered is supported.
+    """
+    if requested is None:
+        return LEGACY_PROTOCOL_VERSION
+    offered = requested if isinstance(requested, (list, tuple, set)) else [requested]
+    versions = []
+    for version in offered:
+        try:
+            versions.append(int(version))
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring unknown protocol version offered by client: {version!r}")
+    supported = [version for version in versions if version in SUPPORTED_PROTOCOL_VERSIONS]
+    return max(supported) if supported else LEGACY_PROTOCOL_VERSION
+
+
+class LegacyStreamEncoder:
+    """Builds the frames older LlamaPress clients expect (protocol version 1)."""
+
+    version = LEGACY_PROTOCOL_VERSION
+
+    def message_chunk(self, message: BaseMessage, node: Optional[str]) -> Optional[dict]:
+        base_message_as_dict = dumpd(message)["kwargs"]
+        return {
+            "type": base_message_as_dict["type"],
+            "content": base_message_as_dict["content"],
+            "tool_calls": [],
+            "base_message": base_message_as_dict
+        }
+
+    def message_update(self, message: BaseMessage, node: Optional[str], tool_calls: list) -> dict:
+        # NOTE: This JSON object is a standardized format that we've been using for all our front-ends.
+        # Eventually, we might want to just rely on the base_message data shape as the source of truth for all front-ends.
+        return {
+            "type": message.type if hasattr(message, 'type') else "ai",
+            "content": message.content if hasattr(message, 'content') else str(message),
+            "tool_calls": tool_calls,
+            "base_message": _serialize_message(message)
+        }
+
+
+class DeltaStreamEncoder:
+    """
+    Builds compact frames (protocol version 2).
+
+    Token chunks become `delta` frames carrying only the message id, the node, the appended text and any
+    tool-call argument deltas. Once a node finishes, the consolidated message is sent once as a `message` frame.
+    Non-chunk messages seen on the token stream (e.g. tool results) are skipped there, since the same message
+    arrives as a `message` frame with the node's state update.
+    """
+
+    version = DELTA_PROTOCOL_VERSION
+
+    def message_chunk(self, message: BaseMessage, node: Optional[str]) -> Optional[dict]:
+        if not isinstance(message, AIMessageChunk):
+            return None
+
+        frame = {"type": "delta", "v": self.version, "id": message.id, "node": node}
+        text = message.content if isinstance(message.content, str) else ""
+        if text:
+            frame["text"] = text
+
+        tool_call_deltas = []
+        for tool_call_chunk in message.tool_call_chunks or []:
+            tool_call_delta = {"index": tool_call_chunk.get("index")}
+            for key in ("id", "name", "args"):
+                if tool_call_chunk.get(key):
+                    tool_call_delta[key] = tool_call_chunk[key]
+            tool_call_deltas.append(tool_call_delta)
+        if tool_call_deltas:
+            frame["tool_calls"] = tool_call_deltas
+
+        if "text" not in frame and "tool_calls" not in frame:
+            return None # e.g. the empty chunk that carries only the finish_reason.
+        return frame
+
+    def message_update(self, message: BaseMessage, node: Optional[str], tool_calls: list) -> dict:
+        return {
+            "type": "message",
+            "v": self.version,
+            "id": getattr(message, "id", None),
+            "node": node,
+            "message": _serialize_message(message)
+        }
+
+
+def get_stream_encoder(protocol_version: int):
+    if protocol_version == DELTA_PROTOCOL_VERSION:
+        return DeltaStreamEncoder()
+    return LegacyStreamEncoder()
+
+
+def _serialize_message(message: BaseMessage) -> dict:
+    #NOTE: AIMessage is not serializable to JSON directly, but dumpd gives us a dict.
+    try:
+        return dumpd(message)["kwargs"]
+    except Exception as e:
+        logger.warning(f"Failed to serialize message: {e}")
+        return {"content": str(message), "type": "ai"}
+
+
+def is_token_frame(frame: dict) -> bool:
+    """True for frames that only carry streamed tokens, which a later consolidated message frame supersedes."""
+    return frame.get("type") in ("delta", "AIMessageChunk")
+
+
+def merge_token_frames(earlier: dict, later: dict) -> Optional[dict]:
+    """
+    Merge two consecutive token frames for the same message into one, or return None if they can't be merged.
+    Used to shrink the outbound queue of a slow client without losing text.
+    """
+    merged = _merge_token_frames(earlier, later)
+    if merged is not None and "seq" in later:
+        merged["seq"] = later["seq"] # the merged frame covers everything up to the later one (see resumable_runs.py)
+    return merged
+
+
+def _merge_token_frames(earlier: dict, later: dict) -> Optional[dict]:
+    if not (is_token_frame(earlier) and is_token_frame(later)) or earlier.get("type") != later.get("type"):
+        return None
+
+    if earlier["type"] == "delta":
+        if earlier.get("id") != later.get("id") or earlier.get("node") != later.get("node"):
+            return None
+        merged = dict(earlier)
+        text = earlier.get("text", "") + later.get("text", "")
+        if text:
+            merged["text"] = text
+        tool_calls = _merge_tool_call_deltas(earlier.get("tool_calls", []), later.get("tool_calls", []))
+        if tool_calls:
+            merged["tool_calls"] = tool_calls
+        return merged
+
+    # Legacy frames: only plain-text chunks are merged, since their base_message also carries parsed tool calls.
+    earlier_message, later_message = earlier.get("base_message", {}), later.get("base_message", {})
+    if earlier_message.get("id") != later_message.get("id"):
+        return None
+    if earlier_message.get("tool_call_chunks") or later_message.get("tool_call_chunks"):
+        return None
+    if not isinstance(earlier.get("content"), str) or not isinstance(later.get("content"), str):
+        return None
+    content = earlier["content"] + later["content"]
+    return dict(earlier, content=content, base_message=dict(earlier_message, content=content))
+
+
+def _merge_tool_call_deltas(earlier: list, later: list) -> list:
+    merged = [dict(tool_call) for tool_call in earlier]
+    for tool_call in later:
+        for existing in merged:
+            if existing.get("index") == tool_call.get("index"):
+                existing["args"] = existing.get("args", "") + tool_call.get("args", "")
+                for key in ("id", "name"):
+                    if tool_call.get(key) and not existing.get(key):
+                        existing[key] = tool_call[key]
+                break
+        else:
+            merged.append(dict(tool_call))
+    return merged
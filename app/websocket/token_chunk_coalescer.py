@@ -0,0 +1,140 @@
+import asyncio
+import os
+import time
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple
+
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.messages.ai import add_ai_message_chunks
+
+# Coalescing window defaults. Set LLAMABOT_STREAM_COALESCE_MS=0 to go back to one frame per token.
+DEFAULT_COALESCE_WINDOW_MS = float(os.getenv("LLAMABOT_STREAM_COALESCE_MS", "50"))
+DEFAULT_COALESCE_MAX_CHARS = int(os.getenv("LLAMABOT_STREAM_COALESCE_MAX_CHARS", "1024"))
+
+# Marker yielded by iterate_with_flush_deadline when the coalescing window expires before the next chunk arrives.
+FLUSH_DUE = object()
+
+# (message, langgraph metadata) - the same pair LangGraph yields in "messages" stream mode.
+MessageWithMetadata = Tuple[BaseMessage, dict]
+
+
+class TokenChunkCoalescer:
+    """
+    Merges consecutive AIMessageChunks from the same node (and the same message) into one chunk.
+
+    LangGraph's "messages" stream mode yields one AIMessageChunk per token, and sending each of those as
+    its own websocket frame costs a dumpd() + send per token. The coalescer buffers chunks until either
+    the time window (measured from the first buffered chunk) or the size window is exceeded, or until a
+    chunk from a different node/message (or a non-chunk message) arrives.
+    """
+
+    def __init__(
+        self,
+        window_ms: Optional[float] = None,
+        max_chars: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.window_seconds = (DEFAULT_COALESCE_WINDOW_MS if window_ms is None else window_ms) / 1000.0
+        self.max_chars = DEFAULT_COALESCE_MAX_CHARS if max_chars is None else max_chars
+        self._clock = clock
+        self._pending: List[AIMessageChunk] = []
+        self._pending_key: Optional[tuple] = None
+        self._pending_metadata: Optional[dict] = None
+        self._pending_chars = 0
+        self._pending_since: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_seconds > 0
+
+    @property
+    def has_pending(self) -> bool:
+        return bool(self._pending)
+
+    def add(self, key: tuple, message: BaseMessage, metadata: dict) -> List[MessageWithMetadata]:
+        """
+        Buffer a streamed message. Returns the (message, metadata) pairs that are ready to be sent, in order.
+        `key` identifies the stream the chunk belongs to, e.g. (namespace, langgraph_node).
+        """
+        if not self.enabled:
+            return [(message, metadata)]
+
+        if not isinstance(message, AIMessageChunk):
+            # Tool messages etc. are never merged, but whatever is buffered must go out before them.
+            return self.flush() + [(message, metadata)]
+
+        ready: List[MessageWithMetadata] = []
+        key = key + (message.id,)
+        if self._pending and key != self._pending_key:
+            ready.extend(self.flush())
+
+        if not self._pending:
+            self._pending_key = key
+            self._pending_metadata = metadata
+            self._pending_since = self._clock()
+
+        self._pending.append(message)
+        self._pending_chars += _chunk_size(message)
+
+        if self._pending_chars >= self.max_chars or self.time_until_flush() == 0:
+            ready.extend(self.flush())
+        return ready
+
+    def time_until_flush(self) -> Optional[float]:
+        """Seconds until the buffered chunks are due, or None if nothing is buffered."""
+        if not self._pending:
+            return None
+        elapsed = self._clock() - self._pending_since
+        return max(0.0, self.window_seconds - elapsed)
+
+    def flush(self) -> List[MessageWithMetadata]:
+        """Return the buffered chunks merged into a single chunk, and reset the buffer."""
+        if not self._pending:
+            return []
+        if len(self._pending) == 1:
+            merged = self._pending[0]
+        else:
+            merged = add_ai_message_chunks(self._pending[0], *self._pending[1:])
+        ready = [(merged, self._pending_metadata)]
+        self._pending = []
+        self._pending_key = None
+        self._pending_metadata = None
+        self._pending_chars = 0
+        self._pending_since = None
+        return ready
+
+
+def _chunk_size(chunk: AIMessageChunk) -> int:
+    """Rough size of a chunk: text content plus any streamed tool-call argument text."""
+    content = chunk.content if isinstance(chunk.content, str) else str(chunk.content)
+    size = len(content)
+    for tool_call_chunk in chunk.tool_call_chunks or []:
+        size += len(tool_call_chunk.get("args") or "")
+    return size
+
+
+async def iterate_with_flush_deadline(
+    stream: AsyncIterator[Any], coalescer: TokenChunkCoalescer
+) -> AsyncIterator[Any]:
+    """
+    Yield items from `stream`, yielding FLUSH_DUE whenever the coalescer's window expires while we are
+    still waiting on the next item. This keeps a stalled token stream from holding buffered text back.
+    """
+    iterator = stream.__aiter__()
+    next_item: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({next_item}, timeout=coalescer.time_until_flush())
+            if not done:
+                yield FLUSH_DUE
+                continue
+            finished, next_item = next_item, None
+            try:
+                item = finished.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if next_item is not None and not next_item.done():
+            next_item.cancel()
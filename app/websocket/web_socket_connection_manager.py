@@ -1,70 +1,286 @@
+from dataclasses import dataclass, field
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from starlette.websockets import WebSocketState
 import asyncio
 import logging
-from typing import Union
-# from logging_config import setup_google_cloud_logging
+import os
+import time
+from typing import Dict, List, Optional, Set, Union
 
-logging.basicConfig(level=logging.INFO)
-# Initialize Google Cloud Logging
-# setup_google_cloud_logging()
+from app.metrics import metrics
+from app.serialization import dumps, send_websocket_json
+from app.websocket.pubsub import InMemoryPubSub, create_pubsub, make_envelope
 
 logger = logging.getLogger(__name__)
 
+# How many sockets a broadcast writes to at once, and how long one socket may take before it's skipped.
+BROADCAST_CONCURRENCY = int(os.getenv("LLAMABOT_WS_BROADCAST_CONCURRENCY", "100"))
+BROADCAST_SEND_TIMEOUT_SECONDS = float(os.getenv("LLAMABOT_WS_BROADCAST_TIMEOUT", "2"))
+
+# Connections that opted in (hello features: ["heartbeat"]) and we haven't heard from for HEARTBEAT_INTERVAL get a
+# {"type": "ping"}; if nothing (e.g. a pong) comes back within PING_TIMEOUT after that, the connection is considered
+# dead and reaped. Other clients don't know the ping and may stay quiet for as long as they like: the server's
+# protocol-level ping/pong (uvicorn --ws-ping-interval / --ws-ping-timeout, answered by browsers on their own)
+# closes their dead sockets, and the heartbeat reaps them once closed. 0 disables the heartbeat.
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("LLAMABOT_WS_HEARTBEAT_INTERVAL", "20"))
+PING_TIMEOUT_SECONDS = float(os.getenv("LLAMABOT_WS_PING_TIMEOUT", "20"))
+# How long a reaped connection's handler gets to clean up after the close before it is cancelled.
+REAP_GRACE_SECONDS = 5
+
+
+@dataclass
+class ConnectionInfo:
+    websocket: WebSocket
+    tenant: Optional[str] = None # set by the client's hello, used to target broadcasts
+    thread_ids: Set[str] = field(default_factory=set) # threads this connection has run messages on
+    connected_at: float = field(default_factory=time.time)
+    last_seen: float = field(default_factory=time.monotonic) # last message received from the client
+    heartbeat: bool = False # the client answers app-level pings (opted in with its hello)
+    handler_task: Optional[asyncio.Task] = None # the task running this connection's WebSocketHandler
+
+
 class WebSocketConnectionManager:
     def __init__(self, app: FastAPI):
         self.app = app
-        self.active_connections: list[WebSocket] = []
-        self.active_tasks: set = set()
-        self._connection_ids: set = set()  # Track unique connections
+        self.connections: Dict[int, ConnectionInfo] = {} # keyed by id(websocket)
+        self._by_tenant: Dict[str, Set[int]] = {}
+        self._by_thread: Dict[str, Set[int]] = {}
+        self.active_tasks: set = set() # background tasks owned by the manager (the heartbeat), cancelled by cleanup()
+        self.reaped_total = 0
+        self.pubsub = InMemoryPubSub() # replaced by start_pubsub(); carries broadcasts to the other workers
+
+    @property
+    def active_connections(self) -> List[WebSocket]:
+        return [info.websocket for info in self.connections.values()]
 
     def _is_websocket_open(self, websocket: WebSocket) -> bool:
         """Check if the WebSocket connection is still open"""
         return websocket.client_state == WebSocketState.CONNECTED
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, tenant: Optional[str] = None):
         try:
             await websocket.accept()
-            connection_id = id(websocket)
-            if connection_id not in self._connection_ids:
-                self._connection_ids.add(connection_id)
-                self.active_connections.append(websocket)
-                logger.info(f"New connection added. Total connections: {len(self.active_connections)}")
-        except Exception as e: 
-            logging.info(f"Connect Exception in WebSocketConnectionManager: {e}")
+            self.register(websocket, tenant)
+        except Exception as e:
+            logger.info(f"Connect Exception in WebSocketConnectionManager: {e}")
+
+    def register(self, websocket: WebSocket, tenant: Optional[str] = None) -> ConnectionInfo:
+        """Track an (already accepted) websocket. Registering the same socket twice is a no-op."""
+        connection_id = id(websocket)
+        info = self.connections.get(connection_id)
+        if info is None:
+            info = ConnectionInfo(websocket)
+            self.connections[connection_id] = info
+            metrics.set_gauge("websocket.connections", len(self.connections))
+            logger.info(f"New connection added. Total connections: {len(self.connections)}")
+        if tenant is not None:
+            self.set_tenant(websocket, tenant)
+        return info
 
     def disconnect(self, websocket: WebSocket):
         try:
             connection_id = id(websocket)
-            if connection_id in self._connection_ids:
-                self._connection_ids.remove(connection_id)
-                self.active_connections.remove(websocket)
-                logger.info(f"Connection removed. Total connections: {len(self.active_connections)}")
-        except Exception as e: 
-            logging.info(f"Disconnect Exception in WebSocketConnectionManager: {e}")
+            info = self.connections.pop(connection_id, None)
+            if info is not None:
+                self._unindex(self._by_tenant, info.tenant, connection_id)
+                for thread_id in info.thread_ids:
+                    self._unindex(self._by_thread, thread_id, connection_id)
+                metrics.set_gauge("websocket.connections", len(self.connections))
+                logger.info(f"Connection removed. Total connections: {len(self.connections)}")
+        except Exception as e:
+            logger.info(f"Disconnect Exception in WebSocketConnectionManager: {e}")
+
+    def get_info(self, websocket: WebSocket) -> Optional[ConnectionInfo]:
+        return self.connections.get(id(websocket))
+
+    def touch(self, websocket: WebSocket):
+        """Record that we just heard from this client."""
+        info = self.connections.get(id(websocket))
+        if info is not None:
+            info.last_seen = time.monotonic()
+
+    def enable_heartbeat(self, websocket: WebSocket):
+        """The client said it answers {"type": "ping"}: from now on, its silence counts against it."""
+        info = self.connections.get(id(websocket))
+        if info is not None:
+            info.heartbeat = True
+            info.last_seen = time.monotonic()
+
+    def attach_handler(self, websocket: WebSocket, task: Optional[asyncio.Task]):
+        """Remember which task serves this connection, so the reaper can stop it."""
+        info = self.connections.get(id(websocket))
+        if info is not None:
+            info.handler_task = task
+
+    def set_tenant(self, websocket: WebSocket, tenant: Optional[str]):
+        connection_id = id(websocket)
+        info = self.connections.get(connection_id)
+        if info is None or info.tenant == tenant:
+            return
+        self._unindex(self._by_tenant, info.tenant, connection_id)
+        info.tenant = tenant
+        if tenant is not None:
+            self._by_tenant.setdefault(tenant, set()).add(connection_id)
+
+    def track_thread(self, websocket: WebSocket, thread_id: str):
+        connection_id = id(websocket)
+        info = self.connections.get(connection_id)
+        if info is None or thread_id in info.thread_ids:
+            return
+        info.thread_ids.add(thread_id)
+        self._by_thread.setdefault(thread_id, set()).add(connection_id)
+
+    def connections_for(self, tenant: Optional[str] = None, thread_id: Optional[str] = None) -> List[ConnectionInfo]:
+        """Connections matching every filter given (all connections if none is given)."""
+        connection_ids = None
+        if tenant is not None:
+            connection_ids = set(self._by_tenant.get(tenant, ()))
+        if thread_id is not None:
+            thread_connection_ids = self._by_thread.get(thread_id, set())
+            connection_ids = set(thread_connection_ids) if connection_ids is None else connection_ids & thread_connection_ids
+        if connection_ids is None:
+            return list(self.connections.values())
+        return [self.connections[connection_id] for connection_id in connection_ids if connection_id in self.connections]
+
+    @staticmethod
+    def _unindex(index: Dict[str, Set[int]], key: Optional[str], connection_id: int):
+        if key is None:
+            return
+        connection_ids = index.get(key)
+        if connection_ids is not None:
+            connection_ids.discard(connection_id)
+            if not connection_ids:
+                del index[key]
 
     async def send_personal_message(self, message: Union[str, dict], websocket: WebSocket):
         # Only send if WebSocket is still open
         if self._is_websocket_open(websocket):
             try:
                 if isinstance(message, dict):
-                    await websocket.send_json(message)
+                    await send_websocket_json(websocket, message)
                 else:
                     await websocket.send_text(message)
             except Exception as e:
                 logger.warning(f"Failed to send message to WebSocket: {e}")
 
-    async def broadcast(self, message: str):
-        # Create a copy of active connections to avoid modification during iteration
-        connections_to_send = self.active_connections.copy()
-        for connection in connections_to_send:
-            if self._is_websocket_open(connection):
+    async def start_pubsub(self, pubsub=None):
+        """Start receiving broadcasts published by other workers (see pubsub.py)."""
+        self.pubsub = pubsub or create_pubsub()
+        await self.pubsub.start(self.deliver)
+
+    async def stop_pubsub(self):
+        await self.pubsub.close()
+
+    async def deliver(self, envelope: dict):
+        """A broadcast published by another worker: send it to the matching sockets of this one."""
+        await self.broadcast_local(envelope.get("message"), envelope.get("tenant"), envelope.get("thread_id"))
+
+    async def broadcast(self, message: str, tenant: Optional[str] = None, thread_id: Optional[str] = None) -> int:
+        """
+        Send `message` to every connection (or only those of a tenant / thread) on every worker.
+        Returns how many sockets of this worker got the message.
+        """
+        await self.pubsub.publish(make_envelope(self.pubsub.origin, message, tenant, thread_id))
+        return await self.broadcast_local(message, tenant, thread_id)
+
+    async def broadcast_local(self, message: str, tenant: Optional[str] = None, thread_id: Optional[str] = None) -> int:
+        """
+        Send `message` to this worker's connections (or only those of a tenant / thread), a bounded number of
+        sockets at a time. A socket that errors or takes longer than the send timeout is dropped instead of
+        holding everyone else up. Returns how many sockets got the message.
+        """
+        # Snapshot the targets, so connects/disconnects during the broadcast don't matter.
+        targets = [info.websocket for info in self.connections_for(tenant, thread_id)]
+        payload = dumps({"message": message}) # encoded once for everybody
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        async def send(connection: WebSocket) -> bool:
+            if not self._is_websocket_open(connection):
+                return False
+            async with semaphore:
                 try:
-                    await connection.send_json({"message": message})
+                    await asyncio.wait_for(connection.send_text(payload), BROADCAST_SEND_TIMEOUT_SECONDS)
+                    return True
+                except asyncio.TimeoutError:
+                    logger.warning("Broadcast to WebSocket timed out, skipping it")
+                    metrics.increment("websocket.broadcast_timeouts")
+                    return False
                 except Exception as e:
                     logger.warning(f"Failed to broadcast message to WebSocket: {e}")
                     # Remove the connection if it's no longer valid
                     self.disconnect(connection)
+                    return False
+
+        started_at = time.monotonic()
+        results = await asyncio.gather(*(send(connection) for connection in targets))
+        metrics.observe("websocket.broadcast_seconds", time.monotonic() - started_at)
+        return sum(results)
+
+    def start_heartbeat(self):
+        """Start the background heartbeat/reaper task (once)."""
+        if HEARTBEAT_INTERVAL_SECONDS <= 0 or any(not task.done() for task in self.active_tasks):
+            return
+        task = asyncio.create_task(self._heartbeat_loop())
+        self.active_tasks.add(task)
+        task.add_done_callback(self.active_tasks.discard)
+        logger.info(f"💓 WebSocket heartbeat every {HEARTBEAT_INTERVAL_SECONDS}s, ping timeout {PING_TIMEOUT_SECONDS}s")
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.warning(f"WebSocket heartbeat failed: {e}")
+
+    async def heartbeat(self) -> int:
+        """One heartbeat round: ping quiet connections, reap dead ones. Returns how many were reaped."""
+        now = time.monotonic()
+        to_ping, to_reap = [], []
+        for info in list(self.connections.values()):
+            silent_for = now - info.last_seen
+            if not self._is_websocket_open(info.websocket):
+                to_reap.append(info)
+            elif not info.heartbeat:
+                continue # silence proves nothing for a client that doesn't know the ping
+            elif silent_for >= HEARTBEAT_INTERVAL_SECONDS + PING_TIMEOUT_SECONDS:
+                to_reap.append(info)
+            elif silent_for >= HEARTBEAT_INTERVAL_SECONDS:
+                to_ping.append(info)
+
+        ping_results = await asyncio.gather(*(self._ping(info) for info in to_ping))
+        to_reap.extend(info for info, delivered in zip(to_ping, ping_results) if not delivered)
+        await asyncio.gather(*(self.reap(info) for info in to_reap))
+
+        metrics.set_gauge("websocket.connections", len(self.connections))
+        if to_reap:
+            logger.info(f"💀 Reaped {len(to_reap)} dead WebSocket connection(s), {self.reaped_total} in total")
+        return len(to_reap)
+
+    async def _ping(self, info: ConnectionInfo) -> bool:
+        try:
+            await asyncio.wait_for(send_websocket_json(info.websocket, {"type": "ping"}), PING_TIMEOUT_SECONDS)
+            return True
+        except Exception as e:
+            logger.info(f"Failed to ping WebSocket: {e!r}")
+            return False
+
+    async def reap(self, info: ConnectionInfo):
+        """Close a dead connection and make sure its handler (and with it locks, runs and queues) gets cleaned up."""
+        self.reaped_total += 1
+        metrics.increment("websocket.reaped")
+        try:
+            await asyncio.wait_for(info.websocket.close(code=1001), REAP_GRACE_SECONDS)
+        except Exception as e:
+            logger.info(f"Failed to close dead WebSocket: {e!r}")
+        task = info.handler_task
+        if task is not None and not task.done() and task is not asyncio.current_task():
+            # The close normally ends the handler's receive loop; a half-open socket may need a push.
+            await asyncio.wait({task}, timeout=REAP_GRACE_SECONDS)
+            if not task.done():
+                task.cancel()
+                await asyncio.wait({task}, timeout=REAP_GRACE_SECONDS)
+        self.disconnect(info.websocket)
 
     def cleanup(self):
         # Cancel all active tasks
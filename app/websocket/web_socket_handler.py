@@ -6,14 +6,25 @@ import os
 import logging
 import time
 import json
+import uuid
+
+from typing import Dict, List, Optional, Tuple
 
 from pydantic import BaseModel
 
+from app.cancellation import cancel_run_task
 from app.websocket.web_socket_connection_manager import WebSocketConnectionManager
 from app.websocket.request_handler import RequestHandler
+from app.websocket.outbound_queue import OutboundQueue
+from app.websocket.resumable_runs import RunIdInUse, run_registry, task_outcome
+from app.websocket.frame_codec import get_frame_codec, negotiate_frame_encoding, supported_frame_encodings
+from app.websocket.stream_protocol import negotiate_protocol_version, SUPPORTED_PROTOCOL_VERSIONS
 
 logger = logging.getLogger(__name__)
 
+# Runs (running + waiting on their thread) a single connection may have before new messages are refused.
+MAX_PENDING_RUNS_PER_CONNECTION = int(os.getenv("LLAMABOT_WS_MAX_PENDING_RUNS", "16"))
+
 # Pydantic model for chat request
 class ChatMessage(dict):
     message: str
@@ -25,15 +36,90 @@ class WebSocketHandler:
         self.websocket = websocket
         self.manager = manager
         self.request_handler = RequestHandler(manager.app)
+        self.runs: Dict[str, Tuple[str, asyncio.Task]] = {} # run_id -> (thread_id, task)
+        self.outbound: Optional[OutboundQueue] = None
 
     def _is_websocket_open(self, websocket: WebSocket) -> bool:
         """Check if the WebSocket connection is still open"""
         return websocket.client_state == WebSocketState.CONNECTED
 
+    def _start_run(self, message: dict) -> str:
+        thread_id = f"{message.get('thread_id')}"
+        run_id = message.get("run_id") or str(uuid.uuid4())
+        # Registered before the task starts, so every frame of the run is logged for a possible resume.
+        tenant = self.request_handler.get_context(self.websocket).tenant
+        run = run_registry.create(run_id, thread_id, subscriber=self.outbound, tenant=tenant)
+        self.manager.track_thread(self.websocket, thread_id) # so thread-targeted broadcasts reach this connection
+        task = asyncio.create_task(self.request_handler.handle_request(message, self.websocket, run_id=run_id))
+        run.task = task
+        self.runs[run_id] = (thread_id, task)
+        task.add_done_callback(lambda finished_task: self._finish_run(run_id, finished_task))
+        return run_id
+
+    def _finish_run(self, run_id: str, task: asyncio.Task):
+        self.runs.pop(run_id, None)
+        run_registry.finish(run_id, task_outcome(task))
+        if not task.cancelled() and task.exception() is not None:
+            logger.info(f"Run {run_id} ended with an error: {task.exception()}") # already reported to the client
+
+    def _resume_run(self, run_id: Optional[str], last_seq, thread_id=None) -> bool:
+        """
+        Re-attach a run started on an earlier connection: replay what the client missed, then stream live.
+        The client must name the run's thread, and be on the same tenant; otherwise it's as if the run didn't exist.
+        """
+        run = run_registry.get(run_id)
+        if run is None or not run.belongs_to(thread_id, self.request_handler.get_context(self.websocket).tenant):
+            return False
+        replayed, gap = run.attach(self.outbound, int(last_seq or 0))
+        logger.info(f"RESUME run {run_id}: replayed {replayed} frame(s), status {run.status}")
+        # Queued right behind the replayed frames: from here on the client is live.
+        self.outbound.put({
+            "type": "resumed",
+            "run_id": run_id,
+            "thread_id": run.thread_id,
+            "status": run.status,
+            "replayed": replayed,
+            "gap": gap, # frames were evicted from the run's log: reload the thread's history to catch up
+            "last_seq": run.log.last_seq
+        })
+        if run.task is not None and not run.task.done():
+            self.runs[run_id] = (run.thread_id, run.task)
+            run.task.add_done_callback(lambda _: self.runs.pop(run_id, None))
+        return True
+
+    def _detach_runs(self) -> List[asyncio.Task]:
+        """Leave our runs running for their grace period; returns the ones that had to be cancelled right away."""
+        cancelled = []
+        for run_id, (thread_id, task) in list(self.runs.items()):
+            run = run_registry.get(run_id)
+            if run is None:
+                cancel_run_task(task, run_id, reason="disconnect")
+                cancelled.append(task)
+            elif run.detach(self.outbound):
+                cancelled.append(task)
+        return cancelled
+
+    def _cancel_runs(self, thread_id: Optional[str] = None, run_id: Optional[str] = None) -> List[asyncio.Task]:
+        """Cancel the matching runs (all of them if neither thread_id nor run_id is given)."""
+        cancelled = []
+        for candidate_run_id, (candidate_thread_id, task) in list(self.runs.items()):
+            if run_id is not None and candidate_run_id != run_id:
+                continue
+            if thread_id is not None and candidate_thread_id != f"{thread_id}":
+                continue
+            if cancel_run_task(task, candidate_run_id):
+                cancelled.append(task)
+        return cancelled
+
     async def handle_websocket(self):
         logger.info(f"New WebSocket connection attempt from {self.websocket.client}")
         await self.manager.connect(self.websocket)
-        current_task = None
+        self.manager.attach_handler(self.websocket, asyncio.current_task()) # lets the reaper stop us if the client vanishes
+        # Frames for this connection go through a bounded queue drained by its own writer task.
+        outbound = OutboundQueue(self.websocket)
+        self.outbound = outbound
+        self.request_handler.get_context(self.websocket).outbound = outbound
+        outbound.start()
         try:
             while True:
                 try:
@@ -43,6 +129,7 @@ class WebSocketHandler:
                     json_data = await self.websocket.receive_json()
 
                     receive_time = asyncio.get_event_loop().time()
+                    self.manager.touch(self.websocket)
                     
                     ### Warning: If LangGraph does await LLM calls appropriately, then this main thread can get blocked and will stop responding to pings from LlamaPress, ultimately killing the websocket connection.
                     logger.info(f"Message received after {receive_time - start_time:.2f}s")
@@ -56,33 +143,82 @@ class WebSocketHandler:
                         )
                         continue
                     
+                    if isinstance(json_data, dict) and json_data.get("type") == "pong":
+                        continue # answer to the server's heartbeat ping, already counted by touch() above
+
+                    if isinstance(json_data, dict) and json_data.get("type") == "hello":
+                        # Clients that understand the compact delta protocol (and/or binary MessagePack frames) say so here, before their first message.
+                        context = self.request_handler.get_context(self.websocket)
+                        context.protocol_version = negotiate_protocol_version(json_data.get("protocols", json_data.get("protocol")))
+                        encoding = negotiate_frame_encoding(json_data.get("encodings", json_data.get("encoding")))
+                        features = json_data.get("features") or []
+                        context.html_preview = "html_preview" in features
+                        if "heartbeat" in features:
+                            self.manager.enable_heartbeat(self.websocket)
+                        logger.info(f"HELLO RECV, using protocol version {context.protocol_version}, {encoding} frames")
+                        # The hello reply itself is always JSON text, so the client can read it before switching.
+                        await self.manager.send_personal_message({
+                            "type": "hello",
+                            "protocol": context.protocol_version,
+                            "protocols": list(SUPPORTED_PROTOCOL_VERSIONS),
+                            "encoding": encoding,
+                            "encodings": supported_frame_encodings(),
+                            "features": [feature for feature in ("html_preview", "heartbeat") if feature in features]
+                        }, self.websocket)
+                        if json_data.get("tenant"):
+                            self.manager.set_tenant(self.websocket, str(json_data["tenant"]))
+                            context.tenant = str(json_data["tenant"])
+                        context.codec = get_frame_codec(encoding)
+                        outbound.codec = context.codec
+                        continue
+
+                    if isinstance(json_data, dict) and json_data.get("type") == "resume":
+                        # A client that lost its socket mid-run picks up where it left off: {"type": "resume", "run_id": ..., "thread_id": ..., "last_seq": ...}
+                        if not self._resume_run(json_data.get("run_id"), json_data.get("last_seq"), json_data.get("thread_id")):
+                            await self.manager.send_personal_message({
+                                "type": "error",
+                                "content": "Run not found, it may have expired",
+                                "run_id": json_data.get("run_id")
+                            }, self.websocket)
+                        continue
+
                     if isinstance(json_data, dict) and json_data.get("type") == "cancel":
+                        # Cancels the runs of one thread (or one run) if given, otherwise everything on this connection.
                         logger.info("CANCEL RECV")
-                        if current_task and not current_task.done(): 
-                            current_task.cancel()
+                        if self._cancel_runs(json_data.get("thread_id"), json_data.get("run_id")):
                             # Only send if WebSocket is still open
                             if self._is_websocket_open(self.websocket):
                                 await self.manager.send_personal_message({
                                     "type": "system_message",
-                                    "content": "Previous task has been cancelled"
+                                    "content": "Previous task has been cancelled",
+                                    "thread_id": json_data.get("thread_id"),
+                                    "run_id": json_data.get("run_id")
                                 }, self.websocket)
                         continue
 
-                    # Cancel previous task if it exists and create new one
-                    if current_task and not current_task.done():
-                        logger.info("Cancelling previous task")
-                        current_task.cancel()
-                        try:
-                            await current_task
-                        except asyncio.CancelledError:
-                            logger.info("Previous task was cancelled successfully")
+                    if len(self.runs) >= MAX_PENDING_RUNS_PER_CONNECTION:
+                        logger.warning(f"Refusing message, {len(self.runs)} runs already pending on this connection")
+                        await self.manager.send_personal_message({
+                            "type": "error",
+                            "content": "Too many pending messages",
+                            "thread_id": json_data.get("thread_id") if isinstance(json_data, dict) else None
+                        }, self.websocket)
+                        continue
 
                     message = ChatMessage(**json_data)
 
                     logger.info(f"Received message: {message}")
-                    current_task = asyncio.create_task(
-                        self.request_handler.handle_request(message, self.websocket)
-                    )
+                    # Messages on different threads run concurrently; messages on the same thread queue up behind
+                    # each other (see RequestHandler.handle_request).
+                    try:
+                        self._start_run(message)
+                    except RunIdInUse as e:
+                        await self.manager.send_personal_message({
+                            "type": "error",
+                            "content": str(e),
+                            "thread_id": message.get("thread_id"),
+                            "run_id": message.get("run_id")
+                        }, self.websocket)
                 except WebSocketDisconnect as e:
                     if e.code == 1000:
                         logger.info(f"WebSocket connection closed gracefully by client: {e.reason}")
@@ -106,13 +242,12 @@ class WebSocketHandler:
                     "content": f"Error 253: {str(e)}"
                 }, self.websocket)
         finally:
-            if current_task and not current_task.done():
-                current_task.cancel()
-                try:
-                    logger.info("Cancelling current task")
-                    await current_task
-                except asyncio.CancelledError:
-                    logger.info("Current task was cancelled successfully")
-                    pass
+            # Runs keep going for a grace period, so a client that reconnects can resume them (see resumable_runs.py).
+            pending_tasks = self._detach_runs()
+            if pending_tasks:
+                logger.info(f"Cancelling {len(pending_tasks)} running task(s)")
+                await asyncio.gather(*pending_tasks, return_exceptions=True)
+                logger.info("Running tasks were cancelled successfully")
+            await outbound.close()
             self.manager.disconnect(self.websocket)
             self.request_handler.cleanup_connection(self.websocket)
\ No newline at end of file
@@ -1,9 +1,24 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Callable, Awaitable, Dict, Any, Optional
 from starlette.websockets import WebSocket
 from langgraph.checkpoint.base import BaseCheckpointSaver
+import asyncio
+import os
+
+from app.websocket.frame_codec import JsonFrameCodec
+from app.websocket.outbound_queue import OutboundQueue
+from app.websocket.stream_protocol import LEGACY_PROTOCOL_VERSION
+
+# How many runs (on different threads) may stream at once over a single websocket connection.
+MAX_CONCURRENT_RUNS_PER_CONNECTION = int(os.getenv("LLAMABOT_WS_MAX_CONCURRENT_RUNS", "4"))
 
 @dataclass
 class WebSocketRequestContext:
     websocket: WebSocket
-    langgraph_checkpointer: Optional[BaseCheckpointSaver] = None
\ No newline at end of file
+    langgraph_checkpointer: Optional[BaseCheckpointSaver] = None
+    protocol_version: int = LEGACY_PROTOCOL_VERSION # negotiated per connection, see stream_protocol.py
+    outbound: Optional[OutboundQueue] = None # bounded send queue + writer task, see outbound_queue.py
+    run_slots: asyncio.Semaphore = field(default_factory=lambda: asyncio.Semaphore(MAX_CONCURRENT_RUNS_PER_CONNECTION))
+    codec: Any = field(default_factory=JsonFrameCodec) # JSON text or MessagePack binary frames, see frame_codec.py
+    html_preview: bool = False # client asked for html_preview frames in its hello (html_preview.py)
+    tenant: Optional[str] = None # from the client's hello, counted against the per-tenant run cap (admission_scheduler.py)